@@ -2,6 +2,262 @@ import time
 
 MAX_RETRIES = 3
 
+# Node properties read by each launch function. Triggers that publish to
+# a launcher return only these properties instead of the whole node;
+# 'generation' and 'crc32c' are part of the input fingerprint. Triggers
+# with NODE_PROPERTIES = None still return whole nodes. Trigger conditions
+# are always checked against the whole node of the query result that
+# activated check-triggers, not against these projections.
+FASTQ_TO_UBAM_PROPERTIES = ['id', 'labels', 'plate', 'sample', 'bucket', 'path', 'readGroup', 'matePair', 'size', 'generation', 'crc32c']
+GATK_5_DOLLAR_PROPERTIES = ['id', 'labels', 'plate', 'sample', 'bucket', 'path', 'size', 'generation', 'crc32c']
+BAM_FASTQC_PROPERTIES = ['id', 'labels', 'plate', 'sample', 'bucket', 'path', 'basename', 'size', 'generation', 'crc32c']
+FLAGSTAT_PROPERTIES = ['id', 'labels', 'plate', 'sample', 'bucket', 'path', 'basename', 'size', 'generation', 'crc32c']
+VCFSTATS_PROPERTIES = ['id', 'labels', 'plate', 'sample', 'bucket', 'path', 'basename', 'size', 'generation', 'crc32c']
+TEXT_TO_TABLE_PROPERTIES = ['id', 'labels', 'plate', 'sample', 'bucket', 'path', 'basename', 'chromosome', 'size', 'generation', 'crc32c']
+# Fastq properties read by blob-update-storage-class
+STORAGE_CLASS_PROPERTIES = ['bucket', 'path', 'extension', 'storageClass']
+
+
+def project_node(variable, properties):
+    """Format a Cypher map projection of the listed node properties."""
+    fields = ", ".join(f".{name}" for name in properties)
+    return f"{variable} {{{fields}}}"
+
+
+def project_nodes(variable, properties):
+    """Format a Cypher map projection of each node in a list."""
+    return f"[inputNode IN {variable} | {project_node('inputNode', properties)}]"
+
+
+def cromwell_lineage_batched(env_vars):
+    """Whether Cromwell lineage is written by build-cromwell-lineage
+    or ingest-cromwell-metadata instead of the RelateCromwell* triggers.
+    """
+    return bool(
+                env_vars.get('TOPIC_CROMWELL_LINEAGE')
+                or env_vars.get('TOPIC_CROMWELL_METADATA'))
+
+
+class WorkflowGate:
+    """Launch a workflow once all of its inputs for a group are present.
+
+    Gate state is kept on a (:SampleReadiness) node for each workflow
+    and group of inputs (e.g. sample): the number of inputs expected,
+    the members (e.g. read groups) that have arrived and the ids of
+    their nodes, and whether a job request has been created. Queries
+    take the readiness node's write lock before reading it, so that
+    concurrent arrivals are counted one at a time and only one of them
+    launches the workflow.
+
+    Args:
+        workflow (str): Job request name, e.g. "gatk-5-dollar".
+        request_labels (list): Labels of job request nodes.
+        input_labels (list): Labels of input nodes.
+        group_key (str): Input property shared by a set of inputs.
+        member_key (str): Input property that distinguishes the inputs
+                          in a set; duplicates of a member are not counted.
+        count_labels (list): Labels of the node, with the same group_key,
+                             that has the expected number of inputs.
+        count_property (str): Property with the expected number.
+        count_divisor (int): Count property value per input.
+    """
+
+    def __init__(self, workflow, request_labels, input_labels, group_key, member_key,
+                 count_labels, count_property, count_divisor=1):
+        self.workflow = workflow
+        self.request_labels = ':'.join(request_labels)
+        self.input_labels = ':'.join(input_labels)
+        self.group_key = group_key
+        self.member_key = member_key
+        self.count_labels = ':'.join(count_labels)
+        self.count_property = count_property
+        self.count_divisor = count_divisor
+
+
+    def _merge_readiness(self, readiness_id, group):
+        """Merge the group's readiness node as "r" and lock it.
+
+        Args:
+            readiness_id (str): Cypher expression for the readiness id,
+                                "{workflow}:{group}".
+            group (str): Cypher expression for the group key value.
+        """
+        return (
+                f"MERGE (r:SampleReadiness {{readinessId: {readiness_id}}}) " +
+                f"ON CREATE SET r.{self.group_key} = {group}, " +
+                    f"r.workflow = \"{self.workflow}\", " +
+                    "r.members = [], " +
+                    "r.inputIds = [], " +
+                    "r.launched = false, " +
+                    "r.nodeCreated = datetime(), " +
+                    "r.nodeCreatedEpoch = datetime().epochSeconds " +
+                # Take the write lock before reading gate state; it is
+                # held until the transaction commits
+                "SET r._lock = true ")
+
+
+    def _expected_count(self, carried):
+        """Look up the expected number of inputs, if it isn't known."""
+        return (
+                f"OPTIONAL MATCH (source:{self.count_labels} {{{self.group_key}: r.{self.group_key}}}) " +
+                "WHERE r.expected IS NULL " +
+                f"WITH {carried}, head(COLLECT(source.{self.count_property})) / {self.count_divisor} AS expected " +
+                "SET r.expected = coalesce(r.expected, expected)")
+
+
+    def _launch(self, event_id, node_properties, first_request=True):
+        """Create a job request for each readiness node "r" and return its inputs.
+
+        Args:
+            first_request (bool): Skip groups that already have a job
+                                  request, e.g. from before readiness
+                                  nodes were added.
+        """
+        query = "WITH r "
+        if first_request:
+            query += (
+                      f"OPTIONAL MATCH (previous:JobRequest {{{self.group_key}: r.{self.group_key}, " +
+                        f"name: \"{self.workflow}\"}}) " +
+                      "WITH r, COUNT(previous) AS previousRequests " +
+                      "WHERE previousRequests = 0 ")
+        query += (
+                  f"MATCH (input:{self.input_labels}) " +
+                  "WHERE input.id IN r.inputIds " +
+                  "WITH r, COLLECT(DISTINCT input) AS inputs " +
+                  # Create a job request, link the input nodes to the
+                  # request node, and return the input nodes so they
+                  # can be passed to the job launching function
+                  f"CREATE (jobRequest:{self.request_labels} {{" +
+                    f"{self.group_key}: r.{self.group_key}, " +
+                    "nodeCreated: datetime(), " +
+                    "nodeCreatedEpoch: datetime().epochSeconds, " +
+                    f"name: \"{self.workflow}\", " +
+                    f"eventId: {event_id} }}) " +
+                  "WITH inputs, jobRequest " +
+                  "UNWIND inputs AS input " +
+                  "MERGE (input)-[:WAS_USED_BY]->(jobRequest) " +
+                  # One result row per job request
+                  "WITH jobRequest, COLLECT(input) AS inputs " +
+                  f"RETURN {project_nodes('inputs', node_properties)} AS nodes, " +
+                         "jobRequest.eventId AS requestEventId")
+        return query
+
+
+    def arrival_query(self, input_id, group, event_id, node_properties, launch=True):
+        """Count an input towards its group and launch when all have arrived.
+
+        Args:
+            input_id (str): Id of the input node that arrived.
+            group (str): Group key value of the input node.
+            launch (bool): Create a job request if the group is ready;
+                           otherwise only record the arrival.
+        """
+        query = (
+                 f"MATCH (n:{self.input_labels} {{id: \"{input_id}\"}}) " +
+                 self._merge_readiness(f"\"{self.workflow}:{group}\"", f"\"{group}\"") +
+                 f"WITH r, n, NOT n.{self.member_key} IN r.members AS isNew " +
+                 self._expected_count("r, n, isNew") +
+                 f", r.members = CASE WHEN isNew THEN r.members + n.{self.member_key} ELSE r.members END" +
+                 ", r.inputIds = CASE WHEN isNew THEN r.inputIds + n.id ELSE r.inputIds END " +
+                 "REMOVE r._lock ")
+        if not launch:
+            return query
+        query += (
+                  # Only the arrival that completes the set launches
+                  "WITH r " +
+                  "WHERE NOT r.launched " +
+                    "AND size(r.members) = r.expected " +
+                  "SET r.launched = true " +
+                  self._launch(event_id, node_properties))
+        return query
+
+
+    def ready_query(self, event_id, limit_count, node_properties):
+        """Launch up to "limit_count" groups that are ready but weren't launched."""
+        query = (
+                 "MATCH (r:SampleReadiness {" +
+                    f"workflow: \"{self.workflow}\", " +
+                    "launched: false}) " +
+                 "WHERE size(r.members) = r.expected " +
+                 f"WITH r LIMIT {limit_count} " +
+                 "SET r._lock = true " +
+                 # Re-check under the lock, in case an arrival launched it
+                 "WITH r " +
+                 "WHERE NOT r.launched " +
+                 "SET r.launched = true " +
+                 "REMOVE r._lock " +
+                 self._launch(event_id, node_properties))
+        return query
+
+
+    def relaunch_query(self, groups, event_id, node_properties):
+        """Create new job requests for groups selected by another query.
+
+        Args:
+            groups (str): Cypher clauses that end by returning group
+                          key values as "group" (e.g. "WITH ... AS group").
+        """
+        query = (
+                 groups +
+                 "MATCH (r:SampleReadiness) " +
+                 f"WHERE r.readinessId = \"{self.workflow}:\" + group " +
+                    "AND size(r.members) = r.expected " +
+                 "SET r.launched = true " +
+                 self._launch(event_id, node_properties, first_request=False))
+        return query
+
+
+    def backfill_query(self, limit_count):
+        """Create readiness nodes for groups with inputs from before gating.
+
+        Groups with an existing job request are marked as launched.
+        """
+        query = (
+                 f"MATCH (n:{self.input_labels}) " +
+                 f"WITH DISTINCT n.{self.group_key} AS group " +
+                 "OPTIONAL MATCH (existing:SampleReadiness) " +
+                 f"WHERE existing.readinessId = \"{self.workflow}:\" + group " +
+                 "WITH group, existing " +
+                 "WHERE existing IS NULL " +
+                 f"WITH group LIMIT {limit_count} " +
+                 f"MATCH (n:{self.input_labels} {{{self.group_key}: group}}) " +
+                 f"WHERE n.{self.member_key} IS NOT NULL " +
+                 f"WITH group, n.{self.member_key} AS member, head(COLLECT(n.id)) AS inputId " +
+                 "WITH group, COLLECT(member) AS members, COLLECT(inputId) AS inputIds " +
+                 f"OPTIONAL MATCH (previous:JobRequest {{{self.group_key}: group, name: \"{self.workflow}\"}}) " +
+                 "WITH group, " +
+                    f"\"{self.workflow}:\" + group AS readinessId, " +
+                    "members, " +
+                    "inputIds, " +
+                    "COUNT(previous) > 0 AS launched " +
+                 self._merge_readiness("readinessId", "group") +
+                 # Merge with inputs that arrived since the groups were selected
+                 "WITH r, launched, members, inputIds, " +
+                    "[i IN range(0, size(members) - 1) WHERE NOT members[i] IN r.members] AS newMembers " +
+                 "SET r.launched = r.launched OR launched, " +
+                    "r.members = r.members + [i IN newMembers | members[i]], " +
+                    "r.inputIds = r.inputIds + [i IN newMembers | inputIds[i]] " +
+                 "WITH r " +
+                 self._expected_count("r") +
+                 " REMOVE r._lock " +
+                 "RETURN COUNT(r) AS readinessNodes")
+        return query
+
+
+# Paired-end sequencing generates (2) fastqs per read group
+GATK_5_DOLLAR_GATE = WorkflowGate(
+                                  workflow = "gatk-5-dollar",
+                                  request_labels = ["JobRequest", "Gatk5Dollar"],
+                                  input_labels = ["Blob", "Ubam"],
+                                  group_key = "sample",
+                                  member_key = "readGroup",
+                                  count_labels = ["Blob", "Checksum"],
+                                  count_property = "fastqCount",
+                                  count_divisor = 2)
+
+WORKFLOW_GATES = {gate.workflow: gate for gate in [GATK_5_DOLLAR_GATE]}
+
+
 class RequestUserPermissionsToDataset: 
     """ Connect a (:ServiceAccount) node to a (:Dataset) node.
 
@@ -178,6 +434,105 @@ class RequestFastqToUbam:
         return query
 
 
+class RequestBulkFastqToUbam:
+    """Launch FastqToUbam jobs for many genomes in a single request.
+
+    Bulk version of RequestFastqToUbam. Instead of sending each
+    Fastq back through check-triggers and LaunchFastqToUbam, one
+    query creates a job request for every unprocessed read group of
+    up to "limitCount" sequencing deliveries and sends all of the
+    Fastq pairs to the launcher in a single message.
+    """
+
+    NODE_PROPERTIES = FASTQ_TO_UBAM_PROPERTIES
+
+    def __init__(self, function_name, env_vars):
+
+        self.function_name = function_name
+        self.env_vars = env_vars
+
+
+    def check_conditions(self, header, body, node):
+
+        reqd_header_labels = ['Request', 'FastqToUbam', 'Bulk']
+
+        conditions = [
+            set(reqd_header_labels).issubset(set(header.get('labels'))),
+            body.get("limitCount"),
+        ]
+
+        for condition in conditions:
+            if condition:
+                continue
+            else:
+                return False
+        return True
+
+
+    def compose_message(self, header, body, node, context):
+        topic = self.env_vars['DB_QUERY_TOPIC']
+
+        event_id = context.event_id
+        seed_id = context.event_id
+        limit_count = body["limitCount"]
+
+        query = self._create_query(event_id, limit_count)
+
+        message = {
+                   "header": {
+                              "resource": "query",
+                              "method": "VIEW",
+                              "labels": ["Cypher", "Query", "Fastq", "Nodes", "Bulk"],
+                              "sentFrom": self.function_name,
+                              "trigger": "RequestBulkFastqToUbam",
+                              "publishTo": self.env_vars['TOPIC_FASTQ_TO_UBAM'],
+                              "seedId": seed_id,
+                              "previousEventId": event_id,
+                   },
+                   "body": {
+                            "cypher": query,
+                            "result-mode": "data",
+                            "result-structure": "list",
+                            # Send all job specs to the launcher in one message
+                            "result-split": "False"
+                   }
+        }
+        return([(topic, message)])
+
+
+    def _create_query(self, event_id, limit_count):
+        query = (
+                 "MATCH (p:PersonalisSequencing)-[]->(f:Fastq) " +
+                 "WHERE NOT (f)-[:WAS_USED_BY]->(:JobRequest:FastqToUbam) " +
+                 f"WITH DISTINCT p LIMIT {limit_count} " +
+                 "MATCH (p)-[:GENERATED]->(n:Fastq) " +
+                 "WHERE NOT (n)-[:WAS_USED_BY]->(:JobRequest:FastqToUbam) " +
+                 "WITH n.sample AS sample, " +
+                      "n.readGroup AS readGroup, " +
+                      "n.matePair AS matePair, " +
+                      "COLLECT(n) AS matePairNodes " +
+                 # In the case of duplicate Fastqs, only use one from
+                 #  each sequencing mate pair.
+                 "WITH sample, " +
+                      "readGroup, " +
+                      "COLLECT(head(matePairNodes)) AS uniqueMatePairs " +
+                 "WHERE size(uniqueMatePairs) = 2 " +
+                 "CREATE (j:JobRequest:FastqToUbam { " +
+                            "sample:sample, " +
+                            "nodeCreated: datetime(), " +
+                            "nodeCreatedEpoch: datetime().epochSeconds, " +
+                            "name: \"fastq-to-ubam\", " +
+                            f"eventId: {event_id} }}) " +
+                 "WITH uniqueMatePairs, j " +
+                 "UNWIND uniqueMatePairs AS uniqueMatePair " +
+                 "MERGE (uniqueMatePair)-[:WAS_USED_BY]->(j) " +
+                 # One result row per job
+                 "WITH j, COLLECT(uniqueMatePair) AS nodes " +
+                 f"RETURN {project_nodes('nodes', self.NODE_PROPERTIES)} AS nodes, " +
+                        "j.eventId AS requestEventId")
+        return query
+
+
 class RequestFastqToUbamCovid19:
     """ Initiate variant calling for Covid19 genomes.
 
@@ -259,11 +614,9 @@ class RequestFastqToUbamCovid19:
 class RequestLaunchGatk5Dollar:
     """Trigger for launching GATK $5 Cromwell workflow.
 
-    Check whether all ubams for a sample are present, and
-    that they haven't already been input to a $5 workflow.
-
-    If so, send all ubam nodes metadata to the gatk-5-dollar
-    pub/sub topic.
+    Find samples whose ubams are all present but haven't been
+    input to a $5 workflow, and send one ubam of each back to
+    check-triggers to activate LaunchGatk5Dollar.
     """
 
     def __init__(self, function_name, env_vars):
@@ -325,20 +678,85 @@ class RequestLaunchGatk5Dollar:
 
 
     def _create_query(self, limit_count):
-        # TODO: How do I implement the LIMIT logic here.
-        ## I want to limit the number of genomes, not ubams
-        ## SOLUTION: limit query to finding RG1
+        # Limit on genomes by sending one ubam per sample
         query = (
-                 "MATCH (s:PersonalisSequencing)" +
-                 "-[:GENERATED]->(:Fastq)" +
-                 "-[:WAS_USED_BY]->(:Job)" +
-                 "-[:GENERATED]->(n:Ubam {readGroup:1}) " +
-                 "WHERE NOT (s)-[*4]->(:JobRequest:Gatk5Dollar) " +
-                 "RETURN DISTINCT n AS node " +
-                 f"LIMIT {limit_count}")
+                 "MATCH (r:SampleReadiness {" +
+                    f"workflow: \"{GATK_5_DOLLAR_GATE.workflow}\", " +
+                    "launched: false}) " +
+                 "WHERE size(r.members) = r.expected " +
+                 f"WITH r LIMIT {limit_count} " +
+                 "MATCH (n:Blob:Ubam {id: head(r.inputIds)}) " +
+                 "RETURN DISTINCT n AS node")
         return query
 
 
+class RequestBulkLaunchGatk5Dollar:
+    """Launch GATK $5 Cromwell workflows for many genomes in a single request.
+
+    Bulk version of RequestLaunchGatk5Dollar. One query finds up to
+    "limitCount" samples whose GATK $5 workflow gate is ready but
+    wasn't launched, creates their job requests, and sends every set
+    of ubams to the gatk-5-dollar function in a single message.
+    """
+
+    NODE_PROPERTIES = GATK_5_DOLLAR_PROPERTIES
+
+    def __init__(self, function_name, env_vars):
+        self.function_name = function_name
+        self.env_vars = env_vars
+
+
+    def check_conditions(self, header, body, node):
+        reqd_header_labels = ['Request', 'LaunchGatk5Dollar', 'Bulk']
+
+        conditions = [
+            set(reqd_header_labels).issubset(set(header.get('labels'))),
+            body.get("limitCount"),
+        ]
+
+        for condition in conditions:
+            if condition:
+                continue
+            else:
+                return False
+        return True
+
+
+    def compose_message(self, header, body, node, context):
+        topic = self.env_vars['DB_QUERY_TOPIC']
+
+        event_id = context.event_id
+        seed_id = context.event_id
+        limit_count = body["limitCount"]
+
+        query = self._create_query(event_id, limit_count)
+
+        message = {
+                   "header": {
+                              "resource": "query",
+                              "method": "VIEW",
+                              "labels": ["Cypher", "Query", "Ubam", "GATK", "Nodes", "Bulk"],
+                              "sentFrom": self.function_name,
+                              "trigger": "RequestBulkLaunchGatk5Dollar",
+                              "publishTo": self.env_vars['TOPIC_GATK_5_DOLLAR'],
+                              "seedId": seed_id,
+                              "previousEventId": event_id,
+                   },
+                   "body": {
+                            "cypher": query,
+                            "result-mode": "data", 
+                            "result-structure": "list",
+                            # Send all job specs to the launcher in one message
+                            "result-split": "False",
+                   }
+        }
+        return([(topic, message)])
+
+
+    def _create_query(self, event_id, limit_count):
+        return GATK_5_DOLLAR_GATE.ready_query(event_id, limit_count, self.NODE_PROPERTIES)
+
+
 class RequestLaunchFailedGatk5Dollar:
     """Trigger re-launching $5 GATK workflows that have failed.
 
@@ -348,6 +766,8 @@ class RequestLaunchFailedGatk5Dollar:
     pub/sub topic.
     """
 
+    NODE_PROPERTIES = GATK_5_DOLLAR_PROPERTIES
+
     def __init__(self, function_name, env_vars):
         self.function_name = function_name
         self.env_vars = env_vars
@@ -405,58 +825,24 @@ class RequestLaunchFailedGatk5Dollar:
         Update notes:
             v0.5.5: To reduce duplicate GATK $5 jobs caused by duplicate ubam objects,
                     check that sample is not related to an existing GATK $5 workflow. 
+            Ubams are read from the sample's readiness node (see WorkflowGate)
+            instead of being matched and grouped by read group.
         """
-
-        query = (
-                 # Match GATK workflows that are stopped 
-                 "MATCH (w:Gatk5Dollar:CromwellWorkflow) " +
-                 # Group workflows by samples
-                 "WITH w.sample AS sampleName, COLLECT(w) AS jobs, COLLECT(w.status) AS statuses " +
-                 # Filter out any samples with running workflows
-                 "WHERE NOT \"RUNNING\" in statuses " +
-                 "UNWIND jobs AS w " +
-                 "WITH sampleName, w " +
-                 "MATCH (w)-[:STATUS]->(d:Dstat) " +
-                 "WITH sampleName, COLLECT(d.status) AS statuses " +
-                 # Select samples where none of the workflows have succeeded
-                 "WHERE NOT \"SUCCESS\" IN statuses " +
-                 "MATCH (s:PersonalisSequencing {sample:sampleName})" +  
-                    "-[:GENERATED]->(:Fastq)" +                        
-                    "-[:WAS_USED_BY]->(:Job)" +                      
-                    "-[:GENERATED]->(n:Ubam), " +
-                 "(s)-[:GENERATED]->(c:Checksum) " +
-                 "WITH s.sample AS sample, " +
-                   "c.fastqCount AS fastqSetSize " +                 
-                   "n.readGroup AS readGroup, " +         
-                   "COLLECT(DISTINCT n) AS allNodes " +
-                 # Ignore duplicate nodes
-                 "WITH fastqSetSize, head(allNodes) AS heads " +
-                 "UNWIND [heads] AS uniqueNodes " +
-                 "WITH uniqueNodes.sample AS sample, " +
-                      "fastqSetSize, " +
-                      "COLLECT(uniqueNodes) AS sampleNodes " +
-                 "WHERE size(sampleNodes) = fastqSetSize/2 " +
-                 # Create job request nodes
-                 "CREATE (j:JobRequest:Gatk5Dollar {" +
-                            "sample: sample, " +
-                            "nodeCreated: datetime(), " +
-                            "nodeCreatedEpoch: " +
-                                "datetime().epochSeconds, " +
-                            "name: \"gatk-5-dollar\", " +
-                            f"eventId: {event_id} }}) " +
-                 "WITH sampleNodes, " +
-                      "sample, " +
-                      "j.eventId AS eventId, " +
-                      "j.nodeCreatedEpoch AS epochTime " +
-                 "UNWIND sampleNodes AS sampleNode " +
-                 # Merge ubam nodes to job request node
-                 "MATCH (jobReq:JobRequest:Gatk5Dollar {" +
-                            "sample: sample, " +
-                            "eventId: eventId}) " +
-                 "MERGE (sampleNode)-[:WAS_USED_BY]->(jobReq) " +
-                 "RETURN DISTINCT(sampleNodes) AS nodes " +
-                 "LIMIT 25")
-        return query
+        groups = (
+                  # Match GATK workflows that are stopped 
+                  "MATCH (w:Gatk5Dollar:CromwellWorkflow) " +
+                  # Group workflows by samples
+                  "WITH w.sample AS sampleName, COLLECT(w) AS jobs, COLLECT(w.status) AS statuses " +
+                  # Filter out any samples with running workflows
+                  "WHERE NOT \"RUNNING\" in statuses " +
+                  "UNWIND jobs AS w " +
+                  "WITH sampleName, w " +
+                  "MATCH (w)-[:STATUS]->(d:Dstat) " +
+                  "WITH sampleName, COLLECT(d.status) AS statuses " +
+                  # Select samples where none of the workflows have succeeded
+                  "WHERE NOT \"SUCCESS\" IN statuses " +
+                  "WITH sampleName AS group LIMIT 25 ")
+        return GATK_5_DOLLAR_GATE.relaunch_query(groups, event_id, self.NODE_PROPERTIES)
 
 
 class RequestGatk5DollarNoJob:
@@ -468,6 +854,8 @@ class RequestGatk5DollarNoJob:
     pub/sub topic.
     """
 
+    NODE_PROPERTIES = GATK_5_DOLLAR_PROPERTIES
+
     def __init__(self, function_name, env_vars):
         self.function_name = function_name
         self.env_vars = env_vars
@@ -523,67 +911,99 @@ class RequestGatk5DollarNoJob:
         """Check if all ubams for a sample are in the database & send to GATK $5 function.
 
         Description of query, by line:
-            (1-2)   Find all ubams associated with this ubams sample.
-            (3,8)   Check that there is not an existing GATK $5 workflow for this sample.
-            (4-7)   Collect all ubams by sample/read group.
-            (9-10)  In case there are duplicate ubams, only get the first node of each 
-                    group of unique sample/read group ubams.
-            (11-13) Group all the ubams with the same sample and setSize, where setSize
-                    indicates how many ubams should be present for this sample.
-            (14)    Check that the count of bams with unique read groups matches the 
-                    expected number of bams.
-            (15)    Return number of ubam nodes.
+            (1-2)   Find samples with a $5 GATK job request & no job.
+            (3-6)   Get the status of every $5 GATK job of each sample.
+            (7)     Don't launch a job if another is currently running
+                    or has succeeded.
+            (8)     Send the sample's ubams, from its readiness node, to
+                    launch-gatk-5-dollar.
 
         Update notes:
             v0.5.5: To reduce duplicate GATK $5 jobs caused by duplicate ubam objects,
                     check that sample is not related to an existing GATK $5 workflow. 
+            Replaced variable-length paths from the sequencing node with
+            lookups of the sample's job requests, and read ubams from the
+            sample's readiness node (see WorkflowGate).
         """
-        query = (
-                 f"MATCH (s:PersonalisSequencing)" +
-                    "-[:GENERATED]->(:Fastq)" +
-                    "-[:WAS_USED_BY]->(:Job)" +
-                    "-[:GENERATED]->(n:Ubam)" +
-                    "-[:WAS_USED_BY]->(jobRequest:JobRequest:Gatk5Dollar), " +
-                 "(s)-[:GENERATED]->(check:Checksum) "
-                 # Find samples with a $5 GATK job request & no job
-                 "WHERE NOT (jobRequest)-[:TRIGGERED]->(:Job:Gatk5Dollar) "
-                 # Don't launch job is another is currently running
-                 "AND NOT (s)-[*4]->(:JobRequest:Gatk5Dollar)" + #5
-                    "-[:TRIGGERED]->(:Job:Gatk5Dollar {status:\"RUNNING\"}) " +
-                 # Don't launch job if another has succeeded
-                 "AND NOT (s)-[*4]->(:JobRequest:Gatk5Dollar)" + #5
-                    "-[:TRIGGERED]->(:Job:Gatk5Dollar {status:\"STOPPED\"})" +
-                    "-[:STATUS]->(:Dstat {status:\"SUCCESS\"}) " +
-                 # Create JobRequest node
-                 "WITH s.sample AS sample, " +
-                       "s.fastqCount AS fastqSetSize, " +
-                       "n.readGroup AS readGroup, " +
-                       "COLLECT(DISTINCT n) AS allNodes " +
-                 "WITH fastqSetSize, head(allNodes) AS heads " +
-                 "UNWIND [heads] AS uniqueNodes " +
-                 "WITH uniqueNodes.sample AS sample, " +
-                      "fastqSetSize, " +
-                      "COLLECT(uniqueNodes) AS sampleNodes " +
-                 "WHERE size(sampleNodes) = fastqSetSize/2 " +
-                 "CREATE (j:JobRequest:Gatk5Dollar {" +
-                            "sample: sample, " +
-                            "nodeCreated: datetime(), " +
-                            "nodeCreatedEpoch: " +
-                                "datetime().epochSeconds, " +
-                            "name: \"gatk-5-dollar\", " +
-                            f"eventId: {event_id} }}) " +
-                 # Send nodes to launch-gatk-5-dollar
-                 "WITH sampleNodes, " +
-                      "sample, " +
-                      "j.eventId AS eventId, " +
-                      "j.nodeCreatedEpoch AS epochTime " +
-                 "UNWIND sampleNodes AS sampleNode " +
-                 "MATCH (jobReq:JobRequest:Gatk5Dollar {" +
-                            "sample: sample, " +
-                            "eventId: eventId}) " +
-                 "MERGE (sampleNode)-[:WAS_USED_BY]->(jobReq) " +
-                 "RETURN DISTINCT(sampleNodes) AS nodes")
-        return query
+        groups = (
+                  f"MATCH (jobRequest:JobRequest:Gatk5Dollar {{name: \"{GATK_5_DOLLAR_GATE.workflow}\"}}) " +
+                  "WHERE NOT (jobRequest)-[:TRIGGERED]->(:Job:Gatk5Dollar) " +
+                  "WITH DISTINCT jobRequest.sample AS sample " +
+                  "MATCH (request:JobRequest {" +
+                    "sample: sample, " +
+                    f"name: \"{GATK_5_DOLLAR_GATE.workflow}\"}}) " +
+                  "OPTIONAL MATCH (request)-[:TRIGGERED]->(job:Job:Gatk5Dollar) " +
+                  "OPTIONAL MATCH (job)-[:STATUS]->(dstat:Dstat) " +
+                  "WITH sample, COLLECT(job.status) AS statuses, COLLECT(dstat.status) AS results " +
+                  "WHERE NOT \"RUNNING\" IN statuses " +
+                    "AND NOT \"SUCCESS\" IN results " +
+                  "WITH sample AS group ")
+        return GATK_5_DOLLAR_GATE.relaunch_query(groups, event_id, self.NODE_PROPERTIES)
+
+
+class RequestBackfillWorkflowGate:
+    """Create workflow gate readiness nodes for existing inputs.
+
+    Groups of inputs that were created before the workflow was gated
+    have no readiness node, so they can't be found by ready or relaunch
+    queries. Samples that already have a job request are marked as
+    launched.
+    """
+
+    def __init__(self, function_name, env_vars):
+        self.function_name = function_name
+        self.env_vars = env_vars
+
+
+    def check_conditions(self, header, body, node):
+        reqd_header_labels = ['Request', 'Backfill', 'WorkflowGate']
+
+        conditions = [
+            set(reqd_header_labels).issubset(set(header.get('labels'))),
+            body.get("workflow") in WORKFLOW_GATES,
+            body.get("limitCount"),
+        ]
+
+        for condition in conditions:
+            if condition:
+                continue
+            else:
+                return False
+        return True
+
+
+    def compose_message(self, header, body, node, context):
+        topic = self.env_vars['DB_QUERY_TOPIC']
+
+        event_id = context.event_id
+        seed_id = context.event_id
+        gate = WORKFLOW_GATES[body["workflow"]]
+        limit_count = body["limitCount"]
+
+        query = self._create_query(gate, limit_count)
+
+        message = {
+                   "header": {
+                              "resource": "query",
+                              "method": "UPDATE",
+                              "labels": ["Backfill", "WorkflowGate", "Cypher", "Query"],
+                              "sentFrom": self.function_name,
+                              "trigger": "RequestBackfillWorkflowGate",
+                              "seedId": seed_id,
+                              "previousEventId": event_id,
+                   },
+                   "body": {
+                            "cypher": query,
+                            "result-mode": "data",
+                            "result-structure": "list",
+                            "result-split": "False",
+                   }
+        }
+        return([(topic, message)])
+
+
+    def _create_query(self, gate, limit_count):
+        return gate.backfill_query(limit_count)
 
 
 class LaunchGatk5Dollar:
@@ -591,13 +1011,17 @@ class LaunchGatk5Dollar:
 
     It's activated by relationships, not nodes.
 
-    Check whether all ubams for a sample are present, and
-    that they haven't already been input to a $5 workflow.
+    Count the ubam towards the GATK $5 workflow gate of its sample,
+    and when ubams for all read groups have arrived, and the sample
+    hasn't already been input to a $5 workflow, send all ubam nodes
+    metadata to the gatk-5-dollar pub/sub topic.
 
-    If so, send all ubam nodes metadata to the gatk-5-dollar
-    pub/sub topic.
+    Arrivals are counted even if variant calling is switched off, so
+    that ready samples can be launched later by RequestBulkLaunchGatk5Dollar.
     """
 
+    NODE_PROPERTIES = GATK_5_DOLLAR_PROPERTIES
+
     def __init__(self, function_name, env_vars):
         self.function_name = function_name
         self.env_vars = env_vars
@@ -615,11 +1039,7 @@ class LaunchGatk5Dollar:
         conditions = [
             set(reqd_header_labels).issubset(set(header.get('labels'))),
             set(required_labels).issubset(set(node.get('labels'))),
-            #node.get('setSize'),
-
-            # On/off switch to control whether variant calling
-            #   should proceed in event-driven fashion.
-            self.env_vars['WGS_VARIANT_CALLING'] == True,
+            node.get('readGroup') is not None,
         ]
 
         for condition in conditions:
@@ -635,9 +1055,14 @@ class LaunchGatk5Dollar:
         topic = self.env_vars['DB_QUERY_TOPIC']
 
         sample = node['sample']
+        ubam_id = node['id']
         event_id = context.event_id
 
-        query = self._create_query(sample, event_id)
+        # On/off switch to control whether variant calling
+        #   should proceed in event-driven fashion.
+        launch = self.env_vars['WGS_VARIANT_CALLING'] == True
+
+        query = self._create_query(sample, ubam_id, event_id, launch)
 
         message = {
                    "header": {
@@ -646,7 +1071,8 @@ class LaunchGatk5Dollar:
                               "labels": ["Cypher", "Query", "Ubam", "GATK", "Nodes"],
                               "sentFrom": self.function_name,
                               "trigger": "LaunchGatk5Dollar",
-                              "publishTo": self.env_vars['TOPIC_GATK_5_DOLLAR'],
+                              # Only record the arrival if variant calling is off
+                              "publishTo": self.env_vars['TOPIC_GATK_5_DOLLAR'] if launch else None,
                               "seedId": header["seedId"],
                               "previousEventId": context.event_id,
                    },
@@ -660,66 +1086,23 @@ class LaunchGatk5Dollar:
         return([(topic, message)])
 
 
-    def _create_query(self, sample, event_id):
-        """Check that all ubams are present for a sample and create a job request.
+    def _create_query(self, sample, ubam_id, event_id, launch=True):
+        """Count the ubam towards its sample and create a job request when all have arrived.
 
         Update notes:
             v0.5.5: To reduce duplicate GATK $5 jobs caused by duplicate ubam objects,
                     check that sample is not related to an existing GATK $5 workflow. 
+            Replaced matching and grouping all of the sample's ubams on every
+            arrival with per-sample readiness counters (see WorkflowGate).
+            Duplicate ubams for a read group are not counted; the first one is used.
         """
-        query = (
-                 # Find all ubams associated with this sample, and checksum object
-                 f"MATCH (s:Blob:PersonalisSequencing {{sample:\"{sample}\"}})" +
-                    "-[:GENERATED]->(:Fastq)" +
-                    "-[:WAS_USED_BY]->(:Job)" +
-                    "-[:GENERATED]->(n:Ubam), " +
-                 "(s)-[:GENERATED]->(c:Checksum) " +
-                 
-                 # Don't start jobs if a job request already exists
-                 "WHERE NOT (s)-[*4]->(:JobRequest:Gatk5Dollar) " +
-                 
-                 # Group ubams by read group
-                 "WITH s.sample AS sample, " +
-                    "c.fastqCount AS fastqSetSize, " +
-                    "n.readGroup AS readGroup, " +
-                    "COLLECT(DISTINCT n) AS allNodes " +
-                 
-                 # In case of duplicate ubams or nodes being generated
-                 # for a read group, use the head() method to only get
-                 # (1) ubam per read group
-                 "WITH fastqSetSize, " +
-                    "head(allNodes) AS heads " +
-                 "UNWIND [heads] AS uniqueNodes " +
-                 "WITH uniqueNodes.sample AS sample, " +
-                      "fastqSetSize, " +
-                      "COLLECT(uniqueNodes) AS sampleNodes " +
-                 
-                 # Check that the number of ubams matches the number of 
-                 # fastqs divided by 2. Paired-end sequencing generates
-                 # (2) fastqs per read group.
-                 "WHERE size(sampleNodes) = fastqSetSize/2 " +
-                 
-                 # Create a job request, link the input nodes to the 
-                 # request node, and return the input nodes so they 
-                 # can be passed to the job launching function
-                 "CREATE (jobRequest:JobRequest:Gatk5Dollar {" +
-                            "sample: sample, " +
-                            "nodeCreated: datetime(), " +
-                            "nodeCreatedEpoch: " +
-                                "datetime().epochSeconds, " +
-                            "name: \"gatk-5-dollar\", " +
-                            f"eventId: {event_id} }}) " +
-                 "WITH sampleNodes, " +
-                      "sample, " +
-                      "jobRequest " +
-                 "UNWIND sampleNodes AS sampleNode " +
-                 "MERGE (sampleNode)-[:WAS_USED_BY]->(jobRequest) " +
-                 "RETURN DISTINCT(sampleNodes) AS nodes")
-        return query
+        return GATK_5_DOLLAR_GATE.arrival_query(ubam_id, sample, event_id, self.NODE_PROPERTIES, launch)
 
 
 class LaunchFastqToUbam:
 
+    NODE_PROPERTIES = FASTQ_TO_UBAM_PROPERTIES
+
     def __init__(self, function_name, env_vars):
 
         self.function_name = function_name
@@ -817,12 +1200,15 @@ class LaunchFastqToUbam:
                      "j.eventId AS eventId " +
                 "UNWIND uniqueMatePairs AS uniqueMatePair " +
                 "MERGE (uniqueMatePair)-[:WAS_USED_BY]->(j) " +
-                "RETURN DISTINCT(uniqueMatePairs) AS nodes")
+                f"RETURN DISTINCT {project_nodes('uniqueMatePairs', self.NODE_PROPERTIES)} AS nodes")
         return query
 
 
 class RequestGetSignatureSnps:
 
+    # Returns whole nodes; launch-view-gvcf-snps doesn't declare the properties it reads
+    NODE_PROPERTIES = None
+
     def __init__(self, function_name, env_vars):
 
         self.function_name = function_name
@@ -896,6 +1282,9 @@ class RequestGetSignatureSnps:
 
 class RequestGetSignatureSnpsCovid19:
 
+    # Returns whole nodes; launch-view-gvcf-snps doesn't declare the properties it reads
+    NODE_PROPERTIES = None
+
     def __init__(self, function_name, env_vars):
 
         self.function_name = function_name
@@ -969,6 +1358,9 @@ class RequestGetSignatureSnpsCovid19:
 
 class LaunchViewSignatureSnps:
 
+    # Returns whole nodes; launch-view-gvcf-snps doesn't declare the properties it reads
+    NODE_PROPERTIES = None
+
     def __init__(self, function_name, env_vars):
 
         self.function_name = function_name
@@ -1392,6 +1784,8 @@ class RecheckDstat:
 
         conditions = [
             set(reqd_header_labels).issubset(set(header.get('labels'))),
+            # Polled jobs are rechecked by the next poll request
+            'Poll' not in header.get('labels'),
             (not header.get('retry-count') 
              or header.get('retry-count') < MAX_RETRIES),
             node.get("status") == "RUNNING",
@@ -1437,9 +1831,105 @@ class RecheckDstat:
         return([(topic, message)])   
 
 
+class RequestPollDstat:
+    """Check the status of all outstanding dsub jobs in one request.
+
+    Finds up to "limitCount" dsub jobs that have no Dstat node or whose
+    latest Dstat node is still RUNNING and sends them, along with their
+    last known status, to check-dstat in a single message. check-dstat
+    looks the jobs up in batches and only writes statuses that changed.
+    Jobs created more than "maxAgeDays" ago are no longer polled, so jobs
+    that dstat can't find don't stay outstanding forever.
+    """
+
+    # Default age limit of polled jobs, in days
+    MAX_AGE_DAYS = 7
+
+    def __init__(self, function_name, env_vars):
+        self.function_name = function_name
+        self.env_vars = env_vars
+
+
+    def check_conditions(self, header, body, node):
+        reqd_header_labels = ['Request', 'Poll', 'Dstat']
+
+        conditions = [
+            set(reqd_header_labels).issubset(set(header.get('labels'))),
+            body.get("limitCount"),
+        ]
+
+        for condition in conditions:
+            if condition:
+                continue
+            else:
+                return False
+        return True
+
+
+    def compose_message(self, header, body, node, context):
+        topic = self.env_vars['DB_QUERY_TOPIC']
+
+        event_id = context.event_id
+        seed_id = context.event_id
+        limit_count = body["limitCount"]
+        max_age_days = body.get("maxAgeDays", self.MAX_AGE_DAYS)
+
+        query = self._create_query(limit_count, max_age_days)
+
+        message = {
+                   "header": {
+                              "resource": "query",
+                              "method": "VIEW",
+                              "labels": ["Cypher", "Query", "Dstat", "Poll", "Jobs"],
+                              "sentFrom": self.function_name,
+                              "trigger": "RequestPollDstat",
+                              "publishTo": self.env_vars['TOPIC_DSTAT'],
+                              "seedId": seed_id,
+                              "previousEventId": event_id,
+                   },
+                   "body": {
+                            "cypher": query,
+                            "result-mode": "data",
+                            "result-structure": "list",
+                            # Send all outstanding jobs in one message
+                            "result-split": "False",
+                   }
+        }
+        return([(topic, message)])
+
+
+    def _create_query(self, limit_count, max_age_days):
+        query = (
+                 "MATCH (job:Job:Dsub) " +
+                 "WHERE EXISTS(job.dsubJobId) " +
+                 # Job nodeCreated is a timestamp() in milliseconds
+                 f"AND job.nodeCreated > timestamp() - {int(max_age_days * 86400000)} " +
+                 "OPTIONAL MATCH (job)-[:STATUS]->(dstat:Dstat) " +
+                 "WITH job, dstat " +
+                 "ORDER BY dstat.lastUpdate DESC " +
+                 # Only compare against the latest status
+                 "WITH job, HEAD(COLLECT(dstat)) AS dstat " +
+                 "WHERE dstat IS NULL " +
+                 "OR dstat.status = \"RUNNING\" " +
+                 "WITH job, dstat " +
+                 "ORDER BY job.nodeCreated DESC " +
+                 f"LIMIT {limit_count} " +
+                 "RETURN job.dsubJobId AS jobId, " +
+                    "job.provider AS provider, " +
+                    "job.project AS project, " +
+                    "job.user AS user, " +
+                    "job.dstatCmd AS dstatCmd, " +
+                    "dstat.instanceName AS instanceName, " +
+                    "dstat.status AS status, " +
+                    "dstat.statusDetail AS statusDetail")
+        return query
+
+
 # Launch QC tasks
 class LaunchBamFastqc:
 
+    NODE_PROPERTIES = BAM_FASTQC_PROPERTIES
+
     def __init__(self, function_name, env_vars):
 
         self.function_name = function_name
@@ -1517,12 +2007,14 @@ class LaunchBamFastqc:
                             "name: \"bam-fastqc\", " +
                             f"eventId: {event_id} }}) " +
                  "MERGE (node)-[:WAS_USED_BY]->(jr) " +
-                 "RETURN node " +
+                 f"RETURN {project_node('node', self.NODE_PROPERTIES)} AS node " +
                  "LIMIT 1")
         return query
 
 
 class LaunchFlagstat:
+
+    NODE_PROPERTIES = FLAGSTAT_PROPERTIES
     
     def __init__(self, function_name, env_vars):
 
@@ -1601,12 +2093,14 @@ class LaunchFlagstat:
                             "name: \"flagstat\", " +
                             f"eventId: {event_id} }}) " +
                  "MERGE (node)-[:WAS_USED_BY]->(jr) " +
-                 "RETURN node " +
+                 f"RETURN {project_node('node', self.NODE_PROPERTIES)} AS node " +
                  "LIMIT 1")
         return query
 
 
 class LaunchVcfstats:
+
+    NODE_PROPERTIES = VCFSTATS_PROPERTIES
     
     def __init__(self, function_name, env_vars):
 
@@ -1686,13 +2180,15 @@ class LaunchVcfstats:
                             "name: \"vcfstats\", " +
                             f"eventId: {event_id} }}) " +
                  "MERGE (node)-[:WAS_USED_BY]->(jr) " +
-                 "RETURN node " +
+                 f"RETURN {project_node('node', self.NODE_PROPERTIES)} AS node " +
                  "LIMIT 1")
         return query
 
 
 class LaunchTextToTable:
 
+    NODE_PROPERTIES = TEXT_TO_TABLE_PROPERTIES
+
     def __init__(self, function_name, env_vars):
 
         self.function_name = function_name
@@ -1776,7 +2272,7 @@ class LaunchTextToTable:
                             "name: \"text-to-table\", " +
                             f"eventId: {event_id} }}) " +
                  "MERGE (node)-[:WAS_USED_BY]->(jr) " +
-                 "RETURN node " +
+                 f"RETURN {project_node('node', self.NODE_PROPERTIES)} AS node " +
                  "LIMIT 1")
         return query
 
@@ -2541,6 +3037,9 @@ class RequestCnvnatorCovid19:
 
 class LaunchCnvnator:
 
+    # Returns whole nodes; launch-cnvnator doesn't declare the properties it reads
+    NODE_PROPERTIES = None
+
     def __init__(self, function_name, env_vars):
 
         self.function_name = function_name
@@ -2924,7 +3423,8 @@ class DeleteNonessentialSequencingData:
                  f"AND b.bucket = \"{self.env_vars['DSUB_OUT_BUCKET']}\" " + 
                  "RETURN b.bucket AS bucket, b.path AS path " +
                  "ORDER BY b.size DESC " +
-                 "LIMIT 100")
+                 # delete-blob deletes objects in batches of 100
+                 "LIMIT 1000")
         return query
 
 
@@ -2975,7 +3475,7 @@ class MoveFastqsToColdline:
                    "header": {
                               "resource": "query",
                               "method": "POST",
-                              "labels": ["Trigger", "Fastq", "Coldline", "Cypher", "Query"],
+                              "labels": ["Trigger", "Fastq", "Coldline", "Cypher", "Query", "Bulk"],
                               "sentFrom": self.function_name,
                               "trigger": "MoveFastqsToColdline",
                               "publishTo": self.env_vars['TOPIC_BLOB_UPDATE_STORAGE'],
@@ -2986,7 +3486,10 @@ class MoveFastqsToColdline:
                             "cypher": query,
                             "result-mode": "data",
                             "result-structure": "list",
-                            "result-split": "True"
+                            # Transition all of the Fastqs in one message; add
+                            # TOPIC_BLOB_UPDATE_STORAGE to CLAIM_CHECK_TOPICS so
+                            # large results are passed by claim check
+                            "result-split": "False"
                    }
         }
         return([(topic, message)])
@@ -2997,7 +3500,8 @@ class MoveFastqsToColdline:
                  f"WHERE s.sample =\"{sample_id}\" " +
                  "AND s.trellis_optimizeStorage = True " +
                  "AND f.storageClass <> \"COLDLINE\" " +
-                 "RETURN f AS node, \"COLDLINE\" AS requested_class")
+                 f"RETURN {project_node('f', STORAGE_CLASS_PROPERTIES)} AS node, " +
+                        "\"COLDLINE\" AS requested_class")
         return query
 
 
@@ -3048,7 +3552,7 @@ class RequestChangeFastqStorage:
                    "header": {
                               "resource": "query",
                               "method": "POST",
-                              "labels": ["Trigger", "Fastq", "Coldline", "Cypher", "Query"],
+                              "labels": ["Trigger", "Fastq", "Coldline", "Cypher", "Query", "Bulk"],
                               "sentFrom": self.function_name,
                               "trigger": "RequestMoveFastqsToColdline",
                               "publishTo": self.env_vars['TOPIC_BLOB_UPDATE_STORAGE'],
@@ -3059,7 +3563,10 @@ class RequestChangeFastqStorage:
                             "cypher": query,
                             "result-mode": "data",
                             "result-structure": "list",
-                            "result-split": "True"
+                            # Transition all of the Fastqs in one message; add
+                            # TOPIC_BLOB_UPDATE_STORAGE to CLAIM_CHECK_TOPICS so
+                            # large results are passed by claim check
+                            "result-split": "False"
                    }
         }
         return([(topic, message)])
@@ -3075,7 +3582,8 @@ class RequestChangeFastqStorage:
                  f"WHERE f.storageClass <> \"{storage_class}\" " +
                  "AND NOT f.storageClass IN [\"COLDLINE\", \"ARCHIVE\"] " +
                  "SET s.trellis_coldlineFastqs = localdatetime() " +
-                 f"RETURN f AS node, \"{storage_class}\" AS requested_class")
+                 f"RETURN {project_node('f', STORAGE_CLASS_PROPERTIES)} AS node, " +
+                        f"\"{storage_class}\" AS requested_class")
         return query
 ## END Data archival triggers
 
@@ -4242,6 +4750,8 @@ class RelateCromwellOutputToStep:
 
         conditions = [
             set(reqd_header_labels).issubset(set(header.get('labels'))),
+            # Built in batches, if configured
+            not cromwell_lineage_batched(self.env_vars),
             #node.get("nodeIteration") == "initial",
             node.get("trellisTaskId"),
             node.get("id"),
@@ -4322,6 +4832,8 @@ class AddWorkflowIdToCromwellWorkflow:
         conditions = [
             # Check that message has appropriate headers
             set(reqd_header_labels).issubset(set(header.get('labels'))),
+            # Built in batches, if configured
+            not cromwell_lineage_batched(self.env_vars),
             # Check that retry count has not been met/exceeded
             (not header.get('retry-count') 
              or header.get('retry-count') < MAX_RETRIES),
@@ -4404,6 +4916,8 @@ class RelateCromwellWorkflowToStep:
         conditions = [
             # Check that message has appropriate headers
             set(reqd_header_labels).issubset(set(header.get('labels'))),
+            # Built in batches, if configured
+            not cromwell_lineage_batched(self.env_vars),
             # Check that retry count has not been met/exceeded
             (not header.get('retry-count')
                 or header.get('retry-count') < MAX_RETRIES),
@@ -4491,6 +5005,8 @@ class RelateCromwellStepToPreviousStep:
         conditions = [
             # Check that message has appropriate headers
             set(reqd_header_labels).issubset(set(header.get('labels'))),
+            # Built in batches, if configured
+            not cromwell_lineage_batched(self.env_vars),
             # Check that retry count has not been met/exceeded
             (not header.get('retry-count') 
              or header.get('retry-count') < MAX_RETRIES),
@@ -4580,6 +5096,8 @@ class CreateCromwellStepFromAttempt:
         conditions = [
             # Check that message has appropriate headers
             set(reqd_header_labels).issubset(set(header.get('labels'))),
+            # Built in batches, if configured
+            not cromwell_lineage_batched(self.env_vars),
             # Check that retry count has not been met/exceeded
             (not header.get('retry-count') 
              or header.get('retry-count') < MAX_RETRIES),
@@ -4670,6 +5188,8 @@ class RelateCromwellStepToLatestAttempt:
         conditions = [
             # Check that message has appropriate headers
             set(reqd_header_labels).issubset(set(header.get('labels'))),
+            # Built in batches, if configured
+            not cromwell_lineage_batched(self.env_vars),
             # Check that retry count has not been met/exceeded
             (not header.get('retry-count') 
              or header.get('retry-count') < MAX_RETRIES),
@@ -4758,6 +5278,8 @@ class RelateCromwellAttemptToPreviousAttempt:
         conditions = [
             # Check that message has appropriate headers
             set(reqd_header_labels).issubset(set(header.get('labels'))),
+            # Built in batches, if configured
+            not cromwell_lineage_batched(self.env_vars),
             # Check that retry count has not been met/exceeded
             (not header.get('retry-count') 
              or header.get('retry-count') < MAX_RETRIES),
@@ -4850,6 +5372,8 @@ class RelateCromwellStepToAttempt:
         conditions = [
             # Check that message has appropriate headers
             set(reqd_header_labels).issubset(set(header.get('labels'))),
+            # Built in batches, if configured
+            not cromwell_lineage_batched(self.env_vars),
             # Check that retry count has not been met/exceeded
             (not header.get('retry-count') 
              or header.get('retry-count') < MAX_RETRIES),
@@ -4935,6 +5459,8 @@ class DeleteRelationshipCromwellStepHasAttempt:
         conditions = [
             # Check that message has appropriate headers
             set(reqd_header_labels).issubset(set(header.get('labels'))),
+            # Built in batches, if configured
+            not cromwell_lineage_batched(self.env_vars),
             # Check that retry count has not been met/exceeded
             (not header.get('retry-count') 
              or header.get('retry-count') < MAX_RETRIES),
@@ -4997,6 +5523,123 @@ class DeleteRelationshipCromwellStepHasAttempt:
         return query 
 
 
+class RecordCromwellLineageEvent:
+
+    def __init__(self, function_name, env_vars):
+        '''Buffer Cromwell attempts and outputs for build-cromwell-lineage.
+
+        When TOPIC_CROMWELL_LINEAGE is configured, the lineage of each
+        workflow (workflow, steps, attempts, outputs) is written in 
+        batches by build-cromwell-lineage instead of by the 
+        RelateCromwell* trigger chain.
+        '''
+
+        self.function_name = function_name
+        self.env_vars = env_vars
+
+
+    def check_conditions(self, header, body, node):
+        attempt_header_labels = ['Create', 'Job', 'CromwellAttempt', 'Node', 'Database', 'Result']
+        output_header_labels = ['Create', 'Blob', 'Node', 'Database', 'Result']
+
+        if not node or not self.env_vars.get('TOPIC_CROMWELL_LINEAGE'):
+            return False
+        # Lineage is read from workflow metadata instead
+        if self.env_vars.get('TOPIC_CROMWELL_METADATA'):
+            return False
+
+        attempt_conditions = [
+            set(attempt_header_labels).issubset(set(header.get('labels'))),
+            'CromwellAttempt' in node.get('labels'),
+            node.get('cromwellWorkflowId'),
+            node.get('wdlCallAlias'),
+            node.get('instanceName'),
+            node.get('startTimeEpoch')
+        ]
+        output_conditions = [
+            set(output_header_labels).issubset(set(header.get('labels'))),
+            node.get('cromwellWorkflowId'),
+            node.get('trellisTaskId'),
+            node.get('wdlCallAlias'),
+            node.get('id')
+        ]
+        return all(attempt_conditions) or all(output_conditions)
+
+
+    def compose_message(self, header, body, node, context):
+        topic = self.env_vars['TOPIC_CROMWELL_LINEAGE']
+
+        event = {
+                 "cromwellWorkflowId": node['cromwellWorkflowId'],
+                 "wdlCallAlias": node['wdlCallAlias'],
+                 "seedId": header["seedId"],
+        }
+        if 'CromwellAttempt' in node.get('labels'):
+            event["instanceName"] = node['instanceName']
+            event["startTimeEpoch"] = node['startTimeEpoch']
+        else:
+            event["id"] = node['id']
+            event["trellisTaskId"] = node['trellisTaskId']
+        return([(topic, event)])
+
+
+class IngestCromwellMetadata:
+
+    def __init__(self, function_name, env_vars):
+        '''Load a finished Cromwell workflow from its metadata.
+
+        Triggered by the metadata written by launch-gatk-5-dollar
+        workflows ("cromwell run --metadata-output").
+        '''
+
+        self.function_name = function_name
+        self.env_vars = env_vars
+
+
+    def check_conditions(self, header, body, node):
+        reqd_header_labels = ['Create', 'Blob', 'Node', 'Database', 'Result']
+
+        if not node or not self.env_vars.get('TOPIC_CROMWELL_METADATA'):
+            return False
+
+        conditions = [
+            set(reqd_header_labels).issubset(set(header.get('labels'))),
+            'Json' in node.get('labels'),
+            node.get('basename') == 'cromwell-metadata.json',
+            node.get('bucket'),
+            node.get('path'),
+        ]
+
+        for condition in conditions:
+            if condition:
+                continue
+            else:
+                return False
+        return True
+
+
+    def compose_message(self, header, body, node, context):
+        topic = self.env_vars['TOPIC_CROMWELL_METADATA']
+
+        message = {
+                   "header": {
+                              "resource": "blob",
+                              "method": "POST",
+                              "labels": ["Cromwell", "Metadata", "Blob"],
+                              "sentFrom": self.function_name,
+                              "trigger": "IngestCromwellMetadata",
+                              "seedId": header["seedId"],
+                              "previousEventId": context.event_id,
+                   },
+                   "body": {
+                            "bucket": node['bucket'],
+                            "path": node['path'],
+                            "trellisTaskId": node.get('trellisTaskId'),
+                   }
+        }
+        return([(topic, message)])
+
+
 def get_triggers(function_name, env_vars):
 
     triggers = []
@@ -5014,17 +5657,26 @@ def get_triggers(function_name, env_vars):
     triggers.append(RequestFastqToUbamCovid19(
                                     function_name,
                                     env_vars))
+    triggers.append(RequestBulkFastqToUbam(
+                                    function_name,
+                                    env_vars))
     
     ## Request-driven triggers to re-launch failed/missing jobs
     triggers.append(RequestLaunchGatk5Dollar(
                                     function_name,
                                     env_vars))
+    triggers.append(RequestBulkLaunchGatk5Dollar(
+                                    function_name,
+                                    env_vars))
     triggers.append(RequestLaunchFailedGatk5Dollar(
                                     function_name,
                                     env_vars))
     triggers.append(RequestGatk5DollarNoJob(
                                     function_name,
                                     env_vars))
+    triggers.append(RequestBackfillWorkflowGate(
+                                    function_name,
+                                    env_vars))
 
     ## Launch QC jobs
     triggers.append(LaunchBamFastqc(
@@ -5091,6 +5743,9 @@ def get_triggers(function_name, env_vars):
     triggers.append(RecheckDstat(
                                     function_name,
                                     env_vars))
+    triggers.append(RequestPollDstat(
+                                    function_name,
+                                    env_vars))
 
     triggers.append(MarkJobAsDuplicate(
                                     function_name,
@@ -5144,6 +5799,12 @@ def get_triggers(function_name, env_vars):
     triggers.append(DeleteRelationshipCromwellStepHasAttempt(
                                     function_name,
                                     env_vars))
+    triggers.append(RecordCromwellLineageEvent(
+                                    function_name,
+                                    env_vars))
+    triggers.append(IngestCromwellMetadata(
+                                    function_name,
+                                    env_vars))
 
     ## Trellis v1.2 refactor
     triggers.append(MergeBiologicalNodesFromSequencing(
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Tests for the messages composed by scheduled "Request" triggers."""
+
+import os
+import importlib.util
+
+from types import SimpleNamespace
+from unittest import TestCase
+
+PHASE3_DIR = os.path.dirname(os.path.abspath(__file__))
+TRIGGERS_PATH = os.path.join(PHASE3_DIR, 'database-triggers.py')
+
+ENV_VARS = {
+            'DB_QUERY_TOPIC': 'db-query',
+            'TOPIC_TRIGGERS': 'check-triggers',
+            'TOPIC_DSTAT': 'check-dstat',
+            'TOPIC_BLOB_UPDATE_STORAGE': 'blob-update-storage-class',
+}
+CONTEXT = SimpleNamespace(event_id=123)
+
+
+def load_triggers():
+    spec = importlib.util.spec_from_file_location('database_triggers', TRIGGERS_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestRequestTriggers(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.triggers = load_triggers()
+
+    def test_request_launch_gatk_5_dollar(self):
+        trigger = self.triggers.RequestLaunchGatk5Dollar('check-triggers', ENV_VARS)
+        header = {'labels': ['Request', 'LaunchGatk5Dollar', 'All']}
+        body = {'limitCount': 10}
+        self.assertTrue(trigger.check_conditions(header, body, None))
+
+        [(topic, message)] = trigger.compose_message(header, body, None, CONTEXT)
+        self.assertEqual(topic, 'db-query')
+        self.assertEqual(message['header']['publishTo'], 'check-triggers')
+        self.assertIn("WITH r LIMIT 10 ", message['body']['cypher'])
+
+    def test_request_poll_dstat(self):
+        trigger = self.triggers.RequestPollDstat('check-triggers', ENV_VARS)
+        header = {'labels': ['Request', 'Poll', 'Dstat']}
+
+        [(topic, message)] = trigger.compose_message(header, {'limitCount': 10}, None, CONTEXT)
+        self.assertEqual(message['header']['publishTo'], 'check-dstat')
+        query = message['body']['cypher']
+        self.assertIn(f"job.nodeCreated > timestamp() - {7 * 86400000} ", query)
+        self.assertIn("LIMIT 10 ", query)
+
+        [(topic, message)] = trigger.compose_message(header, {'limitCount': 10, 'maxAgeDays': 1}, None, CONTEXT)
+        self.assertIn("job.nodeCreated > timestamp() - 86400000 ", message['body']['cypher'])
+
+    def test_request_change_fastq_storage(self):
+        trigger = self.triggers.RequestChangeFastqStorage('check-triggers', ENV_VARS)
+        header = {'labels': ['Request', 'Change', 'Fastq', 'Storage']}
+        body = {'request': {'count': 5, 'storage_class': 'NEARLINE'}}
+        self.assertTrue(trigger.check_conditions(header, body, None))
+
+        [(topic, message)] = trigger.compose_message(header, body, None, CONTEXT)
+        self.assertEqual(message['header']['publishTo'], 'blob-update-storage-class')
+        # Only the properties needed to transition each blob are returned
+        self.assertIn("RETURN f {.bucket, .path, .extension, .storageClass} AS node, ", message['body']['cypher'])
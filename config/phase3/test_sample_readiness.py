@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Tests for the per-sample readiness counters of workflow gates.
+
+The concurrency test runs the trigger queries against a local Neo4j
+database, e.g.
+
+    docker run -p 7687:7687 -e NEO4J_AUTH=neo4j/test neo4j:4.2
+    NEO4J_TEST_URL=bolt://localhost:7687 NEO4J_TEST_PASSWORD=test \
+        python -m pytest config/phase3/test_sample_readiness.py
+
+and is skipped when NEO4J_TEST_URL is not set. It creates and deletes
+nodes with the sample name TEST_SAMPLE; don't point it at a database
+with Trellis data in it.
+"""
+
+import os
+import importlib.util
+
+from unittest import TestCase, skipUnless
+from concurrent.futures import ThreadPoolExecutor
+
+PHASE3_DIR = os.path.dirname(os.path.abspath(__file__))
+TRIGGERS_PATH = os.path.join(PHASE3_DIR, 'database-triggers.py')
+
+NEO4J_TEST_URL = os.environ.get('NEO4J_TEST_URL')
+TEST_SAMPLE = 'TESTREADINESS'
+READ_GROUPS = 8
+
+ENV_VARS = {
+            'DB_QUERY_TOPIC': 'db-query',
+            'TOPIC_GATK_5_DOLLAR': 'gatk-5-dollar',
+            'WGS_VARIANT_CALLING': True,
+}
+
+
+def load_triggers():
+    spec = importlib.util.spec_from_file_location('database_triggers', TRIGGERS_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestReadinessQuery(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.triggers = load_triggers()
+        cls.trigger = cls.triggers.LaunchGatk5Dollar('check-triggers', ENV_VARS)
+        cls.query = cls.trigger._create_query(TEST_SAMPLE, 'ubam-1', 123)
+        cls.gate = cls.triggers.GATK_5_DOLLAR_GATE
+
+    def test_lock_taken_before_counters_read(self):
+        lock = self.query.index('SET r._lock = true')
+        self.assertLess(lock, self.query.index('n.readGroup IN r.members'))
+        self.assertLess(lock, self.query.index('r.expected IS NULL'))
+        self.assertLess(self.query.index('REMOVE r._lock'), self.query.index('WHERE NOT r.launched'))
+
+    def test_launch_flag_set_before_job_request(self):
+        self.assertLess(self.query.index('SET r.launched = true'), self.query.index('CREATE (jobRequest'))
+
+    def test_sample_subgraph_not_matched(self):
+        with open(TRIGGERS_PATH) as fh:
+            self.assertNotIn('[*4]', fh.read())
+        self.assertNotIn(':Fastq', self.query)
+        self.assertIn('MATCH (n:Blob:Ubam {id: "ubam-1"})', self.query)
+        self.assertIn(f'readinessId: "gatk-5-dollar:{TEST_SAMPLE}"', self.query)
+        self.assertIn(f'r.sample = "{TEST_SAMPLE}"', self.query)
+
+    def test_ubam_without_read_group_ignored(self):
+        header = {'labels': ['Create', 'Relationship', 'Database', 'Result']}
+        node = {'labels': ['Blob', 'Ubam'], 'id': 'ubam-1', 'sample': TEST_SAMPLE}
+        self.assertFalse(self.trigger.check_conditions(header, {}, node))
+
+        node['readGroup'] = 0
+        self.assertTrue(self.trigger.check_conditions(header, {}, node))
+
+    def test_arrivals_recorded_when_variant_calling_off(self):
+        header = {'labels': ['Create', 'Relationship', 'Database', 'Result'], 'seedId': 1}
+        node = {'labels': ['Blob', 'Ubam'], 'id': 'ubam-1', 'sample': TEST_SAMPLE, 'readGroup': 0}
+        context = type('Context', (), {'event_id': 123})
+        trigger = self.triggers.LaunchGatk5Dollar('check-triggers', dict(ENV_VARS, WGS_VARIANT_CALLING=False))
+
+        self.assertTrue(trigger.check_conditions(header, {}, node))
+        [(topic, message)] = trigger.compose_message(header, {}, node, context)
+        self.assertIsNone(message['header']['publishTo'])
+        self.assertIn('r.members + n.readGroup', message['body']['cypher'])
+        self.assertNotIn('CREATE (jobRequest', message['body']['cypher'])
+
+    def test_ready_query_rechecks_under_lock(self):
+        query = self.gate.ready_query(123, 10, self.trigger.NODE_PROPERTIES)
+        self.assertLess(query.index('SET r._lock = true'), query.index('WHERE NOT r.launched'))
+        self.assertIn('launched: false', query)
+
+    def test_relaunch_skips_previous_request_check(self):
+        trigger = self.triggers.RequestGatk5DollarNoJob('check-triggers', ENV_VARS)
+        query = trigger._create_query(123)
+        self.assertIn('r.readinessId = "gatk-5-dollar:" + group', query)
+        self.assertNotIn('previousRequests', query)
+        self.assertIn('previousRequests = 0', self.query)
+
+    def test_backfill_request(self):
+        trigger = self.triggers.RequestBackfillWorkflowGate('check-triggers', ENV_VARS)
+        header = {'labels': ['Request', 'Backfill', 'WorkflowGate']}
+        self.assertTrue(trigger.check_conditions(header, {'workflow': 'gatk-5-dollar', 'limitCount': 100}, None))
+        self.assertFalse(trigger.check_conditions(header, {'workflow': 'cnvnator', 'limitCount': 100}, None))
+
+
+@skipUnless(NEO4J_TEST_URL, "Set NEO4J_TEST_URL to run against a local Neo4j database.")
+class TestConcurrentArrivals(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from py2neo import Graph
+
+        cls.graph = Graph(
+                          NEO4J_TEST_URL,
+                          user=os.environ.get('NEO4J_TEST_USER', 'neo4j'),
+                          password=os.environ.get('NEO4J_TEST_PASSWORD'))
+        try:
+            cls.graph.run("CREATE CONSTRAINT ON (n:SampleReadiness) ASSERT n.readinessId IS UNIQUE")
+        except Exception:
+            # Constraint already exists
+            pass
+        cls.trigger = load_triggers().LaunchGatk5Dollar('check-triggers', ENV_VARS)
+
+    def setUp(self):
+        self.delete_sample()
+        self.graph.run(
+                       "CREATE (s:Blob:PersonalisSequencing {sample: $sample, id: $sample}) " +
+                       "CREATE (s)-[:GENERATED]->(:Blob:Checksum {sample: $sample, fastqCount: $fastqCount}) " +
+                       "WITH s " +
+                       "UNWIND range(0, $readGroups - 1) AS readGroup " +
+                       "CREATE (s)-[:GENERATED]->(:Blob:Fastq {sample: $sample})" +
+                            "-[:WAS_USED_BY]->(:Job {sample: $sample})" +
+                            "-[:GENERATED]->(:Blob:Ubam {" +
+                                "sample: $sample, " +
+                                "readGroup: readGroup, " +
+                                "id: $sample + '-ubam-' + readGroup})",
+                       sample=TEST_SAMPLE, fastqCount=READ_GROUPS * 2, readGroups=READ_GROUPS)
+
+    def tearDown(self):
+        self.delete_sample()
+
+    def delete_sample(self):
+        self.graph.run("MATCH (n {sample: $sample}) DETACH DELETE n", sample=TEST_SAMPLE)
+        self.graph.run("MATCH (n:SampleReadiness {sample: $sample}) DETACH DELETE n", sample=TEST_SAMPLE)
+
+    def arrive(self, arrival, launch=True):
+        ubam_id, event_id = arrival
+        query = self.trigger._create_query(TEST_SAMPLE, ubam_id, event_id, launch)
+        return self.graph.run(query).data()
+
+    def test_launches_once(self):
+        ubam_ids = [f"{TEST_SAMPLE}-ubam-{read_group}" for read_group in range(READ_GROUPS)]
+        # Every ubam arrives twice, as with duplicate relationship events
+        arrivals = [(ubam_id, event_id) for event_id, ubam_id in enumerate(ubam_ids * 2)]
+
+        with ThreadPoolExecutor(max_workers=len(arrivals)) as executor:
+            results = list(executor.map(self.arrive, arrivals))
+
+        launches = [result for result in results if result]
+        self.assertEqual(len(launches), 1)
+        self.assertEqual(len(launches[0]), 1)
+        self.assertEqual(sorted(node['id'] for node in launches[0][0]['nodes']), sorted(ubam_ids))
+
+        requests = self.graph.run(
+                                  "MATCH (r:JobRequest:Gatk5Dollar {sample: $sample}) " +
+                                  "RETURN COUNT(r) AS requests",
+                                  sample=TEST_SAMPLE).evaluate()
+        self.assertEqual(requests, 1)
+
+        readiness = self.graph.run(
+                                   "MATCH (r:SampleReadiness {sample: $sample}) RETURN r",
+                                   sample=TEST_SAMPLE).evaluate()
+        self.assertEqual(readiness['expected'], READ_GROUPS)
+        self.assertEqual(sorted(readiness['members']), list(range(READ_GROUPS)))
+        self.assertTrue(readiness['launched'])
+
+    def test_not_launched_until_ready(self):
+        for read_group in range(READ_GROUPS - 1):
+            self.assertEqual(self.arrive((f"{TEST_SAMPLE}-ubam-{read_group}", read_group)), [])
+        self.assertEqual(self.arrive((f"{TEST_SAMPLE}-ubam-0", 100)), [])
+
+        self.assertEqual(len(self.arrive((f"{TEST_SAMPLE}-ubam-{READ_GROUPS - 1}", 101))), 1)
+        self.assertEqual(self.arrive((f"{TEST_SAMPLE}-ubam-{READ_GROUPS - 1}", 102)), [])
+
+    def test_bulk_launches_once(self):
+        for read_group in range(READ_GROUPS):
+            self.arrive((f"{TEST_SAMPLE}-ubam-{read_group}", read_group), launch=False)
+        gate = load_triggers().GATK_5_DOLLAR_GATE
+        query = gate.ready_query(200, 10, self.trigger.NODE_PROPERTIES)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: self.graph.run(query).data(), range(4)))
+
+        launches = [row for result in results for row in result]
+        self.assertEqual(len(launches), 1)
+        self.assertEqual(len(launches[0]['nodes']), READ_GROUPS)
+
+    def test_backfill(self):
+        gate = load_triggers().GATK_5_DOLLAR_GATE
+        self.graph.run(gate.backfill_query(1000))
+
+        readiness = self.graph.run(
+                                   "MATCH (r:SampleReadiness {sample: $sample}) RETURN r",
+                                   sample=TEST_SAMPLE).evaluate()
+        self.assertEqual(readiness['expected'], READ_GROUPS)
+        self.assertEqual(sorted(readiness['members']), list(range(READ_GROUPS)))
+        self.assertFalse(readiness['launched'])
+        self.assertEqual(len(self.graph.run(gate.ready_query(300, 1000, self.trigger.NODE_PROPERTIES)).data()), 1)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import os
+import ast
+
+from unittest import TestCase
+
+PHASE3_DIR = os.path.dirname(os.path.abspath(__file__))
+TRIGGERS_PATH = os.path.join(PHASE3_DIR, 'database-triggers.py')
+FUNCTIONS_DIR = os.path.join(PHASE3_DIR, '..', '..', 'functions')
+
+# Trigger topics and the launch functions subscribed to them
+LAUNCHER_TOPICS = {
+    'TOPIC_FASTQ_TO_UBAM': 'launch-fastq-to-ubam',
+    'TOPIC_GATK_5_DOLLAR': 'launch-gatk-5-dollar',
+    'TOPIC_BAM_FASTQC': 'launch-bam-fastqc',
+    'TOPIC_FLAGSTAT': 'launch-flagstat',
+    'TOPIC_VCFSTATS': 'launch-vcfstats',
+    'TOPIC_TEXT_TO_TABLE': 'launch-text-to-table',
+}
+# Launch functions that don't declare NODE_PROPERTIES; their triggers
+# still return whole nodes and set NODE_PROPERTIES = None to say so
+FULL_NODE_TOPICS = {
+    'TOPIC_VIEW_GVCF_SNPS': 'launch-view-gvcf-snps',
+    'TOPIC_CNVNATOR': 'launch-cnvnator',
+}
+# Shared modules copied into every launch function that read input nodes
+SHARED_MODULES = ['launcher.py', 'placement.py', 'input_fingerprint.py']
+
+
+def parse(path):
+    with open(path) as fh:
+        return ast.parse(fh.read())
+
+
+def string_value(node):
+    # Subscripts are wrapped in ast.Index before Python 3.9
+    if isinstance(node, getattr(ast, 'Index', ())):
+        node = node.value
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return None
+
+
+def module_constants(tree):
+    constants = {}
+    for statement in tree.body:
+        if isinstance(statement, ast.Assign) and len(statement.targets) == 1:
+            target = statement.targets[0]
+            if isinstance(target, ast.Name) and target.id.isupper():
+                try:
+                    constants[target.id] = ast.literal_eval(statement.value)
+                except ValueError:
+                    continue
+    return constants
+
+
+def is_node(item):
+    """A variable named 'node' or an item of a list named 'nodes'."""
+    if isinstance(item, ast.Subscript):
+        item = item.value
+        return isinstance(item, ast.Name) and item.id == 'nodes'
+    return isinstance(item, ast.Name) and item.id == 'node'
+
+
+def node_reads(tree):
+    """Get the keys read from input nodes."""
+    keys = set()
+    for item in ast.walk(tree):
+        if isinstance(item, ast.Subscript):
+            if is_node(item.value):
+                key = string_value(item.slice)
+                if key:
+                    keys.add(key)
+        elif isinstance(item, ast.Call) and isinstance(item.func, ast.Attribute):
+            function = item.func
+            if function.attr == 'get' and is_node(function.value):
+                key = string_value(item.args[0])
+                if key:
+                    keys.add(key)
+    return keys
+
+
+def launcher_triggers(tree, topics=LAUNCHER_TOPICS):
+    """Get trigger classes that publish query results to a launcher.
+
+    Returns:
+        (dict): Class definition and launcher topic of each trigger.
+    """
+    triggers = {}
+    for statement in tree.body:
+        if not isinstance(statement, ast.ClassDef):
+            continue
+        for item in ast.walk(statement):
+            if not isinstance(item, ast.Dict):
+                continue
+            for key, value in zip(item.keys, item.values):
+                if key is None or string_value(key) != 'publishTo':
+                    continue
+                if isinstance(value, ast.Subscript) and string_value(value.slice) in topics:
+                    triggers[statement.name] = (statement, string_value(value.slice))
+    return triggers
+
+
+def class_constant(class_def, name):
+    for statement in class_def.body:
+        if isinstance(statement, ast.Assign) and statement.targets[0].id == name:
+            return statement.value
+    return None
+
+
+def uses_attribute(function_def, name):
+    return any(
+               isinstance(item, ast.Attribute) and item.attr == name
+               for item in ast.walk(function_def))
+
+
+class TestTriggerProjections(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.triggers_tree = parse(TRIGGERS_PATH)
+        cls.trigger_constants = module_constants(cls.triggers_tree)
+
+        # Node keys read for every launcher by the shared modules
+        shared_reads = set()
+        for module in SHARED_MODULES:
+            tree = parse(os.path.join(FUNCTIONS_DIR, 'shared', module))
+            shared_reads |= node_reads(tree)
+            shared_reads |= set(module_constants(tree).get('IDENTITY_FIELDS', ()))
+
+        cls.launcher_properties = {}
+        cls.launcher_reads = {}
+        for launcher in LAUNCHER_TOPICS.values():
+            tree = parse(os.path.join(FUNCTIONS_DIR, launcher, 'main.py'))
+            cls.launcher_properties[launcher] = set(module_constants(tree).get('NODE_PROPERTIES', []))
+            cls.launcher_reads[launcher] = node_reads(tree) | shared_reads
+
+    def test_launchers_only_read_declared_properties(self):
+        for launcher, reads in self.launcher_reads.items():
+            with self.subTest(launcher=launcher):
+                self.assertTrue(self.launcher_properties[launcher], f"{launcher} does not declare NODE_PROPERTIES.")
+                self.assertEqual(reads - self.launcher_properties[launcher], set())
+
+    def test_triggers_project_launcher_properties(self):
+        triggers = launcher_triggers(self.triggers_tree)
+        self.assertIn('LaunchFlagstat', triggers)
+
+        for name, (class_def, topic) in triggers.items():
+            launcher = LAUNCHER_TOPICS[topic]
+            with self.subTest(trigger=name):
+                value = class_constant(class_def, 'NODE_PROPERTIES')
+                self.assertIsNotNone(value, f"{name} does not declare NODE_PROPERTIES.")
+                projected = set(self.trigger_constants[value.id])
+                self.assertEqual(self.launcher_properties[launcher] - projected, set())
+
+                create_query = [
+                                item for item in class_def.body
+                                if isinstance(item, ast.FunctionDef) and item.name == '_create_query']
+                self.assertTrue(uses_attribute(create_query[0], 'NODE_PROPERTIES'))
+
+    def test_full_node_triggers_marked(self):
+        triggers = launcher_triggers(self.triggers_tree, FULL_NODE_TOPICS)
+        self.assertIn('LaunchCnvnator', triggers)
+
+        for name, (class_def, topic) in triggers.items():
+            with self.subTest(trigger=name):
+                value = class_constant(class_def, 'NODE_PROPERTIES')
+                self.assertIsNotNone(value, f"{name} does not declare NODE_PROPERTIES.")
+                self.assertIsNone(ast.literal_eval(value))
+
+    def test_node_reads_found(self):
+        tree = ast.parse("name = node['sample']\nlabels = node.get('labels')\nplate = nodes[0]['plate']\nother = job['id']")
+        self.assertEqual(node_reads(tree), {'sample', 'labels', 'plate'})
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""Cross-check Trellis indexes against the queries that need them.
+
+Extracts every node property lookup (MATCH/MERGE patterns and WHERE
+equality predicates) from the trigger classes in database-triggers.py and
+the query-building functions of the Cloud Functions, then compares them
+with the indexes listed in db-indexes.txt and the indexes backing the
+constraints in db-constraints.txt (or those installed in a running Neo4j
+instance).
+
+Report sections:
+    missing:    lookups that no index can serve.
+    reorder:    composite indexes covering exactly the properties of a
+                lookup, but declared in a different order.
+    unused:     indexes that serve no lookup.
+
+Usage:
+    python databases/index_advisor.py
+    python databases/index_advisor.py --neo4j-url bolt://localhost:7687 \
+        --neo4j-user neo4j --neo4j-password test [--apply]
+"""
+
+import os
+import re
+import ast
+import sys
+import glob
+import argparse
+import warnings
+
+from collections import namedtuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_TRIGGERS = os.path.join(REPO_ROOT, 'config', 'phase3', 'database-triggers.py')
+DEFAULT_FUNCTIONS = os.path.join(REPO_ROOT, 'functions')
+DEFAULT_INDEXES = os.path.join(REPO_ROOT, 'databases', 'db-indexes.txt')
+DEFAULT_CONSTRAINTS = os.path.join(REPO_ROOT, 'databases', 'db-constraints.txt')
+
+# Placeholder inserted for f-string expressions
+PARAM = "$param"
+
+# Clauses that terminate a WHERE predicate
+CLAUSE_KEYWORDS = re.compile(
+    r"\b(MATCH|OPTIONAL MATCH|MERGE|WITH|RETURN|SET|CREATE|DELETE|DETACH|UNWIND|ORDER BY|LIMIT|ON CREATE|ON MATCH|CALL)\b")
+NODE_PATTERN = re.compile(r"\(\s*(?P<var>\w*)\s*(?P<labels>(?::\s*`?[\w$]+`?\s*)*)(?P<props>\{[^{}]*\})?\s*\)")
+MAP_KEY = re.compile(r"(\w+)\s*:")
+WHERE_EQUALITY = re.compile(r"\b(?P<var>[A-Za-z_]\w*)\.(?P<prop>\w+)\s*(?:(?<![<>!])=(?!~)|\bIN\b)")
+INDEX_LINE = re.compile(
+    r"^\s*CREATE\s+INDEX\s+ON\s+:(?P<label>\w+)\s*\((?P<props>[^)]*)\)\s*(?:#\s*\[(?P<users>[^\]]*)\])?")
+CONSTRAINT_LINE = re.compile(
+    r"^\s*(?P<statement>CREATE\s+CONSTRAINT\s+ON\s+\(\s*\w+\s*:\s*(?P<label>\w+)\s*\)\s+" +
+    r"ASSERT\s+(?P<props>\([^)]*\)|\w+\.\w+)\s+IS\s+(?P<kind>UNIQUE|NODE\s+KEY))" +
+    r"\s*(?:#\s*\[(?P<users>[^\]]*)\])?")
+
+Lookup = namedtuple('Lookup', ['source', 'clause', 'labels', 'properties'])
+Index = namedtuple('Index', ['label', 'properties', 'users'])
+Constraint = namedtuple('Constraint', ['label', 'properties', 'kind', 'users', 'statement'])
+
+
+def _expression_to_text(node):
+    """Flatten string concatenations and f-strings into Cypher text.
+
+    Formatted values are replaced with a parameter placeholder so that
+    label and property positions survive.
+    """
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.JoinedStr):
+        parts = []
+        for value in node.values:
+            if isinstance(value, ast.Constant):
+                parts.append(value.value)
+            else:
+                parts.append(PARAM)
+        return ''.join(parts)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left = _expression_to_text(node.left)
+        right = _expression_to_text(node.right)
+        if left is None and right is None:
+            return None
+        return (left or PARAM) + (right or PARAM)
+    return None
+
+
+def _query_strings(function_node):
+    """Yield Cypher strings assembled inside a function body."""
+    for child in ast.walk(function_node):
+        if isinstance(child, (ast.Assign, ast.Return)):
+            text = _expression_to_text(child.value) if child.value else None
+        elif isinstance(child, ast.Dict):
+            # Queries composed inline in message bodies (e.g. KillDuplicateJobs)
+            for key, value in zip(child.keys, child.values):
+                if isinstance(key, ast.Constant) and key.value == 'cypher':
+                    text = _expression_to_text(value)
+                    if text:
+                        yield text
+            continue
+        else:
+            continue
+        if text and re.search(r"\b(MATCH|MERGE)\b", text):
+            yield text
+
+
+def extract_source_queries(path, label=None):
+    """Find Cypher queries defined in a Python source file.
+
+    Args:
+        path (str): Path to Python source.
+        label (str): Prefix used to name queries from module-level
+                     functions (default: file name).
+    Returns:
+        (list): (source name, cypher) tuples.
+    """
+    with open(path) as fh:
+        source = fh.read()
+    # Don't report invalid escape sequences in the parsed modules
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        tree = ast.parse(source, filename=path)
+    if not label:
+        label = os.path.basename(path)
+
+    queries = []
+    for node in tree.body:
+        # Trigger queries are named after the trigger class; queries
+        # built by functions (format_*query, entry points) after the
+        # module and function.
+        if isinstance(node, ast.ClassDef):
+            for item in node.body:
+                if isinstance(item, ast.FunctionDef):
+                    for query in _query_strings(item):
+                        queries.append((node.name, query))
+        elif isinstance(node, ast.FunctionDef):
+            for query in _query_strings(node):
+                queries.append((f"{label}:{node.name}", query))
+    return queries
+
+
+def _where_segments(query):
+    segments = []
+    for match in re.finditer(r"\bWHERE\b", query):
+        rest = query[match.end():]
+        end = CLAUSE_KEYWORDS.search(rest)
+        segments.append(rest[:end.start()] if end else rest)
+    return segments
+
+
+def _clause_before(query, position):
+    preceding = re.findall(r"\b(MATCH|MERGE|CREATE)\b", query[:position])
+    if preceding:
+        return preceding[-1]
+    return 'MATCH'
+
+
+def extract_lookups(source, query):
+    """Extract node property lookups from a Cypher query.
+
+    Args:
+        source (str): Trigger or function the query belongs to.
+        query (str): Cypher query text.
+    Returns:
+        (list): Lookup tuples. CREATE patterns are not lookups and are
+                skipped.
+    """
+    variable_labels = {}
+    pattern_lookups = []
+    for match in NODE_PATTERN.finditer(query):
+        var = match.group('var')
+        # Labels set from Python values are kept as placeholders
+        labels = tuple(
+                       label.strip(' `') for label in match.group('labels').split(':')
+                       if label.strip(' `'))
+        if var and labels:
+            variable_labels.setdefault(var, [])
+            for label in labels:
+                if label not in variable_labels[var]:
+                    variable_labels[var].append(label)
+
+        props = match.group('props')
+        clause = _clause_before(query, match.start())
+        if props and clause != 'CREATE':
+            keys = tuple(MAP_KEY.findall(props))
+            if keys:
+                pattern_lookups.append((var, labels, clause, keys))
+
+    lookups = []
+    for var, labels, clause, keys in pattern_lookups:
+        if not labels:
+            labels = tuple(variable_labels.get(var, []))
+        if labels:
+            lookups.append(Lookup(source, clause, labels, keys))
+
+    for segment in _where_segments(query):
+        predicates = {}
+        for match in WHERE_EQUALITY.finditer(segment):
+            # Ignore negated comparisons, e.g. "NOT b.obj_exists = false"
+            prefix = segment[:match.start()].rstrip(' (')
+            if prefix.endswith('NOT'):
+                continue
+            var = match.group('var')
+            prop = match.group('prop')
+            predicates.setdefault(var, [])
+            if prop not in predicates[var]:
+                predicates[var].append(prop)
+        for var, props in predicates.items():
+            labels = tuple(variable_labels.get(var, []))
+            if labels:
+                lookups.append(Lookup(source, 'WHERE', labels, tuple(props)))
+    return lookups
+
+
+def collect_lookups(triggers_path=DEFAULT_TRIGGERS, functions_dir=DEFAULT_FUNCTIONS):
+    """Collect lookups from the trigger module and every function."""
+    queries = extract_source_queries(triggers_path)
+    for main_path in sorted(glob.glob(os.path.join(functions_dir, '*', 'main.py'))):
+        function_name = os.path.basename(os.path.dirname(main_path))
+        queries.extend(extract_source_queries(main_path, label=function_name))
+
+    lookups = []
+    for source, query in queries:
+        lookups.extend(extract_lookups(source, query))
+    return lookups
+
+
+def parse_index_file(path=DEFAULT_INDEXES):
+    """Parse "CREATE INDEX ON :Label(prop, ...)  # [User, ...]" lines."""
+    indexes = []
+    with open(path) as fh:
+        for line in fh:
+            match = INDEX_LINE.match(line)
+            if not match:
+                continue
+            props = tuple(prop.strip() for prop in match.group('props').split(',') if prop.strip())
+            users = match.group('users')
+            users = tuple(user.strip() for user in users.split(',')) if users else ()
+            indexes.append(Index(match.group('label'), props, users))
+    return indexes
+
+
+def parse_constraint_file(path=DEFAULT_CONSTRAINTS):
+    """Parse "CREATE CONSTRAINT ON (n:Label) ASSERT ... IS UNIQUE|NODE KEY" lines."""
+    constraints = []
+    with open(path) as fh:
+        for line in fh:
+            match = CONSTRAINT_LINE.match(line)
+            if not match:
+                continue
+            props = tuple(
+                          prop.split('.')[-1].strip()
+                          for prop in match.group('props').strip('()').split(',')
+                          if prop.strip())
+            kind = ' '.join(match.group('kind').split())
+            users = match.group('users')
+            users = tuple(user.strip() for user in users.split(',')) if users else ()
+            constraints.append(Constraint(
+                                          match.group('label'),
+                                          props,
+                                          kind,
+                                          users,
+                                          match.group('statement').strip()))
+    return constraints
+
+
+def get_database_indexes(graph):
+    """Get indexes installed in a running Neo4j database.
+
+    Args:
+        graph (py2neo.Graph): Database connection.
+    Returns:
+        (list): Index tuples.
+    """
+    indexes = []
+    for record in graph.run("CALL db.indexes()").data():
+        # Neo4j 3.5 returns "tokenNames"; 4.x returns "labelsOrTypes"
+        labels = record.get('labelsOrTypes') or record.get('tokenNames') or []
+        properties = record.get('properties') or []
+        if record.get('entityType', 'NODE') != 'NODE' or not labels:
+            continue
+        indexes.append(Index(labels[0], tuple(properties), ()))
+    return indexes
+
+
+def index_serves(index, lookup):
+    """An index serves a lookup when its label is one of the lookup's
+    labels and every indexed property is constrained by the lookup.
+    """
+    return (
+            index.label in lookup.labels and
+            set(index.properties).issubset(set(lookup.properties)))
+
+
+def format_create_index(label, properties):
+    return f"CREATE INDEX ON :{label}({', '.join(properties)})"
+
+
+def analyze(lookups, indexes):
+    """Compare lookups against indexes.
+
+    Returns:
+        (dict): "missing", "reorder" and "unused" findings.
+    """
+    missing = {}
+    for lookup in lookups:
+        if any(index_serves(index, lookup) for index in indexes):
+            continue
+        # Suggest an index on the primary label (e.g. Blob, Job)
+        static_labels = [label for label in lookup.labels if label != PARAM]
+        if not static_labels:
+            continue
+        key = (static_labels[0], lookup.properties)
+        missing.setdefault(key, set()).add(lookup.source)
+
+    reorder = {}
+    for index in indexes:
+        if len(index.properties) < 2:
+            continue
+        for lookup in lookups:
+            if (index.label in lookup.labels and
+                    set(index.properties) == set(lookup.properties) and
+                    tuple(index.properties) != tuple(lookup.properties)):
+                key = (index, lookup.properties)
+                reorder.setdefault(key, set()).add(lookup.source)
+
+    unused = [
+              index for index in indexes
+              if not any(index_serves(index, lookup) for lookup in lookups)]
+
+    return {
+            "missing": missing,
+            "reorder": reorder,
+            "unused": unused,
+    }
+
+
+def format_report(findings):
+    lines = []
+
+    lines.append(f"# Missing indexes ({len(findings['missing'])})")
+    for (label, properties), sources in sorted(findings['missing'].items()):
+        lines.append(f"{format_create_index(label, properties)} # [{', '.join(sorted(sources))}]")
+
+    lines.append(f"# Composite indexes in a different order than their lookups ({len(findings['reorder'])})")
+    for (index, properties), sources in sorted(findings['reorder'].items()):
+        lines.append(
+                     f"# {format_create_index(index.label, index.properties)} -> " +
+                     f"{format_create_index(index.label, properties)} " +
+                     f"# [{', '.join(sorted(sources))}]")
+
+    lines.append(f"# Unused indexes ({len(findings['unused'])})")
+    for index in findings['unused']:
+        lines.append(f"# {format_create_index(index.label, index.properties)}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--triggers', default=DEFAULT_TRIGGERS)
+    parser.add_argument('--functions', default=DEFAULT_FUNCTIONS)
+    parser.add_argument('--indexes', default=DEFAULT_INDEXES,
+                        help="Index file to check. Ignored when --neo4j-url is set.")
+    parser.add_argument('--constraints', default=DEFAULT_CONSTRAINTS,
+                        help="Constraint file; each constraint is backed by an index.")
+    parser.add_argument('--neo4j-url', help="Check a running (test) Neo4j instead of the index file.")
+    parser.add_argument('--neo4j-user', default='neo4j')
+    parser.add_argument('--neo4j-password', default='')
+    parser.add_argument('--apply', action='store_true',
+                        help="Create missing indexes in the Neo4j database.")
+    args = parser.parse_args(argv)
+
+    lookups = collect_lookups(args.triggers, args.functions)
+
+    graph = None
+    if args.neo4j_url:
+        from py2neo import Graph
+        graph = Graph(args.neo4j_url, user=args.neo4j_user, password=args.neo4j_password)
+        indexes = get_database_indexes(graph)
+    else:
+        indexes = parse_index_file(args.indexes)
+        for constraint in parse_constraint_file(args.constraints):
+            indexes.append(Index(constraint.label, constraint.properties, constraint.users))
+
+    findings = analyze(lookups, indexes)
+    print(format_report(findings))
+
+    if args.apply:
+        if not graph:
+            parser.error("--apply requires --neo4j-url.")
+        for label, properties in sorted(findings['missing']):
+            statement = format_create_index(label, properties)
+            print(f"> Running: {statement}")
+            graph.run(statement)
+
+    return 1 if findings['missing'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
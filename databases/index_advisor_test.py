@@ -0,0 +1,68 @@
+import index_advisor
+
+from index_advisor import Index, Lookup
+
+
+class TestExtractLookups:
+
+    def test_merge_pattern(self):
+        query = (
+                 "MERGE (node:Blob:Fastq:$param { uri: \"$param\" }) " +
+                 "ON CREATE SET node.nodeCreated = timestamp() " +
+                 "RETURN node")
+        lookups = index_advisor.extract_lookups('format_node_merge_query', query)
+        assert lookups == [Lookup('format_node_merge_query', 'MERGE', ('Blob', 'Fastq', '$param'), ('uri',))]
+
+    def test_where_predicates(self):
+        query = (
+                 "MATCH (n:Job) " +
+                 "WHERE n.sample = \"$param\" " +
+                 "AND n.name = \"$param\" " +
+                 "AND n.inputHash = \"$param\" " +
+                 "AND n.status = \"RUNNING\" " +
+                 "WITH n.inputHash AS hash, COLLECT(n) AS nodes " +
+                 "RETURN nodes")
+        lookups = index_advisor.extract_lookups('KillDuplicateJobs', query)
+        assert lookups == [
+            Lookup('KillDuplicateJobs', 'WHERE', ('Job',), ('sample', 'name', 'inputHash', 'status'))]
+
+    def test_ignore_create_and_negation(self):
+        query = (
+                 "MATCH (b:Blob) " +
+                 "WHERE NOT b.obj_exists = false " +
+                 "CREATE (j:JobRequest { sample: b.sample }) " +
+                 "RETURN j")
+        lookups = index_advisor.extract_lookups('Test', query)
+        assert lookups == []
+
+
+class TestAnalyze:
+
+    def test_findings(self):
+        lookups = [
+            Lookup('RelateDstatToJob', 'MATCH', ('Dstat',), ('jobId', 'instanceName')),
+            Lookup('KillDuplicateJobs', 'WHERE', ('Job',), ('sample', 'name')),
+            Lookup('RelateTbiToMergedVcf', 'WHERE', ('Tbi',), ('id',)),
+        ]
+        indexes = [
+            Index('Dstat', ('instanceName', 'jobId'), ()),
+            Index('Job', ('sample',), ()),
+            Index('Cram', ('uri',), ()),
+        ]
+        findings = index_advisor.analyze(lookups, indexes)
+
+        assert findings['missing'] == {('Tbi', ('id',)): {'RelateTbiToMergedVcf'}}
+        assert list(findings['reorder']) == [(indexes[0], ('jobId', 'instanceName'))]
+        assert findings['unused'] == [indexes[2]]
+
+
+class TestRepository:
+
+    def test_index_file_parsed(self):
+        indexes = index_advisor.parse_index_file()
+        assert Index('Job', ('sample', 'name', 'inputHash', 'status'), ('KillDuplicateJobs',)) in indexes
+
+    def test_trigger_lookups_found(self):
+        sources = set(lookup.source for lookup in index_advisor.collect_lookups())
+        assert 'LaunchFastqToUbam' in sources
+        assert 'create-blob-node:format_node_merge_query' in sources
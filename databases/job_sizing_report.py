@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Fit job sizing models from the database and compare them to current sizing.
+
+Reads completed dsub Job nodes with their Dstat status and the size of
+their inputs, fits a job_sizing model per task and prints a dry-run
+report of the runtime and cost of the recorded jobs with their current
+and proposed resources. Nothing is changed in the database; launch
+functions only use the models once they are written with --output and
+JOB_SIZING_MODELS in the Trellis vars points to them.
+
+Usage:
+    # Report from the database, and save the history for later runs
+    python databases/job_sizing_report.py --vars-file trellis-vars.yaml --save-history history.json
+
+    # Minimize runtime instead of cost, and write the models
+    python databases/job_sizing_report.py --history history.json --objective time --output job-sizing.json
+    gsutil cp job-sizing.json gs://trellis-bucket/job-sizing.json
+"""
+
+import os
+import sys
+import json
+import argparse
+
+SHARED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'shared')
+sys.path.insert(0, SHARED_DIR)
+
+import job_sizing
+
+HISTORY_QUERY = (
+                 "MATCH (job:Job:Dsub) " +
+                 "WHERE job.durationMinutes IS NOT NULL " +
+                    "AND ($tasks IS NULL OR job.name IN $tasks) " +
+                 "OPTIONAL MATCH (job)-[:STATUS]->(dstat:Dstat) " +
+                 "WHERE dstat.status IN [\"SUCCESS\", \"FAILURE\"] " +
+                 "WITH job, HEAD(COLLECT(dstat)) AS dstat " +
+                 "OPTIONAL MATCH (input:Blob) " +
+                 "WHERE input.id IN job.inputIds " +
+                 "RETURN " +
+                    "job.name AS name, " +
+                    "job.durationMinutes AS durationMinutes, " +
+                    "job.minCores AS minCores, " +
+                    "job.minRam AS minRam, " +
+                    "job.machineType AS machineType, " +
+                    "job.diskSize AS diskSize, " +
+                    "SUM(input.size) AS inputBytes, " +
+                    "dstat.status AS dstatStatus, " +
+                    "dstat.machineType AS dstatMachineType")
+
+
+def read_history(graph, tasks=None):
+    """Job history records for job_sizing.run_from_record()."""
+    return graph.run(HISTORY_QUERY, tasks=tasks).data()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--vars-file', help="Trellis vars YAML with Neo4j connection values.")
+    parser.add_argument('--history', help="Read job history saved with --save-history instead of the database.")
+    parser.add_argument('--save-history', help="Write the job history read from the database to this file.")
+    parser.add_argument('--task', action='append', dest='tasks', help="Only fit this task; can be repeated.")
+    parser.add_argument('--objective', choices=job_sizing.OBJECTIVES, default='cost')
+    parser.add_argument('--min-shape-runs', type=int, default=job_sizing.MIN_SHAPE_RUNS)
+    parser.add_argument('--disk-per-input-gb', type=float, default=job_sizing.DISK_PER_INPUT_GB)
+    parser.add_argument('--output', help="Write the fitted models to this file.")
+    args = parser.parse_args(argv)
+
+    if args.history:
+        with open(args.history) as fh:
+            records = json.load(fh)
+        if args.tasks:
+            records = [record for record in records if record.get('name') in args.tasks]
+    elif args.vars_file:
+        from schema_migrations import load_graph
+        records = read_history(load_graph(args.vars_file), args.tasks)
+        if args.save_history:
+            with open(args.save_history, 'w') as fh:
+                json.dump(records, fh)
+    else:
+        parser.error("--vars-file or --history is required.")
+
+    runs = [run for run in map(job_sizing.run_from_record, records) if run]
+    print(f"> Read {len(records)} jobs; {len(runs)} finished with known inputs and resources.")
+
+    models = job_sizing.fit_models(runs, args.min_shape_runs, args.disk_per_input_gb)
+    print(job_sizing.format_report(job_sizing.compare_sizing(models, runs, args.objective)))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(models, fh, indent=4, sort_keys=True)
+        print(f"> Wrote models for {len(models)} tasks to {args.output}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,39 @@
+import json
+
+import job_sizing_report
+
+
+def record(name, size_gb, minutes, machine_type='custom-1-3840', status='SUCCESS'):
+    return {
+            'name': name,
+            'durationMinutes': minutes,
+            'minCores': 1,
+            'minRam': None,
+            'machineType': None,
+            'diskSize': 500,
+            'inputBytes': size_gb * 1000 ** 3,
+            'dstatStatus': status,
+            'dstatMachineType': machine_type}
+
+
+class TestMain:
+
+    def test_history_file(self, tmp_path, capsys):
+        history = tmp_path / 'history.json'
+        history.write_text(json.dumps(
+            [record('flagstat', size, size * 2) for size in (10, 20, 30)] +
+            [record('flagstat', 10, None), record('vcfstats', 1, 5, status='RUNNING')]))
+        output = tmp_path / 'models.json'
+
+        assert job_sizing_report.main(['--history', str(history), '--output', str(output)]) == 0
+
+        report = capsys.readouterr().out
+        assert "Read 5 jobs; 3 finished" in report
+        assert "flagstat" in report
+        models = json.loads(output.read_text())
+        assert list(models) == ['flagstat']
+        assert models['flagstat']['shapes'][0]['cores'] == 1
+
+    def test_history_query_parameters(self):
+        assert "$tasks" in job_sizing_report.HISTORY_QUERY
+        assert "job.inputIds" in job_sizing_report.HISTORY_QUERY
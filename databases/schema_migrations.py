@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""Install Trellis uniqueness/node-key constraints and check MERGE keys.
+
+Constraints are listed in db-constraints.txt. Each one must match the
+keys used by the MERGE statements that create nodes with that label, so
+that concurrent MERGEs are serialized by the constraint instead of
+creating duplicate nodes that have to be cleaned up by triggers later.
+
+The migration is idempotent: constraints that already exist are left
+alone, and plain indexes on the same properties (which Neo4j refuses to
+replace implicitly) are dropped before the constraint is created.
+Node keys are only available in Neo4j Enterprise; on Community, a plain
+index on the node key properties is created once and kept instead.
+
+Usage:
+    # Check MERGE statements against db-constraints.txt (no database)
+    python databases/schema_migrations.py --verify-only
+
+    # Apply to a database described by a Trellis vars file
+    python databases/schema_migrations.py --vars-file trellis-vars.yaml
+"""
+
+import re
+import sys
+import logging
+import argparse
+
+from collections import namedtuple
+
+import index_advisor
+
+from index_advisor import DEFAULT_CONSTRAINTS, DEFAULT_TRIGGERS, DEFAULT_FUNCTIONS
+
+MergeKeyError = namedtuple('MergeKeyError', ['source', 'labels', 'properties', 'reason'])
+
+DESCRIPTION_LABEL = re.compile(r":\s*(\w+)\s*\)")
+DESCRIPTION_PROPS = re.compile(r"\w+\.(\w+)")
+
+
+def verify_merge_keys(lookups, constraints):
+    """Check that every MERGE on a constrained label uses its keys.
+
+    A MERGE only benefits from a constraint when it matches on exactly
+    the constrained label and properties. Extra labels in the pattern are
+    also reported: if an existing node lacks one of them, MERGE tries to
+    create a second node and fails on the constraint.
+
+    Args:
+        lookups (list): index_advisor.Lookup tuples.
+        constraints (list): index_advisor.Constraint tuples.
+    Returns:
+        (list): MergeKeyError tuples; empty if all MERGEs are aligned.
+    """
+    constraint_keys = {}
+    for constraint in constraints:
+        constraint_keys.setdefault(constraint.label, []).append(set(constraint.properties))
+
+    errors = []
+    for lookup in lookups:
+        if lookup.clause != 'MERGE':
+            continue
+        constrained = [label for label in lookup.labels if label in constraint_keys]
+        if not constrained:
+            continue
+        for label in constrained:
+            if set(lookup.properties) not in constraint_keys[label]:
+                errors.append(MergeKeyError(
+                                            lookup.source,
+                                            lookup.labels,
+                                            lookup.properties,
+                                            f"MERGE keys do not match any constraint on :{label}."))
+        if len(lookup.labels) > 1:
+            errors.append(MergeKeyError(
+                                        lookup.source,
+                                        lookup.labels,
+                                        lookup.properties,
+                                        f"MERGE pattern should only use the constrained label; " +
+                                        "set other labels with ON CREATE/ON MATCH."))
+    return errors
+
+
+def get_database_constraints(graph):
+    """Get (label, properties, kind) of constraints installed in Neo4j."""
+    installed = set()
+    for record in graph.run("CALL db.constraints()").data():
+        description = record['description']
+        label = DESCRIPTION_LABEL.search(description)
+        assertion = description.split('ASSERT')[-1]
+        properties = tuple(DESCRIPTION_PROPS.findall(assertion))
+        kind = 'NODE KEY' if 'NODE KEY' in description else 'UNIQUE'
+        if label:
+            installed.add((label.group(1), properties, kind))
+    return installed
+
+
+def supports_node_keys(graph):
+    """Whether the database edition can create NODE KEY constraints."""
+    editions = {record['edition'] for record in graph.run("CALL dbms.components()").data()}
+    return 'enterprise' in editions
+
+
+def count_duplicates(graph, constraint):
+    """Count key values shared by more than one node.
+
+    Nodes without all of the key properties aren't covered by a
+    uniqueness constraint, so they are not counted.
+    """
+    keys = ', '.join(f"n.{prop}" for prop in constraint.properties)
+    present = ' AND '.join(f"n.{prop} IS NOT NULL" for prop in constraint.properties)
+    query = (
+             f"MATCH (n:{constraint.label}) " +
+             f"WHERE {present} " +
+             f"WITH [{keys}] AS key, COUNT(n) AS nodes " +
+             "WHERE nodes > 1 " +
+             "RETURN COUNT(key) AS duplicates")
+    return graph.run(query).evaluate()
+
+
+def count_missing_keys(graph, constraint):
+    """Count nodes missing a node key property, which a NODE KEY rejects."""
+    missing = ' OR '.join(f"n.{prop} IS NULL" for prop in constraint.properties)
+    query = (
+             f"MATCH (n:{constraint.label}) " +
+             f"WHERE {missing} " +
+             "RETURN COUNT(n) AS missing")
+    return graph.run(query).evaluate()
+
+
+def migrate(graph, constraints, dry_run=False):
+    """Install missing constraints.
+
+    Args:
+        graph (py2neo.Graph): Database connection.
+        constraints (list): index_advisor.Constraint tuples.
+        dry_run (bool): Only print the statements that would be run.
+    Returns:
+        (list): Statements that were (or would have been) run.
+    """
+    installed = get_database_constraints(graph)
+    indexes = index_advisor.get_database_indexes(graph)
+    node_keys = supports_node_keys(graph)
+
+    statements = []
+    for constraint in constraints:
+        key = (constraint.label, constraint.properties, constraint.kind)
+        if key in installed:
+            logging.info(f"> Constraint exists: {constraint.statement}.")
+            continue
+
+        matching_indexes = [
+                            index for index in indexes
+                            if index.label == constraint.label and
+                               set(index.properties) == set(constraint.properties)]
+
+        if constraint.kind == 'NODE KEY' and not node_keys:
+            # Community edition: an index on the keys keeps lookups fast
+            if matching_indexes:
+                logging.info(f"> Node keys not supported; index exists for {constraint.statement}.")
+                continue
+            logging.warning(f"> Node keys not supported; creating index instead of {constraint.statement}.")
+            statement = index_advisor.format_create_index(constraint.label, constraint.properties)
+            statements.append(statement)
+            if dry_run:
+                print(f"> Dry run: would run: {statement}")
+            else:
+                print(f"> Running: {statement}")
+                graph.run(statement)
+            continue
+
+        # Neo4j won't create a constraint over an existing plain index
+        constraint_statements = []
+        for index in matching_indexes:
+            constraint_statements.append(
+                f"DROP INDEX ON :{index.label}({', '.join(index.properties)})")
+        constraint_statements.append(constraint.statement)
+        statements.extend(constraint_statements)
+
+        if dry_run:
+            for statement in constraint_statements:
+                print(f"> Dry run: would run: {statement}")
+            continue
+
+        duplicates = count_duplicates(graph, constraint)
+        if duplicates:
+            raise RuntimeError(
+                               f"Cannot create constraint; {duplicates} duplicate " +
+                               f"key values on :{constraint.label}{constraint.properties}. " +
+                               "Resolve duplicates and re-run the migration.")
+        if constraint.kind == 'NODE KEY':
+            missing = count_missing_keys(graph, constraint)
+            if missing:
+                raise RuntimeError(
+                                   f"Cannot create node key; {missing} :{constraint.label} " +
+                                   f"nodes are missing one of {constraint.properties}. " +
+                                   "Set the properties and re-run the migration.")
+
+        for statement in constraint_statements:
+            print(f"> Running: {statement}")
+            graph.run(statement)
+    return statements
+
+
+def load_graph(vars_file):
+    """Connect to Neo4j using the NEO4J_* values of a Trellis vars file."""
+    import yaml
+    from py2neo import Graph
+
+    with open(vars_file) as fh:
+        parsed_vars = yaml.load(fh, Loader=yaml.Loader)
+
+    return Graph(
+                 scheme=parsed_vars['NEO4J_SCHEME'],
+                 host=parsed_vars['NEO4J_HOST'],
+                 port=parsed_vars['NEO4J_PORT'],
+                 user=parsed_vars['NEO4J_USER'],
+                 password=parsed_vars['NEO4J_PASSPHRASE'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--constraints', default=DEFAULT_CONSTRAINTS)
+    parser.add_argument('--triggers', default=DEFAULT_TRIGGERS)
+    parser.add_argument('--functions', default=DEFAULT_FUNCTIONS)
+    parser.add_argument('--vars-file', help="Trellis vars YAML with Neo4j connection values.")
+    parser.add_argument('--verify-only', action='store_true',
+                        help="Only check MERGE statements against the constraints.")
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args(argv)
+
+    constraints = index_advisor.parse_constraint_file(args.constraints)
+    lookups = index_advisor.collect_lookups(args.triggers, args.functions)
+
+    errors = verify_merge_keys(lookups, constraints)
+    for error in errors:
+        print(f"> {error.source}: MERGE :{':'.join(error.labels)}{error.properties}. {error.reason}")
+    if errors:
+        return 1
+    print(f"> All MERGE statements match the {len(constraints)} constraints.")
+
+    if args.verify_only:
+        return 0
+    if not args.vars_file:
+        parser.error("--vars-file is required unless --verify-only is set.")
+
+    graph = load_graph(args.vars_file)
+    migrate(graph, constraints, dry_run=args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import pytest
+
+import schema_migrations
+
+from index_advisor import Constraint, Lookup
+
+
+CONSTRAINTS = [
+    Constraint('Blob', ('uri',), 'UNIQUE', (), ''),
+    Constraint('Dstat', ('instanceName', 'jobId'), 'NODE KEY', (), ''),
+]
+
+
+class TestVerifyMergeKeys:
+
+    def test_aligned_merges(self):
+        lookups = [
+            Lookup('create-blob-node', 'MERGE', ('Blob',), ('uri',)),
+            Lookup('check-dstat', 'MERGE', ('Dstat',), ('jobId', 'instanceName')),
+            Lookup('RelateDstatToJob', 'MATCH', ('Dstat',), ('jobId',)),
+            Lookup('create-job-node', 'MERGE', ('Job',), ('trellisTaskId',)),
+        ]
+        assert schema_migrations.verify_merge_keys(lookups, CONSTRAINTS) == []
+
+    def test_mismatched_keys(self):
+        lookups = [Lookup('create-blob-node', 'MERGE', ('Blob',), ('bucket', 'path'))]
+        errors = schema_migrations.verify_merge_keys(lookups, CONSTRAINTS)
+        assert len(errors) == 1
+        assert errors[0].source == 'create-blob-node'
+
+    def test_extra_labels(self):
+        lookups = [Lookup('create-blob-node', 'MERGE', ('Blob', 'Fastq'), ('uri',))]
+        errors = schema_migrations.verify_merge_keys(lookups, CONSTRAINTS)
+        assert [error.properties for error in errors] == [('uri',)]
+
+
+class FakeGraph:
+
+    def __init__(self, edition, indexes=(), duplicates=0, missing=0):
+        self.edition = edition
+        self.indexes = [{"tokenNames": [label], "properties": list(properties)} for label, properties in indexes]
+        # Counts returned by the duplicate and missing key checks
+        self.duplicates = duplicates
+        self.missing = missing
+        self.checks = []
+        self.statements = []
+
+    def run(self, query):
+        value = None
+        if query == "CALL dbms.components()":
+            records = [{"name": "Neo4j Kernel", "edition": self.edition}]
+        elif query == "CALL db.indexes()":
+            records = self.indexes
+        elif query == "CALL db.constraints()":
+            records = []
+        elif query.startswith("MATCH"):
+            self.checks.append(query)
+            records = []
+            value = self.duplicates if "COUNT(key)" in query else self.missing
+        else:
+            self.statements.append(query)
+            records = []
+        return FakeCursor(records, value)
+
+
+class FakeCursor:
+
+    def __init__(self, records, value=None):
+        self.records = records
+        self.value = value
+
+    def data(self):
+        return self.records
+
+    def evaluate(self):
+        return self.value
+
+
+class TestMigrate:
+
+    def test_enterprise(self):
+        graph = FakeGraph('enterprise', indexes=[('Dstat', ('jobId', 'instanceName'))])
+        statements = schema_migrations.migrate(graph, CONSTRAINTS)
+
+        assert statements == graph.statements
+        assert statements[1] == "DROP INDEX ON :Dstat(jobId, instanceName)"
+        assert len(statements) == 3
+
+    def test_community_keeps_index(self):
+        graph = FakeGraph('community', indexes=[('Dstat', ('jobId', 'instanceName'))])
+        statements = schema_migrations.migrate(graph, CONSTRAINTS)
+
+        # Only the unique constraint; the existing index stands in for the node key
+        assert statements == graph.statements
+        assert len(statements) == 1
+        assert not any(statement.startswith("DROP INDEX") for statement in statements)
+
+    def test_community_creates_index(self):
+        graph = FakeGraph('community')
+        statements = schema_migrations.migrate(graph, CONSTRAINTS)
+        assert statements[-1] == "CREATE INDEX ON :Dstat(instanceName, jobId)"
+
+    def test_duplicates(self):
+        graph = FakeGraph('enterprise', duplicates=2)
+        with pytest.raises(RuntimeError, match="2 duplicate key values on :Blob"):
+            schema_migrations.migrate(graph, CONSTRAINTS)
+        # Nodes without the key aren't grouped together as duplicates
+        assert "WHERE n.uri IS NOT NULL " in graph.checks[0]
+        assert graph.statements == []
+
+    def test_missing_node_keys(self):
+        graph = FakeGraph('enterprise', missing=5)
+        with pytest.raises(RuntimeError, match="5 :Dstat nodes are missing"):
+            schema_migrations.migrate(graph, CONSTRAINTS)
+        assert "WHERE n.instanceName IS NOT NULL AND n.jobId IS NOT NULL " in graph.checks[1]
+        assert "WHERE n.instanceName IS NULL OR n.jobId IS NULL " in graph.checks[2]
@@ -0,0 +1,151 @@
+import os
+import json
+import yaml
+import logging
+
+from google.cloud import storage
+from google.cloud import pubsub
+
+import admission
+
+ENVIRONMENT = os.environ.get('ENVIRONMENT', '')
+if ENVIRONMENT == 'google-cloud':
+    FUNCTION_NAME = os.environ['FUNCTION_NAME']
+
+    vars_blob = storage.Client() \
+                .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
+                .get_blob(os.environ['CREDENTIALS_BLOB']) \
+                .download_as_string()
+    parsed_vars = yaml.load(vars_blob, Loader=yaml.Loader)
+
+    PROJECT_ID = parsed_vars['GOOGLE_CLOUD_PROJECT']
+    ADMISSION = admission.load_config(parsed_vars)
+    if not ADMISSION:
+        raise ValueError("admit-jobs requires JOB_ADMISSION.")
+    HELD_SUBSCRIPTION = parsed_vars['SUBSCRIPTION_ADMIT_JOBS']
+    # Second subscription to TOPIC_JOB_EVENTS
+    JOB_EVENTS_SUBSCRIPTION = parsed_vars['SUBSCRIPTION_ADMISSION_JOB_EVENTS']
+
+    PUBLISHER = pubsub.PublisherClient()
+    SUBSCRIBER = pubsub.SubscriberClient()
+    STORAGE_CLIENT = storage.Client()
+
+# Messages requested by each pull
+MAX_MESSAGES = 1000
+# Messages left in the subscriptions are read in the next window
+MAX_EVENTS = 10000
+
+
+def publish_to_topic(topic, data):
+    topic_path = PUBLISHER.topic_path(PROJECT_ID, topic)
+    message = json.dumps(data).encode('utf-8')
+    result = PUBLISHER.publish(topic_path, data=message).result()
+    return result
+
+
+def pull_messages(subscription_path, max_events=MAX_EVENTS):
+    """Pull the messages waiting in a subscription.
+
+    Returns:
+        (list): (message ID, data) of each message.
+        (list): Acknowledgement IDs of the pulled messages.
+    """
+    messages = []
+    ack_ids = []
+    while len(ack_ids) < max_events:
+        response = SUBSCRIBER.pull(
+                                   subscription_path,
+                                   max_messages=MAX_MESSAGES,
+                                   return_immediately=True)
+        if not response.received_messages:
+            break
+        for received in response.received_messages:
+            ack_ids.append(received.ack_id)
+            try:
+                messages.append((received.message.message_id, json.loads(received.message.data.decode('utf-8'))))
+            except ValueError:
+                logging.error(f"> Could not parse message; discarding: {received.message.data}.")
+    return messages, ack_ids
+
+
+def load_state(uri, client=None):
+    """Load the admission state from a "gs://bucket/path" object or local file."""
+    if uri.startswith('gs://'):
+        bucket, _, path = uri[len('gs://'):].partition('/')
+        blob = (client or storage.Client()).bucket(bucket).get_blob(path)
+        if blob is None:
+            return admission.new_state()
+        return json.loads(blob.download_as_string())
+    if not os.path.exists(uri):
+        return admission.new_state()
+    with open(uri) as fh:
+        return json.load(fh)
+
+
+def save_state(uri, state, client=None):
+    data = json.dumps(state)
+    if uri.startswith('gs://'):
+        bucket, _, path = uri[len('gs://'):].partition('/')
+        (client or storage.Client()).bucket(bucket).blob(path).upload_from_string(data)
+    else:
+        with open(uri, 'w') as fh:
+            fh.write(data)
+
+
+def update_state(state, config, held, job_events, now=None):
+    """Queue held jobs, track instances and admit the jobs that fit.
+
+    Args:
+        state (dict): Admission state.
+        config (dict): JOB_ADMISSION value of the Trellis vars.
+        held (list): (message ID, hold message) of each hold request.
+        job_events (list): Events published to TOPIC_JOB_EVENTS.
+    Returns:
+        (list): Admitted jobs.
+    """
+    for message_id, message in held:
+        admission.add_held(state, config, message, message_id, now)
+    admission.record_job_events(state, config, job_events)
+    admission.expire(state, now)
+    return admission.release(state, config, now)
+
+
+def admit_jobs(event, context):
+    """Triggered by a Cloud Scheduler message on a Pub/Sub topic.
+
+    Read the jobs held by launch functions and the job events since
+    the last run, and release the held jobs that fit their task and
+    region quotas to their launch functions. Only one instance of
+    this function may run, since it owns the admission state.
+
+    Launches are published before the state is saved and messages are
+    acknowledged, so a failed run can launch a job twice but never
+    loses one; duplicate jobs are stopped by KillDuplicateJobs.
+
+    Args:
+        event (dict): Event payload.
+        context (google.cloud.functions.Context): Metadata for the event.
+    """
+    held_path = SUBSCRIBER.subscription_path(PROJECT_ID, HELD_SUBSCRIPTION)
+    events_path = SUBSCRIBER.subscription_path(PROJECT_ID, JOB_EVENTS_SUBSCRIPTION)
+    held, held_ack_ids = pull_messages(held_path)
+    job_events, event_ack_ids = pull_messages(events_path)
+
+    state = load_state(ADMISSION['store'], STORAGE_CLIENT)
+    admitted = update_state(state, ADMISSION, held, [data for message_id, data in job_events])
+
+    jobs, cores = admission.usage(state, ADMISSION)
+    logging.info(
+                 f"> Admitted {len(admitted)} jobs; {len(state['pending'])} held. " +
+                 f"Jobs by task: {jobs}. Cores by region: {cores}.")
+
+    for topic, message in admission.format_release_messages(admitted, ADMISSION, FUNCTION_NAME, context.event_id):
+        result = publish_to_topic(topic, message)
+        logging.info(f"> Released {len(message['body']['results'])} jobs to {topic} with result: {result}.")
+
+    save_state(ADMISSION['store'], state, STORAGE_CLIENT)
+
+    for path, ack_ids in [(held_path, held_ack_ids), (events_path, event_ack_ids)]:
+        for start in range(0, len(ack_ids), MAX_MESSAGES):
+            SUBSCRIBER.acknowledge(path, ack_ids[start:start + MAX_MESSAGES])
+    return len(admitted)
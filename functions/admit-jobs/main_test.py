@@ -0,0 +1,44 @@
+import admission
+
+import main
+
+CONFIG = {
+          "tasks": {"fastq-to-ubam": {"topic": "fastq-to-ubam-topic", "maxRunning": 2, "cores": 1}},
+          "regions": {},
+}
+
+
+def held(message_id, count):
+    results = [{"nodes": [{"id": f"{message_id}-{index}"}]} for index in range(count)]
+    [message] = admission.format_hold_messages('fastq-to-ubam', results, ['us-west1'], {"seedId": 1}, 'launcher', 2)
+    return message_id, message
+
+
+class TestUpdateState:
+
+    def test_admit_and_release(self):
+        state = admission.new_state()
+        admitted = main.update_state(state, CONFIG, [held('m1', 3)], [], now=100)
+        assert len(admitted) == 2
+
+        job_events = [
+            {"instanceName": "vm-1", "trellisName": "fastq-to-ubam", "timeEpoch": 110,
+             "properties": {"status": "RUNNING", "zone": "us-west1-a"}},
+            {"instanceName": "vm-1", "timeEpoch": 150, "properties": {"status": "STOPPED"}},
+        ]
+        admitted = main.update_state(state, CONFIG, [held('m1', 3)], job_events, now=200)
+        # Redelivered hold message isn't queued twice
+        assert [job['result']['nodes'][0]['id'] for job in admitted] == ['m1-2']
+        assert state['pending'] == []
+
+
+class TestStateStore:
+
+    def test_local_file(self, tmp_path):
+        uri = str(tmp_path / 'state.json')
+        assert main.load_state(uri) == admission.new_state()
+
+        state = admission.new_state()
+        main.update_state(state, CONFIG, [held('m1', 3)], [], now=100)
+        main.save_state(uri, state)
+        assert main.load_state(uri) == state
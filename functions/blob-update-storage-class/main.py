@@ -1,18 +1,102 @@
 import os
 import re
 import json
+import time
+import yaml
 import base64
 import logging
+import threading
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import pubsub
 from google.cloud import storage
 from google.api_core import exceptions
 
+import claim_check
+
 ENVIRONMENT = os.environ.get('ENVIRONMENT', '')
 if ENVIRONMENT == 'google-cloud':
     FUNCTION_NAME = os.environ['FUNCTION_NAME']
     PROJECT_ID = os.environ['GCP_PROJECT']
 
+    vars_blob = storage.Client() \
+                .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
+                .get_blob(os.environ['CREDENTIALS_BLOB']) \
+                .download_as_string()
+    parsed_vars = yaml.load(vars_blob, Loader=yaml.Loader)
+
+    DB_QUERY_TOPIC = parsed_vars['DB_QUERY_TOPIC']
+    TOPIC_BLOB_UPDATE_STORAGE = parsed_vars['TOPIC_BLOB_UPDATE_STORAGE']
+
     CLIENT = storage.Client()
+    PUBLISHER = pubsub.PublisherClient()
+
+# Concurrent rewrites in bulk mode
+MAX_WORKERS = 8
+# Seconds after which no more rewrite calls are started and unfinished
+# rewrites are requeued. The function times out after 540 seconds.
+TIME_LIMIT = 420
+
+# Per-object outcomes in bulk mode
+UPDATED = 'updated'
+IN_PROGRESS = 'in-progress'
+INVALID = 'invalid'
+FAILED = 'failed'
+DRY_RUN = 'dry-run'
+
+# Rewrites are independent requests, so each worker uses its own client
+_LOCAL = threading.local()
+
+
+def _get_worker_client():
+    if not hasattr(_LOCAL, 'client'):
+        _LOCAL.client = storage.Client()
+    return _LOCAL.client
+
+
+def format_pubsub_message(query, seed_id, event_id):
+    message = {
+               "header": {
+                          "resource": "query",
+                          "method": "UPDATE",
+                          "labels": ["Update", "Blob", "Storage", "Class", "Cypher", "Query"],
+                          "sentFrom": FUNCTION_NAME,
+                          "seedId": f"{seed_id}",
+                          "previousEventId": f"{event_id}"
+               },
+               "body": {
+                        "cypher": query,
+                        "result-mode": "stats",
+               },
+    }
+    return message
+
+
+def format_resume_message(header, rows, event_id):
+    """Requeue unfinished transitions, with their rewrite tokens."""
+    message = {
+               "header": {
+                          "resource": "queryResult",
+                          "method": header.get('method'),
+                          "labels": header.get('labels', []) + ["Resume"],
+                          "sentFrom": FUNCTION_NAME,
+                          "seedId": header.get('seedId', f"{event_id}"),
+                          "previousEventId": f"{event_id}"
+               },
+               "body": {
+                        "results": rows,
+               },
+    }
+    return message
+
+
+def publish_to_topic(topic, data):
+    topic_path = PUBLISHER.topic_path(PROJECT_ID, topic)
+    message = json.dumps(data).encode('utf-8')
+    result = PUBLISHER.publish(topic_path, data=message).result()
+    return result
 
 
 def check_storage_class_request(extension, current_class, requested_class):
@@ -45,13 +129,149 @@ def check_storage_class_request(extension, current_class, requested_class):
         return False
 
 def update_storage_class(client, bucket, path, storage_class, dry_run):
-    bucket = client.get_bucket(bucket)
+    # Reference the bucket without requesting its metadata
+    bucket = client.bucket(bucket)
     blob = bucket.blob(path)
 
     if not dry_run:
         blob.update_storage_class(storage_class)
     return storage_class
 
+def rewrite_storage_class(client, bucket, path, storage_class, token=None, deadline=None):
+    """Rewrite an object to a new storage class.
+
+    Large objects need several rewrite calls. If the deadline passes
+    before the rewrite is done, the token to resume it is returned.
+
+    Returns:
+        (str, int, int): Rewrite token (None once the rewrite is done),
+                         bytes rewritten and total bytes.
+    """
+    blob = client.bucket(bucket).blob(path)
+    blob.storage_class = storage_class
+
+    while True:
+        token, bytes_rewritten, total_bytes = blob.rewrite(blob, token=token)
+        if token is None:
+            return token, bytes_rewritten, total_bytes
+        if deadline and time.time() > deadline:
+            logging.info(f"> Pausing rewrite of gs://{bucket}/{path} at {bytes_rewritten}/{total_bytes} bytes.")
+            return token, bytes_rewritten, total_bytes
+
+
+def transition_blob(row, dry_run, deadline, client_factory=_get_worker_client):
+    """Change the storage class of the object described by one result row.
+
+    Args:
+        row (dict): Query result with the Blob 'node', the
+                    'requested_class' and, when resuming, the
+                    'rewriteToken' of an unfinished rewrite.
+    Returns:
+        (dict): Outcome of the transition.
+    """
+    node = row['node']
+    requested_class = row['requested_class']
+
+    outcome = {
+               "uri": f"gs://{node['bucket']}/{node['path']}",
+               "storageClass": requested_class,
+               "status": None,
+               "bytes": 0,
+    }
+
+    valid_storage = check_storage_class_request(node['extension'], node.get('storageClass'), requested_class)
+    if not valid_storage:
+        outcome['status'] = INVALID
+        return outcome
+    if dry_run:
+        outcome['status'] = DRY_RUN
+        return outcome
+    # Leave objects that were not started for the requeued message
+    if time.time() > deadline:
+        outcome['status'] = IN_PROGRESS
+        outcome['rewriteToken'] = row.get('rewriteToken')
+        return outcome
+
+    try:
+        token, bytes_rewritten, total_bytes = rewrite_storage_class(
+                                                    client = client_factory(),
+                                                    bucket = node['bucket'],
+                                                    path = node['path'],
+                                                    storage_class = requested_class,
+                                                    token = row.get('rewriteToken'),
+                                                    deadline = deadline)
+    except exceptions.GoogleAPICallError as error:
+        logging.error(f"> Could not change storage class of {outcome['uri']}: {error}.")
+        outcome['status'] = FAILED
+        return outcome
+
+    if token:
+        outcome['status'] = IN_PROGRESS
+        outcome['rewriteToken'] = token
+    else:
+        outcome['status'] = UPDATED
+        outcome['bytes'] = total_bytes
+    return outcome
+
+
+def format_storage_class_query(outcomes):
+    """Set the storage class of all transitioned blobs in one query."""
+    entries = [
+               {"uri": outcome['uri'], "storageClass": outcome['storageClass']}
+               for outcome in outcomes
+               if outcome['status'] == UPDATED]
+    query = (
+             f"UNWIND {json.dumps(entries)} AS entry " +
+             "MATCH (node:Blob {uri: entry.uri}) " +
+             "SET node.storageClass = entry.storageClass")
+    return query
+
+
+def transition_in_bulk(rows, header, event_id, dry_run):
+    """Change the storage class of many objects concurrently.
+
+    Returns:
+        (int): Bytes transitioned.
+    """
+    deadline = time.time() + TIME_LIMIT
+
+    def _transition(row):
+        return transition_blob(row, dry_run, deadline)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        outcomes = list(executor.map(_transition, rows))
+
+    status_counts = Counter(outcome['status'] for outcome in outcomes)
+    bytes_transitioned = sum(outcome['bytes'] for outcome in outcomes)
+    logging.info(
+                 f"> Storage class transitions: {dict(status_counts)}. " +
+                 f"Bytes transitioned: {bytes_transitioned}.")
+
+    seed_id = header.get('seedId', event_id)
+    if status_counts[UPDATED]:
+        query = format_storage_class_query(outcomes)
+        message = format_pubsub_message(
+                                        query = query,
+                                        seed_id = seed_id,
+                                        event_id = event_id)
+        result = publish_to_topic(DB_QUERY_TOPIC, message)
+        logging.info(f"> Published message to {DB_QUERY_TOPIC} with result: {result}.")
+
+    if status_counts[IN_PROGRESS]:
+        unfinished = []
+        for row, outcome in zip(rows, outcomes):
+            if outcome['status'] != IN_PROGRESS:
+                continue
+            row = dict(row)
+            if outcome.get('rewriteToken'):
+                row['rewriteToken'] = outcome['rewriteToken']
+            unfinished.append(row)
+        message = format_resume_message(header, unfinished, event_id)
+        result = publish_to_topic(TOPIC_BLOB_UPDATE_STORAGE, message)
+        logging.info(f"> Requeued {len(unfinished)} unfinished transitions with result: {result}.")
+    return bytes_transitioned
+
+
 def main(event, context):
     """Triggered from a message on a Cloud Pub/Sub topic.
     
@@ -79,6 +299,15 @@ def main(event, context):
     else:
         dry_run = False
 
+    # Bulk requests have a list of result rows; large results are read
+    # from their claim check object
+    if claim_check.CLAIM_CHECK_KEY in body or isinstance(body.get('results'), list):
+        rows = list(claim_check.iter_results(body, client=CLIENT))
+        if not rows:
+            print("> No node metadata found; exiting.")
+            return
+        return transition_in_bulk(rows, header, event_id, dry_run)
+
     node = body['results']['node']
     if not node:
         print("> No node metadata found; exiting.")
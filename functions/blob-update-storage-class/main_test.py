@@ -1,11 +1,13 @@
 import json
 import mock
+import time
 import base64
 import google
 from uuid import uuid4
 import pytest
 
 from google.cloud import storage
+from google.api_core import exceptions
 
 import main
 
@@ -96,4 +98,136 @@ class TestMain:
         event = {'data': base64.b64encode(data_utf8)}
 
         result = main.main(event, mock_context)
-        assert result == 2
\ No newline at end of file
+        assert result == 2
+
+
+class FakeBlob:
+
+    def __init__(self, client, bucket, path):
+        self.client = client
+        self.bucket = bucket
+        self.path = path
+        self.storage_class = None
+
+    def rewrite(self, source, token=None):
+        """Rewrite 100 bytes per call."""
+        total_bytes = self.client.sizes.get(self.path, 100)
+        if self.path in self.client.failing:
+            raise exceptions.Forbidden('Access denied')
+        self.client.rewrites.append((self.path, self.storage_class, token))
+        done = (token or 0) + 100
+        if done >= total_bytes:
+            return None, total_bytes, total_bytes
+        return done, done, total_bytes
+
+
+class FakeBucket:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, path):
+        return FakeBlob(self.client, self.name, path)
+
+
+class FakeClient:
+
+    def __init__(self, sizes={}, failing=()):
+        self.sizes = sizes
+        self.failing = set(failing)
+        self.rewrites = []
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+
+def make_row(path, extension='fastq.gz', requested_class='COLDLINE'):
+    return {
+            'node': {
+                     'bucket': 'from-personalis',
+                     'path': path,
+                     'extension': extension,
+                     'storageClass': 'REGIONAL'},
+            'requested_class': requested_class}
+
+
+class TestTransitionBlob:
+
+    def test_multiple_rewrite_calls(self):
+        client = FakeClient(sizes={'SHIP0_1_R1.fastq.gz': 250})
+        outcome = main.transition_blob(
+                                       make_row('SHIP0_1_R1.fastq.gz'),
+                                       dry_run = False,
+                                       deadline = time.time() + 60,
+                                       client_factory = lambda: client)
+
+        assert outcome['status'] == main.UPDATED
+        assert outcome['bytes'] == 250
+        assert [token for path, storage_class, token in client.rewrites] == [None, 100, 200]
+        assert set(storage_class for path, storage_class, token in client.rewrites) == {'COLDLINE'}
+
+    def test_resume_after_deadline(self):
+        client = FakeClient(sizes={'SHIP0_1_R1.fastq.gz': 250})
+        # Only one rewrite call is made once the deadline has passed
+        token, bytes_rewritten, total_bytes = main.rewrite_storage_class(
+                                                    client = client,
+                                                    bucket = 'from-personalis',
+                                                    path = 'SHIP0_1_R1.fastq.gz',
+                                                    storage_class = 'COLDLINE',
+                                                    deadline = time.time() - 1)
+        assert (token, bytes_rewritten, total_bytes) == (100, 100, 250)
+
+        row = make_row('SHIP0_1_R1.fastq.gz')
+        row['rewriteToken'] = token
+        outcome = main.transition_blob(row, False, time.time() + 60, lambda: client)
+        assert outcome['status'] == main.UPDATED
+        assert client.rewrites[-1] == ('SHIP0_1_R1.fastq.gz', 'COLDLINE', 200)
+
+    def test_not_started_after_deadline(self):
+        client = FakeClient()
+        outcome = main.transition_blob(make_row('SHIP0_1_R1.fastq.gz'), False, time.time() - 1, lambda: client)
+
+        assert outcome['status'] == main.IN_PROGRESS
+        assert client.rewrites == []
+
+    def test_invalid_and_failed(self):
+        client = FakeClient(failing=['SHIP0_2_R1.fastq.gz'])
+        deadline = time.time() + 60
+
+        invalid = main.transition_blob(make_row('SHIP0.bam', extension='bam'), False, deadline, lambda: client)
+        failed = main.transition_blob(make_row('SHIP0_2_R1.fastq.gz'), False, deadline, lambda: client)
+        assert invalid['status'] == main.INVALID
+        assert failed['status'] == main.FAILED
+        assert client.rewrites == []
+
+    def test_storage_class_query(self):
+        outcomes = [
+                    {'uri': 'gs://bucket/a.fastq.gz', 'storageClass': 'COLDLINE', 'status': main.UPDATED, 'bytes': 10},
+                    {'uri': 'gs://bucket/b.fastq.gz', 'storageClass': 'COLDLINE', 'status': main.FAILED, 'bytes': 0}]
+        query = main.format_storage_class_query(outcomes)
+
+        assert query.startswith('UNWIND [{"uri": "gs://bucket/a.fastq.gz", "storageClass": "COLDLINE"}] AS entry ')
+
+
+class TestMainBulk:
+
+    def test_claim_check(self, monkeypatch):
+        rows = [make_row('SHIP0_1_R1.fastq.gz'), make_row('SHIP0_1_R2.fastq.gz')]
+        uri = 'gs://trellis/claim-checks/123.jsonl'
+        transitioned = []
+        monkeypatch.setattr(main, 'CLIENT', None, raising=False)
+        monkeypatch.setattr(
+                            main.claim_check, 'iter_results',
+                            lambda body, client=None: iter(rows) if body[main.claim_check.CLAIM_CHECK_KEY]['uri'] == uri else iter([]))
+        monkeypatch.setattr(
+                            main, 'transition_in_bulk',
+                            lambda rows, header, event_id, dry_run: transitioned.extend(rows))
+
+        data = {
+                'header': {'resource': 'queryResult', 'method': 'VIEW'},
+                'body': {main.claim_check.CLAIM_CHECK_KEY: {'uri': uri, 'format': 'jsonl', 'count': 2}}}
+        event = {'data': base64.b64encode(json.dumps(data).encode('utf-8'))}
+
+        main.main(event, mock_context)
+        assert transitioned == rows
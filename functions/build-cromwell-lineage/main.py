@@ -0,0 +1,131 @@
+import os
+import json
+import yaml
+import logging
+
+from google.cloud import storage
+from google.cloud import pubsub
+
+import cromwell_lineage
+
+ENVIRONMENT = os.environ.get('ENVIRONMENT', '')
+if ENVIRONMENT == 'google-cloud':
+    FUNCTION_NAME = os.environ['FUNCTION_NAME']
+
+    vars_blob = storage.Client() \
+                .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
+                .get_blob(os.environ['CREDENTIALS_BLOB']) \
+                .download_as_string()
+    parsed_vars = yaml.load(vars_blob, Loader=yaml.Loader)
+
+    PROJECT_ID = parsed_vars['GOOGLE_CLOUD_PROJECT']
+    DB_QUERY_TOPIC = parsed_vars['DB_QUERY_TOPIC']
+    TOPIC_TRIGGERS = parsed_vars['TOPIC_TRIGGERS']
+    LINEAGE_SUBSCRIPTION = parsed_vars['SUBSCRIPTION_CROMWELL_LINEAGE']
+
+    PUBLISHER = pubsub.PublisherClient()
+    SUBSCRIBER = pubsub.SubscriberClient()
+
+# Messages requested by each pull
+MAX_MESSAGES = 1000
+# Events left in the subscription are handled in the next window
+MAX_EVENTS = 10000
+# Workflows written by each database query
+BATCH_SIZE = 50
+
+
+def publish_to_topic(topic, data):
+    topic_path = PUBLISHER.topic_path(PROJECT_ID, topic)
+    message = json.dumps(data).encode('utf-8')
+    result = PUBLISHER.publish(topic_path, data=message).result()
+    return result
+
+
+def pull_events(subscription_path, max_events=MAX_EVENTS):
+    """Pull the lineage events waiting in the subscription.
+
+    Returns:
+        (list): Lineage events.
+        (list): Acknowledgement IDs of the pulled messages.
+    """
+    events = []
+    ack_ids = []
+    while len(events) < max_events:
+        response = SUBSCRIBER.pull(
+                                   subscription_path,
+                                   max_messages=MAX_MESSAGES,
+                                   return_immediately=True)
+        if not response.received_messages:
+            break
+        for received in response.received_messages:
+            ack_ids.append(received.ack_id)
+            try:
+                events.append(json.loads(received.message.data.decode('utf-8')))
+            except ValueError:
+                logging.error(f"> Could not parse lineage event; discarding: {received.message.data}.")
+    return events, ack_ids
+
+
+def build_lineage(events):
+    """Group attempt and output events by Cromwell workflow.
+
+    Steps are named by the call alias of their attempts and start with
+    their earliest attempt.
+
+    Args:
+        events (list): Events published by RecordCromwellLineageEvent.
+    Returns:
+        (list): One lineage update per workflow.
+    """
+    workflows = {}
+    for event in events:
+        workflow_id = event['cromwellWorkflowId']
+        if workflow_id not in workflows:
+            workflows[workflow_id] = cromwell_lineage.new_workflow(workflow_id)
+        workflow = workflows[workflow_id]
+
+        if event.get('instanceName'):
+            cromwell_lineage.add_step(workflow, event['wdlCallAlias'], event['startTimeEpoch'])
+        elif event.get('id'):
+            workflow['trellisTaskId'] = event['trellisTaskId']
+            cromwell_lineage.add_output(workflow, event['wdlCallAlias'], event['id'])
+
+    for workflow in workflows.values():
+        workflow['steps'].sort(key=lambda step: step['startTimeEpoch'])
+    return list(workflows.values())
+
+
+def make_batches(workflows, batch_size=BATCH_SIZE):
+    return [workflows[start:start + batch_size] for start in range(0, len(workflows), batch_size)]
+
+
+def build_cromwell_lineage(event, context):
+    """Triggered by a Cloud Scheduler message on a Pub/Sub topic.
+
+    Pull the Cromwell attempts and outputs recorded since the last run
+    and write the lineage of each workflow in batched database queries.
+    Messages are acknowledged only after every query has been published.
+
+    Args:
+        event (dict): Event payload.
+        context (google.cloud.functions.Context): Metadata for the event.
+    """
+    seed_id = context.event_id
+
+    subscription_path = SUBSCRIBER.subscription_path(PROJECT_ID, LINEAGE_SUBSCRIPTION)
+    events, ack_ids = pull_events(subscription_path)
+    if not ack_ids:
+        print("> No lineage events found; exiting.")
+        return 0
+
+    workflows = build_lineage(events)
+    logging.info(f"> Grouped {len(events)} lineage events into {len(workflows)} workflows.")
+
+    for batch in make_batches(workflows):
+        message = cromwell_lineage.format_lineage_message(batch, FUNCTION_NAME, TOPIC_TRIGGERS, seed_id)
+        result = publish_to_topic(DB_QUERY_TOPIC, message)
+        logging.info(f"> Published lineage of {len(batch)} workflows to {DB_QUERY_TOPIC} with result: {result}.")
+
+    for start in range(0, len(ack_ids), MAX_MESSAGES):
+        SUBSCRIBER.acknowledge(subscription_path, ack_ids[start:start + MAX_MESSAGES])
+    return len(workflows)
@@ -0,0 +1,114 @@
+import os
+import importlib.util
+
+import main
+
+TRIGGERS_PATH = os.path.join(
+                             os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'config', 'phase3', 'database-triggers.py')
+
+
+def attempt(alias='bwa', instance=1, start=100, workflow='wf-1'):
+    return {
+            "cromwellWorkflowId": workflow,
+            "wdlCallAlias": alias,
+            "instanceName": f"google-pipelines-worker-{instance}",
+            "startTimeEpoch": start,
+            "seedId": 1,
+    }
+
+
+def output(alias='SortSam', blob_id='out-1', workflow='wf-1'):
+    return {
+            "cromwellWorkflowId": workflow,
+            "wdlCallAlias": alias,
+            "id": blob_id,
+            "trellisTaskId": "210101-000000-000-1",
+            "seedId": 1,
+    }
+
+
+def load_triggers():
+    spec = importlib.util.spec_from_file_location('database_triggers', TRIGGERS_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestBuildLineage:
+
+    def test_steps_ordered_by_first_attempt(self):
+        # Retry of bwa is received before its first attempt
+        workflows = main.build_lineage([
+                                        attempt('sortsam', 3, start=300),
+                                        attempt('bwa', 2, start=200),
+                                        attempt('bwa', 1, start=100)])
+
+        assert len(workflows) == 1
+        assert workflows[0]['steps'] == [
+                                         {"wdlCallAlias": "bwa", "startTimeEpoch": 100},
+                                         {"wdlCallAlias": "sortsam", "startTimeEpoch": 300}]
+        assert workflows[0]['trellisTaskId'] is None
+
+    def test_outputs_related_to_lower_case_step(self):
+        workflows = main.build_lineage([output(), output(), attempt('sortsam')])
+
+        assert workflows[0]['outputs'] == [{"id": "out-1", "wdlCallAlias": "SortSam", "stepAlias": "sortsam"}]
+        assert workflows[0]['attempts'] == []
+        assert workflows[0]['trellisTaskId'] == "210101-000000-000-1"
+
+    def test_workflows_kept_separate(self):
+        workflows = main.build_lineage([attempt(workflow='wf-1'), attempt(workflow='wf-2'), output(workflow='wf-2')])
+
+        assert [(workflow['cromwellWorkflowId'], len(workflow['steps']), len(workflow['outputs']))
+                for workflow in workflows] == [('wf-1', 1, 0), ('wf-2', 1, 1)]
+
+
+class TestMakeBatches:
+
+    def test_batch_size(self):
+        assert [len(batch) for batch in main.make_batches(list(range(120)))] == [50, 50, 20]
+
+
+class TestLineageTriggers:
+
+    env_vars = {'DB_QUERY_TOPIC': 'db-query', 'TOPIC_TRIGGERS': 'check-triggers'}
+    attempt_header = {'labels': ['Create', 'Job', 'CromwellAttempt', 'Node', 'Database', 'Result'], 'seedId': 1}
+    attempt_node = {
+                    'labels': ['Job', 'CromwellAttempt', 'GcpInstance'],
+                    'cromwellWorkflowId': 'wf-1',
+                    'wdlCallAlias': 'bwa',
+                    'instanceName': 'google-pipelines-worker-1',
+                    'instanceId': 1,
+                    'startTimeEpoch': 100}
+
+    def activated(self, env_vars, header, node):
+        triggers = load_triggers()
+        names = [
+                 'CreateCromwellStepFromAttempt',
+                 'RelateCromwellAttemptToPreviousAttempt',
+                 'RecordCromwellLineageEvent']
+        return [name for name in names
+                if getattr(triggers, name)('check-triggers', env_vars).check_conditions(header, {}, node)]
+
+    def test_chain_replaced_when_configured(self):
+        assert self.activated(self.env_vars, self.attempt_header, self.attempt_node) == [
+            'CreateCromwellStepFromAttempt', 'RelateCromwellAttemptToPreviousAttempt']
+
+        env_vars = dict(self.env_vars, TOPIC_CROMWELL_LINEAGE='cromwell-lineage')
+        assert self.activated(env_vars, self.attempt_header, self.attempt_node) == ['RecordCromwellLineageEvent']
+
+    def test_events(self):
+        env_vars = dict(self.env_vars, TOPIC_CROMWELL_LINEAGE='cromwell-lineage')
+        trigger = load_triggers().RecordCromwellLineageEvent('check-triggers', env_vars)
+        context = type('Context', (), {'event_id': 2})
+
+        [(topic, event)] = trigger.compose_message(self.attempt_header, {}, self.attempt_node, context)
+        assert topic == 'cromwell-lineage'
+        assert event == attempt()
+
+        header = {'labels': ['Create', 'Blob', 'Node', 'Cypher', 'Query', 'Database', 'Result'], 'seedId': 1}
+        node = dict(output(), labels=['Blob', 'Bam'])
+        assert trigger.check_conditions(header, {}, node)
+        [(topic, event)] = trigger.compose_message(header, {}, node, context)
+        assert event == output()
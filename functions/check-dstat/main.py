@@ -28,6 +28,8 @@ import subprocess
 from google.cloud import pubsub
 from google.cloud import storage
 
+from dsub_client import DsubClient
+
 app = Flask(__name__)
 # [END run_pubsub_server_setup]
 
@@ -50,6 +52,12 @@ if ENVIRONMENT == 'google-cloud':
 
     PUBLISHER = pubsub.PublisherClient()
 
+# Keeps dsub providers initialized between poll requests
+DSUB = DsubClient()
+
+# Maximum number of jobs looked up with one provider call
+MAX_JOBS_PER_LOOKUP = 100
+
 
 def _dash_to_camelcase(word):
     return re.sub(r'(?!^)-([a-zA-Z])', lambda m: m.group(1).upper(), word)
@@ -159,6 +167,144 @@ def _create_query(dstat_cmd, dstat_json):
     return query
 
 
+def _format_cypher_list(entries):
+    """Format a list of flat dicts as a Cypher list of map literals."""
+    maps = []
+    for entry in entries:
+        properties = [f"`{key}`: {json.dumps(value)}" for key, value in entry.items()]
+        maps.append(f"{{{', '.join(properties)}}}")
+    return f"[{', '.join(maps)}]"
+
+
+def _format_dstat_properties(dstat_cmd, dstat_json):
+    """Flatten a dstat result into Dstat node properties.
+
+    Uses the same property names and conversions as _create_query.
+    """
+    dstat_json = dict(dstat_json)
+    provider_attributes = dict(dstat_json.pop('provider-attributes', {}))
+
+    script = dstat_json.pop('script', None) or ''
+    events = dstat_json.pop('events', None) or []
+    regions = provider_attributes.pop('regions', None) or []
+
+    properties = {}
+    for key, value in list(provider_attributes.items()) + list(dstat_json.items()):
+        if not value:
+            continue
+        if isinstance(value, str):
+            value = value.replace('"', "'")
+        elif isinstance(value, dict):
+            value = str(value)
+        properties[_dash_to_camelcase(key)] = value
+
+    # Node labels take precedence over the dsub job labels
+    properties.update({
+                       "labels": ["Dstat", "Status"],
+                       "command": dstat_cmd,
+                       "script": script.replace('"', "'"),
+                       "events": [str(event) for event in events],
+                       "regions": [region.replace('"', "'") for region in regions],
+    })
+    return properties
+
+
+def _status_changed(job, properties):
+    """Compare a dstat result to the last status recorded for the job."""
+    last_status = (job.get('instanceName'), job.get('status'), job.get('statusDetail'))
+    status = (properties.get('instanceName'), properties.get('status'), properties.get('statusDetail'))
+    return status != last_status
+
+
+def _create_batch_query(dstat_properties):
+    """Create or update the Dstat nodes of all changed jobs in one query."""
+    query = (
+             f"UNWIND {_format_cypher_list(dstat_properties)} AS row " +
+             "MERGE (dstat:Dstat " +
+              "{ " +
+                "instanceName: row.instanceName, " +
+                "jobId: row.jobId " +
+              "}) " +
+             "ON CREATE SET dstat += row " +
+             "ON MATCH SET dstat.statusMessage = row.statusMessage, " +
+             "dstat.status = row.status, " +
+             "dstat.statusDetail = row.statusDetail, " +
+             "dstat.endTime = row.endTime, " +
+             "dstat.lastUpdate = row.lastUpdate, " +
+             "dstat.events = row.events " +
+             "RETURN dstat AS node")
+    return query
+
+
+def _group_jobs(jobs):
+    """Group jobs by the dsub provider and project they were submitted to."""
+    groups = {}
+    for job in jobs:
+        key = (job['provider'], job['project'])
+        groups.setdefault(key, []).append(job)
+    return groups
+
+
+def _lookup_jobs(provider, project, jobs):
+    dstat_results = []
+    for start in range(0, len(jobs), MAX_JOBS_PER_LOOKUP):
+        chunk = jobs[start:start + MAX_JOBS_PER_LOOKUP]
+        dstat_results.extend(DSUB.lookup_tasks(
+                                               provider,
+                                               project,
+                                               job_ids = [job['jobId'] for job in chunk],
+                                               user_ids = {job['user'] for job in chunk}))
+    return dstat_results
+
+
+def _get_changed_statuses(jobs, trunc_id):
+    """Look up outstanding jobs and return the ones whose status changed.
+
+    Args:
+        jobs (list): Job dsub IDs, provider, project & user, along
+                     with the instance name, status and status detail
+                     of their latest Dstat node.
+    Returns:
+        (list): Dstat node properties for each changed job.
+    """
+    changed = []
+    for (provider, project), group in _group_jobs(jobs).items():
+        jobs_by_id = {job['jobId']: job for job in group}
+        try:
+            dstat_results = _lookup_jobs(provider, project, group)
+        except:
+            logging.error(f"{trunc_id}> Error: could not look up {len(group)} jobs in {project}: {sys.exc_info()}.")
+            continue
+
+        for dstat_json in dstat_results:
+            job = jobs_by_id.get(dstat_json.get('job-id'))
+            if not job:
+                continue
+            properties = _format_dstat_properties(job['dstatCmd'], dstat_json)
+            # Tasks without an instance are not running yet
+            if not properties.get('instanceName'):
+                continue
+            if _status_changed(job, properties):
+                changed.append(properties)
+    return changed
+
+
+def _poll_jobs(jobs, event_id, trunc_id):
+    changed = _get_changed_statuses(jobs, trunc_id)
+    print(f"{trunc_id}> {len(changed)} of {len(jobs)} polled jobs changed status.")
+    if not changed:
+        return
+
+    query = _create_batch_query(changed)
+    message = _format_pubsub_message(
+                                     query = query,
+                                     event_id = event_id)
+    # Polled jobs are rechecked by the next poll, not by RecheckDstat
+    message['header']['labels'].append('Poll')
+    result = _publish_to_topic(DB_TOPIC, message)
+    print(f"{trunc_id}> Published {len(changed)} status updates to {DB_TOPIC} with result: {result}.")
+
+
 def _publish_to_topic(topic, data):
     topic_path = PUBLISHER.topic_path(PROJECT_ID, topic)
     message = json.dumps(data).encode('utf-8')
@@ -194,6 +340,11 @@ def get_dstat_result():
 
         retry_count = header.get('retry-count')
 
+        if 'Poll' in header['labels']:
+            _poll_jobs(body['results'], message_id, trunc_id)
+            sys.stdout.flush()
+            return ('', 204)
+
         dstat_cmd = body['command']
 
     try:
@@ -61,3 +61,95 @@ def test_populated_message(client, capsys):
 
     out, _ = capsys.readouterr()
     assert f'Hello {name}!' in out
+
+
+def make_dstat_json(job_id, status='RUNNING', instance_name='google-pipelines-worker-1'):
+    return {
+            'job-id': job_id,
+            'job-name': 'fq2u-abcd1',
+            'status': status,
+            'status-message': 'Running',
+            'status-detail': 'Started running "user-command"',
+            'last-update': '2021-01-01 12:30:00.000000',
+            'end-time': None,
+            'labels': {'trellis-id': 'abcd1'},
+            'events': [{'name': 'start'}],
+            'script': 'echo "hello"',
+            'provider-attributes': {
+                                    'instance-name': instance_name,
+                                    'regions': ['us-west1'],
+                                    'preemptible': False,
+            },
+    }
+
+
+def make_job(job_id, **last_status):
+    job = {
+           'jobId': job_id,
+           'provider': 'google-cls-v2',
+           'project': 'test-project',
+           'user': 'trellis',
+           'dstatCmd': f"dstat --jobs '{job_id}'",
+    }
+    job.update(last_status)
+    return job
+
+
+class FakeDsub:
+
+    def __init__(self, dstat_results):
+        self.dstat_results = dstat_results
+        self.lookups = []
+
+    def lookup_tasks(self, provider, project, job_ids, user_ids):
+        self.lookups.append((provider, project, sorted(job_ids)))
+        return [self.dstat_results[job_id] for job_id in job_ids if job_id in self.dstat_results]
+
+
+def test_dstat_properties():
+    properties = main._format_dstat_properties("dstat --jobs 'job-1'", make_dstat_json('job-1'))
+
+    assert properties['labels'] == ['Dstat', 'Status']
+    assert properties['instanceName'] == 'google-pipelines-worker-1'
+    assert properties['statusDetail'] == "Started running 'user-command'"
+    assert properties['script'] == "echo 'hello'"
+    assert properties['events'] == ["{'name': 'start'}"]
+    assert 'endTime' not in properties
+
+
+def test_batch_query():
+    properties = main._format_dstat_properties("dstat --jobs 'job-1'", make_dstat_json('job-1'))
+    query = main._create_batch_query([properties, properties])
+
+    assert query.startswith("UNWIND [{")
+    assert query.count("`jobId`: \"job-1\"") == 2
+    assert "MERGE (dstat:Dstat { instanceName: row.instanceName, jobId: row.jobId })" in query
+
+
+def test_only_changed_statuses(monkeypatch):
+    fake_dsub = FakeDsub({
+        'job-1': make_dstat_json('job-1'),
+        'job-2': make_dstat_json('job-2', status='SUCCESS'),
+        'job-3': make_dstat_json('job-3', instance_name=''),
+        'job-4': make_dstat_json('job-4'),
+    })
+    monkeypatch.setattr(main, 'DSUB', fake_dsub)
+
+    jobs = [
+            make_job(
+                     'job-1',
+                     instanceName='google-pipelines-worker-1',
+                     status='RUNNING',
+                     statusDetail="Started running 'user-command'"),
+            make_job('job-2', instanceName='google-pipelines-worker-1', status='RUNNING'),
+            make_job('job-3'),
+            make_job('job-4'),
+    ]
+    jobs[3]['project'] = 'other-project'
+    changed = main._get_changed_statuses(jobs, 'abcdefg')
+
+    # One lookup per provider & project
+    assert fake_dsub.lookups == [
+        ('google-cls-v2', 'test-project', ['job-1', 'job-2', 'job-3']),
+        ('google-cls-v2', 'other-project', ['job-4'])]
+    assert [properties['jobId'] for properties in changed] == ['job-2', 'job-4']
@@ -3,13 +3,15 @@ import re
 import pdb
 import json
 import yaml
-import base64
 import logging
 import importlib
 
 from google.cloud import storage
 from google.cloud import pubsub
 
+import claim_check
+import message_envelope
+
 # Get runtime variables from cloud storage bucket
 # https://www.sethvargo.com/secrets-in-serverless/
 ENVIRONMENT = os.environ.get('ENVIRONMENT')
@@ -28,6 +30,7 @@ if ENVIRONMENT == 'google-cloud':
     DATA_GROUP = parsed_vars.get('DATA_GROUP')
 
     PUBLISHER = pubsub.PublisherClient()
+    STORAGE_CLIENT = storage.Client()
 
     # Load trigger module
     trigger_module_name = f"database-triggers"
@@ -42,31 +45,12 @@ def publish_to_topic(topic, data):
     return result
 
 
-def check_triggers(event, context, dry_run=False):
-    """When object created in bucket, add metadata to database.
-    Args:
-        event (dict): Event payload.
-        context (google.cloud.functions.Context): Metadata for the event.
-    """
-
-    # Trellis config data
-    pubsub_message = base64.b64decode(event['data']).decode('utf-8')
-    data = json.loads(pubsub_message)
-    logging.info(f"> Received pubsub message: {data}.")
-    header = data['header']
-    body = data['body']
-
-    resource = header['resource']
-    #query = body['query']
-    results = body['results']
-
-    # Check that resource is query
-    if not resource in ['queryResult', 'request']:
-    #if resource != 'queryResult':
-        raise ValueError(
-                         f"Error: Expected resource type 'queryResult', " +
-                         f"got '{header['resource']}.'")
+def run_triggers(header, body, context, dry_run=False):
+    """Publish the messages of each trigger activated by a query result.
 
+    Returns:
+        (list): Activated triggers.
+    """
     node = body['results'].get('node')
 
     activated_triggers = []
@@ -88,4 +72,41 @@ def check_triggers(event, context, dry_run=False):
                 else:
                     result = publish_to_topic(topic, data)
                     logging.info(f"> Published message to {topic} with result: {result}.")
+    return activated_triggers
+
+
+def check_triggers(event, context, dry_run=False):
+    """When object created in bucket, add metadata to database.
+    Args:
+        event (dict): Event payload.
+        context (google.cloud.functions.Context): Metadata for the event.
+    """
+
+    # Trellis config data
+    data = message_envelope.decode_event(event)
+    logging.info(f"> Received pubsub message: {data}.")
+    header = data['header']
+    body = data['body']
+
+    resource = header['resource']
+
+    # Check that resource is query
+    if not resource in ['queryResult', 'request']:
+    #if resource != 'queryResult':
+        raise ValueError(
+                         f"Error: Expected resource type 'queryResult', " +
+                         f"got '{header['resource']}.'")
+
+    # Unsplit results are a list of rows, inline or, when too large for
+    # the message, read from the claim check object one row at a time;
+    # triggers are checked against each row
+    if claim_check.CLAIM_CHECK_KEY in body or isinstance(body.get('results'), list):
+        activated_triggers = []
+        for result in claim_check.iter_results(body, client=STORAGE_CLIENT):
+            row_body = {key: value for key, value in body.items() if key != claim_check.CLAIM_CHECK_KEY}
+            row_body['results'] = result
+            activated_triggers.extend(run_triggers(header, row_body, context, dry_run))
+        return(activated_triggers)
+
+    activated_triggers = run_triggers(header, body, context, dry_run)
     return(activated_triggers)
@@ -0,0 +1,36 @@
+import json
+import base64
+
+import main
+
+
+class NodeTrigger:
+    """Records the node of each result row it is checked against."""
+
+    def __init__(self):
+        self.nodes = []
+
+    def check_conditions(self, header, body, node):
+        self.nodes.append(node)
+        return False
+
+
+def event(results):
+    message = {"header": {"resource": "queryResult", "labels": []}, "body": {"results": results}}
+    return {"data": base64.b64encode(json.dumps(message).encode('utf-8'))}
+
+
+class TestCheckTriggers:
+
+    def test_split_result(self, monkeypatch):
+        trigger = NodeTrigger()
+        monkeypatch.setattr(main, 'ALL_TRIGGERS', [trigger], raising=False)
+        main.check_triggers(event({"node": {"id": "a"}}), None)
+        assert trigger.nodes == [{"id": "a"}]
+
+    def test_unsplit_results(self, monkeypatch):
+        trigger = NodeTrigger()
+        monkeypatch.setattr(main, 'ALL_TRIGGERS', [trigger], raising=False)
+        monkeypatch.setattr(main, 'STORAGE_CLIENT', None, raising=False)
+        main.check_triggers(event([{"node": {"id": "a"}}, {"node": {"id": "b"}}]), None)
+        assert trigger.nodes == [{"id": "a"}, {"id": "b"}]
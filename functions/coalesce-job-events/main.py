@@ -0,0 +1,224 @@
+import os
+import json
+import yaml
+import logging
+
+from google.cloud import storage
+from google.cloud import pubsub
+
+ENVIRONMENT = os.environ.get('ENVIRONMENT', '')
+if ENVIRONMENT == 'google-cloud':
+    FUNCTION_NAME = os.environ['FUNCTION_NAME']
+
+    vars_blob = storage.Client() \
+                .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
+                .get_blob(os.environ['CREDENTIALS_BLOB']) \
+                .download_as_string()
+    parsed_vars = yaml.load(vars_blob, Loader=yaml.Loader)
+
+    PROJECT_ID = parsed_vars['GOOGLE_CLOUD_PROJECT']
+    DB_QUERY_TOPIC = parsed_vars['DB_QUERY_TOPIC']
+    TOPIC_TRIGGERS = parsed_vars['TOPIC_TRIGGERS']
+    JOB_EVENTS_SUBSCRIPTION = parsed_vars['SUBSCRIPTION_JOB_EVENTS']
+
+    PUBLISHER = pubsub.PublisherClient()
+    SUBSCRIBER = pubsub.SubscriberClient()
+
+# Messages requested by each pull
+MAX_MESSAGES = 1000
+# Events left in the subscription are coalesced in the next window
+MAX_EVENTS = 10000
+# Events applied by each database query
+BATCH_SIZE = 500
+
+# Compute run time once both the start and stop time are known
+DURATION_CLAUSE = (
+                   "SET node.durationMinutes = CASE " +
+                        "WHEN node.startTime IS NULL OR node.stopTime IS NULL " +
+                            "THEN node.durationMinutes " +
+                        "ELSE duration.inSeconds(" +
+                            "datetime(node.startTime), " +
+                            "datetime(node.stopTime)).minutes " +
+                   "END ")
+
+# Trellis jobs are merged on their task ID, like log-insert-trellis-instance
+TRELLIS_QUERY = (
+                 "UNWIND $events AS event " +
+                 "MERGE (node:Job {trellisTaskId: event.trellisTaskId}) " +
+                 "ON CREATE SET node.labels = event.labels " +
+                 "SET node += event.properties " +
+                 DURATION_CLAUSE +
+                 "RETURN node")
+
+# Cromwell attempts are merged on their instance ID, like log-insert-cromwell-instance
+CROMWELL_QUERY = (
+                  "UNWIND $events AS event " +
+                  "MERGE (node:Job {instanceId: event.instanceId}) " +
+                  "ON CREATE SET node.labels = event.labels, " +
+                      "node:CromwellAttempt:GcpInstance " +
+                  "SET node += event.properties " +
+                  DURATION_CLAUSE +
+                  "RETURN node")
+
+# Header labels of the stop events sent by log-delete-instance
+STOPPED_LABELS = ['Update', 'Job', 'Node', 'Query', 'Cypher']
+
+# Stopped instances must already exist, like log-delete-instance
+STOPPED_QUERY = (
+                 "UNWIND $events AS event " +
+                 "MATCH (node:Job {instanceId: event.instanceId, instanceName: event.instanceName}) " +
+                 "SET node += event.properties " +
+                 DURATION_CLAUSE +
+                 "RETURN node")
+
+
+def format_pubsub_message(query, labels, events, seed_id):
+    message = {
+               "header": {
+                          "resource": "query",
+                          "method": "UPDATE",
+                          "labels": labels,
+                          "sentFrom": FUNCTION_NAME,
+                          "publishTo": TOPIC_TRIGGERS,
+                          "seedId": f"{seed_id}",
+                          "previousEventId": f"{seed_id}"
+               },
+               "body": {
+                        "cypher": query,
+                        "parameters": {"events": events},
+                        "result-mode": "data",
+                        "result-structure": "list",
+                        # Evaluate triggers for each updated node
+                        "result-split": "True",
+               },
+    }
+    return message
+
+
+def publish_to_topic(topic, data):
+    topic_path = PUBLISHER.topic_path(PROJECT_ID, topic)
+    message = json.dumps(data).encode('utf-8')
+    result = PUBLISHER.publish(topic_path, data=message).result()
+    return result
+
+
+def pull_events(subscription_path, max_events=MAX_EVENTS):
+    """Pull the job events waiting in the subscription.
+
+    Returns:
+        (list): Job events.
+        (list): Acknowledgement IDs of the pulled messages.
+    """
+    events = []
+    ack_ids = []
+    while len(events) < max_events:
+        response = SUBSCRIBER.pull(
+                                   subscription_path,
+                                   max_messages=MAX_MESSAGES,
+                                   return_immediately=True)
+        if not response.received_messages:
+            break
+        for received in response.received_messages:
+            ack_ids.append(received.ack_id)
+            try:
+                events.append(json.loads(received.message.data.decode('utf-8')))
+            except ValueError:
+                logging.error(f"> Could not parse job event; discarding: {received.message.data}.")
+    return events, ack_ids
+
+
+def coalesce_events(events):
+    """Collapse the events of each instance into its latest state.
+
+    Events are applied in the order they occurred, so properties of
+    later events (e.g. a STOPPED status) override earlier ones. States
+    that include a stop event are marked "stopped".
+
+    Args:
+        events (list): Job events published by log-* functions.
+    Returns:
+        (list): One coalesced event per instance ID.
+    """
+    states = {}
+    for event in sorted(events, key=lambda event: event['timeEpoch']):
+        state = states.setdefault(
+                                  event['instanceId'],
+                                  {"instanceId": event['instanceId'], "properties": {}})
+        for key in ['instanceName', 'trellisTaskId', 'labels']:
+            if event.get(key):
+                state[key] = event[key]
+        # Stop events from log-delete-instance have no task ID or labels
+        if not event.get('trellisTaskId') and not event.get('labels'):
+            state['stopped'] = True
+        state['properties'].update(event['properties'])
+        state['timeEpoch'] = event['timeEpoch']
+    return list(states.values())
+
+
+def group_updates(states):
+    """Group coalesced events by the query used to apply them.
+
+    Use the same header labels as the uncoalesced queries so that the
+    same triggers are evaluated. Instances that were inserted and stopped
+    in the same window also get the stop labels, so that triggers waiting
+    for the stop still run.
+
+    Returns:
+        (list): (query, header labels, events) tuples.
+    """
+    groups = {}
+    for state in states:
+        stopped = state.pop('stopped', False)
+        if state.get('trellisTaskId'):
+            query, labels = TRELLIS_QUERY, ['Update', 'Job', 'Node', 'Query', 'Cypher']
+        elif state.get('labels'):
+            query, labels = CROMWELL_QUERY, ['Create', 'Job', 'CromwellAttempt', 'Node', 'Query', 'Cypher']
+        else:
+            query, labels = STOPPED_QUERY, STOPPED_LABELS
+        if stopped:
+            labels = labels + [label for label in STOPPED_LABELS if label not in labels]
+        groups.setdefault((query, tuple(labels)), []).append(state)
+
+    order = [TRELLIS_QUERY, CROMWELL_QUERY, STOPPED_QUERY]
+    return [
+            (query, list(labels), events)
+            for (query, labels), events in sorted(groups.items(), key=lambda item: order.index(item[0][0]))]
+
+
+def make_batches(events, batch_size=BATCH_SIZE):
+    return [events[start:start + batch_size] for start in range(0, len(events), batch_size)]
+
+
+def coalesce_job_events(event, context):
+    """Triggered by a Cloud Scheduler message on a Pub/Sub topic.
+
+    Pull the job lifecycle events buffered since the last run, collapse
+    them into the latest state of each instance and apply the states in
+    batched database queries. The subscription ack deadline must cover
+    the time taken to publish the queries; messages are acknowledged
+    only after every query has been published.
+
+    Args:
+        event (dict): Event payload.
+        context (google.cloud.functions.Context): Metadata for the event.
+    """
+    seed_id = context.event_id
+
+    subscription_path = SUBSCRIBER.subscription_path(PROJECT_ID, JOB_EVENTS_SUBSCRIPTION)
+    events, ack_ids = pull_events(subscription_path)
+    if not ack_ids:
+        print("> No job events found; exiting.")
+        return 0
+
+    states = coalesce_events(events)
+    logging.info(f"> Coalesced {len(events)} job events into {len(states)} updates.")
+
+    for query, labels, group in group_updates(states):
+        for batch in make_batches(group):
+            message = format_pubsub_message(query, labels, batch, seed_id)
+            result = publish_to_topic(DB_QUERY_TOPIC, message)
+            logging.info(f"> Published {len(batch)} job updates to {DB_QUERY_TOPIC} with result: {result}.")
+
+    for start in range(0, len(ack_ids), MAX_MESSAGES):
+        SUBSCRIBER.acknowledge(subscription_path, ack_ids[start:start + MAX_MESSAGES])
+    return len(states)
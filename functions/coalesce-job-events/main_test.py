@@ -0,0 +1,93 @@
+import main
+
+
+def trellis_start(instance_id=111, time_epoch=100.0):
+    return {
+            "instanceId": instance_id,
+            "instanceName": f"google-pipelines-worker-{instance_id}",
+            "trellisTaskId": f"210101-000000-000-{instance_id}",
+            "labels": ["Job"],
+            "timeEpoch": time_epoch,
+            "properties": {"status": "RUNNING", "startTime": "2021-01-01T00:00:00Z"},
+    }
+
+
+def cromwell_start(instance_id=222, time_epoch=100.0):
+    return {
+            "instanceId": instance_id,
+            "instanceName": f"google-pipelines-worker-{instance_id}",
+            "labels": ["Job", "CromwellAttempt", "GcpInstance"],
+            "timeEpoch": time_epoch,
+            "properties": {"status": "RUNNING", "wdlCallAlias": "bwa"},
+    }
+
+
+def instance_stop(instance_id=111, time_epoch=200.0):
+    return {
+            "instanceId": instance_id,
+            "instanceName": f"google-pipelines-worker-{instance_id}",
+            "timeEpoch": time_epoch,
+            "properties": {"status": "STOPPED", "stopTime": "2021-01-01T01:00:00Z"},
+    }
+
+
+class TestCoalesceEvents:
+
+    def test_latest_state_kept(self):
+        # Stop event is received before the start event
+        states = main.coalesce_events([instance_stop(), trellis_start()])
+
+        assert len(states) == 1
+        state = states[0]
+        assert state['trellisTaskId'] == "210101-000000-000-111"
+        assert state['properties'] == {
+                                       "status": "STOPPED",
+                                       "startTime": "2021-01-01T00:00:00Z",
+                                       "stopTime": "2021-01-01T01:00:00Z"}
+
+    def test_instances_kept_separate(self):
+        states = main.coalesce_events([trellis_start(111), cromwell_start(222), trellis_start(333)])
+        assert sorted(state['instanceId'] for state in states) == [111, 222, 333]
+
+
+class TestGroupUpdates:
+
+    def test_groups(self):
+        states = main.coalesce_events([
+                                       trellis_start(111),
+                                       cromwell_start(222),
+                                       instance_stop(222, time_epoch=300.0),
+                                       instance_stop(444)])
+        groups = main.group_updates(states)
+
+        assert [(query, [state['instanceId'] for state in events]) for query, labels, events in groups] == [
+            (main.TRELLIS_QUERY, [111]),
+            (main.CROMWELL_QUERY, [222]),
+            (main.STOPPED_QUERY, [444])]
+        assert groups[1][2][0]['properties']['status'] == "STOPPED"
+        assert 'stopped' not in groups[1][2][0]
+
+    def test_insert_and_stop(self):
+        states = main.coalesce_events([
+                                       cromwell_start(222),
+                                       cromwell_start(333),
+                                       instance_stop(222, time_epoch=300.0)])
+        groups = main.group_updates(states)
+
+        # Coalesced attempts keep the labels that their triggers depend on,
+        # plus the stop labels when the window contains the stop
+        assert [(labels, [state['instanceId'] for state in events]) for query, labels, events in groups] == [
+            (['Create', 'Job', 'CromwellAttempt', 'Node', 'Query', 'Cypher', 'Update'], [222]),
+            (['Create', 'Job', 'CromwellAttempt', 'Node', 'Query', 'Cypher'], [333])]
+        assert set(main.STOPPED_LABELS).issubset(groups[0][1])
+
+    def test_empty_groups_skipped(self):
+        groups = main.group_updates(main.coalesce_events([instance_stop()]))
+        assert [query for query, labels, events in groups] == [main.STOPPED_QUERY]
+
+
+class TestMakeBatches:
+
+    def test_batch_size(self):
+        batches = main.make_batches(list(range(1201)))
+        assert [len(batch) for batch in batches] == [500, 500, 201]
@@ -201,13 +201,17 @@ def format_node_merge_query(db_dict, dry_run=False):
                 merge_strings.append(f'node.{key} = {value}')
     merge_string = ', '.join(merge_strings)
 
+    # Merge on the constrained key (Blob.uri) only; other labels are
+    # set afterwards so a node missing one of them is not duplicated.
     query = (
-        f"MERGE (node:Blob:{labels_str} {{ " +
+        "MERGE (node:Blob { " +
             f'uri: "{db_dict["uri"]}" }}) ' +
         "ON CREATE SET node.nodeCreated = timestamp(), " +
+            f"node:{labels_str}, " +
             'node.nodeIteration = "initial", ' +
             f"{create_string} " +
         f"ON MATCH SET " +
+            f"node:{labels_str}, " +
             'node.nodeIteration = "merged", ' +
             f"{merge_string} " +
         "RETURN node")
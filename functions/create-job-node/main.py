@@ -57,6 +57,24 @@ def format_pubsub_message(query, seed_id, event_id):
     return message
 
 
+def format_failed_launch_message(query, seed_id, event_id):
+    message = {
+               "header": {
+                          "resource": "query",
+                          "method": "POST",
+                          "labels": ['Update', 'JobRequest', 'Failed', 'Query', 'Cypher'],
+                          "sentFrom": f"{FUNCTION_NAME}",
+                          "seedId": f"{seed_id}",
+                          "previousEventId": f"{event_id}"
+               },
+               "body": {
+                        "cypher": query,
+                        "result-mode": "stats",
+                },
+    }
+    return message
+
+
 def publish_to_topic(topic, data):
     topic_path = PUBLISHER.topic_path(PROJECT_ID, topic)
     message = json.dumps(data).encode('utf-8')
@@ -169,6 +187,98 @@ def format_query(db_entry, dry_run=False):
     return query
 
 
+def format_cypher_list(entries):
+    """Format a list of flat dicts as a Cypher list of map literals.
+
+    Property values are strings, numbers, booleans or lists of those,
+    which have the same literal syntax in JSON and Cypher.
+    """
+    maps = []
+    for entry in entries:
+        properties = [f"`{key}`: {json.dumps(value)}" for key, value in entry.items()]
+        maps.append(f"{{{', '.join(properties)}}}")
+    return f"[{', '.join(maps)}]"
+
+
+def format_bulk_query(db_entries):
+    """Create or update all job nodes from a bulk launch in one query.
+
+    All entries must have the same labels.
+    """
+    labels = list(db_entries[0]['labels'])
+    labels.remove('Job')
+    labels_str = ':'.join(labels)
+
+    query = (
+             f"UNWIND {format_cypher_list(db_entries)} AS job " +
+             "MERGE (node:Job { trellisTaskId: job.trellisTaskId }) " +
+             "ON CREATE SET " +
+                f"node :{labels_str}, " +
+                "node += job, " +
+                "node.nodeCreated= timestamp() " +
+             "ON MATCH SET " +
+                f"node :{labels_str}, " +
+                "node += job " +
+             "RETURN node")
+    return query
+
+
+def format_failed_launch_query(failures):
+    """Release the inputs of jobs that could not be launched.
+
+    Removing the input relationships lets the next request pick the
+    inputs up again; the job request is kept with the launch error.
+    Each failure is matched to its own job request by the event ID
+    the request was created with, not to every request of the task.
+    """
+    query = (
+             f"UNWIND {format_cypher_list(failures)} AS failure " +
+             "MATCH (input:Blob)-[r:WAS_USED_BY]->" +
+                "(request:JobRequest { name: failure.name, eventId: failure.requestEventId }) " +
+             "WHERE input.id IN failure.inputIds " +
+             "SET request.launchFailed = true, " +
+                 "request.launchError = failure.error " +
+             "DELETE r")
+    return query
+
+
+def write_bulk_job_node_queries(body, seed_id, event_id):
+    """Send one database update for all jobs of a bulk launch."""
+    job_groups = {}
+    for node in body['nodes']:
+        db_dict = clean_metadata_dict(node)
+        db_dict['gitCommitHash'] = GIT_COMMIT_HASH
+        db_dict['gitVersionTag'] = GIT_VERSION_TAG
+        db_dict.update(get_standard_time_fields(node))
+        job_groups.setdefault(tuple(db_dict['labels']), []).append(db_dict)
+
+    for db_entries in job_groups.values():
+        db_query = format_bulk_query(db_entries)
+        print(f"> Database query for {len(db_entries)} jobs: \"{db_query}\".")
+        message = format_pubsub_message(
+                                        query = db_query,
+                                        seed_id = seed_id,
+                                        event_id = event_id)
+        result = publish_to_topic(TOPIC, message)
+        print(f"> Published message to {TOPIC} with result: {result}.")
+
+    failures = []
+    for failure in body.get('failed', []):
+        if failure.get('requestEventId') is None:
+            print(f"> No job request to update for failed job: {failure}.")
+        else:
+            failures.append(failure)
+    if failures:
+        db_query = format_failed_launch_query(failures)
+        print(f"> Database query for {len(failures)} failed jobs: \"{db_query}\".")
+        message = format_failed_launch_message(
+                                               query = db_query,
+                                               seed_id = seed_id,
+                                               event_id = event_id)
+        result = publish_to_topic(TOPIC, message)
+        print(f"> Published message to {TOPIC} with result: {result}.")
+
+
 def write_job_node_query(event, context):
     """When object created in bucket, add metadata to database.
     Args:
@@ -188,6 +298,10 @@ def write_job_node_query(event, context):
     event_id = context.event_id
     seed_id = header['seedId']
 
+    if 'Bulk' in header['labels']:
+        write_bulk_job_node_queries(body, seed_id, event_id)
+        return
+
     # Create dict of metadata to add to database node
     db_dict = clean_metadata_dict(body['node'])
 
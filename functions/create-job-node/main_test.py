@@ -0,0 +1,80 @@
+import json
+import base64
+
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+CONTEXT = SimpleNamespace(event_id=7)
+
+
+@pytest.fixture
+def published(monkeypatch):
+    messages = []
+    monkeypatch.setattr(main, 'FUNCTION_NAME', 'create-job-node', raising=False)
+    monkeypatch.setattr(main, 'TOPIC', 'db-query', raising=False)
+    monkeypatch.setattr(main, 'TOPIC_TRIGGERS', 'check-triggers', raising=False)
+    monkeypatch.setattr(main, 'GIT_COMMIT_HASH', 'abc123', raising=False)
+    monkeypatch.setattr(main, 'GIT_VERSION_TAG', 'v1', raising=False)
+    monkeypatch.setattr(main, 'publish_to_topic', lambda topic, data: messages.append((topic, data)))
+    return messages
+
+
+def job_node(index):
+    return {
+            "name": "fastq-to-ubam",
+            "labels": ["Job", "Dsub", "FastqToUbam"],
+            "trellisTaskId": f"task-{index}",
+            "inputIds": [f"fastq-{index}"],
+            "requestEventId": 5,
+            "inputs": {"FASTQ": f"gs://in/fastq-{index}.fastq.gz"},
+            "input_FASTQ": f"gs://in/fastq-{index}.fastq.gz",
+    }
+
+
+def bulk_event(body):
+    message = {"header": {"seedId": 1, "labels": ["Create", "Job", "Dsub", "Node", "Bulk"]}, "body": body}
+    return {"data": base64.b64encode(json.dumps(message).encode('utf-8'))}
+
+
+class TestBulk:
+
+    def test_launched(self, published):
+        main.write_job_node_query(bulk_event({"nodes": [job_node(0), job_node(1)], "failed": []}), CONTEXT)
+
+        [(topic, message)] = published
+        assert topic == 'db-query'
+        assert message['header']['labels'] == ['Create', 'Job', 'Node', 'Query', 'Cypher']
+        assert message['header']['previousEventId'] == "7"
+        query = message['body']['cypher']
+        assert query.startswith("UNWIND [{`name`: \"fastq-to-ubam\"")
+        assert query.count("`trellisTaskId`") == 2
+        assert "node :Dsub:FastqToUbam" in query
+        # Nested dicts aren't valid node properties
+        assert "`inputs`" not in query
+
+    def test_partial_failure(self, published):
+        failures = [
+                    {"name": "fastq-to-ubam", "inputIds": ["fastq-1"], "requestEventId": 5, "error": "Bad parameter"},
+                    {"name": "fastq-to-ubam", "inputIds": ["fastq-2"], "requestEventId": None, "error": "Missing label"},
+        ]
+        main.write_job_node_query(bulk_event({"nodes": [job_node(0)], "failed": failures}), CONTEXT)
+
+        [(_, created), (topic, failed)] = published
+        assert created['body']['cypher'].count("`trellisTaskId`") == 1
+        assert topic == 'db-query'
+        assert failed['header']['labels'] == ['Update', 'JobRequest', 'Failed', 'Query', 'Cypher']
+        query = failed['body']['cypher']
+        # Only the request the job was created for is marked failed
+        assert "(request:JobRequest { name: failure.name, eventId: failure.requestEventId })" in query
+        assert "\"fastq-1\"" in query
+        assert "\"fastq-2\"" not in query
+
+    def test_all_failed(self, published):
+        failures = [{"name": "fastq-to-ubam", "inputIds": ["fastq-1"], "requestEventId": 5, "error": "Bad parameter"}]
+        main.write_job_node_query(bulk_event({"nodes": [], "failed": failures}), CONTEXT)
+
+        [(topic, message)] = published
+        assert message['header']['labels'] == ['Update', 'JobRequest', 'Failed', 'Query', 'Cypher']
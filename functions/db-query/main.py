@@ -1,11 +1,9 @@
 import os
 import pdb
 import sys
-import json
 import math
 import time
 import yaml
-import base64
 import logging
 import neobolt
 
@@ -19,6 +17,9 @@ from neobolt.exceptions import ServiceUnavailable
 from google.cloud import pubsub
 from google.cloud import storage
 
+import claim_check
+import message_envelope
+
 # Get runtime variables from cloud storage bucket
 # https://www.sethvargo.com/secrets-in-serverless/
 ENVIRONMENT = os.environ.get('ENVIRONMENT')
@@ -35,6 +36,13 @@ if ENVIRONMENT == 'google-cloud':
     DATA_GROUP = parsed_vars['DATA_GROUP']
     PROJECT_ID = parsed_vars['GOOGLE_CLOUD_PROJECT']
     DB_QUERY_TOPIC = parsed_vars['DB_QUERY_TOPIC']
+    # Topics whose subscribers decode msgpack+zstd message envelopes
+    BINARY_ENVELOPE_TOPICS = parsed_vars.get('BINARY_ENVELOPE_TOPICS', [])
+    # Unsplit results too large to send inline are written to this
+    # location for subscribers of these topics
+    CLAIM_CHECK_LOCATION = parsed_vars.get('CLAIM_CHECK_LOCATION')
+    CLAIM_CHECK_TOPICS = parsed_vars.get('CLAIM_CHECK_TOPICS', [])
+    CLAIM_CHECK_THRESHOLD = parsed_vars.get('CLAIM_CHECK_THRESHOLD', claim_check.DEFAULT_THRESHOLD)
 
     #NEO4J_URL = parsed_vars['NEO4J_URL']
     NEO4J_SCHEME = parsed_vars['NEO4J_SCHEME']
@@ -46,6 +54,7 @@ if ENVIRONMENT == 'google-cloud':
 
     # Pubsub client
     PUBLISHER = pubsub.PublisherClient()
+    STORAGE_CLIENT = storage.Client()
 
     # Neo4j graph
     GRAPH = Graph(
@@ -59,7 +68,7 @@ if ENVIRONMENT == 'google-cloud':
 QUERY_ELAPSED_MAX = 0.300
 PUBSUB_ELAPSED_MAX = 10
 
-def format_pubsub_message(method, labels, query, results, seed_id, event_id, retry_count=None):
+def format_pubsub_message(method, labels, query, results, seed_id, event_id, retry_count=None, results_claim=None):
     # Labels from the incoming message are perpetuated in the outgoing message with
     # these additional labels
     labels.extend(["Database", "Result"])
@@ -82,14 +91,21 @@ def format_pubsub_message(method, labels, query, results, seed_id, event_id, ret
     if retry_count:
         message['header']['retry-count'] = retry_count
 
+    # Consumers read claim checked results with claim_check.iter_results()
+    if results_claim:
+        del message['body']['results']
+        message['body'][claim_check.CLAIM_CHECK_KEY] = results_claim
+
     return message
 
 
 def publish_to_topic(topic, json_data):
     topic_path = PUBLISHER.topic_path(PROJECT_ID, topic)
-    # https://stackoverflow.com/questions/11875770/how-to-overcome-datetime-datetime-not-json-serializable/36142844#36142844
-    message = json.dumps(json_data, indent=4, sort_keys=True, default=str).encode('utf-8')
-    result = PUBLISHER.publish(topic_path, data=message).result()
+    if topic in BINARY_ENVELOPE_TOPICS:
+        encoding = message_envelope.MSGPACK_ZSTD
+    else:
+        encoding = message_envelope.JSON
+    result = message_envelope.publish(PUBLISHER, topic_path, json_data, encoding)
     return result
 
 
@@ -129,8 +145,7 @@ def query_db(event, context):
 
     start = datetime.now()
 
-    pubsub_message = base64.b64decode(event['data']).decode('utf-8')
-    data = json.loads(pubsub_message)
+    data = message_envelope.decode_event(event)
     print(f"> Received pubsub message: {data}.")
     print(f"> Context: {context}.")
     #print(f"> Data: {data}.")
@@ -181,6 +196,8 @@ def query_db(event, context):
     retry_count = header.get('retry-count')
 
     query = body['cypher']
+    # Optional query parameters, e.g. entries for an UNWIND clause
+    parameters = body.get('parameters')
     result_mode = body.get('result-mode')
     result_structure = body.get('result-structure')
     result_split = body.get('result-split')
@@ -190,12 +207,12 @@ def query_db(event, context):
         query_start = time.time()
         if result_mode == 'stats':
             print(f"> Running stats query: {query}")
-            query_results = GRAPH.run(query).stats()
+            query_results = GRAPH.run(query, parameters).stats()
         elif result_mode == 'data':
             print(f"> Running data query: {query}")
-            query_results = GRAPH.run(query).data()
+            query_results = GRAPH.run(query, parameters).data()
         else:
-            GRAPH.run(query)
+            GRAPH.run(query, parameters)
             query_results = None
         query_elapsed = time.time() - query_start
         print(f"> Query results: {query_results}.")
@@ -219,7 +236,7 @@ def query_db(event, context):
         result = republish_message(DB_QUERY_TOPIC, data)
         logging.warn(f"> Published message to {DB_QUERY_TOPIC} with result: {result}.")
         # Duplicate message flagged as warning
-        logging.warn(f"> Requeued message: {pubsub_message}.")
+        logging.warn(f"> Requeued message: {data}.")
         return
     except ConnectionResetError as error:
         logging.warn(f"> Encountered connection interruption: {error}.")
@@ -227,7 +244,7 @@ def query_db(event, context):
         result = republish_message(DB_QUERY_TOPIC, data)
         logging.warn(f"> Published message to {DB_QUERY_TOPIC} with result: {result}.")
         # Duplicate message flagged as warning
-        logging.warn(f"> Requeued message: {pubsub_message}.")
+        logging.warn(f"> Requeued message: {data}.")
         return
 
     # Return if not pubsub topic
@@ -247,6 +264,19 @@ def query_db(event, context):
     if isinstance(topics, str):
         topics = [topics]
 
+    # Write large unsplit results once for all topics that accept claim checks
+    results_claim = None
+    accepts_claim = any(topic in CLAIM_CHECK_TOPICS for topic in topics)
+    if result_split != 'True' and isinstance(query_results, list) and CLAIM_CHECK_LOCATION and accepts_claim:
+        results_claim = claim_check.check_in(
+                                             query_results,
+                                             location = CLAIM_CHECK_LOCATION,
+                                             name = event_id,
+                                             threshold = CLAIM_CHECK_THRESHOLD,
+                                             client = STORAGE_CLIENT)
+        if results_claim:
+            print(f"> Wrote {results_claim['rowCount']} results to {results_claim['uri']}.")
+
     # Track how many messages are published to each topic
     published_message_counts = {}
     for topic in topics:
@@ -292,7 +322,8 @@ def query_db(event, context):
                                             results = query_results,
                                             seed_id = seed_id,
                                             event_id = event_id,
-                                            retry_count=retry_count)
+                                            retry_count=retry_count,
+                                            results_claim = results_claim if topic in CLAIM_CHECK_TOPICS else None)
             print(f"> Pubsub message: {message}.")
             publish_result = publish_to_topic(topic, message)
             print(f"> Published message to {topic} with result: {publish_result}.")
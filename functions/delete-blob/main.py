@@ -1,19 +1,89 @@
 import os
 import re
 import json
+import time
+import yaml
 import base64
 import logging
+import threading
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import pubsub
 from google.cloud import storage
 from google.api_core import exceptions
 
+import claim_check
+
 ENVIRONMENT = os.environ.get('ENVIRONMENT', '')
 if ENVIRONMENT == 'google-cloud':
     FUNCTION_NAME = os.environ['FUNCTION_NAME']
     PROJECT_ID = os.environ['GCP_PROJECT']
 
-    CLIENT = storage.Client()
-    
+    vars_blob = storage.Client() \
+                .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
+                .get_blob(os.environ['CREDENTIALS_BLOB']) \
+                .download_as_string()
+    parsed_vars = yaml.load(vars_blob, Loader=yaml.Loader)
+
+    DB_QUERY_TOPIC = parsed_vars['DB_QUERY_TOPIC']
+
+    PUBLISHER = pubsub.PublisherClient()
+
+# GCS JSON API batch requests are limited to 100 calls
+MAX_BATCH_SIZE = 100
+# Concurrent batch requests
+MAX_WORKERS = 8
+# Attempts to delete an object outside of a batch
+MAX_ATTEMPTS = 3
+# Seconds to wait before the first retry; doubled for each retry after
+RETRY_DELAY = 1
+
+RETRYABLE_ERRORS = (exceptions.TooManyRequests, exceptions.ServerError)
+
+# Per-object outcomes
+DELETED = 'deleted'
+NOT_FOUND = 'not-found'
+PROTECTED = 'protected'
+FAILED = 'failed'
+DRY_RUN = 'dry-run'
+
+# Batches are tracked by the client, so each worker uses its own client
+_LOCAL = threading.local()
+
+
+def _get_worker_client():
+    if not hasattr(_LOCAL, 'client'):
+        _LOCAL.client = storage.Client()
+    return _LOCAL.client
+
+
+def format_pubsub_message(query, seed_id, event_id):
+    message = {
+               "header": {
+                          "resource": "query",
+                          "method": "UPDATE",
+                          "labels": ["Update", "Blob", "Deleted", "Cypher", "Query"],
+                          "sentFrom": FUNCTION_NAME,
+                          "seedId": f"{seed_id}",
+                          "previousEventId": f"{event_id}"
+               },
+               "body": {
+                        "cypher": query,
+                        "result-mode": "stats",
+               },
+    }
+    return message
+
+
+def publish_to_topic(topic, data):
+    topic_path = PUBLISHER.topic_path(PROJECT_ID, topic)
+    message = json.dumps(data).encode('utf-8')
+    result = PUBLISHER.publish(topic_path, data=message).result()
+    return result
+
+
 def check_protected_patterns(path):
 
     # Include the patterns within this function so that unit tests
@@ -33,10 +103,11 @@ def check_protected_patterns(path):
         if re.search(pattern, path):
             return True
     return False
- 
+
 
 def delete_blob(client, bucket, path, dry_run):
-    bucket = client.get_bucket(bucket)
+    # Reference the bucket without requesting its metadata
+    bucket = client.bucket(bucket)
     blob = bucket.blob(path)
 
     try:
@@ -47,18 +118,133 @@ def delete_blob(client, bucket, path, dry_run):
         return False
     return True
 
+
+def delete_blob_with_retries(client, bucket, path):
+    """Delete a single object, retrying transient errors.
+
+    Returns:
+        (str): Outcome of the deletion.
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            blob_deleted = delete_blob(client, bucket, path, dry_run=False)
+        except RETRYABLE_ERRORS as error:
+            if attempt == MAX_ATTEMPTS:
+                logging.error(f"> Could not delete gs://{bucket}/{path} after {attempt} attempts: {error}.")
+                return FAILED
+            time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            continue
+        except exceptions.GoogleAPICallError as error:
+            logging.error(f"> Could not delete gs://{bucket}/{path}: {error}.")
+            return FAILED
+
+        if blob_deleted:
+            return DELETED
+        else:
+            return NOT_FOUND
+
+
+def delete_batch(client, bucket, paths):
+    """Delete objects from one bucket with a single batch request.
+
+    A failed batch only reports its first error, so if any call fails
+    the objects are deleted one at a time to get the outcome of each.
+
+    Returns:
+        (dict): Outcome of the deletion for each path.
+    """
+    bucket_ref = client.bucket(bucket)
+    try:
+        with client.batch():
+            for path in paths:
+                bucket_ref.blob(path).delete()
+    except exceptions.GoogleAPICallError as error:
+        logging.warning(
+                        f"> Batch delete from gs://{bucket} failed: {error}. " +
+                        f"Deleting {len(paths)} objects individually.")
+        return {path: delete_blob_with_retries(client, bucket, path) for path in paths}
+    return {path: DELETED for path in paths}
+
+
+def make_batches(nodes, batch_size=MAX_BATCH_SIZE):
+    """Group objects by bucket into batches of up to batch_size paths.
+
+    Returns:
+        (list): (bucket, paths) tuples.
+    """
+    buckets = {}
+    for node in nodes:
+        buckets.setdefault(node['bucket'], []).append(node['path'])
+
+    batches = []
+    for bucket, paths in buckets.items():
+        for start in range(0, len(paths), batch_size):
+            batches.append((bucket, paths[start:start + batch_size]))
+    return batches
+
+
+def delete_blobs(nodes, dry_run, client_factory=_get_worker_client, max_workers=MAX_WORKERS):
+    """Delete objects in per-bucket batches with bounded concurrency.
+
+    Args:
+        nodes (iterable): Dicts with the bucket and path of each object.
+        dry_run (bool): Only check which objects would be deleted.
+        client_factory (function): Returns the storage client for
+                                   the current worker.
+        max_workers (int): Maximum number of concurrent batch requests.
+    Returns:
+        (list): Bucket, path and deletion outcome for each object.
+    """
+    outcomes = []
+    deletable = []
+    for node in nodes:
+        if check_protected_patterns(node['path']):
+            logging.error(
+                          "> Attempted to delete protected object. Skipping: " +
+                          f"gs://{node['bucket']}/{node['path']}.")
+            outcome = PROTECTED
+        elif dry_run:
+            outcome = DRY_RUN
+        else:
+            deletable.append(node)
+            continue
+        outcomes.append({"bucket": node['bucket'], "path": node['path'], "outcome": outcome})
+
+    def _delete(batch):
+        bucket, paths = batch
+        results = delete_batch(client_factory(), bucket, paths)
+        return [{"bucket": bucket, "path": path, "outcome": results[path]} for path in paths]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch_outcomes in executor.map(_delete, make_batches(deletable)):
+            outcomes.extend(batch_outcomes)
+    return outcomes
+
+
+def format_deleted_query(outcomes):
+    """Mark the nodes of all objects that no longer exist in one query."""
+    uris = [
+            f"gs://{outcome['bucket']}/{outcome['path']}"
+            for outcome in outcomes
+            if outcome['outcome'] in (DELETED, NOT_FOUND)]
+    query = (
+             f"UNWIND {json.dumps(uris)} AS uri " +
+             "MATCH (node:Blob {uri: uri}) " +
+             "SET node.obj_exists = false")
+    return query
+
+
 def main(event, context):
     """Triggered from a message on a Cloud Pub/Sub topic.
-    
-    Update the metadata of a Blob specified by PubSub message.
+
+    Delete the Blobs specified by a PubSub message.
 
     Args:
-         event (dict): 'data' contains a string describing with the
-                       bucket and name of a GCS blob in the format 
-                       of : {bucket}#{name}
+         event (dict): 'data' contains a list of results with the
+                       bucket and path of each GCS blob.
          context (google.cloud.functions.Context): Metadata for the event.
     """
-    
+
     pubsub_message = base64.b64decode(event['data']).decode('utf-8')
     event_id = context.event_id
     data = json.loads(pubsub_message)
@@ -74,28 +260,28 @@ def main(event, context):
     else:
         dry_run = False
 
-    nodes = body['results']
-    if not nodes:
+    node_count = claim_check.count_results(body)
+    if not node_count:
         print("> No node metadata found; exiting.")
-        return  
+        return
 
-    blob_counter = 0
-    for node in nodes:
+    # Large results are streamed from their claim check object
+    nodes = claim_check.iter_results(body)
+    logging.info(f"> Attempting to delete {node_count} blobs.")
+    outcomes = delete_blobs(nodes, dry_run)
+    outcome_counts = Counter(outcome['outcome'] for outcome in outcomes)
+    logging.info(f"> Deletion outcomes: {dict(outcome_counts)}.")
 
-        protected_status = check_protected_patterns(node['path'])
-        if protected_status:
-            logging.error(f"> Attempted to delete protected object. Aborting. {pattern}: {path}.")
-
-        logging.info(f"> Attempting to delete blob gs://{node['bucket']}/{node['path']}.")     
-        blob_deleted = delete_blob(
-                                   client = CLIENT,
-                                   bucket = node["bucket"],
-                                   path = node["path"],
-                                   dry_run = dry_run)
-        
-        if blob_deleted:
-            logging.info(f"> Blob deleted.")
-            blob_counter +=1
+    # Update the database once for all blobs that no longer exist
+    if outcome_counts[DELETED] or outcome_counts[NOT_FOUND]:
+        query = format_deleted_query(outcomes)
+        message = format_pubsub_message(
+                                        query = query,
+                                        seed_id = header.get('seedId', event_id),
+                                        event_id = event_id)
+        result = publish_to_topic(DB_QUERY_TOPIC, message)
+        logging.info(f"> Published message to {DB_QUERY_TOPIC} with result: {result}.")
+
+    blob_counter = outcome_counts[DELETED] + outcome_counts[DRY_RUN]
     logging.info(f"> Count of blobs deleted: {blob_counter}.")
     return blob_counter
-        
\ No newline at end of file
@@ -1,11 +1,13 @@
 import json
 import mock
+import contextlib
 import base64
 import google
 from uuid import uuid4
 import pytest
 
 from google.cloud import storage
+from google.api_core import exceptions
 
 import main
 
@@ -122,4 +124,94 @@ class TestMain:
         event = {'data': base64.b64encode(data_utf8)}
 
         result = main.main(event, mock_context)
-        assert result == 2
\ No newline at end of file
+        assert result == 2
+
+class FakeBlob:
+
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+
+    def delete(self):
+        if self.client.batch_paths is not None:
+            self.client.batch_paths.append(self.path)
+            return
+        self.client.single_deletes.append(self.path)
+        if self.path in self.client.missing:
+            raise exceptions.NotFound('No such object')
+
+
+class FakeBucket:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, path):
+        return FakeBlob(self.client, path)
+
+
+class FakeClient:
+    """Collects deletes into batches instead of calling GCS."""
+
+    def __init__(self, missing=()):
+        self.missing = set(missing)
+        self.batches = []
+        self.single_deletes = []
+        self.batch_paths = None
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.batch_paths = []
+        yield
+        paths, self.batch_paths = self.batch_paths, None
+        self.batches.append(paths)
+        if self.missing.intersection(paths):
+            raise exceptions.NotFound('No such object')
+
+
+def make_nodes(bucket, count):
+    return [{'bucket': bucket, 'path': f"SHIP0/output/{i}.bam"} for i in range(count)]
+
+
+class TestDeleteBlobs:
+
+    def test_make_batches(self):
+        nodes = make_nodes('bucket-a', 250) + make_nodes('bucket-b', 10)
+        batches = main.make_batches(nodes)
+
+        assert [(bucket, len(paths)) for bucket, paths in batches] == [
+            ('bucket-a', 100), ('bucket-a', 100), ('bucket-a', 50), ('bucket-b', 10)]
+
+    def test_batched(self):
+        client = FakeClient()
+        nodes = make_nodes('bucket-a', 150)
+        outcomes = main.delete_blobs(nodes, dry_run=False, client_factory=lambda: client, max_workers=1)
+
+        assert [len(paths) for paths in client.batches] == [100, 50]
+        assert client.single_deletes == []
+        assert set(outcome['outcome'] for outcome in outcomes) == {main.DELETED}
+
+    def test_failed_batch_outcomes(self):
+        nodes = make_nodes('bucket-a', 3)
+        client = FakeClient(missing=[nodes[1]['path']])
+        nodes.append({'bucket': 'bucket-a', 'path': 'SHIP0/SHIP0.cram'})
+        outcomes = main.delete_blobs(nodes, dry_run=False, client_factory=lambda: client, max_workers=1)
+
+        # Protected objects are never sent to GCS
+        assert client.batches == [[node['path'] for node in nodes[:3]]]
+        assert client.single_deletes == [node['path'] for node in nodes[:3]]
+        assert [outcome['outcome'] for outcome in outcomes] == [
+            main.PROTECTED, main.DELETED, main.NOT_FOUND, main.DELETED]
+
+    def test_deleted_query(self):
+        outcomes = [
+                    {'bucket': 'bucket-a', 'path': 'a.bam', 'outcome': main.DELETED},
+                    {'bucket': 'bucket-a', 'path': 'b.bam', 'outcome': main.NOT_FOUND},
+                    {'bucket': 'bucket-a', 'path': 'c.bam', 'outcome': main.FAILED}]
+        query = main.format_deleted_query(outcomes)
+
+        assert query.startswith('UNWIND ["gs://bucket-a/a.bam", "gs://bucket-a/b.bam"] AS uri ')
@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import pytz
+import yaml
+import ijson
+import base64
+import logging
+import argparse
+import iso8601
+
+from datetime import datetime
+
+from google.cloud import storage
+from google.cloud import pubsub
+
+import cromwell_lineage
+
+ENVIRONMENT = os.environ.get('ENVIRONMENT', '')
+if ENVIRONMENT == 'google-cloud':
+    FUNCTION_NAME = os.environ['FUNCTION_NAME']
+
+    vars_blob = storage.Client() \
+                .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
+                .get_blob(os.environ['CREDENTIALS_BLOB']) \
+                .download_as_string()
+    parsed_vars = yaml.load(vars_blob, Loader=yaml.Loader)
+
+    PROJECT_ID = parsed_vars['GOOGLE_CLOUD_PROJECT']
+    DB_QUERY_TOPIC = parsed_vars['DB_QUERY_TOPIC']
+    TOPIC_TRIGGERS = parsed_vars['TOPIC_TRIGGERS']
+
+    PUBLISHER = pubsub.PublisherClient()
+    STORAGE_CLIENT = storage.Client()
+
+# Bytes downloaded per request when reading metadata
+CHUNK_SIZE = 1024 * 1024
+
+# Top-level workflow fields kept from the metadata
+WORKFLOW_FIELDS = ['id', 'workflowName', 'status', 'start', 'end']
+
+
+def publish_to_topic(topic, data):
+    topic_path = PUBLISHER.topic_path(PROJECT_ID, topic)
+    message = json.dumps(data).encode('utf-8')
+    result = PUBLISHER.publish(topic_path, data=message).result()
+    return result
+
+
+def get_seconds_from_epoch(datetime_obj):
+    """Get datetime as total seconds from epoch.
+
+    Provides datetime in easily sortable format
+
+    Args:
+        datetime_obj (datetime): Datetime.
+    Returns:
+        (float): Seconds from epoch
+    """
+    from_epoch = datetime_obj - datetime(1970, 1, 1, tzinfo=pytz.UTC)
+    from_epoch_seconds = from_epoch.total_seconds()
+    return from_epoch_seconds
+
+
+def get_time_fields(prefix, date_string):
+    """Cromwell timestamp as an ISO 8601 string and seconds from epoch."""
+    if not date_string:
+        return {}
+    epoch = get_seconds_from_epoch(iso8601.parse_date(date_string))
+    return {prefix: date_string, f"{prefix}Epoch": epoch}
+
+
+class ChunkReader:
+    """File-like reader over the chunks of a metadata object."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def read(self, size=-1):
+        # ijson checks the type of the source with read(0)
+        if size == 0:
+            return b''
+        return next(self._chunks, b'')
+
+
+def read_chunks(uri, client=None, chunk_size=CHUNK_SIZE):
+    """Read a "gs://bucket/path" object, or a local file, in chunks."""
+    if uri.startswith('gs://'):
+        bucket, _, path = uri[len('gs://'):].partition('/')
+        blob = (client or storage.Client()).bucket(bucket).get_blob(path)
+        if blob is None:
+            raise ValueError(f"Cromwell metadata not found: {uri}.")
+        for start in range(0, blob.size, chunk_size):
+            end = min(start + chunk_size, blob.size) - 1
+            yield blob.download_as_string(start=start, end=end)
+    else:
+        with open(uri, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(chunk_size), b''):
+                yield chunk
+
+
+def iter_metadata(source):
+    """Stream the workflow fields and call attempts of Cromwell metadata.
+
+    Only one call attempt is held in memory at a time; the metadata of
+    a whole workflow can be much larger than the function memory.
+
+    Args:
+        source: File-like object with the metadata JSON.
+    Yields:
+        ('workflow', field, value) for top-level workflow fields and
+        ('attempt', call name, attempt metadata) for each call attempt.
+    """
+    builder = None
+    attempt_prefix = None
+    for prefix, event, value in ijson.parse(source, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == attempt_prefix and event == 'end_map':
+                yield 'attempt', call_name, builder.value
+                builder = None
+        elif prefix in WORKFLOW_FIELDS and event in ('string', 'number'):
+            yield 'workflow', prefix, value
+        elif prefix.startswith('calls.') and prefix.endswith('.item') and event == 'start_map':
+            # Call names include the workflow name, e.g. "Workflow.Call"
+            call_name = prefix[len('calls.'):-len('.item')]
+            attempt_prefix = prefix
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+
+
+def summarize_attempt(call_name, attempt):
+    """CromwellAttempt properties of a call attempt that ran on a VM.
+
+    Property names follow log-insert-cromwell-instance and
+    log-delete-instance, so attempts look the same whichever way they
+    were recorded.
+
+    Returns:
+        (dict): Attempt properties, or None for call-cached attempts.
+    """
+    backend = attempt.get('jes') or {}
+    instance_name = backend.get('instanceName')
+    if not instance_name:
+        return None
+
+    runtime = attempt.get('runtimeAttributes') or {}
+    properties = {
+                  "instanceName": instance_name,
+                  # Instance labels are lower case
+                  "wdlCallAlias": call_name.split('.')[-1].lower(),
+                  "cromwellCallName": call_name,
+                  "shardIndex": attempt.get('shardIndex'),
+                  "cromwellAttempt": attempt.get('attempt'),
+                  "executionStatus": attempt.get('executionStatus'),
+                  "returnCode": attempt.get('returnCode'),
+                  "preemptible": attempt.get('preemptible'),
+                  "zone": backend.get('zone'),
+                  "machineType": (backend.get('machineType') or '').split('/')[-1] or None,
+                  "cpu": runtime.get('cpu'),
+                  "memory": runtime.get('memory'),
+                  "disks": runtime.get('disks'),
+                  "callRoot": attempt.get('callRoot'),
+                  "status": "STOPPED",
+    }
+    properties.update(get_time_fields('startTime', attempt.get('start')))
+    properties.update(get_time_fields('stopTime', attempt.get('end')))
+    if properties.get('startTimeEpoch') and properties.get('stopTimeEpoch'):
+        properties['durationMinutes'] = int((properties['stopTimeEpoch'] - properties['startTimeEpoch']) // 60)
+    return {key: value for key, value in properties.items() if value is not None}
+
+
+def iter_attempts(call_name, attempt):
+    """Yield the call attempt and the attempts of its sub-workflow."""
+    yield call_name, attempt
+    subworkflow = attempt.get('subWorkflowMetadata') or {}
+    for sub_call_name, sub_attempts in (subworkflow.get('calls') or {}).items():
+        for sub_attempt in sub_attempts:
+            yield from iter_attempts(sub_call_name, sub_attempt)
+
+
+def build_workflow(source, trellis_task_id=None):
+    """Build the lineage update of one workflow from its metadata.
+
+    Attempts of sub-workflow calls are added to the parent workflow.
+
+    Args:
+        source: File-like object with the metadata JSON.
+        trellis_task_id (str): Task ID of the CromwellWorkflow job.
+    Returns:
+        (dict): Lineage update for cromwell_lineage.LINEAGE_QUERY.
+    """
+    # The workflow ID can come after the calls
+    workflow = cromwell_lineage.new_workflow(None, trellis_task_id)
+    fields = {}
+    for kind, name, value in iter_metadata(source):
+        if kind == 'workflow':
+            fields[name] = value
+            continue
+        for call_name, attempt in iter_attempts(name, value):
+            properties = summarize_attempt(call_name, attempt)
+            if not properties or 'startTimeEpoch' not in properties:
+                continue
+            workflow['attempts'].append(properties)
+            cromwell_lineage.add_step(workflow, properties['wdlCallAlias'], properties['startTimeEpoch'])
+            # Output blobs keep the case of the call alias in their path
+            cromwell_lineage.add_output(workflow, call_name.split('.')[-1])
+
+    workflow['cromwellWorkflowId'] = fields['id']
+    for properties in workflow['attempts']:
+        properties['cromwellWorkflowId'] = fields['id']
+    workflow['steps'].sort(key=lambda step: step['startTimeEpoch'])
+
+    workflow['properties'] = {
+                              "cromwellWorkflowName": fields.get('workflowName'),
+                              "cromwellWorkflowStatus": fields.get('status'),
+    }
+    workflow['properties'].update(get_time_fields('cromwellStartTime', fields.get('start')))
+    workflow['properties'].update(get_time_fields('cromwellStopTime', fields.get('end')))
+    workflow['properties'] = {key: value for key, value in workflow['properties'].items() if value is not None}
+    return workflow
+
+
+def ingest_cromwell_metadata(event, context):
+    """Load the lineage and attempts of a finished Cromwell workflow.
+
+    Triggered by IngestCromwellMetadata when the metadata written by
+    "cromwell run --metadata-output" is added to the database. To
+    re-sync a workflow, publish the same message again.
+
+    Args:
+        event (dict): Event payload.
+        context (google.cloud.functions.Context): Metadata for the event.
+    """
+    pubsub_message = base64.b64decode(event['data']).decode('utf-8')
+    data = json.loads(pubsub_message)
+    logging.info(f"> Data: {data}.")
+    header = data['header']
+    body = data['body']
+
+    uri = f"gs://{body['bucket']}/{body['path']}"
+    source = ChunkReader(read_chunks(uri, client=STORAGE_CLIENT))
+    workflow = build_workflow(source, body.get('trellisTaskId'))
+    logging.info(
+                 f"> Read {len(workflow['attempts'])} attempts of " +
+                 f"{len(workflow['steps'])} steps from {uri}.")
+
+    message = cromwell_lineage.format_lineage_message(
+                                                      [workflow],
+                                                      FUNCTION_NAME,
+                                                      TOPIC_TRIGGERS,
+                                                      header['seedId'])
+    message['header']['previousEventId'] = context.event_id
+    result = publish_to_topic(DB_QUERY_TOPIC, message)
+    logging.info(f"> Published lineage of {workflow['cromwellWorkflowId']} to {DB_QUERY_TOPIC} with result: {result}.")
+    return workflow
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print the lineage update read from Cromwell metadata.")
+    parser.add_argument('uri', help="gs://bucket/path or local metadata JSON file.")
+    parser.add_argument('--trellis-task-id', default=None)
+    args = parser.parse_args()
+
+    workflow = build_workflow(ChunkReader(read_chunks(args.uri)), args.trellis_task_id)
+    json.dump(workflow, sys.stdout, indent=4)
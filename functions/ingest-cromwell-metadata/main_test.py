@@ -0,0 +1,172 @@
+import os
+import json
+import importlib.util
+
+import main
+
+TRIGGERS_PATH = os.path.join(
+                             os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'config', 'phase3', 'database-triggers.py')
+
+WORKFLOW_ID = "0f3b6e1c-1d8e-4f2b-9a0e-1f2e3d4c5b6a"
+
+
+def call_attempt(instance, start, end, shard=-1, attempt=1, status="Done"):
+    return {
+            "shardIndex": shard,
+            "attempt": attempt,
+            "executionStatus": status,
+            "preemptible": True,
+            "returnCode": 0,
+            "start": start,
+            "end": end,
+            "callRoot": f"gs://bucket/output/Germline/{WORKFLOW_ID}/call-X",
+            "runtimeAttributes": {"cpu": "16", "memory": "14 GB", "disks": "local-disk 100 HDD"},
+            "jes": {
+                    "instanceName": f"google-pipelines-worker-{instance}",
+                    "machineType": "custom-16-14848",
+                    "zone": "us-west1-b"},
+            "executionEvents": [{"description": "RunningJob"}],
+    }
+
+
+def metadata():
+    return {
+            "workflowName": "germline_single_sample_workflow",
+            "calls": {
+                "germline_single_sample_workflow.SamToFastqAndBwaMem": [
+                    # Preempted attempt and its retry
+                    call_attempt(1, "2021-06-01T12:00:00.000Z", "2021-06-01T12:30:00.000Z", 0, 1, "Preempted"),
+                    call_attempt(2, "2021-06-01T12:31:00.000Z", "2021-06-01T13:31:00.000Z", 0, 2),
+                    call_attempt(3, "2021-06-01T12:00:05.000Z", "2021-06-01T13:00:05.000Z", 1, 1),
+                ],
+                "germline_single_sample_workflow.CheckFingerprint": [
+                    # Cached from an earlier run; no VM
+                    {"shardIndex": -1, "attempt": 1, "executionStatus": "Done", "callCaching": {"hit": True}},
+                ],
+                "germline_single_sample_workflow.MarkDuplicates": [
+                    call_attempt(4, "2021-06-01T14:00:00Z", "2021-06-01T15:00:00Z"),
+                ],
+            },
+            "status": "Succeeded",
+            "start": "2021-06-01T11:59:00.000Z",
+            "end": "2021-06-01T15:01:00.000Z",
+            # Workflow ID after the calls
+            "id": WORKFLOW_ID,
+    }
+
+
+def chunked(data, chunk_size=64):
+    encoded = json.dumps(data).encode('utf-8')
+    return main.ChunkReader(encoded[start:start + chunk_size] for start in range(0, len(encoded), chunk_size))
+
+
+class TestIterMetadata:
+
+    def test_fields_and_attempts(self):
+        items = list(main.iter_metadata(chunked(metadata())))
+
+        fields = {name: value for kind, name, value in items if kind == 'workflow'}
+        assert fields == {
+                          "workflowName": "germline_single_sample_workflow",
+                          "status": "Succeeded",
+                          "start": "2021-06-01T11:59:00.000Z",
+                          "end": "2021-06-01T15:01:00.000Z",
+                          "id": WORKFLOW_ID}
+
+        attempts = [(name, value) for kind, name, value in items if kind == 'attempt']
+        assert [name.split('.')[-1] for name, value in attempts] == [
+            'SamToFastqAndBwaMem', 'SamToFastqAndBwaMem', 'SamToFastqAndBwaMem',
+            'CheckFingerprint', 'MarkDuplicates']
+        assert attempts[0][1]['executionEvents'] == [{"description": "RunningJob"}]
+
+
+class TestBuildWorkflow:
+
+    def test_attempts(self):
+        workflow = main.build_workflow(chunked(metadata()), "210601-120000-000-1")
+
+        assert workflow['cromwellWorkflowId'] == WORKFLOW_ID
+        assert workflow['trellisTaskId'] == "210601-120000-000-1"
+        # Call-cached attempt is skipped
+        assert len(workflow['attempts']) == 4
+        attempt = workflow['attempts'][0]
+        assert attempt['instanceName'] == "google-pipelines-worker-1"
+        assert attempt['cromwellWorkflowId'] == WORKFLOW_ID
+        assert attempt['wdlCallAlias'] == "samtofastqandbwamem"
+        assert attempt['executionStatus'] == "Preempted"
+        assert attempt['machineType'] == "custom-16-14848"
+        assert attempt['durationMinutes'] == 30
+        assert attempt['stopTimeEpoch'] - attempt['startTimeEpoch'] == 1800
+        assert 'executionEvents' not in attempt
+
+    def test_steps_and_outputs(self):
+        workflow = main.build_workflow(chunked(metadata()))
+
+        assert [(step['wdlCallAlias'], step['startTimeEpoch']) for step in workflow['steps']] == [
+            ("samtofastqandbwamem", 1622548800.0),
+            ("markduplicates", 1622556000.0)]
+        assert workflow['outputs'] == [
+            {"wdlCallAlias": "SamToFastqAndBwaMem", "stepAlias": "samtofastqandbwamem", "id": None},
+            {"wdlCallAlias": "MarkDuplicates", "stepAlias": "markduplicates", "id": None}]
+        assert workflow['properties']['cromwellWorkflowStatus'] == "Succeeded"
+
+    def test_subworkflow_attempts(self):
+        data = metadata()
+        data['calls']['germline_single_sample_workflow.AggregatedBamQC'] = [{
+            "shardIndex": -1,
+            "attempt": 1,
+            "subWorkflowMetadata": {
+                "id": "sub-workflow",
+                "calls": {"AggregatedBamQC.CollectReadgroupBamQualityMetrics": [
+                    call_attempt(5, "2021-06-01T15:00:00Z", "2021-06-01T15:10:00Z")]}}}]
+
+        workflow = main.build_workflow(chunked(data))
+
+        assert workflow['attempts'][-1]['wdlCallAlias'] == "collectreadgroupbamqualitymetrics"
+        assert workflow['attempts'][-1]['cromwellWorkflowId'] == WORKFLOW_ID
+
+
+class TestReadChunks:
+
+    def test_local_file(self, tmp_path):
+        path = tmp_path / 'cromwell-metadata.json'
+        path.write_text(json.dumps(metadata()))
+
+        chunks = list(main.read_chunks(str(path), chunk_size=100))
+        assert len(chunks) > 1
+        workflow = main.build_workflow(main.ChunkReader(chunks))
+        assert workflow['cromwellWorkflowId'] == WORKFLOW_ID
+
+
+class TestIngestTrigger:
+
+    def test_metadata_blob(self):
+        spec = importlib.util.spec_from_file_location('database_triggers', TRIGGERS_PATH)
+        triggers = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(triggers)
+
+        env_vars = {'TOPIC_CROMWELL_METADATA': 'cromwell-metadata', 'TOPIC_CROMWELL_LINEAGE': 'cromwell-lineage'}
+        header = {'labels': ['Create', 'Blob', 'Node', 'Cypher', 'Query', 'Database', 'Result'], 'seedId': 1}
+        node = {
+                'labels': ['Blob', 'Gatk', 'Json', 'WGS35'],
+                'bucket': 'gatk-out',
+                'path': 'PLATE/SAMPLE/gatk-5-dollar/210601-120000-000-1/metadata/cromwell-metadata.json',
+                'basename': 'cromwell-metadata.json',
+                'trellisTaskId': '210601-120000-000-1'}
+        trigger = triggers.IngestCromwellMetadata('check-triggers', env_vars)
+        context = type('Context', (), {'event_id': 2})
+
+        assert trigger.check_conditions(header, {}, node)
+        [(topic, message)] = trigger.compose_message(header, {}, node, context)
+        assert topic == 'cromwell-metadata'
+        assert message['body'] == {
+                                   'bucket': 'gatk-out',
+                                   'path': node['path'],
+                                   'trellisTaskId': '210601-120000-000-1'}
+
+        # Lineage events aren't recorded for outputs either
+        output = dict(node, cromwellWorkflowId='wf-1', wdlCallAlias='SortSam', id='out-1')
+        assert not triggers.RecordCromwellLineageEvent('check-triggers', env_vars).check_conditions(header, {}, output)
+        assert not triggers.RelateCromwellOutputToStep('check-triggers', env_vars).check_conditions(header, {}, output)
+        assert not triggers.IngestCromwellMetadata('check-triggers', {}).check_conditions(header, {}, node)
@@ -30,6 +30,8 @@ if ENVIRONMENT == 'google-cloud':
     DB_TOPIC = parsed_vars.get('DB_QUERY_TOPIC')
     TOPIC_TRIGGERS = parsed_vars.get('TOPIC_TRIGGERS')
     DATA_GROUP = parsed_vars.get('DATA_GROUP')
+    # Optional; when set, events are coalesced before updating the database
+    TOPIC_JOB_EVENTS = parsed_vars.get('TOPIC_JOB_EVENTS')
 
     PUBLISHER = pubsub.PublisherClient()
 
@@ -151,6 +153,22 @@ def log_delete_instance(event, context):
         print(f"> No instance ID provided; skipping.")
         return
 
+    if TOPIC_JOB_EVENTS:
+        job_event = {
+                     "instanceId": int(instance_id),
+                     "instanceName": instance_name,
+                     "timeEpoch": stop_time_epoch,
+                     "properties": {
+                                    "stopTime": stop_time,
+                                    "stopTimeEpoch": stop_time_epoch,
+                                    "stoppedBy": stopped_by,
+                                    "status": status,
+                     },
+        }
+        result = publish_to_topic(TOPIC_JOB_EVENTS, job_event)
+        print(f"> Published job event to {TOPIC_JOB_EVENTS} with result: {result}.")
+        return
+
     print(f"> Database query: \"{query}\".")
 
     message = format_pubsub_message(
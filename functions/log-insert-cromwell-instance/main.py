@@ -30,6 +30,11 @@ if ENVIRONMENT == 'google-cloud':
     DB_TOPIC = parsed_vars.get('DB_QUERY_TOPIC')
     TOPIC_TRIGGERS = parsed_vars.get('TOPIC_TRIGGERS')
     DATA_GROUP = parsed_vars.get('DATA_GROUP')
+    # Optional; when set, events are coalesced before updating the database
+    TOPIC_JOB_EVENTS = parsed_vars.get('TOPIC_JOB_EVENTS')
+    # Optional; when set, attempts are loaded from workflow metadata
+    # by ingest-cromwell-metadata instead
+    TOPIC_CROMWELL_METADATA = parsed_vars.get('TOPIC_CROMWELL_METADATA')
 
     PUBLISHER = pubsub.PublisherClient()
 
@@ -100,6 +105,10 @@ def log_insert_cromwell_instance(event, context):
         context (google.cloud.functions.Context): Metadata for the event.
     """
 
+    if TOPIC_CROMWELL_METADATA:
+        print(f"> Attempts are loaded from Cromwell metadata; skipping.")
+        return
+
     #print(f"> Processing new Pub/Sub message: {context['event_id']}.")
     print(f"> Context: {context}.")
     pubsub_message = base64.b64decode(event['data']).decode('utf-8')
@@ -161,9 +170,9 @@ def log_insert_cromwell_instance(event, context):
     else:
         cromwell_query_str = ''
 
+    # Instance IDs are unique; merge on the constrained key only
     query = (
         "MERGE (node:Job { " +
-            f"instanceName: \"{instance_name}\", " +
             f"instanceId: {instance_id} }} ) " +
         "ON CREATE SET " +
             # Unique to creation
@@ -202,6 +211,30 @@ def log_insert_cromwell_instance(event, context):
         print(f"> No instance ID provided; skipping.")
         return
 
+    if TOPIC_JOB_EVENTS:
+        properties = {
+                      "status": status,
+                      "instanceName": instance_name,
+                      "instanceId": int(instance_id),
+                      "startTime": start_time,
+                      "startTimeEpoch": start_time_epoch,
+                      "zone": zone,
+                      "machineType": machine_type,
+                      "bootDiskSize": f"{boot_disk_size}",
+                      "attachedDiskSize": f"{attached_disk_size}",
+        }
+        properties.update(cromwell_fields)
+        job_event = {
+                     "instanceId": int(instance_id),
+                     "instanceName": instance_name,
+                     "labels": ["Job", "CromwellAttempt", "GcpInstance"],
+                     "timeEpoch": start_time_epoch,
+                     "properties": properties,
+        }
+        result = publish_to_topic(TOPIC_JOB_EVENTS, job_event)
+        print(f"> Published job event to {TOPIC_JOB_EVENTS} with result: {result}.")
+        return
+
     print(f"> Database query: \"{query}\".")
     message = format_pubsub_message(
                                     query = query,
@@ -30,6 +30,8 @@ if ENVIRONMENT == 'google-cloud':
     DB_TOPIC = parsed_vars.get('DB_QUERY_TOPIC')
     TOPIC_TRIGGERS = parsed_vars.get('TOPIC_TRIGGERS')
     DATA_GROUP = parsed_vars.get('DATA_GROUP')
+    # Optional; when set, events are coalesced before updating the database
+    TOPIC_JOB_EVENTS = parsed_vars.get('TOPIC_JOB_EVENTS')
 
     PUBLISHER = pubsub.PublisherClient()
 
@@ -118,6 +120,7 @@ def log_insert_trellis_instance(event, context):
 
     # Get task ID from request
     # labels: [{0: {key: "trellis-id", value: "1907-5fxf7"}}]
+    trellis_name = None
     labels = payload['request']['labels']
     for label in labels:
         key = label['key']
@@ -131,6 +134,8 @@ def log_insert_trellis_instance(event, context):
             job_name = value
         elif key == 'plate':
             plate = value
+        elif key == 'trellis-name':
+            trellis_name = value
 
     instance_name = payload['request']['name']
 
@@ -178,6 +183,29 @@ def log_insert_trellis_instance(event, context):
         print(f"> No instance ID provided; skipping.")
         return
 
+    if TOPIC_JOB_EVENTS:
+        job_event = {
+                     "instanceId": int(instance_id),
+                     "instanceName": instance_name,
+                     "trellisTaskId": task_id,
+                     # Task name, used by admit-jobs
+                     "trellisName": trellis_name,
+                     "labels": ["Job"],
+                     "timeEpoch": start_time_epoch,
+                     "properties": {
+                                    "status": status,
+                                    "instanceName": instance_name,
+                                    "instanceId": int(instance_id),
+                                    "startTime": start_time,
+                                    "startTimeEpoch": start_time_epoch,
+                                    "zone": zone,
+                                    "machineType": machine_type,
+                     },
+        }
+        result = publish_to_topic(TOPIC_JOB_EVENTS, job_event)
+        print(f"> Published job event to {TOPIC_JOB_EVENTS} with result: {result}.")
+        return
+
     print(f"> Database query: \"{query}\".")
     message = format_pubsub_message(
                                     query = query,
@@ -7,7 +7,6 @@ import uuid
 import yaml
 import base64
 import random
-import hashlib
 import logging
 import psycopg2
 
@@ -16,6 +15,8 @@ from datetime import datetime
 from google.cloud import pubsub
 from google.cloud import storage
 from google.cloud import exceptions
+
+import input_fingerprint
 #from google.cloud import error_reporting
 
 ENVIRONMENT = os.environ.get('ENVIRONMENT', '')
@@ -135,15 +136,10 @@ def get_datetime_stamp():
 
 
 def make_unique_task_id(nodes, datetime_stamp):
-    # Create pretty-unique hash value based on input nodes
-    # https://www.geeksforgeeks.org/ways-sort-list-dictionaries-values-python-using-lambda-function/
-    sorted_nodes = sorted(nodes, key = lambda i: i['id'])
-    nodes_str = json.dumps(sorted_nodes, sort_keys=True, ensure_ascii=True, default=str)
-    nodes_hash = hashlib.sha256(nodes_str.encode('utf-8')).hexdigest()
-    print(nodes_hash)
-    trunc_nodes_hash = str(nodes_hash)[:8]
-    task_id = f"{datetime_stamp}-{trunc_nodes_hash}"
-    return(task_id, trunc_nodes_hash)
+    # Fingerprint the identity of the input nodes, not their metadata
+    nodes_hash = input_fingerprint.fingerprint(nodes)
+    task_id = f"{datetime_stamp}-{nodes_hash}"
+    return(task_id, nodes_hash)
 
 
 def load_json(path):
@@ -1,8 +1,11 @@
 import os
 import re
 import pdb
+import csv
+import gzip
 import json
 import yaml
+import base64
 import logging
 
 from datetime import datetime
@@ -15,7 +18,9 @@ from google.cloud import pubsub
 ENVIRONMENT = os.environ.get('ENVIRONMENT', '')
 if ENVIRONMENT == 'google-cloud':
     FUNCTION_NAME = os.environ['FUNCTION_NAME']
-    TRIGGER_OPERATION = os.environ['TRIGGER_OPERATION']
+    TRIGGER_OPERATION = os.environ.get('TRIGGER_OPERATION')
+    # Bucket of the status CSV and snapshot, for record_applied_statuses
+    STATUS_BUCKET = os.environ.get('STATUS_BUCKET')
     GIT_COMMIT_HASH = os.environ['GIT_COMMIT_HASH']
     GIT_VERSION_TAG = os.environ['GIT_VERSION_TAG']
 
@@ -29,19 +34,28 @@ if ENVIRONMENT == 'google-cloud':
     PROJECT_ID = parsed_vars.get('GOOGLE_CLOUD_PROJECT')
     DB_QUERY_TOPIC = parsed_vars.get('DB_QUERY_TOPIC')
     TOPIC_TRIGGERS = parsed_vars.get('TOPIC_TRIGGERS')
+    # Results of status updates; read by record_applied_statuses
+    TOPIC_SNVQA_APPLIED = parsed_vars.get('TOPIC_SNVQA_APPLIED')
 
     PUBLISHER = pubsub.PublisherClient()
     STORAGE_CLIENT = storage.Client()
 
+# Size of the ranged reads used to stream the status CSV
+CHUNK_SIZE = 1024 * 1024
+# Samples updated by each database query
+BATCH_SIZE = 1000
+# Sample statuses that the database has confirmed applying
+SNAPSHOT_PATH = "analysis-notebooks/sample-status.applied.json.gz"
 
-def format_pubsub_message(query, seed_id):
+
+def format_pubsub_message(query, seed_id, parameters=None):
     message = {
                "header": {
                           "resource": "query",
                           "method": "PUT",
                           "labels": ["Update", "Sample", "Node", "Cypher", "Query"],
                           "sentFrom": f"{FUNCTION_NAME}",
-                          "publishTo": f"{TOPIC_TRIGGERS}",
+                          "publishTo": f"{TOPIC_SNVQA_APPLIED}",
                           "seedId": f"{seed_id}",
                           "previousEventId": f"{seed_id}"
                },
@@ -49,9 +63,12 @@ def format_pubsub_message(query, seed_id):
                         "cypher": query,
                         "result-mode": "data",
                         "result-structure": "list",
-                        "result-split": "True",
+                        # Applied statuses of the batch in one message
+                        "result-split": "False",
                },
     }
+    if parameters:
+        message['body']['parameters'] = parameters
     return message
 
 
@@ -84,42 +101,128 @@ def register_sample_snvqa_status(event, context):
         logging.warning("Object path does not match specified pattern. Ignoring.")
         return
 
-    # Load CSV object (format: "sample,status[pass,fail]")
-    print("> Loading sample status CSV from GCS.")
-    bucket = STORAGE_CLIENT.get_bucket(object_bucket)
+    bucket = STORAGE_CLIENT.bucket(object_bucket)
     blob = bucket.get_blob(object_path)
-    csv_data = blob.download_as_string()
-
-    print("> Parsing sample status data from CSV.")
-    csv_data = csv_data.decode("utf-8")
-    csv_data = csv_data.rstrip()
-    lines = csv_data.split('\n')
-    for line in lines:
-        elements = line.split(',')
-        sample = elements[0]
-        status = elements[1]
-        neo4j_status = None
+
+    print("> Streaming sample statuses from CSV.")
+    snapshot = load_snapshot(bucket)
+    statuses = parse_statuses(iter_blob_lines(blob))
+
+    # The snapshot is only updated by record_applied_statuses, once the
+    # database has applied a status; statuses that weren't applied, e.g.
+    # for Samples not in the database yet, are sent again with the next CSV
+    db_query = _create_batch_query()
+    changed_count = 0
+    for batch in make_batches(get_changed_statuses(statuses, snapshot)):
+        message = format_pubsub_message(db_query, seed_id, parameters={"statuses": batch})
+        result = publish_to_topic(DB_QUERY_TOPIC, message)
+        print(f"> Published {len(batch)} sample statuses to {DB_QUERY_TOPIC} with result: {result}.")
+        changed_count += len(batch)
+    print(f"> {changed_count} sample statuses changed since the last applied update.")
+
+
+def record_applied_statuses(event, context):
+    """When the database applies a batch of statuses, add them to the snapshot.
+
+    Deployed with a single instance, so snapshot updates don't overlap.
+
+    Args:
+        event (dict): Event payload.
+        context (google.cloud.functions.Context): Metadata for the event.
+    """
+    data = json.loads(base64.b64decode(event['data']).decode('utf-8'))
+    results = data['body'].get('results') or []
+    if not results:
+        print("> No sample statuses were applied.")
+        return
+
+    bucket = STORAGE_CLIENT.bucket(STATUS_BUCKET)
+    snapshot = load_snapshot(bucket)
+    update_snapshot(snapshot, results)
+    save_snapshot(bucket, snapshot)
+    print(f"> Recorded {len(results)} applied sample statuses.")
+
+
+def iter_blob_lines(blob, chunk_size=CHUNK_SIZE):
+    """Download a blob in ranges and yield it one line at a time."""
+    remainder = b''
+    for start in range(0, blob.size, chunk_size):
+        end = min(start + chunk_size, blob.size) - 1
+        chunk = remainder + blob.download_as_string(start=start, end=end)
+        lines = chunk.split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    if remainder:
+        yield remainder.decode('utf-8')
+
+
+def parse_statuses(lines):
+    """Parse (sample, status) pairs from "sample,status[pass,fail]" lines.
+
+    Statuses other than pass or fail are parsed as None.
+    """
+    for row in csv.reader(lines):
+        if len(row) < 2:
+            continue
+        sample = row[0].strip()
+        status = row[1].strip()
 
         if status == 'pass':
-            neo4j_status = True
+            yield sample, True
         elif status == 'fail':
-            neo4j_status = False
+            yield sample, False
+        else:
+            yield sample, None
 
-        # Create a query to update :Sample node
-        db_query = _create_query(sample, neo4j_status)
 
-        message = format_pubsub_message(db_query, seed_id)
-        print(f"> Pubsub message: {message}.")
-        result = publish_to_topic(DB_QUERY_TOPIC, message)
-        print(f"> Published message to {DB_QUERY_TOPIC} with result: {result}.")
+def load_snapshot(bucket):
+    blob = bucket.get_blob(SNAPSHOT_PATH)
+    if not blob:
+        return {}
+    return json.loads(gzip.decompress(blob.download_as_string()).decode('utf-8'))
+
 
+def save_snapshot(bucket, snapshot):
+    data = json.dumps(snapshot, separators=(',', ':'), sort_keys=True)
+    bucket.blob(SNAPSHOT_PATH).upload_from_string(
+                                                  gzip.compress(data.encode('utf-8')),
+                                                  content_type='application/gzip')
 
-def _create_query(sample, neo4j_status):
 
+def update_snapshot(snapshot, results):
+    """Add the {"sample", "status"} rows returned by the update query."""
+    for result in results:
+        snapshot[result['sample']] = result['status']
+    return snapshot
+
+
+def get_changed_statuses(statuses, snapshot):
+    """Yield the (sample, status) pairs that are new or differ from the snapshot."""
+    for sample, status in statuses:
+        if sample in snapshot and snapshot[sample] == status:
+            continue
+        yield sample, status
+
+
+def make_batches(changed, batch_size=BATCH_SIZE):
+    """Group (sample, status) pairs into lists of query parameters."""
+    batch = []
+    for sample, status in changed:
+        batch.append({"sample": sample, "status": status})
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _create_batch_query():
+    # Only samples that exist are returned and recorded as applied
     query = (
+        "UNWIND $statuses AS entry " +
         "MATCH (node:Sample) " +
-        f"WHERE node.sample = \"{sample}\" " +
-        f"SET node.trellis_snvQa = {neo4j_status} " +
-        "RETURN node")
+        "WHERE node.sample = entry.sample " +
+        "SET node.trellis_snvQa = entry.status " +
+        "RETURN DISTINCT entry.sample AS sample, entry.status AS status")
     return query
-
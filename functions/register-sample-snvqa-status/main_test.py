@@ -0,0 +1,63 @@
+import pytest
+
+import main
+
+
+class FakeBlob:
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.ranges = []
+
+    def download_as_string(self, start=None, end=None):
+        self.ranges.append((start, end))
+        return self.data[start:end + 1]
+
+
+class TestIterBlobLines:
+
+    def test_lines_split_across_chunks(self):
+        blob = FakeBlob("SHIP1,pass\nSHIP2,fail\nSHIP3,pass".encode('utf-8'))
+        lines = list(main.iter_blob_lines(blob, chunk_size=4))
+
+        assert lines == ["SHIP1,pass", "SHIP2,fail", "SHIP3,pass"]
+        assert blob.ranges[:2] == [(0, 3), (4, 7)]
+
+    def test_trailing_newline(self):
+        blob = FakeBlob(b"SHIP1,pass\r\nSHIP2,fail\n")
+        lines = list(main.iter_blob_lines(blob, chunk_size=1024))
+
+        assert lines == ["SHIP1,pass\r", "SHIP2,fail"]
+
+
+class TestStatuses:
+
+    def test_parse_statuses(self):
+        lines = ["SHIP1,pass\r", "SHIP2,fail", "SHIP3,unknown", ""]
+        statuses = list(main.parse_statuses(lines))
+
+        assert statuses == [("SHIP1", True), ("SHIP2", False), ("SHIP3", None)]
+
+    def test_changed_statuses(self):
+        snapshot = {"SHIP1": True, "SHIP2": True, "SHIP4": False}
+        statuses = iter([("SHIP1", True), ("SHIP2", False), ("SHIP3", True)])
+
+        changed = main.get_changed_statuses(statuses, snapshot)
+        assert list(changed) == [("SHIP2", False), ("SHIP3", True)]
+
+    def test_batches(self):
+        changed = ((f"SHIP{i}", True) for i in range(25))
+        batches = list(main.make_batches(changed, batch_size=10))
+
+        assert [len(batch) for batch in batches] == [10, 10, 5]
+        assert batches[0][0] == {"sample": "SHIP0", "status": True}
+
+    def test_unapplied_statuses_resent(self):
+        snapshot = {"SHIP1": True}
+        # SHIP2 has no Sample node yet, so the update query doesn't return it
+        main.update_snapshot(snapshot, [{"sample": "SHIP3", "status": False}])
+        statuses = [("SHIP1", True), ("SHIP2", True), ("SHIP3", False)]
+
+        assert snapshot == {"SHIP1": True, "SHIP3": False}
+        assert list(main.get_changed_statuses(statuses, snapshot)) == [("SHIP2", True)]
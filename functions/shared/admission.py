@@ -0,0 +1,302 @@
+"""Hold dsub launches until their task and region have capacity.
+
+Launch requests are sent to launch functions as soon as their inputs
+are ready, so a burst of deliveries can start more VMs than the
+regional CPU quota allows; the extra VMs queue or fail and the
+duplicate jobs have to be cleaned up afterwards. When admission control
+is configured, launch functions hold each requested job with the
+admit-jobs function instead of launching it. admit-jobs tracks the jobs
+it has admitted and the Trellis instances that are running, from the
+job events published by the log-* functions, and releases held jobs to
+their launch function, highest priority first, as capacity frees up.
+
+Admission is configured by the JOB_ADMISSION value of the Trellis vars:
+
+    JOB_ADMISSION:
+        store: gs://trellis-bucket/admission/state.json
+        tasks:
+            fastq-to-ubam:
+                topic: launch-fastq-to-ubam topic
+                maxRunning: 400    # Jobs running or starting
+                cores: 1           # Cores of each job
+                priority: 2        # Higher priorities are released first
+            gatk-5-dollar:
+                topic: launch-gatk-5-dollar topic
+                maxRunning: 50
+                cores: 16
+                priority: 1
+        regions:
+            us-west1:
+                maxCores: 2400     # Cores of all admitted jobs
+
+Admission also requires these Trellis vars:
+
+    TOPIC_ADMIT_JOBS: topic launch functions hold jobs with
+    SUBSCRIPTION_ADMIT_JOBS: pull subscription admit-jobs reads held jobs from
+    TOPIC_JOB_EVENTS: topic the log-* functions publish job events to
+    SUBSCRIPTION_ADMISSION_JOB_EVENTS: pull subscription admit-jobs reads
+        job events from
+
+Without job events, admitted jobs are dropped after START_TIMEOUT and
+the limits stop being enforced, so load_config() refuses a JOB_ADMISSION
+value without TOPIC_JOB_EVENTS.
+
+Tasks that aren't listed are launched without admission control, and
+regions that aren't listed have no core limit. A job is admitted to the
+first of its regions with room, and a job that listed several regions is
+released with the "admittedRegion" it was admitted to.
+
+This module is copied into each function that uses it by its cloudbuild.yaml.
+"""
+
+import time
+
+# Jobs in each hold message
+MAX_HELD_RESULTS = 500
+# Admitted jobs that haven't started a VM after this long are assumed
+# to have failed to launch
+START_TIMEOUT = 60 * 60
+# Running instances without a stop event after this long are dropped
+RUNNING_TIMEOUT = 3 * 24 * 60 * 60
+
+ADMITTED_LABEL = 'Admitted'
+
+
+def load_config(parsed_vars):
+    """JOB_ADMISSION value of the Trellis vars, or None if it isn't set.
+
+    Raises:
+        ValueError: Admission is configured without TOPIC_JOB_EVENTS.
+    """
+    config = parsed_vars.get('JOB_ADMISSION')
+    if config and not parsed_vars.get('TOPIC_JOB_EVENTS'):
+        raise ValueError("JOB_ADMISSION requires TOPIC_JOB_EVENTS; admitted jobs are never seen to start or stop without job events.")
+    return config
+
+
+def is_held(config, task, labels):
+    """Whether a launch function should hold the jobs of a request."""
+    return bool(config) and task in config.get('tasks', {}) and ADMITTED_LABEL not in labels
+
+
+def format_hold_messages(task, results, regions, header, sent_from, event_id):
+    """Messages that hold requested jobs with admit-jobs.
+
+    Args:
+        task (str): Task name of the launch function.
+        results (iterable): Query results; one job per result.
+        regions (list): Regions the jobs can run in.
+        header (dict): Header of the launch request.
+    Returns:
+        (list): Hold messages.
+    """
+    if isinstance(regions, str):
+        regions = regions.split()
+
+    messages = []
+    batch = []
+    for result in results:
+        batch.append(result)
+        if len(batch) == MAX_HELD_RESULTS:
+            messages.append(batch)
+            batch = []
+    if batch:
+        messages.append(batch)
+
+    return [{
+             "header": {
+                        "resource": "admission",
+                        "method": "POST",
+                        "labels": ["Hold", "Job", "Admission"],
+                        "sentFrom": sent_from,
+                        "seedId": f"{header['seedId']}",
+                        "previousEventId": f"{event_id}",
+             },
+             "body": {
+                      "task": task,
+                      "regions": regions,
+                      "dryRun": bool(header.get('dryRun')),
+                      "results": batch,
+             },
+            } for batch in messages]
+
+
+def new_state():
+    return {"seq": 0, "pending": [], "starting": [], "running": {}, "stopped": {}, "heldIds": {}}
+
+
+def add_held(state, config, message, message_id=None, now=None):
+    """Queue the jobs of a hold message.
+
+    Redelivered messages, with the ID of a message already queued,
+    are ignored.
+    """
+    now = time.time() if now is None else now
+    if message_id:
+        if message_id in state['heldIds']:
+            return
+        state['heldIds'][message_id] = now
+    header = message['header']
+    body = message['body']
+    task = body['task']
+    priority = config['tasks'].get(task, {}).get('priority', 0)
+    for result in body['results']:
+        state['seq'] += 1
+        state['pending'].append({
+                                 "task": task,
+                                 "priority": priority,
+                                 "heldEpoch": now,
+                                 "seq": state['seq'],
+                                 "regions": body.get('regions') or [],
+                                 "dryRun": body.get('dryRun', False),
+                                 "seedId": header.get('seedId'),
+                                 "result": result,
+        })
+
+
+def _region(zone):
+    # Zone "us-west1-b" is in region "us-west1"
+    return zone.rsplit('-', 1)[0] if zone else None
+
+
+def record_job_events(state, config, events):
+    """Track Trellis instances from the job events of log-* functions.
+
+    A started instance of a task takes the place of the oldest job of
+    the task that was admitted but hadn't started yet.
+    """
+    for event in sorted(events, key=lambda event: event['timeEpoch']):
+        name = event['instanceName']
+        properties = event.get('properties', {})
+        status = properties.get('status')
+
+        if status == 'STOPPED':
+            if state['running'].pop(name, None) is None:
+                # Stopped before its start event was read
+                state['stopped'][name] = event['timeEpoch']
+        elif status == 'RUNNING' and event.get('trellisName') in config['tasks']:
+            if name in state['running'] or state['stopped'].pop(name, None):
+                continue
+            task = event['trellisName']
+            region = _region(properties.get('zone'))
+            state['running'][name] = {"task": task, "region": region, "startEpoch": event['timeEpoch']}
+
+            starting = [job for job in state['starting'] if job['task'] == task]
+            if starting:
+                # Prefer a job admitted to the same region
+                same_region = [job for job in starting if job['region'] == region]
+                state['starting'].remove((same_region or starting)[0])
+
+
+def expire(state, now=None):
+    """Drop jobs that never started and instances that never stopped."""
+    now = time.time() if now is None else now
+    state['starting'] = [job for job in state['starting'] if now - job['admittedEpoch'] < START_TIMEOUT]
+    state['running'] = {
+                        name: job for name, job in state['running'].items()
+                        if now - job['startEpoch'] < RUNNING_TIMEOUT}
+    state['stopped'] = {name: epoch for name, epoch in state['stopped'].items() if now - epoch < START_TIMEOUT}
+    state['heldIds'] = {key: epoch for key, epoch in state['heldIds'].items() if now - epoch < START_TIMEOUT}
+
+
+def usage(state, config):
+    """Jobs of each task and cores in each region, running or starting.
+
+    Returns:
+        (dict, dict): Jobs by task, cores by region.
+    """
+    jobs = {}
+    cores = {}
+    for job in list(state['running'].values()) + state['starting']:
+        jobs[job['task']] = jobs.get(job['task'], 0) + 1
+        task_cores = config['tasks'].get(job['task'], {}).get('cores', 1)
+        cores[job['region']] = cores.get(job['region'], 0) + task_cores
+    return jobs, cores
+
+
+def _find_region(job_regions, task_cores, cores, regions):
+    """First region of a job with room for its cores.
+
+    Returns:
+        (bool, str): Whether a region was found, and the region; None
+                     if the job didn't list its regions.
+    """
+    for region in job_regions or [None]:
+        max_cores = regions.get(region, {}).get('maxCores')
+        if max_cores is None or cores.get(region, 0) + task_cores <= max_cores:
+            return True, region
+    return False, None
+
+
+def release(state, config, now=None):
+    """Admit held jobs in priority order while their quotas allow.
+
+    Jobs that don't fit are skipped, so lower priority jobs of other
+    tasks or regions can still be admitted.
+
+    Returns:
+        (list): Admitted jobs, removed from the pending queue.
+    """
+    now = time.time() if now is None else now
+    jobs, cores = usage(state, config)
+    regions = config.get('regions', {})
+
+    admitted = []
+    pending = []
+    for job in sorted(state['pending'], key=lambda job: (-job['priority'], job['heldEpoch'], job['seq'])):
+        task_config = config['tasks'].get(job['task'], {})
+        max_running = task_config.get('maxRunning')
+        task_cores = task_config.get('cores', 1)
+
+        fits = max_running is None or jobs.get(job['task'], 0) < max_running
+        if fits:
+            fits, region = _find_region(job['regions'], task_cores, cores, regions)
+        if not fits:
+            pending.append(job)
+            continue
+
+        jobs[job['task']] = jobs.get(job['task'], 0) + 1
+        cores[region] = cores.get(region, 0) + task_cores
+        state['starting'].append({"task": job['task'], "region": region, "admittedEpoch": now})
+        job['region'] = region
+        admitted.append(job)
+
+    state['pending'] = sorted(pending, key=lambda job: job['seq'])
+    return admitted
+
+
+def _released_result(job):
+    # Jobs admitted to one of several regions are launched in that region
+    if len(job['regions']) > 1 and job.get('region'):
+        return dict(job['result'], admittedRegion=job['region'])
+    return job['result']
+
+
+def format_release_messages(admitted, config, sent_from, event_id):
+    """Launch requests for admitted jobs; one bulk request per task.
+
+    Returns:
+        (list): (topic, message) tuples.
+    """
+    groups = {}
+    for job in admitted:
+        groups.setdefault((job['task'], job['dryRun']), []).append(job)
+
+    messages = []
+    for (task, dry_run), jobs in groups.items():
+        message = {
+                   "header": {
+                              "resource": "queryResult",
+                              "method": "VIEW",
+                              "labels": ["Job", "Request", "Bulk", ADMITTED_LABEL],
+                              "sentFrom": sent_from,
+                              "seedId": f"{jobs[0]['seedId']}",
+                              "previousEventId": f"{event_id}",
+                              "dryRun": dry_run,
+                   },
+                   "body": {
+                            "results": [_released_result(job) for job in jobs],
+                   },
+        }
+        messages.append((config['tasks'][task]['topic'], message))
+    return messages
@@ -0,0 +1,153 @@
+import pytest
+
+import admission
+
+CONFIG = {
+          "tasks": {
+                    "fastq-to-ubam": {"topic": "fastq-to-ubam-topic", "maxRunning": 3, "cores": 1, "priority": 2},
+                    "gatk-5-dollar": {"topic": "gatk-topic", "maxRunning": 10, "cores": 16, "priority": 1},
+          },
+          "regions": {"us-west1": {"maxCores": 40}},
+}
+
+
+def hold(task, count, regions=('us-west1',), seed_id=1):
+    results = [{"nodes": [{"id": f"{task}-{index}"}]} for index in range(count)]
+    [message] = admission.format_hold_messages(task, results, list(regions), {"seedId": seed_id}, 'launcher', 2)
+    return message
+
+
+def start(name, task, zone='us-west1-b', time_epoch=100.0):
+    return {
+            "instanceName": name,
+            "trellisName": task,
+            "timeEpoch": time_epoch,
+            "properties": {"status": "RUNNING", "zone": zone},
+    }
+
+
+def stop(name, time_epoch=200.0):
+    return {"instanceName": name, "timeEpoch": time_epoch, "properties": {"status": "STOPPED"}}
+
+
+class TestLoadConfig:
+
+    def test_load_config(self):
+        assert admission.load_config({}) is None
+        assert admission.load_config({"JOB_ADMISSION": CONFIG, "TOPIC_JOB_EVENTS": "job-events"}) == CONFIG
+
+    def test_requires_job_events(self):
+        with pytest.raises(ValueError):
+            admission.load_config({"JOB_ADMISSION": CONFIG})
+
+
+class TestHold:
+
+    def test_is_held(self):
+        assert admission.is_held(CONFIG, 'fastq-to-ubam', ['Bulk'])
+        assert not admission.is_held(CONFIG, 'fastq-to-ubam', ['Bulk', 'Admitted'])
+        assert not admission.is_held(CONFIG, 'flagstat', [])
+        assert not admission.is_held(None, 'fastq-to-ubam', [])
+
+    def test_messages_split(self, monkeypatch):
+        monkeypatch.setattr(admission, 'MAX_HELD_RESULTS', 2)
+        results = [{"nodes": [{"id": index}]} for index in range(5)]
+        messages = admission.format_hold_messages('fastq-to-ubam', iter(results), 'us-west1 us-east1', {"seedId": 1}, 'launcher', 2)
+
+        assert [len(message['body']['results']) for message in messages] == [2, 2, 1]
+        assert messages[0]['body']['regions'] == ['us-west1', 'us-east1']
+
+    def test_redelivered_messages_ignored(self):
+        state = admission.new_state()
+        admission.add_held(state, CONFIG, hold('fastq-to-ubam', 2), 'message-1')
+        admission.add_held(state, CONFIG, hold('fastq-to-ubam', 2), 'message-1')
+        assert len(state['pending']) == 2
+
+
+class TestRelease:
+
+    def test_task_quota(self):
+        state = admission.new_state()
+        admission.add_held(state, CONFIG, hold('fastq-to-ubam', 5), now=10)
+
+        admitted = admission.release(state, CONFIG, now=20)
+        assert [job['result']['nodes'][0]['id'] for job in admitted] == [
+            'fastq-to-ubam-0', 'fastq-to-ubam-1', 'fastq-to-ubam-2']
+        assert len(state['pending']) == 2
+        # Nothing more until jobs finish
+        assert admission.release(state, CONFIG, now=30) == []
+
+    def test_released_as_jobs_finish(self):
+        state = admission.new_state()
+        admission.add_held(state, CONFIG, hold('fastq-to-ubam', 5))
+        admission.release(state, CONFIG)
+
+        admission.record_job_events(state, CONFIG, [start('vm-1', 'fastq-to-ubam'), start('vm-2', 'fastq-to-ubam')])
+        assert len(state['starting']) == 1
+        assert admission.usage(state, CONFIG) == ({'fastq-to-ubam': 3}, {'us-west1': 3})
+        assert admission.release(state, CONFIG) == []
+
+        admission.record_job_events(state, CONFIG, [stop('vm-1')])
+        assert len(admission.release(state, CONFIG)) == 1
+        assert len(state['pending']) == 1
+
+    def test_priority_and_region_quota(self):
+        state = admission.new_state()
+        admission.add_held(state, CONFIG, hold('gatk-5-dollar', 3), now=10)
+        admission.add_held(state, CONFIG, hold('fastq-to-ubam', 2), now=20)
+
+        admitted = admission.release(state, CONFIG)
+        # Higher priority first; two 16-core workflows fit in 40 cores
+        # and the 1-core jobs still fit beside them
+        assert [job['task'] for job in admitted] == ['fastq-to-ubam', 'fastq-to-ubam', 'gatk-5-dollar', 'gatk-5-dollar']
+        assert admission.usage(state, CONFIG)[1] == {'us-west1': 34}
+        assert [job['task'] for job in state['pending']] == ['gatk-5-dollar']
+
+    def test_other_region(self):
+        state = admission.new_state()
+        admission.add_held(state, CONFIG, hold('gatk-5-dollar', 3, regions=('us-west1', 'us-east1')))
+
+        admitted = admission.release(state, CONFIG)
+        assert len(admitted) == 3
+        assert [job['region'] for job in state['starting']] == ['us-west1', 'us-west1', 'us-east1']
+
+    def test_expire(self):
+        state = admission.new_state()
+        admission.add_held(state, CONFIG, hold('fastq-to-ubam', 4), now=0)
+        admission.release(state, CONFIG, now=0)
+        admission.record_job_events(state, CONFIG, [start('vm-1', 'fastq-to-ubam', time_epoch=0)])
+
+        # Admitted jobs that never started free their slots
+        admission.expire(state, now=admission.START_TIMEOUT)
+        assert admission.usage(state, CONFIG)[0] == {'fastq-to-ubam': 1}
+        assert len(admission.release(state, CONFIG)) == 1
+
+    def test_stop_before_start(self):
+        state = admission.new_state()
+        admission.record_job_events(state, CONFIG, [stop('vm-1', time_epoch=100)])
+        admission.record_job_events(state, CONFIG, [start('vm-1', 'fastq-to-ubam', time_epoch=50)])
+        assert state['running'] == {}
+
+
+class TestReleaseMessages:
+
+    def test_bulk_per_task(self):
+        state = admission.new_state()
+        admission.add_held(state, CONFIG, hold('fastq-to-ubam', 2, seed_id=7))
+        admission.add_held(state, CONFIG, hold('gatk-5-dollar', 1))
+
+        messages = admission.format_release_messages(admission.release(state, CONFIG), CONFIG, 'admit-jobs', 3)
+        topics = {topic: message for topic, message in messages}
+        message = topics['fastq-to-ubam-topic']
+        assert message['header']['labels'] == ['Job', 'Request', 'Bulk', 'Admitted']
+        assert message['header']['seedId'] == '7'
+        assert message['body']['results'] == [{"nodes": [{"id": "fastq-to-ubam-0"}]}, {"nodes": [{"id": "fastq-to-ubam-1"}]}]
+        assert len(topics['gatk-topic']['body']['results']) == 1
+
+    def test_admitted_region(self):
+        state = admission.new_state()
+        admission.add_held(state, CONFIG, hold('gatk-5-dollar', 3, regions=('us-west1', 'us-east1')))
+
+        messages = admission.format_release_messages(admission.release(state, CONFIG), CONFIG, 'admit-jobs', 3)
+        [(topic, message)] = messages
+        assert [result['admittedRegion'] for result in message['body']['results']] == ['us-west1', 'us-west1', 'us-east1']
@@ -0,0 +1,139 @@
+"""Pass large query results by reference instead of inside the message.
+
+db-query used to put every row of an unsplit result into one Pub/Sub
+message, which can exceed the 10MB message limit and slows every
+consumer that has to decode it. Results larger than a threshold are
+written to a gzipped JSON lines object, one row per line, and the
+message body carries a claim check with the object URI and row count
+instead of 'results'. Consumers read the rows back lazily with
+iter_results(), which works the same for inline results.
+
+Objects are written to a "gs://bucket/prefix" location, or a local
+directory when testing. Claim check objects are not deleted by
+Trellis; use a lifecycle rule on the bucket to expire them.
+
+This module is copied into each function that uses it by its cloudbuild.yaml.
+"""
+
+import os
+import gzip
+import json
+import zlib
+
+try:
+    from google.cloud import storage
+except ImportError:
+    storage = None
+
+# Message body key used instead of 'results'
+CLAIM_CHECK_KEY = 'results-claim-check'
+
+CLAIM_CHECK_FORMAT = 'jsonl.gz'
+
+# Results up to this size are sent inside the message
+DEFAULT_THRESHOLD = 1024 * 1024
+# Bytes downloaded per request when reading results
+CHUNK_SIZE = 1024 * 1024
+
+
+def _split_gcs_uri(uri):
+    bucket, _, path = uri[len('gs://'):].partition('/')
+    return bucket, path
+
+
+def _get_client(client):
+    if client is None:
+        client = storage.Client()
+    return client
+
+
+def _write_object(uri, data, client=None):
+    if uri.startswith('gs://'):
+        bucket, path = _split_gcs_uri(uri)
+        blob = _get_client(client).bucket(bucket).blob(path)
+        blob.upload_from_string(data, content_type='application/gzip')
+    else:
+        os.makedirs(os.path.dirname(uri), exist_ok=True)
+        with open(uri, 'wb') as fh:
+            fh.write(data)
+
+
+def _read_chunks(uri, client=None, chunk_size=CHUNK_SIZE):
+    if uri.startswith('gs://'):
+        bucket, path = _split_gcs_uri(uri)
+        blob = _get_client(client).bucket(bucket).get_blob(path)
+        if blob is None:
+            raise ValueError(f"Claim check object not found: {uri}.")
+        for start in range(0, blob.size, chunk_size):
+            end = min(start + chunk_size, blob.size) - 1
+            yield blob.download_as_string(start=start, end=end)
+    else:
+        with open(uri, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(chunk_size), b''):
+                yield chunk
+
+
+def _iter_lines(chunks):
+    """Decompress gzipped chunks and yield complete lines."""
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    remainder = b''
+    for chunk in chunks:
+        lines = (remainder + decompressor.decompress(chunk)).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line
+    remainder += decompressor.flush()
+    if remainder:
+        yield remainder
+
+
+def check_in(rows, location, name, threshold=DEFAULT_THRESHOLD, client=None):
+    """Write rows to an object if they are too large to send inline.
+
+    Args:
+        rows (list): Query result rows.
+        location (str): "gs://bucket/prefix" or local directory.
+        name (str): Object name, unique to the query.
+        threshold (int): Size in bytes of the JSON encoded rows above
+                         which they are written to an object.
+        client (google.cloud.storage.Client): Client used for GCS.
+    Returns:
+        (dict): Claim check with the object 'uri', 'rowCount' and
+                'format', or None if the rows should be sent inline.
+    """
+    lines = [json.dumps(row, separators=(',', ':'), default=str) for row in rows]
+    size = sum(len(line) + 1 for line in lines)
+    if size <= threshold:
+        return None
+
+    uri = f"{location.rstrip('/')}/{name}.{CLAIM_CHECK_FORMAT}"
+    data = gzip.compress('\n'.join(lines).encode('utf-8'))
+    _write_object(uri, data, client)
+    return {
+            "uri": uri,
+            "rowCount": len(lines),
+            "format": CLAIM_CHECK_FORMAT,
+    }
+
+
+def count_results(body):
+    """Count result rows without reading a claim checked object."""
+    claim_check = body.get(CLAIM_CHECK_KEY)
+    if claim_check:
+        return claim_check['rowCount']
+    return len(body.get('results') or [])
+
+
+def iter_results(body, client=None, chunk_size=CHUNK_SIZE):
+    """Yield result rows from the message body or its claim check object."""
+    claim_check = body.get(CLAIM_CHECK_KEY)
+    if not claim_check:
+        yield from body.get('results') or []
+        return
+
+    if claim_check['format'] != CLAIM_CHECK_FORMAT:
+        raise ValueError(f"Unsupported claim check format: {claim_check['format']}.")
+    chunks = _read_chunks(claim_check['uri'], client, chunk_size)
+    for line in _iter_lines(chunks):
+        if line:
+            yield json.loads(line.decode('utf-8'))
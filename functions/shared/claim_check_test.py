@@ -0,0 +1,41 @@
+import claim_check
+
+
+def make_rows(count):
+    return [{"node": {"id": f"blob-{index}", "path": f"plate/sample/blob-{index}.bam"}} for index in range(count)]
+
+
+class TestCheckIn:
+
+    def test_small_results_inline(self, tmp_path):
+        result = claim_check.check_in(make_rows(3), str(tmp_path), 'event-1')
+
+        assert result is None
+        assert list(tmp_path.iterdir()) == []
+
+    def test_large_results_written(self, tmp_path):
+        rows = make_rows(2000)
+        result = claim_check.check_in(rows, str(tmp_path), 'event-1', threshold=1000)
+
+        assert result == {
+                          "uri": f"{tmp_path}/event-1.jsonl.gz",
+                          "rowCount": 2000,
+                          "format": "jsonl.gz"}
+
+        body = {"cypher": "MATCH (node:Blob) RETURN node", claim_check.CLAIM_CHECK_KEY: result}
+        assert claim_check.count_results(body) == 2000
+        # Small chunks split rows and gzip blocks across reads
+        assert list(claim_check.iter_results(body, chunk_size=64)) == rows
+
+
+class TestIterResults:
+
+    def test_inline_results(self):
+        body = {"results": make_rows(2)}
+
+        assert claim_check.count_results(body) == 2
+        assert list(claim_check.iter_results(body)) == make_rows(2)
+
+    def test_empty_results(self):
+        assert claim_check.count_results({"results": None}) == 0
+        assert list(claim_check.iter_results({"results": None})) == []
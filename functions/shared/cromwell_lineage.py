@@ -0,0 +1,198 @@
+"""Write Cromwell workflow lineage in one batched query.
+
+The RelateCromwell* triggers build the workflow, step, attempt and
+output graph one relationship at a time, with a database query and a
+trigger evaluation for each. LINEAGE_QUERY writes the same graph for a
+batch of workflows in one transaction:
+
+    (CromwellWorkflow)-[:LED_TO]->(CromwellStep)-[:LED_TO]->(CromwellStep)
+    (CromwellStep)-[:GENERATED_ATTEMPT]->(latest CromwellAttempt)
+    (CromwellAttempt)-[:AFTER]->(previous CromwellAttempt)
+    (CromwellStep)-[:GENERATED]->(Blob)
+
+Step order and attempt order are recomputed from the stored nodes, so
+updates for a workflow can be split across batches and arrive in any
+order, and rerunning a batch doesn't change the graph.
+
+Each workflow in the $workflows parameter is a dict with:
+
+    cromwellWorkflowId (str)
+    trellisTaskId (str): Task ID of the CromwellWorkflow job, or None.
+    properties (dict): Set on the CromwellWorkflow job node.
+    attempts (list): CromwellAttempt properties, merged on instanceName.
+                     Empty when attempts were created from VM logs.
+    steps (list): {wdlCallAlias, startTimeEpoch} of each step with new
+                  attempts.
+    outputs (list): {wdlCallAlias, stepAlias, id} of each output; the
+                    outputs of a call are all related if id is None.
+
+This module is copied into each function that uses it by its cloudbuild.yaml.
+"""
+
+LINEAGE_QUERY = (
+                 "UNWIND $workflows AS workflow " +
+                 # Attempts read from workflow metadata
+                 "FOREACH (event IN workflow.attempts | " +
+                    "MERGE (attempt:CromwellAttempt {instanceName: event.instanceName}) " +
+                    "ON CREATE SET " +
+                        "attempt:Job:GcpInstance, " +
+                        "attempt.labels = [\"Job\", \"CromwellAttempt\", \"GcpInstance\"] " +
+                    "SET attempt += event) " +
+                 # Steps are created from their first attempt (CreateCromwellStepFromAttempt)
+                 "FOREACH (event IN workflow.steps | " +
+                    "MERGE (step:CromwellStep { " +
+                        "cromwellWorkflowId: workflow.cromwellWorkflowId, " +
+                        "wdlCallAlias: event.wdlCallAlias " +
+                    "}) " +
+                    "ON CREATE SET " +
+                        "step.startTimeEpoch = event.startTimeEpoch, " +
+                        "step.labels = [\"CromwellStep\"], " +
+                        "step.nodeIteration = \"initial\" " +
+                    "ON MATCH SET " +
+                        "step.nodeIteration = \"merged\", " +
+                        "step.startTimeEpoch = CASE " +
+                            "WHEN event.startTimeEpoch < step.startTimeEpoch " +
+                                "THEN event.startTimeEpoch " +
+                            "ELSE step.startTimeEpoch " +
+                        "END) " +
+                 # AddWorkflowIdToCromwellWorkflow
+                 "WITH workflow " +
+                 "OPTIONAL MATCH (cromwellWorkflow:CromwellWorkflow { " +
+                    "trellisTaskId: workflow.trellisTaskId }) " +
+                 "SET cromwellWorkflow += workflow.properties, " +
+                    "cromwellWorkflow.cromwellWorkflowId = workflow.cromwellWorkflowId " +
+                 "WITH DISTINCT workflow " +
+                 "OPTIONAL MATCH (cromwellWorkflow:CromwellWorkflow { " +
+                    "cromwellWorkflowId: workflow.cromwellWorkflowId }) " +
+                 "OPTIONAL MATCH (step:CromwellStep { " +
+                    "cromwellWorkflowId: workflow.cromwellWorkflowId }) " +
+                 "WITH workflow, cromwellWorkflow, step " +
+                 "ORDER BY step.startTimeEpoch " +
+                 "WITH workflow, cromwellWorkflow, COLLECT(step) AS steps " +
+                 # Remove step order written before an earlier step arrived
+                 "OPTIONAL MATCH (previous:CromwellStep { " +
+                    "cromwellWorkflowId: workflow.cromwellWorkflowId " +
+                 "})-[staleStep:LED_TO]->(current:CromwellStep) " +
+                 "WHERE NOT coalesce(previous.startTimeEpoch = last([" +
+                    "s IN steps WHERE s.startTimeEpoch < current.startTimeEpoch" +
+                 "]).startTimeEpoch, false) " +
+                 "OPTIONAL MATCH (cromwellWorkflow)-[staleFirst:LED_TO]->(later:CromwellStep) " +
+                 "WHERE later.startTimeEpoch > head(steps).startTimeEpoch " +
+                 "WITH workflow, cromwellWorkflow, steps, " +
+                    "COLLECT(DISTINCT staleStep) + COLLECT(DISTINCT staleFirst) AS stale " +
+                 "FOREACH (relationship IN stale | DELETE relationship) " +
+                 # RelateCromwellWorkflowToStep
+                 "FOREACH (first IN CASE " +
+                        "WHEN cromwellWorkflow IS NULL THEN [] " +
+                        "ELSE [s IN steps WHERE s.startTimeEpoch = head(steps).startTimeEpoch] " +
+                    "END | " +
+                    "MERGE (cromwellWorkflow)-[:LED_TO]->(first)) " +
+                 # RelateCromwellStepToPreviousStep
+                 "FOREACH (current IN steps | " +
+                    "FOREACH (previous IN [s IN steps WHERE s.startTimeEpoch = last([" +
+                            "p IN steps WHERE p.startTimeEpoch < current.startTimeEpoch" +
+                        "]).startTimeEpoch] | " +
+                        "MERGE (previous)-[:LED_TO]->(current))) " +
+                 # Attempts of the steps in this batch; the null step
+                 # keeps a row for workflows that only have outputs
+                 "WITH workflow, steps " +
+                 "UNWIND [s IN steps WHERE s.wdlCallAlias IN [" +
+                    "event IN workflow.steps | event.wdlCallAlias]] + [null] AS step " +
+                 "OPTIONAL MATCH (attempt:CromwellAttempt { " +
+                    "cromwellWorkflowId: workflow.cromwellWorkflowId, " +
+                    "wdlCallAlias: step.wdlCallAlias }) " +
+                 "WITH workflow, step, attempt " +
+                 "ORDER BY attempt.startTimeEpoch " +
+                 "WITH workflow, step, COLLECT(attempt) AS attempts " +
+                 # RelateCromwellAttemptToPreviousAttempt
+                 "FOREACH (current IN attempts | " +
+                    "FOREACH (previous IN [a IN attempts WHERE a.startTimeEpoch = last([" +
+                            "p IN attempts WHERE p.startTimeEpoch < current.startTimeEpoch" +
+                        "]).startTimeEpoch] | " +
+                        "MERGE (current)-[:AFTER]->(previous))) " +
+                 # RelateCromwellStepToLatestAttempt, RelateCromwellStepToAttempt
+                 "FOREACH (latest IN [a IN attempts WHERE a.startTimeEpoch = last(attempts).startTimeEpoch] | " +
+                    "MERGE (step)-[:GENERATED_ATTEMPT]->(latest)) " +
+                 # DeleteRelationshipCromwellStepHasAttempt
+                 "WITH workflow, step, attempts " +
+                 "OPTIONAL MATCH (step)-[older:GENERATED_ATTEMPT]->(olderAttempt) " +
+                 "WHERE olderAttempt.startTimeEpoch < last(attempts).startTimeEpoch " +
+                 "DELETE older " +
+                 # RelateCromwellOutputToStep; outputs that are already
+                 # related aren't returned, so triggers aren't repeated
+                 "WITH DISTINCT workflow " +
+                 "UNWIND workflow.outputs AS output " +
+                 "MATCH (step:CromwellStep { " +
+                    "cromwellWorkflowId: workflow.cromwellWorkflowId, " +
+                    "wdlCallAlias: output.stepAlias " +
+                 "}) " +
+                 "MATCH (node:Blob { " +
+                    "cromwellWorkflowId: workflow.cromwellWorkflowId, " +
+                    "wdlCallAlias: output.wdlCallAlias " +
+                 "}) " +
+                 "WHERE (output.id IS NULL OR node.id = output.id) " +
+                    "AND NOT (step)-[:GENERATED]->(node) " +
+                 "MERGE (step)-[:GENERATED]->(node) " +
+                 "RETURN node")
+
+# Same labels as RelateCromwellOutputToStep, so that the
+# QC triggers are evaluated for each related output
+LINEAGE_LABELS = ["Create", "Generated", "Relationship", "CromwellStep", "Output", "Cypher", "Query"]
+
+
+def new_workflow(cromwell_workflow_id, trellis_task_id=None):
+    """Empty lineage update for one workflow."""
+    return {
+            "cromwellWorkflowId": cromwell_workflow_id,
+            "trellisTaskId": trellis_task_id,
+            "properties": {},
+            "attempts": [],
+            "steps": [],
+            "outputs": [],
+    }
+
+
+def add_step(workflow, wdl_call_alias, start_time_epoch):
+    """Add a step, or move it back to an earlier start time."""
+    for step in workflow['steps']:
+        if step['wdlCallAlias'] == wdl_call_alias:
+            step['startTimeEpoch'] = min(step['startTimeEpoch'], start_time_epoch)
+            return step
+    step = {"wdlCallAlias": wdl_call_alias, "startTimeEpoch": start_time_epoch}
+    workflow['steps'].append(step)
+    return step
+
+
+def add_output(workflow, wdl_call_alias, blob_id=None):
+    """Relate one output, or every output of a call, to its step.
+
+    Output blobs keep the case of the call alias in their path, while
+    step aliases come from lower-case instance labels.
+    """
+    output = {"wdlCallAlias": wdl_call_alias, "stepAlias": wdl_call_alias.lower(), "id": blob_id}
+    if output not in workflow['outputs']:
+        workflow['outputs'].append(output)
+    return output
+
+
+def format_lineage_message(workflows, sent_from, publish_to, seed_id):
+    message = {
+               "header": {
+                          "resource": "query",
+                          "method": "POST",
+                          "labels": LINEAGE_LABELS,
+                          "sentFrom": sent_from,
+                          "publishTo": publish_to,
+                          "seedId": f"{seed_id}",
+                          "previousEventId": f"{seed_id}"
+               },
+               "body": {
+                        "cypher": LINEAGE_QUERY,
+                        "parameters": {"workflows": workflows},
+                        "result-mode": "data",
+                        "result-structure": "list",
+                        # Evaluate triggers for each related output
+                        "result-split": "True",
+               },
+    }
+    return message
@@ -0,0 +1,44 @@
+import cromwell_lineage
+
+
+class TestWorkflowUpdate:
+
+    def test_steps_start_with_earliest_attempt(self):
+        workflow = cromwell_lineage.new_workflow('wf-1')
+        cromwell_lineage.add_step(workflow, 'bwa', 200)
+        cromwell_lineage.add_step(workflow, 'bwa', 100)
+        cromwell_lineage.add_step(workflow, 'sortsam', 300)
+
+        assert workflow['steps'] == [
+                                     {"wdlCallAlias": "bwa", "startTimeEpoch": 100},
+                                     {"wdlCallAlias": "sortsam", "startTimeEpoch": 300}]
+
+    def test_outputs(self):
+        workflow = cromwell_lineage.new_workflow('wf-1')
+        cromwell_lineage.add_output(workflow, 'SortSam', 'out-1')
+        cromwell_lineage.add_output(workflow, 'SortSam', 'out-1')
+        cromwell_lineage.add_output(workflow, 'MarkDuplicates')
+
+        assert workflow['outputs'] == [
+            {"wdlCallAlias": "SortSam", "stepAlias": "sortsam", "id": "out-1"},
+            {"wdlCallAlias": "MarkDuplicates", "stepAlias": "markduplicates", "id": None}]
+
+
+class TestLineageMessage:
+
+    def test_parameterized(self):
+        workflow = cromwell_lineage.new_workflow('wf-1', '210101-000000-000-1')
+        message = cromwell_lineage.format_lineage_message([workflow], 'build-cromwell-lineage', 'check-triggers', 123)
+
+        assert message['body']['parameters'] == {"workflows": [workflow]}
+        assert message['body']['result-split'] == "True"
+        assert message['header']['labels'] == cromwell_lineage.LINEAGE_LABELS
+        assert message['header']['publishTo'] == 'check-triggers'
+        # Values are only passed as parameters
+        assert 'wf-1' not in message['body']['cypher']
+        assert message['body']['cypher'].startswith("UNWIND $workflows AS workflow ")
+
+    def test_outputs_returned_once(self):
+        query = cromwell_lineage.LINEAGE_QUERY
+        assert query.index("AND NOT (step)-[:GENERATED]->(node)") < query.index("MERGE (step)-[:GENERATED]->(node)")
+        assert query.endswith("RETURN node")
@@ -0,0 +1,296 @@
+"""Submit dsub jobs directly from Trellis job metadata.
+
+Launch functions used to turn each job_dict into a dsub command line and
+call dsub.dsub_main(), which re-parses the arguments and initializes a new
+provider (API clients and credentials) for every job. DsubClient builds
+the dsub job parameters and resources from the job_dict itself and keeps
+initialized providers for reuse by later submissions in the same process.
+
+This module is copied into each launch-* function by its cloudbuild.yaml.
+"""
+
+import time
+import queue
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dsub.commands import dsub
+from dsub.commands import dstat
+from dsub.lib import job_model
+from dsub.lib import param_util
+from dsub.lib import output_formatter
+from dsub.providers import google_v2
+from dsub.providers import google_cls_v2
+
+
+class NotSubmittedError(Exception):
+    """A job failed before it was sent to dsub, so it can be submitted again."""
+
+
+def _rate_limited(error):
+    """Whether the Pipelines API rejected a submission with HTTP 429."""
+    response = getattr(error, 'resp', None)
+    return getattr(response, 'status', None) == 429
+
+
+def create_provider(provider_name, project, location, dry_run):
+    """Create a dsub provider the same way the dsub CLI does."""
+    if provider_name == 'google-cls-v2':
+        return google_cls_v2.GoogleCLSV2JobProvider(dry_run, project, location)
+    elif provider_name == 'google-v2':
+        return google_v2.GoogleV2JobProvider(dry_run, project)
+    else:
+        raise ValueError(f"Unsupported dsub provider: {provider_name}.")
+
+
+def _split_pair(pair):
+    name, value = pair.split('=', 1)
+    return name, value
+
+
+def build_job_params(job_dict, labels):
+    """Build dsub job parameters from job_dict envs, inputs & outputs.
+
+    Args:
+        job_dict (dict): Trellis job metadata.
+        labels (dict): dsub labels to add to the job.
+    Returns:
+        (dict): Sets of dsub envs, labels, inputs, outputs and mounts.
+    """
+    input_util = param_util.InputFileParamUtil(dsub.DEFAULT_INPUT_LOCAL_PATH)
+    output_util = param_util.OutputFileParamUtil(dsub.DEFAULT_OUTPUT_LOCAL_PATH)
+
+    inputs = set()
+    for name, uri in job_dict.get('inputs', {}).items():
+        inputs.add(input_util.make_param(name, uri, False))
+
+    # Recursive inputs are stored as "NAME=uri" strings
+    input_recursive = job_dict.get('inputRecursive')
+    if input_recursive:
+        name, uri = _split_pair(input_recursive)
+        inputs.add(input_util.make_param(name, uri, True))
+
+    outputs = set()
+    for name, uri in job_dict.get('outputs', {}).items():
+        outputs.add(output_util.make_param(name, uri, False))
+
+    job_params = {
+                  'envs': {
+                           job_model.EnvParam(name, str(value))
+                           for name, value in job_dict.get('envs', {}).items()},
+                  'labels': {
+                             job_model.LabelParam(name, str(value))
+                             for name, value in labels.items()},
+                  'inputs': inputs,
+                  'outputs': outputs,
+                  'mounts': set(),
+    }
+    return job_params
+
+
+def build_job_resources(job_dict):
+    """Build dsub job resources from job_dict machine & logging fields."""
+    regions = job_dict.get('regions')
+    if isinstance(regions, str):
+        regions = regions.split()
+
+    resources = {
+                 'min_cores': job_dict.get('minCores'),
+                 'min_ram': job_dict.get('minRam'),
+                 'machine_type': job_dict.get('machineType'),
+                 'disk_size': job_dict.get('diskSize', job_model.DEFAULT_DISK_SIZE),
+                 'boot_disk_size': job_dict.get('bootDiskSize', job_model.DEFAULT_BOOT_DISK_SIZE),
+                 'image': job_dict['image'],
+                 'logging': param_util.build_logging_param(job_dict['logging']),
+                 'regions': regions,
+                 'network': job_dict.get('network'),
+                 'subnetwork': job_dict.get('subnetwork'),
+                 'use_private_address': job_dict.get('usePrivateAddress', True),
+                 'timeout': param_util.timeout_in_seconds(job_dict.get('timeout')),
+                 'ssh': job_dict.get('ssh', False),
+                 'enable_stackdriver_monitoring': job_dict.get('enableStackdriverMonitoring', False),
+                 'max_retries': 0,
+                 'max_preemptible_attempts': param_util.PreemptibleParam(
+                                                bool(job_dict.get('preemptible', False))),
+    }
+    # Only supported by newer versions of dsub
+    if job_dict.get('blockExternalNetwork'):
+        resources['block_external_network'] = True
+    return job_model.Resources(**resources)
+
+
+class DsubClient:
+    """Submit and look up dsub jobs using cached, already-initialized providers.
+
+    Providers wrap Google API clients that are not thread-safe, so each
+    provider is used by one submission at a time. Idle providers are kept
+    for the lifetime of the process.
+    """
+
+    def __init__(self, location=job_model.DEFAULT_LOCATION, provider_factory=create_provider, claims=None):
+        self.location = location
+        self._provider_factory = provider_factory
+        # launch_claims.LaunchClaims; if set, each job claims its inputs before it is launched
+        self.claims = claims
+        self._providers = {}
+        self._lock = threading.Lock()
+
+
+    def _acquire_provider(self, provider_name, project, dry_run):
+        key = (provider_name, project, dry_run)
+        with self._lock:
+            idle = self._providers.setdefault(key, queue.LifoQueue())
+        try:
+            provider = idle.get_nowait()
+        except queue.Empty:
+            logging.info(f"> Initializing dsub provider {provider_name} for {project}.")
+            provider = self._provider_factory(provider_name, project, self.location, dry_run)
+        return key, provider
+
+
+    def _release_provider(self, key, provider):
+        self._providers[key].put(provider)
+
+
+    def submit(self, job_dict, name, labels):
+        """Submit a single job.
+
+        Args:
+            job_dict (dict): Trellis job metadata describing the job.
+            name (str): dsub job name.
+            labels (dict): dsub labels to add to the job.
+        Returns:
+            (dict): dsub result with 'job-id', 'user-id' and 'task-id',
+                    plus the submission 'latency' in seconds. Jobs that
+                    are not launched because their inputs are already
+                    claimed get an 'error' and 'duplicate' instead.
+        """
+        dry_run = job_dict.get('dryRun', False)
+        claims = self.claims if job_dict.get('inputHash') and not dry_run else None
+        try:
+            if claims:
+                claim = claims.claim(job_dict['name'], job_dict['inputHash'], job_dict['trellisTaskId'])
+                if claim:
+                    return {'error': f"Duplicate of job {claim['owner']}.", 'duplicate': True}
+
+            job_params = build_job_params(job_dict, labels)
+            job_resources = build_job_resources(job_dict)
+            task_descriptors = [
+                                job_model.TaskDescriptor(
+                                    {'task-id': None},
+                                    {'labels': set(), 'envs': set(), 'inputs': set(), 'outputs': set()},
+                                    job_model.Resources())]
+
+            key, provider = self._acquire_provider(job_dict['provider'], job_dict['project'], dry_run)
+        except Exception as error:
+            if claims:
+                claims.release(job_dict['name'], job_dict['inputHash'], job_dict['trellisTaskId'])
+            # Invalid job parameters fail the same way every time
+            if isinstance(error, ValueError):
+                raise
+            raise NotSubmittedError(str(error)) from error
+
+        start = time.perf_counter()
+        try:
+            # dsub's progress output goes to the function logs as is;
+            # dsub_util.replace_print() swaps the global sys.stdout,
+            # which isn't safe with concurrent submissions.
+            result = dsub.run(
+                              provider,
+                              job_resources,
+                              job_params,
+                              task_descriptors,
+                              name=name,
+                              dry_run=dry_run,
+                              command=job_dict.get('command'),
+                              script=job_dict.get('script'),
+                              user=job_dict.get('user'),
+                              project=job_dict['project'],
+                              location=self.location,
+                              disable_warning=True)
+        except Exception:
+            # Let a later request launch the inputs
+            if claims:
+                claims.release(job_dict['name'], job_dict['inputHash'], job_dict['trellisTaskId'])
+            raise
+        finally:
+            self._release_provider(key, provider)
+        latency = time.perf_counter() - start
+
+        logging.info(f"> dsub submission latency: {latency:.3f} seconds for {name}.")
+        result['latency'] = latency
+        return result
+
+
+    def submit_all(self, submissions, max_workers=1):
+        """Submit several jobs in one call.
+
+        Args:
+            submissions (list): (job_dict, name, labels) tuples.
+            max_workers (int): Maximum number of concurrent submissions.
+        Returns:
+            (list): A result for each submission, in order. Failed
+                    submissions have an 'error' instead of a 'job-id'.
+        """
+        results = [None] * len(submissions)
+        for index, result in self.submit_as_completed(submissions, max_workers):
+            results[index] = result
+        return results
+
+
+    def submit_as_completed(self, submissions, max_workers=1):
+        """Submit several jobs, yielding each result as soon as it is ready.
+
+        Args:
+            submissions (list): (job_dict, name, labels) tuples.
+            max_workers (int): Maximum number of concurrent submissions.
+        Yields:
+            (int, dict): Index of the submission and its result. Failed
+                         submissions have an 'error' instead of a 'job-id',
+                         and 'retry' if they certainly weren't launched and
+                         submitting them again may succeed.
+        """
+        def _submit(submission):
+            try:
+                return self.submit(*submission)
+            except Exception as error:
+                logging.error(f"> dsub submission failed for {submission[1]}: {error}.")
+                # Other errors may be raised after the job was created, so
+                # submitting it again could launch it twice
+                retry = isinstance(error, NotSubmittedError) or _rate_limited(error)
+                return {'error': str(error), 'retry': retry}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_submit, submission): index for index, submission in enumerate(submissions)}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+
+    def lookup_tasks(self, provider_name, project, job_ids, user_ids):
+        """Get the status of several jobs with one provider lookup.
+
+        Args:
+            provider_name (str): dsub provider the jobs were submitted with.
+            project (str): Project the jobs were submitted to.
+            job_ids (set): dsub job IDs to look up.
+            user_ids (set): dsub users that submitted the jobs.
+        Returns:
+            (list): A task dict for each task of the jobs, formatted
+                    like the output of "dstat --full --format json".
+        """
+        formatter = output_formatter.JsonOutput(True)
+
+        key, provider = self._acquire_provider(provider_name, project, False)
+        try:
+            job_producer = dstat.dstat_job_producer(
+                                                    provider,
+                                                    {'*'},
+                                                    user_ids=set(user_ids),
+                                                    job_ids=set(job_ids),
+                                                    full_output=True)
+            tasks = next(job_producer)
+        finally:
+            self._release_provider(key, provider)
+        return [formatter.prepare_output(task) for task in tasks]
@@ -0,0 +1,211 @@
+import pytest
+
+from types import SimpleNamespace
+from datetime import datetime
+
+import dsub_client
+import launch_claims
+
+from dsub.lib import providers_util
+from dsub.providers import provider_base
+
+
+class RateLimited(Exception):
+    """Looks like a googleapiclient HttpError with status 429."""
+
+    resp = SimpleNamespace(status=429)
+
+
+class FakeTask:
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def get_field(self, field, default=None):
+        return self.fields.get(field, default)
+
+
+class FakeProvider:
+    """Records submitted jobs instead of calling the Pipelines API."""
+
+    status_message = None
+
+    def __init__(self, provider_name, project, location, dry_run):
+        self.project = project
+        self.submitted = []
+        self.lookups = []
+
+    def prepare_job_metadata(self, script, job_name, user_id):
+        return providers_util.prepare_job_metadata(script, job_name, user_id)
+
+    def submit_job(self, job_descriptor, skip_if_output_present):
+        self.submitted.append(job_descriptor)
+        if 'fail' in job_descriptor.job_metadata['job-name']:
+            raise ValueError("Submission failed.")
+        if 'timeout' in job_descriptor.job_metadata['job-name']:
+            raise TimeoutError("No response.")
+        if 'limit' in job_descriptor.job_metadata['job-name']:
+            raise RateLimited()
+        return {
+                'job-id': job_descriptor.job_metadata['job-id'],
+                'user-id': job_descriptor.job_metadata['user-id'],
+                'task-id': []}
+
+    def lookup_job_tasks(self, statuses, user_ids=None, job_ids=None, **kwargs):
+        self.lookups.append(job_ids)
+        return [
+                FakeTask({
+                          'job-id': job_id,
+                          'user-id': 'trellis',
+                          'status': 'RUNNING',
+                          'last-update': datetime(2021, 1, 1, 12, 30)})
+                for job_id in sorted(job_ids)]
+
+
+@pytest.fixture
+def providers(monkeypatch):
+    # dsub looks up provider names when printing dstat instructions
+    monkeypatch.setitem(provider_base.PROVIDER_NAME_MAP, FakeProvider, 'google-cls-v2')
+
+    created = []
+    def factory(*args):
+        if args[0] == 'unavailable':
+            raise ConnectionError("Could not reach the Pipelines API.")
+        provider = FakeProvider(*args)
+        created.append(provider)
+        return provider
+    return created, dsub_client.DsubClient(provider_factory=factory)
+
+
+def make_job_dict(task_id='210101-000000-000-abcd1234'):
+    return {
+            "provider": "google-cls-v2",
+            "user": "trellis",
+            "regions": "us-west1",
+            "project": "test-project",
+            "minCores": 1,
+            "minRam": 7.5,
+            "bootDiskSize": 20,
+            "image": "gcr.io/test-project/broadinstitute/gatk:4.1.0.0",
+            "logging": f"gs://log-bucket/plate/sample/fastq-to-ubam/{task_id}/logs",
+            "diskSize": 500,
+            "command": "echo ${RG} > ${UBAM}",
+            "envs": {"RG": 1, "SM": "SAMPLE1"},
+            "inputs": {"FASTQ_1": "gs://bucket/sample_R1.fastq.gz"},
+            "outputs": {"UBAM": f"gs://out-bucket/{task_id}/output/sample_1.ubam"},
+            "trellisTaskId": task_id,
+            "dryRun": False,
+            "preemptible": False,
+            "network": "trellis",
+            "subnetwork": "trellis-us-west1",
+    }
+
+
+class TestBuildJob:
+
+    def test_job_params(self):
+        params = dsub_client.build_job_params(make_job_dict(), {'sample': 'sample1'})
+
+        assert {(env.name, env.value) for env in params['envs']} == {('RG', '1'), ('SM', 'SAMPLE1')}
+        assert {(label.name, label.value) for label in params['labels']} == {('sample', 'sample1')}
+        assert [param.uri for param in params['inputs']] == ['gs://bucket/sample_R1.fastq.gz']
+        assert [param.name for param in params['outputs']] == ['UBAM']
+
+    def test_recursive_input(self):
+        job_dict = make_job_dict()
+        job_dict['inputRecursive'] = "DIR=gs://bucket/references/"
+        params = dsub_client.build_job_params(job_dict, {})
+
+        recursive = [param for param in params['inputs'] if param.recursive]
+        assert [param.name for param in recursive] == ['DIR']
+
+    def test_job_resources(self):
+        resources = dsub_client.build_job_resources(make_job_dict())
+
+        assert resources.regions == ['us-west1']
+        assert resources.min_ram == 7.5
+        assert resources.use_private_address
+        assert resources.logging.uri.endswith('/logs/')
+
+
+class TestDsubClient:
+
+    def test_provider_reused(self, providers):
+        created, client = providers
+
+        first = client.submit(make_job_dict(), 'fq2u-abcd1', {'trellis-id': 'a'})
+        second = client.submit(make_job_dict(), 'fq2u-abcd2', {'trellis-id': 'b'})
+
+        assert len(created) == 1
+        assert len(created[0].submitted) == 2
+        assert first['job-id'].startswith('fq2u-abcd1')
+        assert first['latency'] >= 0
+        assert second['user-id'] == 'trellis'
+
+    def test_logging_path_resolved(self, providers):
+        created, client = providers
+        client.submit(make_job_dict(), 'fq2u-abcd1', {})
+
+        descriptor = created[0].submitted[0]
+        logging_path = descriptor.task_descriptors[0].task_resources.logging_path
+        assert logging_path.uri.startswith('gs://log-bucket/plate/sample/fastq-to-ubam/')
+        assert logging_path.uri.endswith('.log')
+
+    def test_submit_all(self, providers):
+        created, client = providers
+        submissions = [
+            (make_job_dict(), 'fq2u-abcd1', {}),
+            (make_job_dict(), 'fail-abcd2', {}),
+            (make_job_dict(), 'fq2u-abcd3', {}),
+        ]
+        results = client.submit_all(submissions, max_workers=2)
+
+        assert [('job-id' in result) for result in results] == [True, False, True]
+        assert results[1]['error'] == "Submission failed."
+        # Each concurrent submission gets its own provider
+        assert 1 <= len(created) <= 2
+
+    def test_retry_only_if_not_launched(self, providers):
+        created, client = providers
+        submissions = [
+            (make_job_dict(), 'fail-abcd1', {}),
+            (make_job_dict(), 'timeout-abcd2', {}),
+            (make_job_dict(), 'limit-abcd3', {}),
+            (dict(make_job_dict(), provider='unavailable'), 'fq2u-abcd4', {}),
+        ]
+        results = dict(client.submit_as_completed(submissions))
+
+        # The job may have been created before the timeout
+        assert [results[index]['retry'] for index in range(4)] == [False, False, True, True]
+
+    def test_lookup_tasks(self, providers):
+        created, client = providers
+        client.submit(make_job_dict(), 'fq2u-abcd1', {})
+
+        tasks = client.lookup_tasks('google-cls-v2', 'test-project', ['job-1', 'job-2'], ['trellis'])
+
+        # Jobs are looked up in one call with the provider used to submit them
+        assert len(created) == 1
+        assert created[0].lookups == [{'job-1', 'job-2'}]
+        assert [task['job-id'] for task in tasks] == ['job-1', 'job-2']
+        assert tasks[0]['last-update'] == '2021-01-01 12:30:00.000000'
+
+    def test_duplicate_claims(self, providers, tmp_path):
+        created, client = providers
+        client.claims = launch_claims.LaunchClaims(str(tmp_path))
+        first = dict(make_job_dict('task-1'), name='fastq-to-ubam', inputHash='hash-1')
+        second = dict(make_job_dict('task-2'), name='fastq-to-ubam', inputHash='hash-1')
+
+        assert 'job-id' in client.submit(first, 'fq2u-abcd1', {})
+        result = client.submit(second, 'fq2u-abcd2', {})
+        assert result == {'error': "Duplicate of job task-1.", 'duplicate': True}
+        assert len(created[0].submitted) == 1
+
+    def test_failed_launch_released(self, providers, tmp_path):
+        created, client = providers
+        client.claims = launch_claims.LaunchClaims(str(tmp_path))
+        job_dict = dict(make_job_dict(), name='fastq-to-ubam', inputHash='hash-1')
+
+        with pytest.raises(ValueError):
+            client.submit(job_dict, 'fail-abcd1', {})
+        assert 'job-id' in client.submit(job_dict, 'fq2u-abcd1', {})
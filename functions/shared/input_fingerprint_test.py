@@ -0,0 +1,81 @@
+import json
+import time
+import hashlib
+
+import input_fingerprint
+
+SYNTHETIC_INPUTS = 1000000
+
+
+def make_ubam(index, read_group=0):
+    generation = 1600000000000000 + index
+    return {
+            "id": f"trellis-bucket/plate/SAMPLE{index}/fastq-to-ubam/output/SAMPLE{index}_{read_group}.ubam/{generation}",
+            "generation": generation,
+            "crc32c": f"{index:08x}==",
+            "labels": ["Blob", "Ubam", "WGS35", "Gatk5DollarInput"],
+            "plate": "plate",
+            "sample": f"SAMPLE{index}",
+            "bucket": "trellis-bucket",
+            "path": f"plate/SAMPLE{index}/fastq-to-ubam/output/SAMPLE{index}_{read_group}.ubam",
+            "readGroup": read_group,
+            "metadata": {f"key{key}": f"value{key}" * 4 for key in range(50)},
+    }
+
+
+def legacy_input_hash(nodes):
+    # make_unique_task_id before input fingerprints
+    sorted_nodes = sorted(nodes, key = lambda i: i['id'])
+    nodes_str = json.dumps(sorted_nodes, sort_keys=True, ensure_ascii=True, default=str)
+    return hashlib.sha256(nodes_str.encode('utf-8')).hexdigest()[:8]
+
+
+class TestFingerprint:
+
+    def test_identity_fields_only(self):
+        nodes = [make_ubam(1, 0), make_ubam(1, 1)]
+        fingerprint = input_fingerprint.fingerprint(nodes)
+        assert len(fingerprint) == input_fingerprint.FINGERPRINT_LENGTH
+
+        # Order and other metadata don't matter
+        changed = [dict(nodes[1], sample='OTHER'), nodes[0]]
+        assert input_fingerprint.fingerprint(changed) == fingerprint
+        # A new generation of an object is a new input
+        assert input_fingerprint.fingerprint([nodes[0], dict(nodes[1], generation=1)]) != fingerprint
+
+    def test_fields_not_ambiguous(self):
+        fingerprint = input_fingerprint.fingerprint
+        assert fingerprint([{"id": "a", "generation": "1"}]) != fingerprint([{"id": "a1"}])
+        assert fingerprint([{"id": "a", "crc32c": "b"}]) != fingerprint([{"id": "a", "generation": "b"}])
+        assert fingerprint([{"id": "a"}, {"id": "b"}]) != fingerprint([{"id": "ab"}])
+        # Stable across processes and releases
+        assert fingerprint([{"id": "a", "generation": 1, "crc32c": "c"}]) == '3a882dcc09ab1a56'
+
+    def test_no_collisions(self):
+        fingerprints = set()
+        for index in range(SYNTHETIC_INPUTS):
+            generation = 1600000000000000 + index
+            fingerprints.add(input_fingerprint.fingerprint([{
+                "id": f"trellis-bucket/plate/sample/file_{index}.ubam/{generation}",
+                "generation": generation,
+                "crc32c": "AAAAAA==",
+            }]))
+        assert len(fingerprints) == SYNTHETIC_INPUTS
+        # The 8 characters kept before collide at this scale
+        assert len({fingerprint[:8] for fingerprint in fingerprints}) < SYNTHETIC_INPUTS
+
+    def test_faster_than_legacy_hash(self):
+        # GATK launches have 16 ubams with large property maps
+        launches = [[make_ubam(index, read_group) for read_group in range(16)] for index in range(200)]
+
+        start = time.perf_counter()
+        for nodes in launches:
+            legacy_input_hash(nodes)
+        legacy_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for nodes in launches:
+            input_fingerprint.fingerprint(nodes)
+        fingerprint_seconds = time.perf_counter() - start
+
+        assert fingerprint_seconds * 5 < legacy_seconds
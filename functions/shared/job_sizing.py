@@ -0,0 +1,303 @@
+"""Size dsub jobs from the runtimes of earlier jobs of the same task.
+
+Launch functions request the same cores, memory and disk for every job
+of a task (docs/trellis-job-machine-types.csv), whatever the size of
+its inputs. This module fits a model per task from completed Job nodes
+and their Dstat status, and picks the resources of a new job from the
+total size of its inputs.
+
+For each machine shape (cores, memory) a task has run on, runtime is
+fit as a linear function of input gigabytes. Failed jobs, including
+those retried by a new Job node, count against their shape: expected
+runtime and cost are divided by the success rate of the shape. Only
+shapes that have already run jobs with inputs of a similar size are
+proposed, so sizing never leaves the range of the history. Disk is
+sized from the input size, with a minimum.
+
+Models are JSON, so they can be fit offline (databases/job_sizing_report.py)
+and loaded by launch functions from a "gs://bucket/path" or local file.
+
+This module is copied into each function that uses it by its cloudbuild.yaml.
+"""
+
+import re
+import json
+import math
+
+from collections import namedtuple, Counter
+
+try:
+    from google.cloud import storage
+except ImportError:
+    storage = None
+
+# One completed job of a task
+JobRun = namedtuple('JobRun', ['task', 'input_bytes', 'minutes', 'cores', 'ram_gb', 'disk_gb', 'succeeded'])
+
+# N1 custom machine and standard persistent disk prices, USD per hour
+CORE_HOUR = 0.033174
+RAM_GB_HOUR = 0.004446
+DISK_GB_HOUR = 0.04 / 730
+
+BYTES_PER_GB = 1000 ** 3
+
+# Successful runs a shape needs before it is proposed
+MIN_SHAPE_RUNS = 3
+# Largest input, relative to the largest successful input of a shape,
+# that the shape is proposed for
+MAX_INPUT_RATIO = 1.25
+# Disk for inputs, outputs and temporary files
+DISK_PER_INPUT_GB = 3
+MIN_DISK_GB = 10
+
+OBJECTIVES = ('cost', 'time')
+
+PREDEFINED_RAM_PER_CORE = {'standard': 3.75, 'highmem': 6.5, 'highcpu': 0.9}
+
+
+def parse_machine_type(machine_type):
+    """Cores and memory (GB) of a Compute Engine machine type.
+
+    Supports custom types, e.g. "custom-2-7680" or "n2-custom-2-8192",
+    and N1 predefined types, e.g. "n1-standard-8".
+
+    Returns:
+        (tuple): (cores, ram_gb), or None for other machine types.
+    """
+    if not machine_type:
+        return None
+    machine_type = machine_type.split('/')[-1]
+    custom = re.search(r"custom-(\d+)-(\d+)", machine_type)
+    if custom:
+        return int(custom.group(1)), int(custom.group(2)) / 1024
+    predefined = re.fullmatch(r"n1-(standard|highmem|highcpu)-(\d+)", machine_type)
+    if predefined:
+        cores = int(predefined.group(2))
+        return cores, cores * PREDEFINED_RAM_PER_CORE[predefined.group(1)]
+    return None
+
+
+def run_from_record(record):
+    """Convert a job history record to a JobRun.
+
+    Records have the Job properties 'name', 'durationMinutes', 'minCores',
+    'minRam', 'machineType' and 'diskSize', with the 'inputBytes' of its
+    inputs and the 'status' and 'machineType' of its Dstat node as
+    'dstatStatus' and 'dstatMachineType'.
+
+    Returns:
+        (JobRun): Run, or None if the job didn't finish or its
+                  resources are unknown.
+    """
+    if record.get('dstatStatus') not in ('SUCCESS', 'FAILURE'):
+        return None
+    if record.get('durationMinutes') is None or not record.get('inputBytes'):
+        return None
+
+    # The machine dsub chose for the requested cores and memory
+    shape = (
+             parse_machine_type(record.get('dstatMachineType')) or
+             parse_machine_type(record.get('machineType')))
+    if not shape and record.get('minCores'):
+        shape = (int(record['minCores']), float(record.get('minRam') or 3.75 * int(record['minCores'])))
+    if not shape:
+        return None
+
+    return JobRun(
+                  task = record['name'],
+                  input_bytes = int(record['inputBytes']),
+                  minutes = float(record['durationMinutes']),
+                  cores = shape[0],
+                  ram_gb = shape[1],
+                  disk_gb = int(record.get('diskSize') or 0),
+                  succeeded = record['dstatStatus'] == 'SUCCESS')
+
+
+def hourly_cost(cores, ram_gb, disk_gb):
+    return cores * CORE_HOUR + ram_gb * RAM_GB_HOUR + disk_gb * DISK_GB_HOUR
+
+
+def _fit_line(points):
+    """Least squares fit of minutes = intercept + slope * gb.
+
+    Falls back to a line through the origin when there are too few
+    distinct input sizes or the fit doesn't make sense for runtimes.
+    """
+    count = len(points)
+    mean_gb = sum(gb for gb, minutes in points) / count
+    mean_minutes = sum(minutes for gb, minutes in points) / count
+    variance = sum((gb - mean_gb) ** 2 for gb, minutes in points)
+    if variance > 0:
+        slope = sum((gb - mean_gb) * (minutes - mean_minutes) for gb, minutes in points) / variance
+        intercept = mean_minutes - slope * mean_gb
+        if slope >= 0 and intercept >= 0:
+            return intercept, slope
+    return 0.0, mean_minutes / mean_gb
+
+
+def fit_models(runs, min_shape_runs=MIN_SHAPE_RUNS, disk_per_input_gb=DISK_PER_INPUT_GB):
+    """Fit a sizing model for each task.
+
+    Args:
+        runs (iterable): JobRun tuples.
+        min_shape_runs (int): Successful runs needed to propose a shape.
+        disk_per_input_gb (float): Disk gigabytes per input gigabyte.
+    Returns:
+        (dict): Models by task name; tasks without a shape with enough
+                successful runs are left out.
+    """
+    shapes = {}
+    for run in runs:
+        shapes.setdefault(run.task, {}).setdefault((run.cores, run.ram_gb), []).append(run)
+
+    models = {}
+    for task, task_shapes in shapes.items():
+        fitted = []
+        for (cores, ram_gb), shape_runs in sorted(task_shapes.items()):
+            succeeded = [run for run in shape_runs if run.succeeded]
+            if len(succeeded) < min_shape_runs:
+                continue
+            intercept, slope = _fit_line([(run.input_bytes / BYTES_PER_GB, run.minutes) for run in succeeded])
+            fitted.append({
+                           "cores": cores,
+                           "ramGb": ram_gb,
+                           "interceptMinutes": intercept,
+                           "minutesPerGb": slope,
+                           "maxInputGb": max(run.input_bytes for run in succeeded) / BYTES_PER_GB,
+                           "runs": len(shape_runs),
+                           "successRate": len(succeeded) / len(shape_runs),
+            })
+        if fitted:
+            models[task] = {
+                            "task": task,
+                            "diskPerInputGb": disk_per_input_gb,
+                            "minDiskGb": MIN_DISK_GB,
+                            "shapes": fitted,
+            }
+    return models
+
+
+def predict(model, shape, input_bytes):
+    """Expected minutes and cost of a job, including failed attempts.
+
+    Returns:
+        (dict): 'minCores', 'minRam' and 'diskSize' resources of the job,
+                with its 'predictedMinutes' and 'predictedCost'.
+    """
+    input_gb = input_bytes / BYTES_PER_GB
+    disk_gb = max(model['minDiskGb'], int(math.ceil(input_gb * model['diskPerInputGb'])))
+    minutes = (shape['interceptMinutes'] + shape['minutesPerGb'] * input_gb) / shape['successRate']
+    cost = minutes / 60 * hourly_cost(shape['cores'], shape['ramGb'], disk_gb)
+    return {
+            "minCores": shape['cores'],
+            "minRam": shape['ramGb'],
+            "diskSize": disk_gb,
+            "predictedMinutes": round(minutes, 1),
+            "predictedCost": round(cost, 4),
+    }
+
+
+def choose_resources(model, input_bytes, objective='cost'):
+    """Pick the resources for a job that minimize its cost or runtime.
+
+    Args:
+        model (dict): Task model from fit_models(), or None.
+        input_bytes (int): Total size of the job inputs.
+        objective (str): 'cost' or 'time'.
+    Returns:
+        (dict): Job resources from predict(), or None if the task has no
+                model or no shape has run jobs with inputs this large.
+                Launch functions then keep their default resources.
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Sizing objective must be one of {OBJECTIVES}, not {objective}.")
+    if not model or not input_bytes:
+        return None
+
+    input_gb = input_bytes / BYTES_PER_GB
+    candidates = [
+                  predict(model, shape, input_bytes) for shape in model['shapes']
+                  if input_gb <= shape['maxInputGb'] * MAX_INPUT_RATIO]
+    if not candidates:
+        return None
+
+    if objective == 'cost':
+        key = lambda sizing: (sizing['predictedCost'], sizing['predictedMinutes'])
+    else:
+        key = lambda sizing: (sizing['predictedMinutes'], sizing['predictedCost'])
+    return min(candidates, key=key)
+
+
+def compare_sizing(models, runs, objective='cost'):
+    """Compare proposed sizing to the sizing of each job in the history.
+
+    Current minutes and cost are those of the recorded runs, failed
+    ones included. Proposed minutes and cost are predicted for a job
+    with the same inputs; runs the model has no proposal for keep
+    their current values.
+
+    Returns:
+        (list): One dict per task, ordered by task name.
+    """
+    tasks = {}
+    for run in runs:
+        tasks.setdefault(run.task, []).append(run)
+
+    rows = []
+    for task, task_runs in sorted(tasks.items()):
+        row = {
+               "task": task,
+               "runs": len(task_runs),
+               "currentShapes": Counter(),
+               "proposedShapes": Counter(),
+               "currentHours": 0.0,
+               "currentCost": 0.0,
+               "proposedHours": 0.0,
+               "proposedCost": 0.0,
+        }
+        for run in task_runs:
+            current_cost = run.minutes / 60 * hourly_cost(run.cores, run.ram_gb, run.disk_gb)
+            row['currentShapes'][(run.cores, run.ram_gb)] += 1
+            row['currentHours'] += run.minutes / 60
+            row['currentCost'] += current_cost
+
+            sizing = choose_resources(models.get(task), run.input_bytes, objective)
+            if sizing:
+                row['proposedShapes'][(sizing['minCores'], sizing['minRam'])] += 1
+                row['proposedHours'] += sizing['predictedMinutes'] / 60
+                row['proposedCost'] += sizing['predictedCost']
+            else:
+                row['proposedShapes'][(run.cores, run.ram_gb)] += 1
+                row['proposedHours'] += run.minutes / 60
+                row['proposedCost'] += current_cost
+        rows.append(row)
+    return rows
+
+
+def format_report(rows):
+    """Format compare_sizing() rows as a text table."""
+    def shapes(counter):
+        return ', '.join(f"{cores}x{ram_gb:g}GB:{count}" for (cores, ram_gb), count in counter.most_common())
+
+    lines = [f"{'task':<24} {'runs':>6} {'hours':>10} {'cost':>10} {'hours*':>10} {'cost*':>10} {'change':>8}  shapes -> shapes*"]
+    for row in rows:
+        change = (row['proposedCost'] - row['currentCost']) / row['currentCost'] * 100 if row['currentCost'] else 0
+        lines.append(
+                     f"{row['task']:<24} {row['runs']:>6} " +
+                     f"{row['currentHours']:>10.1f} {row['currentCost']:>10.2f} " +
+                     f"{row['proposedHours']:>10.1f} {row['proposedCost']:>10.2f} {change:>7.1f}%  " +
+                     f"{shapes(row['currentShapes'])} -> {shapes(row['proposedShapes'])}")
+    lines.append("* proposed; predicted from the model for the inputs of each recorded job.")
+    return '\n'.join(lines)
+
+
+def load_models(uri, client=None):
+    """Load models from a "gs://bucket/path" object or a local file."""
+    if uri.startswith('gs://'):
+        bucket, _, path = uri[len('gs://'):].partition('/')
+        client = client or storage.Client()
+        data = client.bucket(bucket).blob(path).download_as_string()
+    else:
+        with open(uri) as fh:
+            data = fh.read()
+    return json.loads(data)
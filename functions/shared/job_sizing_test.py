@@ -0,0 +1,116 @@
+import json
+
+import pytest
+
+import job_sizing
+
+from job_sizing import JobRun
+
+GB = job_sizing.BYTES_PER_GB
+
+
+def runs(task, cores, ram_gb, minutes_per_gb, sizes, succeeded=True, disk_gb=500):
+    return [JobRun(task, size * GB, 10 + minutes_per_gb * size, cores, ram_gb, disk_gb, succeeded) for size in sizes]
+
+
+def history():
+    # Two cores are faster than one, but not fast enough to be cheaper
+    return (
+            runs('fastq-to-ubam', 1, 7.5, 2.0, [10, 20, 30, 40]) +
+            runs('fastq-to-ubam', 2, 7.5, 1.4, [10, 20, 30]) +
+            # Too few runs to be proposed
+            runs('fastq-to-ubam', 4, 15, 3.0, [10, 20]))
+
+
+class TestMachineTypes:
+
+    def test_parse(self):
+        assert job_sizing.parse_machine_type('custom-2-7680') == (2, 7.5)
+        assert job_sizing.parse_machine_type('zones/us-west1-b/machineTypes/n2-custom-4-16384') == (4, 16)
+        assert job_sizing.parse_machine_type('n1-standard-8') == (8, 30)
+        assert job_sizing.parse_machine_type('e2-medium') is None
+        assert job_sizing.parse_machine_type(None) is None
+
+    def test_run_from_record(self):
+        record = {
+                  'name': 'flagstat',
+                  'durationMinutes': 12,
+                  'minCores': 1,
+                  'diskSize': 500,
+                  'inputBytes': 5 * GB,
+                  'dstatStatus': 'SUCCESS',
+                  'dstatMachineType': 'custom-1-3840'}
+        assert job_sizing.run_from_record(record) == JobRun('flagstat', 5 * GB, 12, 1, 3.75, 500, True)
+        assert job_sizing.run_from_record(dict(record, dstatMachineType=None)).ram_gb == 3.75
+        assert job_sizing.run_from_record(dict(record, dstatStatus='RUNNING')) is None
+        assert job_sizing.run_from_record(dict(record, inputBytes=None)) is None
+
+
+class TestFitModels:
+
+    def test_shapes(self):
+        model = job_sizing.fit_models(history())['fastq-to-ubam']
+
+        assert [(shape['cores'], shape['ramGb']) for shape in model['shapes']] == [(1, 7.5), (2, 7.5)]
+        shape = model['shapes'][0]
+        assert shape['interceptMinutes'] == pytest.approx(10)
+        assert shape['minutesPerGb'] == pytest.approx(2)
+        assert shape['maxInputGb'] == 40
+        # Models can be saved and loaded
+        assert json.loads(json.dumps(model)) == model
+
+    def test_failures_lower_success_rate(self):
+        failed = runs('fastq-to-ubam', 1, 7.5, 2.0, [20, 30], succeeded=False)
+        model = job_sizing.fit_models(history() + failed)['fastq-to-ubam']
+
+        assert model['shapes'][0]['successRate'] == pytest.approx(4 / 6)
+        assert model['shapes'][0]['minutesPerGb'] == pytest.approx(2)
+
+    def test_single_input_size(self):
+        model = job_sizing.fit_models(runs('flagstat', 1, 3.75, 1.0, [10, 10, 10]))['flagstat']
+        assert model['shapes'][0]['interceptMinutes'] == 0
+        assert model['shapes'][0]['minutesPerGb'] == pytest.approx(2)
+
+
+class TestChooseResources:
+
+    def test_objectives(self):
+        model = job_sizing.fit_models(history())['fastq-to-ubam']
+
+        cheapest = job_sizing.choose_resources(model, 25 * GB, 'cost')
+        fastest = job_sizing.choose_resources(model, 25 * GB, 'time')
+        assert (cheapest['minCores'], cheapest['minRam']) == (1, 7.5)
+        assert (fastest['minCores'], fastest['minRam']) == (2, 7.5)
+        assert fastest['predictedMinutes'] == pytest.approx(45)
+        assert cheapest['diskSize'] == 75
+
+    def test_stays_within_history(self):
+        model = job_sizing.fit_models(history())['fastq-to-ubam']
+
+        # Two-core jobs have only run with up to 30GB of inputs
+        assert job_sizing.choose_resources(model, 45 * GB, 'time')['minCores'] == 1
+        assert job_sizing.choose_resources(model, 100 * GB) is None
+        assert job_sizing.choose_resources(None, 10 * GB) is None
+        assert job_sizing.choose_resources(model, 1 * GB)['diskSize'] == job_sizing.MIN_DISK_GB
+
+    def test_unknown_objective(self):
+        with pytest.raises(ValueError):
+            job_sizing.choose_resources({}, GB, 'speed')
+
+
+class TestCompareSizing:
+
+    def test_report(self):
+        models = job_sizing.fit_models(history())
+        # A task without a model keeps its sizing
+        rows = job_sizing.compare_sizing(models, history() + runs('flagstat', 1, 3.75, 1.0, [10]), 'time')
+
+        assert [row['task'] for row in rows] == ['fastq-to-ubam', 'flagstat']
+        ubam, flagstat = rows
+        assert ubam['runs'] == 9
+        assert ubam['proposedHours'] < ubam['currentHours']
+        assert flagstat['proposedCost'] == pytest.approx(flagstat['currentCost'])
+
+        report = job_sizing.format_report(rows)
+        assert 'fastq-to-ubam' in report
+        assert '1x7.5GB:4' in report
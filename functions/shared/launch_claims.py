@@ -0,0 +1,240 @@
+"""Claim the inputs of a job before it is launched.
+
+Duplicate jobs, launched for the same inputs by overlapping requests,
+used to be found only once their VMs were running, by KillDuplicateJobs,
+and then stopped by kill-job. Launch functions now claim the task name
+and inputHash of each job before calling dsub. Only the first claim
+succeeds, so a duplicate is never launched.
+
+A claim is an object named after the task and inputHash, created only if
+it doesn't exist. Claims expire after a time-to-live, so the inputs can
+be launched again later, e.g. to rerun a failed job, and are released
+right away when dsub fails to launch the job. Each claim counts the
+duplicate launches it rejected.
+
+Claims are kept in a "gs://bucket/prefix" location, using object
+generation preconditions, or a local directory when testing. Expired
+claim objects are not deleted by Trellis; use a lifecycle rule on the
+bucket to delete them.
+
+This module is copied into each function that uses it by its cloudbuild.yaml.
+"""
+
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+
+from collections import Counter
+
+try:
+    from google.cloud import storage
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+except ImportError:
+    storage = None
+
+# Duplicates are expected within minutes of the first launch; later
+# duplicates are still stopped by KillDuplicateJobs
+DEFAULT_TTL = 60 * 60
+
+
+class _LocalClaims:
+    """Claim objects in a local directory, for testing."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def create(self, name, data):
+        # Write the claim aside first, so it is never read half-written
+        temp_path = f"{self._path(name)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as fh:
+            fh.write(data)
+        try:
+            os.link(temp_path, self._path(name))
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temp_path)
+        return True
+
+    def read(self, name):
+        """Claim data and generation, or (None, None) if there is no claim."""
+        try:
+            with open(self._path(name)) as fh:
+                fcntl.flock(fh, fcntl.LOCK_SH)
+                data = fh.read()
+        except FileNotFoundError:
+            return None, None
+        return data, data
+
+    def replace(self, name, data, generation):
+        try:
+            with open(self._path(name), 'r+') as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                if fh.read() != generation:
+                    return False
+                fh.seek(0)
+                fh.truncate()
+                fh.write(data)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def delete(self, name, generation):
+        if self.read(name)[1] == generation:
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def list(self):
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.json'):
+                yield self.read(name)[0]
+
+
+class _GcsClaims:
+    """Claim objects in GCS; changes are conditional on the object generation."""
+
+    def __init__(self, location, client=None):
+        bucket, _, prefix = location[len('gs://'):].partition('/')
+        self.bucket = (client or storage.Client()).bucket(bucket)
+        self.prefix = prefix.strip('/')
+
+    def _blob_name(self, name):
+        return f"{self.prefix}/{name}" if self.prefix else name
+
+    def create(self, name, data):
+        try:
+            self.bucket.blob(self._blob_name(name)).upload_from_string(data, if_generation_match=0)
+        except PreconditionFailed:
+            return False
+        return True
+
+    def read(self, name):
+        blob = self.bucket.get_blob(self._blob_name(name))
+        if blob is None:
+            return None, None
+        try:
+            return blob.download_as_string(if_generation_match=blob.generation).decode('utf-8'), blob.generation
+        except (NotFound, PreconditionFailed):
+            return None, None
+
+    def replace(self, name, data, generation):
+        try:
+            self.bucket.blob(self._blob_name(name)).upload_from_string(data, if_generation_match=generation)
+        except (NotFound, PreconditionFailed):
+            return False
+        return True
+
+    def delete(self, name, generation):
+        try:
+            self.bucket.blob(self._blob_name(name)).delete(if_generation_match=generation)
+        except (NotFound, PreconditionFailed):
+            pass
+
+    def list(self):
+        prefix = f"{self.prefix}/" if self.prefix else ''
+        for blob in self.bucket.list_blobs(prefix=prefix):
+            yield blob.download_as_string().decode('utf-8')
+
+
+class LaunchClaims:
+    """Claims on the (task name, inputHash) of jobs being launched.
+
+    Counts of the claims made, duplicates rejected, expired claims
+    taken over and claims released by this process are kept in 'stats'.
+    """
+
+    def __init__(self, location, client=None, ttl=DEFAULT_TTL):
+        if location.startswith('gs://'):
+            self._store = _GcsClaims(location, client)
+        else:
+            self._store = _LocalClaims(location)
+        self.ttl = ttl
+        self.stats = Counter()
+
+    @staticmethod
+    def _name(task, input_hash):
+        return f"{task}.{input_hash}.json"
+
+    def claim(self, task, input_hash, owner, now=None):
+        """Claim the inputs of a job.
+
+        Args:
+            task (str): Task name of the job.
+            input_hash (str): inputHash of the job.
+            owner (str): Task ID of the job.
+        Returns:
+            (dict): None if the claim was made, or the claim of the job
+                    already launched with the same inputs.
+        """
+        now = time.time() if now is None else now
+        name = self._name(task, input_hash)
+        claim = {"task": task, "inputHash": input_hash, "owner": owner, "claimedEpoch": now, "duplicates": 0}
+        if self._store.create(name, json.dumps(claim)):
+            self.stats['claimed'] += 1
+            return None
+
+        data, generation = self._store.read(name)
+        if data is None:
+            # Released since it was created; try once more
+            if self._store.create(name, json.dumps(claim)):
+                self.stats['claimed'] += 1
+                return None
+            data, generation = self._store.read(name)
+            if data is None:
+                raise RuntimeError(f"Could not claim {name}.")
+
+        existing = json.loads(data)
+        if now - existing['claimedEpoch'] >= self.ttl:
+            # Keep the count of duplicates from earlier claims
+            claim['duplicates'] = existing.get('duplicates', 0)
+            if self._store.replace(name, json.dumps(claim), generation):
+                self.stats['expired'] += 1
+                self.stats['claimed'] += 1
+                return None
+            data, generation = self._store.read(name)
+            existing = json.loads(data) if data else existing
+
+        self.stats['duplicates'] += 1
+        # Best effort; a concurrent update to the claim wins
+        existing['duplicates'] = existing.get('duplicates', 0) + 1
+        if generation is not None:
+            self._store.replace(name, json.dumps(existing), generation)
+        logging.warning(
+                        f"> Duplicate launch of {task} inputs {input_hash} by {owner} avoided; " +
+                        f"already claimed by {existing['owner']}.")
+        return existing
+
+    def release(self, task, input_hash, owner):
+        """Release a claim, e.g. when its job failed to launch."""
+        name = self._name(task, input_hash)
+        data, generation = self._store.read(name)
+        if data is not None and json.loads(data)['owner'] == owner:
+            self._store.delete(name, generation)
+            self.stats['released'] += 1
+
+    def count_duplicates(self):
+        """Duplicate launches avoided by each task, from the stored claims."""
+        counts = Counter()
+        for data in self._store.list():
+            if data:
+                claim = json.loads(data)
+                counts[claim['task']] += claim.get('duplicates', 0)
+        return counts
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 2:
+        sys.exit("Usage: python launch_claims.py gs://bucket/prefix")
+    for task, count in sorted(LaunchClaims(sys.argv[1]).count_duplicates().items()):
+        print(f"{task}\t{count}")
@@ -0,0 +1,47 @@
+import launch_claims
+
+
+class TestLaunchClaims:
+
+    def test_duplicate_rejected(self, tmp_path):
+        claims = launch_claims.LaunchClaims(str(tmp_path))
+
+        assert claims.claim('fastq-to-ubam', 'hash-1', 'task-1', now=0) is None
+        duplicate = claims.claim('fastq-to-ubam', 'hash-1', 'task-2', now=10)
+        assert duplicate['owner'] == 'task-1'
+        # Other tasks and inputs are claimed separately
+        assert claims.claim('fastq-to-ubam', 'hash-2', 'task-3', now=10) is None
+        assert claims.claim('bam-fastqc', 'hash-1', 'task-4', now=10) is None
+        assert claims.stats == {'claimed': 3, 'duplicates': 1}
+
+    def test_expired_claim_taken_over(self, tmp_path):
+        claims = launch_claims.LaunchClaims(str(tmp_path), ttl=100)
+        claims.claim('fastq-to-ubam', 'hash-1', 'task-1', now=0)
+        claims.claim('fastq-to-ubam', 'hash-1', 'task-2', now=50)
+
+        assert claims.claim('fastq-to-ubam', 'hash-1', 'task-3', now=100) is None
+        assert claims.claim('fastq-to-ubam', 'hash-1', 'task-4', now=150)['owner'] == 'task-3'
+        assert claims.stats['expired'] == 1
+
+    def test_release(self, tmp_path):
+        claims = launch_claims.LaunchClaims(str(tmp_path))
+        claims.claim('fastq-to-ubam', 'hash-1', 'task-1')
+
+        # Only the owner releases a claim
+        claims.release('fastq-to-ubam', 'hash-1', 'task-2')
+        assert claims.claim('fastq-to-ubam', 'hash-1', 'task-2') is not None
+        claims.release('fastq-to-ubam', 'hash-1', 'task-1')
+        assert claims.claim('fastq-to-ubam', 'hash-1', 'task-2') is None
+
+    def test_count_duplicates(self, tmp_path):
+        claims = launch_claims.LaunchClaims(str(tmp_path), ttl=100)
+        claims.claim('fastq-to-ubam', 'hash-1', 'task-1', now=0)
+        claims.claim('fastq-to-ubam', 'hash-1', 'task-2', now=10)
+        # Duplicates counted by earlier claims are kept
+        claims.claim('fastq-to-ubam', 'hash-1', 'task-3', now=200)
+        claims.claim('fastq-to-ubam', 'hash-1', 'task-4', now=210)
+        claims.claim('bam-fastqc', 'hash-1', 'task-5', now=0)
+
+        # Counted from the stored claims, by any process
+        counts = launch_claims.LaunchClaims(str(tmp_path)).count_duplicates()
+        assert counts == {'fastq-to-ubam': 2, 'bam-fastqc': 0}
@@ -0,0 +1,564 @@
+"""Launch the dsub jobs of a Trellis task from query result messages.
+
+Each launch-* function used to parse its own messages, hash its inputs,
+build the common job metadata, call dsub and publish job nodes, and
+only some of them could launch bulk requests, hold jobs for admission
+or size jobs. A launch function now declares its task as a Task
+subclass: its name and labels, the checks on its input nodes and the
+task-specific job fields. Launcher does the rest for every task:
+
+    - holds requests with admit-jobs when admission control is configured,
+    - launches single and bulk requests, streaming claim check results,
+    - fingerprints the input nodes for the task ID and inputHash,
+    - sizes jobs from the JOB_SIZING_MODELS of the task, if any,
+    - places jobs in the region nearest to their inputs, if JOB_PLACEMENT
+      is configured,
+    - submits jobs concurrently and retries failed submissions,
+    - publishes job nodes to create-job-node in batches as jobs are
+      launched, without waiting for each publish, and
+    - logs the timing and outcome of each launch request.
+
+A launch function then looks like:
+
+    class FlagstatTask(launcher.Task):
+        name = 'flagstat'
+        label = 'Flagstat'
+        required_labels = ['Bam']
+
+        def job_fields(self, nodes, job, settings):
+            return {"image": ..., "command": ..., "inputs": ..., "outputs": ...}
+
+    LAUNCHER = launcher.Launcher(FlagstatTask(), launcher.load_settings(parsed_vars, FUNCTION_NAME))
+
+    def launch_flagstat(event, context):
+        return LAUNCHER.handle(event, context)
+
+This module is copied into each function that uses it by its cloudbuild.yaml.
+"""
+
+import abc
+import json
+import time
+import base64
+import random
+import logging
+
+from datetime import datetime
+from collections import namedtuple
+
+try:
+    from google.cloud import pubsub
+    from google.cloud import storage
+except ImportError:
+    pubsub = None
+    storage = None
+
+import admission
+import job_sizing
+import claim_check
+import placement
+import launch_claims
+import input_fingerprint
+
+from dsub_client import DsubClient
+
+# Concurrent dsub submissions for each request
+MAX_LAUNCH_WORKERS = 8
+# Submissions that certainly weren't launched, e.g. rate limited, are
+# tried again this many times, waiting RETRY_SECONDS, then twice as long,
+# between tries; other failures aren't retried, to avoid launching twice
+LAUNCH_RETRIES = 2
+RETRY_SECONDS = 5
+# Launched jobs in each message to create-job-node
+PUBLISH_BATCH = 100
+
+# Labels of the messages sent to create-job-node
+JOB_MESSAGE_LABELS = ["Create", "Job", "Dsub", "Node"]
+
+Settings = namedtuple('Settings', [
+                                   'function_name',
+                                   'project',
+                                   'new_jobs_topic',
+                                   'regions',
+                                   'out_bucket',
+                                   'log_bucket',
+                                   'dsub_user',
+                                   'network',
+                                   'subnetwork',
+                                   'admission',
+                                   'admit_jobs_topic',
+                                   'launch_claims',
+                                   'sizing_models',
+                                   'sizing_objective',
+                                   'placement',
+                                   # All Trellis vars, for task-specific values
+                                   'vars',
+])
+
+# What a task needs to know about the job it is creating
+Job = namedtuple('Job', [
+                         'task_id',
+                         'input_hash',
+                         'plate',
+                         'sample',
+                         # "plate/sample/task/task-id" path of the job's objects
+                         'prefix',
+                         # Bucket and gs:// path of the job's output objects
+                         'out_bucket',
+                         'output',
+                         # Query result the input nodes came from
+                         'result',
+                         'dry_run',
+])
+
+
+def load_settings(parsed_vars, function_name):
+    """Launch settings from the Trellis vars."""
+    admit_jobs_topic = parsed_vars.get('TOPIC_ADMIT_JOBS')
+    return Settings(
+                    function_name = function_name,
+                    project = parsed_vars['GOOGLE_CLOUD_PROJECT'],
+                    new_jobs_topic = parsed_vars['NEW_JOBS_TOPIC'],
+                    regions = parsed_vars['DSUB_REGIONS'],
+                    out_bucket = parsed_vars['DSUB_OUT_BUCKET'],
+                    log_bucket = parsed_vars['DSUB_LOG_BUCKET'],
+                    dsub_user = parsed_vars['DSUB_USER'],
+                    network = parsed_vars['DSUB_NETWORK'],
+                    subnetwork = parsed_vars['DSUB_SUBNETWORK'],
+                    # Optional admission control; jobs are held with admit-jobs
+                    admission = admission.load_config(parsed_vars) if admit_jobs_topic else None,
+                    admit_jobs_topic = admit_jobs_topic,
+                    # Optional claims on job inputs, so duplicate jobs aren't launched
+                    launch_claims = parsed_vars.get('LAUNCH_CLAIMS'),
+                    # Optional job sizing models (databases/job_sizing_report.py)
+                    sizing_models = parsed_vars.get('JOB_SIZING_MODELS'),
+                    sizing_objective = parsed_vars.get('JOB_SIZING_OBJECTIVE', 'cost'),
+                    # Optional data-locality placement (placement.py)
+                    placement = parsed_vars.get('JOB_PLACEMENT'),
+                    vars = parsed_vars)
+
+
+def get_datetime_stamp():
+    now = datetime.now()
+    datestamp = now.strftime("%y%m%d-%H%M%S-%f")[:-3]
+    return datestamp
+
+
+class Task(abc.ABC):
+    """Declarative spec of a dsub task.
+
+    Subclasses set the class attributes and implement job_fields().
+    """
+
+    # Task name, used for the job node, paths and dsub labels
+    name = None
+    # Unique label of the job nodes of the task
+    label = None
+    # Labels of the job nodes; defaults to ["Job", "Dsub", label]
+    job_labels = None
+    # Prefix of the dsub job names; defaults to the task name
+    dsub_prefix = None
+    # Number of input nodes of each job, if fixed
+    input_count = None
+    # Labels every input node must have
+    required_labels = []
+    # Longest random wait before launching the job of a single request
+    launch_delay = 0
+    # Run jobs on preemptible VMs
+    preemptible = False
+
+    def input_nodes(self, result):
+        """Input nodes of the job for a query result."""
+        if result.get('nodes'):
+            return result['nodes']
+        if result.get('node'):
+            return [result['node']]
+        return []
+
+    def check(self, nodes):
+        """Raise ValueError if the input nodes can't be used for a job."""
+        if self.input_count and len(nodes) != self.input_count:
+            raise ValueError(f"{self.name} needs {self.input_count} inputs; {len(nodes)} provided.")
+        for node in nodes:
+            missing = set(self.required_labels) - set(node.get('labels', []))
+            if missing:
+                raise ValueError(f"Input {node.get('id')} is missing labels {sorted(missing)}.")
+
+    @abc.abstractmethod
+    def job_fields(self, nodes, job, settings):
+        """Task-specific job metadata: image, command or script, inputs,
+        outputs, envs and resources, plus any other job node properties.
+
+        Args:
+            nodes (list): Input nodes, checked by check().
+            job (Job): Task ID, sample and paths of the job.
+            settings (Settings): Launch settings and Trellis vars.
+        Returns:
+            (dict): Fields added to the common job metadata.
+        """
+
+    def dsub_labels(self, nodes, job_dict):
+        """Task-specific dsub labels."""
+        return {}
+
+
+class Launcher:
+    """Launch the jobs of a task.
+
+    Clients are created when the launcher is, so they are kept between
+    invocations of the function.
+    """
+
+    def __init__(self, task, settings, dsub=None, publisher=None, storage_client=None):
+        self.task = task
+        self.settings = settings
+        self.dsub = dsub or DsubClient()
+        self.publisher = publisher or pubsub.PublisherClient()
+        self.storage_client = storage_client or storage.Client()
+        self.sleep = time.sleep
+
+        if settings.launch_claims and not self.dsub.claims:
+            self.dsub.claims = launch_claims.LaunchClaims(settings.launch_claims, self.storage_client)
+
+        self.sizing_model = None
+        if settings.sizing_models:
+            models = job_sizing.load_models(settings.sizing_models, self.storage_client)
+            self.sizing_model = models.get(task.name)
+
+        self.placement = None
+        if settings.placement:
+            self.placement = placement.Placement(settings.placement, self.storage_client)
+
+
+    def _publish(self, topic, message):
+        topic_path = self.publisher.topic_path(self.settings.project, topic)
+        return self.publisher.publish(topic_path, data=json.dumps(message).encode('utf-8'))
+
+
+    def format_job_message(self, header, event_id, job_dicts, failures=None, bulk=False):
+        """Message that adds launched jobs to the database."""
+        labels = list(JOB_MESSAGE_LABELS)
+        if bulk:
+            body = {"nodes": job_dicts, "failed": failures or []}
+            labels.append("Bulk")
+        else:
+            body = {"node": job_dicts[0]}
+        return {
+                "header": {
+                           "resource": "job-metadata",
+                           "method": "POST",
+                           "labels": labels,
+                           "sentFrom": self.settings.function_name,
+                           "seedId": f"{header['seedId']}",
+                           "previousEventId": f"{event_id}",
+                },
+                "body": body,
+        }
+
+
+    def create_job(self, nodes, result, dry_run):
+        """Create the job metadata and dsub name/labels for a set of input nodes.
+
+        Returns:
+            (dict, str, dict): Job metadata, dsub job name and dsub labels.
+        """
+        task = self.task
+        settings = self.settings
+        task.check(nodes)
+
+        input_hash = input_fingerprint.fingerprint(nodes)
+        task_id = f"{get_datetime_stamp()}-{input_hash}"
+        plate = nodes[0]['plate']
+        sample = nodes[0]['sample']
+
+        # Run the job near its inputs, if placement is configured
+        regions = settings.regions
+        out_bucket = settings.out_bucket
+        plan = None
+        if self.placement:
+            plan = self.placement.place(
+                                        nodes,
+                                        settings.regions,
+                                        settings.out_bucket,
+                                        task.preemptible,
+                                        result.get('admittedRegion'))
+            regions = [plan.region]
+            out_bucket = plan.out_bucket
+
+        prefix = f"{plate}/{sample}/{task.name}/{task_id}"
+        job = Job(
+                  task_id = task_id,
+                  input_hash = input_hash,
+                  plate = plate,
+                  sample = sample,
+                  prefix = prefix,
+                  out_bucket = out_bucket,
+                  output = f"gs://{out_bucket}/{prefix}/output",
+                  result = result,
+                  dry_run = dry_run)
+
+        job_dict = {
+                    "provider": "google-cls-v2",
+                    "user": settings.dsub_user,
+                    "regions": regions,
+                    "project": settings.project,
+                    "preemptible": task.preemptible,
+                    "logging": f"gs://{settings.log_bucket}/{prefix}/logs",
+                    "trellisTaskId": task_id,
+                    "dryRun": dry_run,
+                    "sample": sample,
+                    "plate": plate,
+                    "name": task.name,
+                    "inputHash": input_hash,
+                    "labels": task.job_labels or ["Job", "Dsub", task.label],
+                    "inputIds": [node['id'] for node in nodes],
+                    "network": settings.network,
+                    "subnetwork": settings.subnetwork,
+        }
+        job_dict.update(task.job_fields(nodes, job, settings))
+        # Event ID of the bulk JobRequest, to mark the request if the launch fails
+        if result.get('requestEventId'):
+            job_dict['requestEventId'] = result['requestEventId']
+
+        if plan:
+            job_dict['placementRegion'] = plan.region
+            job_dict['predictedEgressBytes'] = plan.estimate.egress_bytes
+            job_dict['predictedEgressCost'] = round(plan.estimate.egress_cost, 4)
+            job_dict['predictedTransferSeconds'] = round(plan.estimate.transfer_seconds, 1)
+
+        # Size the job for its inputs, if the task has a sizing model
+        input_bytes = sum(node.get('size') or 0 for node in nodes)
+        sizing = job_sizing.choose_resources(self.sizing_model, input_bytes, settings.sizing_objective)
+        if sizing:
+            job_dict.update(sizing)
+            job_dict['sizingObjective'] = settings.sizing_objective
+
+        dsub_name = f"{task.dsub_prefix or task.name}-{input_hash[0:5]}"
+        dsub_labels = {
+                       "sample": sample.lower(),
+                       "trellis-id": task_id,
+                       "trellis-name": task.name,
+                       "plate": plate.lower(),
+                       "input-hash": input_hash,
+                       "wdl-call-alias": task.name,
+        }
+        dsub_labels.update(task.dsub_labels(nodes, job_dict))
+        return job_dict, dsub_name, dsub_labels
+
+
+    @staticmethod
+    def add_dsub_result(job_dict, dsub_result):
+        """Add dsub job ID and dstat command to job metadata."""
+        job_dict['dsubJobId'] = dsub_result['job-id']
+        job_dict['dsubSubmitSeconds'] = dsub_result['latency']
+        job_dict['dstatCmd'] = (
+                                 "dstat " +
+                                f"--project {job_dict['project']} " +
+                                f"--provider {job_dict['provider']} " +
+                                f"--jobs '{job_dict['dsubJobId']}' " +
+                                f"--users '{job_dict['user']}' " +
+                                 "--full " +
+                                 "--format json " +
+                                 "--status '*'")
+
+        # Reformat dict values as separate key/value pairs
+        # to be compatible with Neo4j
+        for key, value in job_dict["inputs"].items():
+            job_dict[f"input_{key}"] = value
+        for key, value in job_dict.get("envs", {}).items():
+            job_dict[f"env_{key}"] = value
+        for key, value in job_dict["outputs"].items():
+            job_dict[f"output_{key}"] = value
+        return job_dict
+
+
+    def launch(self, results, dry_run, on_launched=None):
+        """Launch one job per query result.
+
+        Args:
+            results (iterable): Query results; one job per result.
+            dry_run (bool): Pass --dry-run to dsub.
+            on_launched (function): Called with the metadata of each
+                                    job as soon as it is launched.
+        Returns:
+            (list, dict): The input IDs and error of each job that
+                          could not be launched, and launch metrics.
+        """
+        metrics = {
+                   "requested": 0,
+                   "launched": 0,
+                   "failed": 0,
+                   "duplicates": 0,
+                   "retries": 0,
+                   "createSeconds": 0.0,
+                   "submitSeconds": 0.0,
+                   "maxSubmitSeconds": 0.0,
+                   "predictedEgressBytes": 0,
+                   "predictedEgressCost": 0.0,
+        }
+        failures = []
+
+        start = time.perf_counter()
+        submissions = []
+        for result in results:
+            metrics['requested'] += 1
+            nodes = self.task.input_nodes(result)
+            try:
+                submissions.append(self.create_job(nodes, result, dry_run))
+            except Exception as error:
+                logging.error(f"> Failed to create {self.task.name} job for nodes {nodes}: {error}.")
+                failures.append({
+                                 "name": self.task.name,
+                                 "inputIds": [node['id'] for node in nodes if node],
+                                 "requestEventId": result.get('requestEventId'),
+                                 "error": str(error),
+                })
+        metrics['createSeconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for attempt in range(LAUNCH_RETRIES + 1):
+            if attempt:
+                metrics['retries'] += len(submissions)
+                self.sleep(RETRY_SECONDS * 2 ** (attempt - 1))
+
+            retry = []
+            for index, dsub_result in self.dsub.submit_as_completed(submissions, max_workers=MAX_LAUNCH_WORKERS):
+                job_dict, dsub_name, dsub_labels = submissions[index]
+                if 'job-id' in dsub_result:
+                    metrics['launched'] += 1
+                    metrics['maxSubmitSeconds'] = max(metrics['maxSubmitSeconds'], dsub_result['latency'])
+                    job_dict['launchAttempts'] = attempt + 1
+                    metrics['predictedEgressBytes'] += job_dict.get('predictedEgressBytes', 0)
+                    metrics['predictedEgressCost'] += job_dict.get('predictedEgressCost', 0.0)
+                    job_dict = self.add_dsub_result(job_dict, dsub_result)
+                    if on_launched:
+                        on_launched(job_dict)
+                elif dsub_result.get('duplicate'):
+                    # Launched by another request; not a failure
+                    metrics['duplicates'] += 1
+                elif dsub_result.get('retry') and attempt < LAUNCH_RETRIES:
+                    retry.append(submissions[index])
+                else:
+                    failures.append({
+                                     "name": job_dict['name'],
+                                     "inputIds": job_dict['inputIds'],
+                                     "requestEventId": job_dict.get('requestEventId'),
+                                     "error": dsub_result['error'],
+                    })
+            if not retry:
+                break
+            submissions = retry
+        metrics['submitSeconds'] = time.perf_counter() - start
+        metrics['failed'] = len(failures)
+        return failures, metrics
+
+
+    def hold_jobs(self, header, results, event_id):
+        """Hold requested jobs with admit-jobs instead of launching them.
+
+        Released jobs are sent back as a bulk request with the "Admitted" label.
+        With placement, each job lists its regions nearest first, so it is
+        admitted to the nearest region with quota.
+        """
+        settings = self.settings
+        results = (result for result in results if result and self.task.input_nodes(result))
+
+        if self.placement:
+            groups = {}
+            for result in results:
+                ranked = self.placement.rank(self.task.input_nodes(result), settings.regions, self.task.preemptible)
+                groups.setdefault(tuple(estimate.region for estimate in ranked), []).append(result)
+            groups = [(list(regions), group) for regions, group in groups.items()]
+        else:
+            groups = [(settings.regions, results)]
+
+        messages = []
+        for regions, group in groups:
+            messages.extend(admission.format_hold_messages(
+                                                           self.task.name,
+                                                           group,
+                                                           regions,
+                                                           header,
+                                                           settings.function_name,
+                                                           event_id))
+        for message in messages:
+            result = self._publish(settings.admit_jobs_topic, message).result()
+            print(f"> Held {len(message['body']['results'])} jobs with {settings.admit_jobs_topic} with result: {result}.")
+        return sum(len(message['body']['results']) for message in messages)
+
+
+    def handle(self, event, context):
+        """Launch the jobs requested by a Pub/Sub message.
+
+        Returns:
+            (dict): Launch metrics, or None if no jobs were launched.
+        """
+        start = time.perf_counter()
+        pubsub_message = base64.b64decode(event['data']).decode('utf-8')
+        data = json.loads(pubsub_message)
+        print(f"> Context: {context}.")
+        print(f"> Data: {data}.")
+        header = data['header']
+        body = data['body']
+
+        # Get seed/event ID to track provenance of Trellis events
+        event_id = context.event_id
+        dry_run = bool(header.get('dryRun'))
+        bulk = 'Bulk' in header['labels']
+
+        # Bulk requests send a list of results; one per job. Large
+        # results are streamed from their claim check object.
+        if bulk:
+            if not claim_check.count_results(body):
+                print("> No jobs provided. Exiting.")
+                return
+            results = claim_check.iter_results(body, client=self.storage_client)
+        else:
+            if not body.get('results') or not self.task.input_nodes(body['results']):
+                # Expected when a trigger's inputs aren't all present yet
+                print("> No input nodes provided. Exiting.")
+                return
+            results = [body['results']]
+
+        # Launch only when admitted, if admission control is configured
+        if admission.is_held(self.settings.admission, self.task.name, header['labels']):
+            self.hold_jobs(header, results, event_id)
+            return
+
+        if not bulk and self.task.launch_delay:
+            # Spread out jobs requested at the same time
+            self.sleep(random.randrange(0, self.task.launch_delay))
+
+        # Job nodes are published in batches while other jobs are launching
+        topic = self.settings.new_jobs_topic
+        futures = []
+        batch = []
+        def publish_batch(failures=None):
+            if bulk:
+                message = self.format_job_message(header, event_id, batch, failures, bulk=True)
+            else:
+                message = self.format_job_message(header, event_id, batch)
+            futures.append(self._publish(topic, message))
+            batch.clear()
+
+        def on_launched(job_dict):
+            batch.append(job_dict)
+            if len(batch) >= PUBLISH_BATCH:
+                publish_batch()
+
+        failures, metrics = self.launch(results, dry_run, on_launched)
+        if bulk and (batch or failures):
+            publish_batch(failures)
+        elif batch:
+            publish_batch()
+        elif failures:
+            logging.error(f"> Could not launch {self.task.name} job: {failures[0]['error']}")
+
+        publish_start = time.perf_counter()
+        for future in futures:
+            print(f"> Published message to {topic} with result: {future.result()}.")
+        metrics['publishSeconds'] = time.perf_counter() - publish_start
+        metrics['totalSeconds'] = time.perf_counter() - start
+
+        logging.info(f"> Launch metrics for {self.task.name}: {json.dumps(metrics)}.")
+        return metrics
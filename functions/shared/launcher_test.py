@@ -0,0 +1,235 @@
+import json
+import base64
+
+from types import SimpleNamespace
+
+import pytest
+
+import launcher
+import placement
+
+
+class FakeFuture:
+
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+
+class FakePublisher:
+
+    def __init__(self):
+        self.messages = []
+
+    def topic_path(self, project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic_path, data):
+        self.messages.append((topic_path, json.loads(data)))
+        return FakeFuture(str(len(self.messages)))
+
+
+class FakeDsub:
+    """Fail the first submissions of jobs with errors queued by input ID."""
+
+    def __init__(self, errors=None):
+        self.claims = None
+        self.errors = errors or {}
+        self.submitted = []
+
+    def submit_as_completed(self, submissions, max_workers=1):
+        for index, (job_dict, name, labels) in enumerate(submissions):
+            self.submitted.append(name)
+            errors = self.errors.get(job_dict['inputIds'][0])
+            if errors:
+                yield index, errors.pop(0)
+            else:
+                yield index, {'job-id': f"{name}-{len(self.submitted)}", 'latency': 0.5}
+
+
+class EchoTask(launcher.Task):
+
+    name = 'echo'
+    label = 'Echo'
+    input_count = 1
+    required_labels = ['Text']
+
+    def job_fields(self, nodes, job, settings):
+        return {
+                "image": "ubuntu",
+                "command": "cat ${INPUT} > ${OUTPUT}",
+                "envs": {"SAMPLE_ID": job.sample},
+                "inputs": {"INPUT": f"gs://{nodes[0]['bucket']}/{nodes[0]['path']}"},
+                "outputs": {"OUTPUT": f"{job.output}/echo.txt"},
+        }
+
+    def dsub_labels(self, nodes, job_dict):
+        return {"echo": "yes"}
+
+
+SETTINGS = launcher.Settings(
+                             function_name = 'launch-echo',
+                             project = 'project',
+                             new_jobs_topic = 'new-jobs',
+                             regions = 'us-west1',
+                             out_bucket = 'out',
+                             log_bucket = 'logs',
+                             dsub_user = 'trellis',
+                             network = 'trellis',
+                             subnetwork = 'trellis-us-west1',
+                             admission = None,
+                             admit_jobs_topic = None,
+                             launch_claims = None,
+                             sizing_models = None,
+                             sizing_objective = 'cost',
+                             placement = None,
+                             vars = {})
+
+
+def text_node(index):
+    return {
+            "id": f"text-{index}",
+            "labels": ["Blob", "Text"],
+            "plate": "PLATE",
+            "sample": "SAMPLE",
+            "bucket": "in",
+            "path": f"text-{index}.txt",
+            "generation": 1,
+            "crc32c": "c",
+    }
+
+
+def event(labels, body):
+    message = {"header": {"seedId": 1, "labels": labels}, "body": body}
+    return {"data": base64.b64encode(json.dumps(message).encode('utf-8'))}
+
+
+CONTEXT = SimpleNamespace(event_id=2)
+
+
+@pytest.fixture
+def make_launcher():
+    def make(errors=None):
+        return launcher.Launcher(EchoTask(), SETTINGS, FakeDsub(errors), FakePublisher(), storage_client=object())
+    return make
+
+
+def test_task_requires_job_fields():
+    class NoFieldsTask(launcher.Task):
+        name = 'no-fields'
+
+    with pytest.raises(TypeError):
+        NoFieldsTask()
+
+
+class TestCreateJob:
+
+    def test_job_fields(self, make_launcher):
+        job_dict, name, labels = make_launcher().create_job([text_node(0)], {}, False)
+
+        assert job_dict['name'] == 'echo'
+        assert job_dict['labels'] == ["Job", "Dsub", "Echo"]
+        assert job_dict['inputIds'] == ['text-0']
+        assert job_dict['logging'] == f"gs://logs/PLATE/SAMPLE/echo/{job_dict['trellisTaskId']}/logs"
+        assert job_dict['outputs']['OUTPUT'] == f"gs://out/PLATE/SAMPLE/echo/{job_dict['trellisTaskId']}/output/echo.txt"
+        assert name == f"echo-{job_dict['inputHash'][:5]}"
+        assert labels['trellis-name'] == 'echo'
+        assert labels['echo'] == 'yes'
+
+    def test_missing_labels(self, make_launcher):
+        node = dict(text_node(0), labels=["Blob"])
+        with pytest.raises(ValueError):
+            make_launcher().create_job([node], {}, False)
+
+    def test_placement(self, make_launcher):
+        runner = make_launcher()
+        runner.settings = SETTINGS._replace(regions=['us-west1', 'us-east1'])
+        runner.placement = placement.Placement(
+                                               {"regions": {"us-east1": {"outBucket": "out-east"}}, "buckets": {"in": "us-east1"}},
+                                               client=None)
+        job_dict, name, labels = runner.create_job([dict(text_node(0), size=10 ** 9)], {}, False)
+
+        assert job_dict['regions'] == ['us-east1']
+        assert job_dict['outputs']['OUTPUT'].startswith("gs://out-east/PLATE/SAMPLE/echo/")
+        assert job_dict['predictedEgressBytes'] == 0
+
+        job_dict, name, labels = runner.create_job([dict(text_node(0), size=10 ** 9)], {"admittedRegion": "us-west1"}, False)
+        assert job_dict['regions'] == ['us-west1']
+        assert job_dict['predictedEgressCost'] == 0.01
+
+
+class TestLaunch:
+
+    def test_retry(self, make_launcher):
+        errors = {"text-0": [{'error': 'Backend error', 'retry': True}]}
+        runner = make_launcher(errors)
+        runner.sleep = lambda seconds: None
+        failures, metrics = runner.launch([{"node": text_node(0)}], False)
+
+        assert not failures
+        assert metrics['launched'] == 1
+        assert metrics['retries'] == 1
+
+    def test_failures_not_retried(self, make_launcher):
+        errors = {"text-0": [{'error': 'Bad parameter', 'retry': False}]}
+        failures, metrics = make_launcher(errors).launch([{"node": text_node(0)}, {"node": text_node(1)}], False)
+
+        assert failures == [{"name": "echo", "inputIds": ["text-0"], "requestEventId": None, "error": "Bad parameter"}]
+        assert metrics['launched'] == 1
+        assert metrics['retries'] == 0
+
+    def test_duplicates_skipped(self, make_launcher):
+        errors = {"text-0": [{'error': 'Duplicate of job 1.', 'duplicate': True}]}
+        failures, metrics = make_launcher(errors).launch([{"node": text_node(0)}], False)
+
+        assert not failures
+        assert metrics['duplicates'] == 1
+        assert metrics['launched'] == 0
+
+
+class TestHandle:
+
+    def test_bulk_batches(self, make_launcher, monkeypatch):
+        monkeypatch.setattr(launcher, 'PUBLISH_BATCH', 2)
+        runner = make_launcher()
+        results = [{"node": text_node(index)} for index in range(5)]
+        results.append({"node": dict(text_node(5), labels=[])})
+        metrics = runner.handle(event(["Bulk"], {"results": results}), CONTEXT)
+
+        messages = [message for topic, message in runner.publisher.messages]
+        assert [len(message['body']['nodes']) for message in messages] == [2, 2, 1]
+        assert all("Bulk" in message['header']['labels'] for message in messages)
+        assert [failure['inputIds'] for failure in messages[-1]['body']['failed']] == [['text-5']]
+        assert metrics['launched'] == 5
+        assert metrics['failed'] == 1
+
+    def test_bulk_partial_failure(self, make_launcher):
+        errors = {"text-1": [{'error': 'Bad parameter', 'retry': False}]}
+        runner = make_launcher(errors)
+        results = [{"node": text_node(index), "requestEventId": 10 + index} for index in range(3)]
+        metrics = runner.handle(event(["Bulk"], {"results": results}), CONTEXT)
+
+        [(topic, message)] = runner.publisher.messages
+        assert [node['requestEventId'] for node in message['body']['nodes']] == [10, 12]
+        assert message['body']['failed'] == [
+            {"name": "echo", "inputIds": ["text-1"], "requestEventId": 11, "error": "Bad parameter"}]
+        assert metrics['launched'] == 2
+        assert metrics['failed'] == 1
+
+    def test_single(self, make_launcher):
+        runner = make_launcher()
+        runner.handle(event(["Launch"], {"results": {"node": text_node(0)}}), CONTEXT)
+
+        [(topic, message)] = runner.publisher.messages
+        assert topic == "projects/project/topics/new-jobs"
+        assert message['header']['labels'] == launcher.JOB_MESSAGE_LABELS
+        assert message['header']['previousEventId'] == "2"
+        assert message['body']['node']['input_INPUT'] == "gs://in/text-0.txt"
+        assert message['body']['node']['launchAttempts'] == 1
+
+    def test_no_inputs(self, make_launcher):
+        runner = make_launcher()
+        assert runner.handle(event(["Launch"], {"results": {}}), CONTEXT) is None
+        assert not runner.publisher.messages
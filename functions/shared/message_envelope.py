@@ -0,0 +1,118 @@
+"""Encode and decode the header/body messages passed between Trellis functions.
+
+Messages were serialized with json.dumps and sent without attributes,
+so receivers could only assume JSON. The envelope records its version
+and encoding as Pub/Sub message attributes so receivers can detect how
+the payload was encoded; messages without attributes are read as JSON.
+
+Compact JSON is readable by every Trellis function. The msgpack+zstd
+encoding is smaller, especially for results with large property maps,
+but should only be sent to functions that decode with this module and
+have msgpack and zstandard installed.
+
+This module is copied into each function that uses it by its cloudbuild.yaml.
+"""
+
+import json
+import base64
+
+try:
+    import msgpack
+    import zstandard
+except ImportError:
+    msgpack = None
+    zstandard = None
+
+ENVELOPE_VERSION = 1
+
+# Pub/Sub message attributes
+VERSION_ATTRIBUTE = 'trellis-envelope'
+ENCODING_ATTRIBUTE = 'trellis-encoding'
+
+# Encodings
+JSON = 'json'
+MSGPACK_ZSTD = 'msgpack+zstd'
+
+ZSTD_LEVEL = 3
+
+
+def binary_encoding_available():
+    return msgpack is not None and zstandard is not None
+
+
+def _check_binary_encoding():
+    if not binary_encoding_available():
+        raise ValueError(f"Encoding '{MSGPACK_ZSTD}' requires the msgpack and zstandard packages.")
+
+
+def encode(data, encoding=JSON):
+    """Encode a message for publishing.
+
+    Values that cannot be serialized (e.g. datetimes) are converted
+    to strings, as db-query did with json.dumps(default=str).
+
+    Args:
+        data (dict): Message with header and body.
+        encoding (str): JSON or MSGPACK_ZSTD.
+    Returns:
+        (bytes): Encoded message data.
+        (dict): Pub/Sub attributes describing the encoding.
+    """
+    if encoding == JSON:
+        payload = json.dumps(data, separators=(',', ':'), default=str).encode('utf-8')
+    elif encoding == MSGPACK_ZSTD:
+        _check_binary_encoding()
+        packed = msgpack.packb(data, default=str, use_bin_type=True)
+        payload = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(packed)
+    else:
+        raise ValueError(f"Unsupported message encoding: {encoding}.")
+
+    attributes = {
+                  VERSION_ATTRIBUTE: str(ENVELOPE_VERSION),
+                  ENCODING_ATTRIBUTE: encoding,
+    }
+    return payload, attributes
+
+
+def decode(payload, attributes=None):
+    """Decode message data using the encoding in its attributes.
+
+    Args:
+        payload (bytes): Message data.
+        attributes (dict): Pub/Sub message attributes, if any.
+    Returns:
+        (dict): Message with header and body.
+    """
+    attributes = attributes or {}
+
+    version = int(attributes.get(VERSION_ATTRIBUTE, ENVELOPE_VERSION))
+    if version > ENVELOPE_VERSION:
+        raise ValueError(
+                         f"Message envelope version {version} is newer " +
+                         f"than supported version {ENVELOPE_VERSION}.")
+
+    encoding = attributes.get(ENCODING_ATTRIBUTE, JSON)
+    if encoding == JSON:
+        return json.loads(payload.decode('utf-8'))
+    elif encoding == MSGPACK_ZSTD:
+        _check_binary_encoding()
+        packed = zstandard.ZstdDecompressor().decompress(payload)
+        return msgpack.unpackb(packed, raw=False)
+    else:
+        raise ValueError(f"Unsupported message encoding: {encoding}.")
+
+
+def decode_event(event):
+    """Decode the message of a Pub/Sub triggered Cloud Function event."""
+    payload = base64.b64decode(event['data'])
+    return decode(payload, event.get('attributes'))
+
+
+def publish(publisher, topic_path, data, encoding=JSON):
+    """Encode a message and publish it with its envelope attributes.
+
+    Returns:
+        (str): Published message ID.
+    """
+    payload, attributes = encode(data, encoding)
+    return publisher.publish(topic_path, data=payload, **attributes).result()
@@ -0,0 +1,138 @@
+"""Compare message sizes and encode/decode times across envelope encodings.
+
+Recorded traffic is read from files containing either one JSON message
+per line, or the output of:
+
+    gcloud pubsub subscriptions pull <subscription> --limit=1000 --format=json
+
+Usage:
+    python message_envelope_benchmark.py <recorded-traffic> [<recorded-traffic> ...]
+"""
+
+import sys
+import json
+import time
+import base64
+import argparse
+import statistics
+
+import message_envelope
+
+# Serialization used by db-query before the envelope codec
+DB_QUERY_LEGACY = 'db-query-legacy'
+
+
+def load_messages(path):
+    """Load recorded messages from a JSON lines file or a pull export.
+
+    Returns:
+        (list): Messages with header and body.
+    """
+    with open(path) as fh:
+        text = fh.read()
+
+    if text.lstrip().startswith('['):
+        records = json.loads(text)
+    else:
+        records = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    messages = []
+    for record in records:
+        # Pull exports wrap the encoded message with its attributes
+        pubsub_message = record.get('message')
+        if pubsub_message:
+            payload = base64.b64decode(pubsub_message['data'])
+            messages.append(message_envelope.decode(payload, pubsub_message.get('attributes')))
+        else:
+            messages.append(record)
+    return messages
+
+
+def _encode(message, encoding):
+    if encoding == DB_QUERY_LEGACY:
+        return json.dumps(message, indent=4, sort_keys=True, default=str).encode('utf-8'), {}
+    return message_envelope.encode(message, encoding)
+
+
+def benchmark(messages, encodings, repeat=3):
+    """Measure each encoding across all messages.
+
+    Args:
+        messages (list): Messages with header and body.
+        encodings (list): Encodings to measure.
+        repeat (int): Passes over the messages; the fastest is reported.
+    Returns:
+        (list): Per-encoding dicts with byte counts and mean
+                encode/decode times in microseconds.
+    """
+    rows = []
+    for encoding in encodings:
+        sizes = []
+        encode_seconds = []
+        decode_seconds = []
+        for message in messages:
+            encode_times = []
+            decode_times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                payload, attributes = _encode(message, encoding)
+                encode_times.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                message_envelope.decode(payload, attributes)
+                decode_times.append(time.perf_counter() - start)
+            sizes.append(len(payload))
+            encode_seconds.append(min(encode_times))
+            decode_seconds.append(min(decode_times))
+
+        rows.append({
+                     "encoding": encoding,
+                     "messages": len(messages),
+                     "total_bytes": sum(sizes),
+                     "mean_bytes": statistics.mean(sizes),
+                     "max_bytes": max(sizes),
+                     "encode_us": statistics.mean(encode_seconds) * 1e6,
+                     "decode_us": statistics.mean(decode_seconds) * 1e6,
+        })
+    return rows
+
+
+def format_report(rows):
+    baseline = rows[0]['total_bytes']
+    lines = [
+             f"{'encoding':<18}{'messages':>10}{'mean bytes':>12}{'max bytes':>12}" +
+             f"{'vs first':>10}{'encode us':>12}{'decode us':>12}"]
+    for row in rows:
+        ratio = row['total_bytes'] / baseline if baseline else 0
+        lines.append(
+                     f"{row['encoding']:<18}{row['messages']:>10}{row['mean_bytes']:>12.0f}" +
+                     f"{row['max_bytes']:>12}{ratio:>10.2f}" +
+                     f"{row['encode_us']:>12.1f}{row['decode_us']:>12.1f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help="Files of recorded messages.")
+    parser.add_argument('--repeat', type=int, default=3, help="Passes over the messages.")
+    args = parser.parse_args(argv)
+
+    messages = []
+    for path in args.paths:
+        messages.extend(load_messages(path))
+    if not messages:
+        print("No messages found.")
+        return 1
+
+    encodings = [DB_QUERY_LEGACY, message_envelope.JSON]
+    if message_envelope.binary_encoding_available():
+        encodings.append(message_envelope.MSGPACK_ZSTD)
+    else:
+        print(f"msgpack and zstandard are not installed; skipping {message_envelope.MSGPACK_ZSTD}.")
+
+    print(format_report(benchmark(messages, encodings, args.repeat)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
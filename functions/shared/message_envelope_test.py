@@ -0,0 +1,100 @@
+import json
+import base64
+import pytest
+
+from datetime import datetime
+
+import message_envelope
+import message_envelope_benchmark
+
+
+def make_message():
+    return {
+            "header": {
+                       "method": "VIEW",
+                       "resource": "queryResult",
+                       "labels": ["Request", "Database", "Result"],
+                       "sentFrom": "trellis-db-query",
+                       "seedId": "123",
+                       "previousEventId": "456",
+            },
+            "body": {
+                     "cypher": "MATCH (node:Sample) RETURN node",
+                     "results": {"node": {"sample": "SAMPLE1", "sizes": [1, 2, 3], "updated": 1.5}},
+            },
+    }
+
+
+class TestEnvelope:
+
+    def test_json_round_trip(self):
+        payload, attributes = message_envelope.encode(make_message())
+
+        assert b' ' not in payload.split(b'"cypher"')[0]
+        assert attributes == {'trellis-envelope': '1', 'trellis-encoding': 'json'}
+        assert message_envelope.decode(payload, attributes) == make_message()
+
+    def test_message_without_attributes(self):
+        # Messages from functions that publish plain JSON
+        payload = json.dumps(make_message(), indent=4).encode('utf-8')
+        assert message_envelope.decode(payload) == make_message()
+
+    def test_decode_event(self):
+        payload, attributes = message_envelope.encode(make_message())
+        event = {'data': base64.b64encode(payload), 'attributes': attributes}
+        assert message_envelope.decode_event(event) == make_message()
+
+        # Attributes are None when a message is published without any
+        event = {'data': base64.b64encode(payload), 'attributes': None}
+        assert message_envelope.decode_event(event) == make_message()
+
+    def test_unserializable_values(self):
+        message = make_message()
+        message['body']['results'] = {'time': datetime(2021, 1, 1)}
+        payload, attributes = message_envelope.encode(message)
+        decoded = message_envelope.decode(payload, attributes)
+        assert decoded['body']['results']['time'] == '2021-01-01 00:00:00'
+
+    def test_unsupported_version(self):
+        payload, attributes = message_envelope.encode(make_message())
+        attributes['trellis-envelope'] = '2'
+        with pytest.raises(ValueError):
+            message_envelope.decode(payload, attributes)
+
+    def test_unsupported_encoding(self):
+        with pytest.raises(ValueError):
+            message_envelope.encode(make_message(), 'pickle')
+
+    def test_binary_round_trip(self):
+        pytest.importorskip('msgpack')
+        pytest.importorskip('zstandard')
+
+        message = make_message()
+        message['body']['results']['node']['json'] = json.dumps([make_message()] * 20)
+        payload, attributes = message_envelope.encode(message, message_envelope.MSGPACK_ZSTD)
+        json_payload, _ = message_envelope.encode(message)
+
+        assert attributes['trellis-encoding'] == 'msgpack+zstd'
+        assert len(payload) < len(json_payload)
+        assert message_envelope.decode(payload, attributes) == message
+
+
+class TestBenchmark:
+
+    def test_pull_export(self, tmp_path):
+        payload, attributes = message_envelope.encode(make_message())
+        records = [{'ackId': 'a', 'message': {'data': base64.b64encode(payload).decode(), 'attributes': attributes}}]
+        path = tmp_path / 'pulled.json'
+        path.write_text(json.dumps(records))
+
+        assert message_envelope_benchmark.load_messages(str(path)) == [make_message()]
+
+    def test_report(self):
+        rows = message_envelope_benchmark.benchmark(
+                                                    [make_message()] * 3,
+                                                    [message_envelope_benchmark.DB_QUERY_LEGACY, message_envelope.JSON],
+                                                    repeat=1)
+
+        assert [row['messages'] for row in rows] == [3, 3]
+        assert rows[1]['mean_bytes'] < rows[0]['mean_bytes']
+        assert 'db-query-legacy' in message_envelope_benchmark.format_report(rows)
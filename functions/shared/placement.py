@@ -0,0 +1,225 @@
+"""Place dsub jobs in the region nearest to their input data.
+
+Launch functions used to pass every job the same DSUB_REGIONS and
+write its outputs to the same DSUB_OUT_BUCKET, wherever its inputs
+were stored, so a job could read a large Cram or Fastq from another
+region or continent and pay for the egress. When placement is
+configured, the launcher looks up the location of each input bucket,
+predicts the egress and transfer time of running the job in each of
+its regions, and runs the job in the best region, with its outputs
+written to that region's bucket.
+
+Placement is configured by the JOB_PLACEMENT value of the Trellis vars:
+
+    JOB_PLACEMENT:
+        regions:
+            us-west1:
+                outBucket: trellis-out-us-west1   # Optional; else DSUB_OUT_BUCKET
+                preemptible: true                 # Region has preemptible capacity
+            us-east1:
+                outBucket: trellis-out-us-east1
+                preemptible: false
+        # Optional: locations of buckets that can't be looked up
+        buckets:
+            personalis-deliveries: us-west1
+        # Optional: USD per GB and MB per second by locality of the data
+        egressPerGb:
+            continent: 0.01
+        transferMBps:
+            intercontinental: 40
+
+Regions are ranked by whether they have preemptible capacity for
+preemptible jobs, then by predicted egress cost and transfer time, then
+by their order in DSUB_REGIONS. When admission control is configured,
+held jobs list their regions in this order, so admit-jobs admits each
+job to the nearest region that has quota for it, and the launcher
+runs the job in the region it was admitted to.
+
+Each outBucket must be watched by create-blob-node like DSUB_OUT_BUCKET.
+
+This module is copied into each function that uses it by its cloudbuild.yaml.
+"""
+
+import time
+import logging
+
+from collections import namedtuple
+
+BYTES_PER_GB = 1000 ** 3
+BYTES_PER_MB = 1000 ** 2
+
+# Bucket locations are looked up again after this long
+LOCATION_TTL = 24 * 60 * 60
+
+# Locality of data to a region
+SAME_REGION = 'region'
+MULTI_REGION = 'multi-region'
+SAME_CONTINENT = 'continent'
+INTERCONTINENTAL = 'intercontinental'
+
+# Cloud Storage network egress, USD per GB. Reads from a multi-region
+# bucket by a region inside it are free.
+EGRESS_PER_GB = {
+                 SAME_REGION: 0.0,
+                 MULTI_REGION: 0.0,
+                 SAME_CONTINENT: 0.01,
+                 INTERCONTINENTAL: 0.08,
+}
+# Sustained read throughput of a single VM
+TRANSFER_MBPS = {
+                 SAME_REGION: 200,
+                 MULTI_REGION: 150,
+                 SAME_CONTINENT: 100,
+                 INTERCONTINENTAL: 40,
+}
+
+# Continent of the regions in each multi-region and dual-region location
+MULTI_REGIONS = {'us': 'us', 'eu': 'europe', 'asia': 'asia'}
+DUAL_REGIONS = {
+                'nam4': ('us-central1', 'us-east1'),
+                'eur4': ('europe-north1', 'europe-west4'),
+                'asia1': ('asia-northeast1', 'asia-northeast2'),
+}
+
+# Predicted cost of running a job's inputs in a region
+Estimate = namedtuple('Estimate', [
+                                   'region',
+                                   'egress_bytes',
+                                   'egress_cost',
+                                   'transfer_seconds',
+                                   # Preemptible job in a region without preemptible capacity
+                                   'no_preemptible',
+])
+
+# Where a job runs and writes its outputs
+Plan = namedtuple('Plan', [
+                           'region',
+                           'out_bucket',
+                           # Candidate regions, best first
+                           'regions',
+                           'estimate',
+])
+
+
+def _continent(region):
+    # Region "us-west1" is in continent "us"
+    return region.split('-')[0]
+
+
+def locality(location, region):
+    """Locality of data in a bucket location to a region.
+
+    Returns:
+        (str): One of the locality constants, or None if the bucket
+               location isn't known.
+    """
+    if not location or not region:
+        return None
+    location = location.lower()
+    if location == region or region in DUAL_REGIONS.get(location, ()):
+        return SAME_REGION
+    if MULTI_REGIONS.get(location) == _continent(region):
+        return MULTI_REGION
+
+    if location in MULTI_REGIONS:
+        continent = MULTI_REGIONS[location]
+    elif location in DUAL_REGIONS:
+        continent = _continent(DUAL_REGIONS[location][0])
+    else:
+        continent = _continent(location)
+    if continent == _continent(region):
+        return SAME_CONTINENT
+    return INTERCONTINENTAL
+
+
+class BucketLocations:
+    """Cache of bucket locations, read from bucket metadata."""
+
+    def __init__(self, client, known=None, ttl=LOCATION_TTL):
+        self.client = client
+        self.ttl = ttl
+        # Configured locations never expire
+        self._known = {bucket: location.lower() for bucket, location in (known or {}).items()}
+        self._cache = {}
+
+
+    def get(self, bucket):
+        """Location of a bucket, lower case, or None if it can't be read."""
+        if bucket in self._known:
+            return self._known[bucket]
+        cached = self._cache.get(bucket)
+        if cached and time.time() - cached[1] < self.ttl:
+            return cached[0]
+
+        try:
+            location = self.client.get_bucket(bucket).location
+            location = location.lower() if location else None
+        except Exception as error:
+            logging.warning(f"> Could not read location of bucket {bucket}: {error}.")
+            location = None
+        self._cache[bucket] = (location, time.time())
+        return location
+
+
+class Placement:
+    """Rank regions for jobs by the location and size of their inputs."""
+
+    def __init__(self, config, client):
+        self.regions = config.get('regions', {})
+        self.locations = BucketLocations(client, config.get('buckets'))
+        self.egress_per_gb = dict(EGRESS_PER_GB, **config.get('egressPerGb', {}))
+        self.transfer_mbps = dict(TRANSFER_MBPS, **config.get('transferMBps', {}))
+
+
+    def estimate(self, nodes, region, preemptible=False):
+        """Predict the egress and transfer time of reading nodes in a region."""
+        egress_bytes = 0
+        egress_cost = 0.0
+        transfer_seconds = 0.0
+        for node in nodes:
+            size = int(node.get('size') or 0)
+            kind = locality(self.locations.get(node.get('bucket')), region) if node.get('bucket') else None
+            if not size or not kind:
+                continue
+            if self.egress_per_gb[kind]:
+                egress_bytes += size
+                egress_cost += size / BYTES_PER_GB * self.egress_per_gb[kind]
+            transfer_seconds += size / BYTES_PER_MB / self.transfer_mbps[kind]
+
+        no_preemptible = bool(preemptible) and not self.regions.get(region, {}).get('preemptible', True)
+        return Estimate(region, egress_bytes, egress_cost, transfer_seconds, no_preemptible)
+
+
+    def rank(self, nodes, regions, preemptible=False):
+        """Estimates for each region, best first."""
+        if isinstance(regions, str):
+            regions = regions.split()
+        estimates = [self.estimate(nodes, region, preemptible) for region in regions]
+        order = {region: index for index, region in enumerate(regions)}
+        return sorted(estimates, key=lambda estimate: (
+                                                       estimate.no_preemptible,
+                                                       estimate.egress_cost,
+                                                       estimate.transfer_seconds,
+                                                       order[estimate.region]))
+
+
+    def place(self, nodes, regions, out_bucket, preemptible=False, admitted_region=None):
+        """Choose the region and output bucket of a job.
+
+        Args:
+            nodes (list): Input nodes, with their 'bucket' and 'size'.
+            regions (list): Regions the job can run in.
+            out_bucket (str): Output bucket for regions without their own.
+            preemptible (bool): Whether the job runs on preemptible VMs.
+            admitted_region (str): Region admit-jobs admitted the job to;
+                                   used if it is one of the regions.
+        Returns:
+            (Plan): Region, output bucket and estimate of the job.
+        """
+        ranked = self.rank(nodes, regions, preemptible)
+        best = ranked[0]
+        for estimate in ranked:
+            if estimate.region == admitted_region:
+                best = estimate
+        region_out_bucket = self.regions.get(best.region, {}).get('outBucket') or out_bucket
+        return Plan(best.region, region_out_bucket, [estimate.region for estimate in ranked], best)
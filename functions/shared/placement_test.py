@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import pytest
+
+import placement
+
+GB = placement.BYTES_PER_GB
+
+CONFIG = {
+          "regions": {
+                      "us-west1": {"outBucket": "out-us-west1"},
+                      "us-east1": {"outBucket": "out-us-east1", "preemptible": False},
+          },
+          "buckets": {"configured": "US-EAST1"},
+}
+
+
+class FakeStorage:
+
+    def __init__(self, locations):
+        self.locations = locations
+        self.lookups = []
+
+    def get_bucket(self, name):
+        self.lookups.append(name)
+        if name not in self.locations:
+            raise ValueError(f"No bucket {name}.")
+        return SimpleNamespace(location=self.locations[name])
+
+
+def node(bucket, size):
+    return {"id": f"{bucket}-{size}", "bucket": bucket, "size": size}
+
+
+@pytest.mark.parametrize('location, region, expected', [
+    ('us-west1', 'us-west1', placement.SAME_REGION),
+    ('nam4', 'us-east1', placement.SAME_REGION),
+    ('us', 'us-west1', placement.MULTI_REGION),
+    ('eu', 'us-west1', placement.INTERCONTINENTAL),
+    ('us-east1', 'us-west1', placement.SAME_CONTINENT),
+    ('europe-west4', 'us-west1', placement.INTERCONTINENTAL),
+    (None, 'us-west1', None),
+])
+def test_locality(location, region, expected):
+    assert placement.locality(location, region) == expected
+
+
+class TestBucketLocations:
+
+    def test_cached(self):
+        client = FakeStorage({"west": "US-WEST1"})
+        locations = placement.BucketLocations(client, {"configured": "US-EAST1"})
+
+        assert locations.get("west") == "us-west1"
+        assert locations.get("west") == "us-west1"
+        assert locations.get("configured") == "us-east1"
+        assert locations.get("missing") is None
+        assert client.lookups == ["west", "missing"]
+
+    def test_expired(self):
+        client = FakeStorage({"west": "US-WEST1"})
+        locations = placement.BucketLocations(client, ttl=0)
+        locations.get("west")
+        locations.get("west")
+        assert client.lookups == ["west", "west"]
+
+
+class TestPlacement:
+
+    def test_nearest_region(self):
+        planner = placement.Placement(CONFIG, FakeStorage({"east": "us-east1"}))
+        plan = planner.place([node("east", 100 * GB)], ["us-west1", "us-east1"], "out")
+
+        assert plan.region == "us-east1"
+        assert plan.out_bucket == "out-us-east1"
+        assert plan.regions == ["us-east1", "us-west1"]
+        assert plan.estimate.egress_bytes == 0
+
+        [west] = planner.rank([node("east", 100 * GB)], "us-west1")
+        assert west.egress_bytes == 100 * GB
+        assert west.egress_cost == pytest.approx(1.0)
+        assert west.transfer_seconds == pytest.approx(1000)
+
+    def test_largest_input_wins(self):
+        planner = placement.Placement(CONFIG, FakeStorage({"west": "us-west1"}))
+        nodes = [node("configured", 1 * GB), node("west", 50 * GB)]
+        assert planner.place(nodes, ["us-east1", "us-west1"], "out").region == "us-west1"
+
+    def test_preemptible_capacity(self):
+        planner = placement.Placement(CONFIG, FakeStorage({}))
+        nodes = [node("configured", 10 * GB)]
+
+        assert planner.place(nodes, ["us-west1", "us-east1"], "out").region == "us-east1"
+        assert planner.place(nodes, ["us-west1", "us-east1"], "out", preemptible=True).region == "us-west1"
+
+    def test_admitted_region(self):
+        planner = placement.Placement(CONFIG, FakeStorage({}))
+        plan = planner.place([node("configured", GB)], ["us-west1", "us-east1"], "out", admitted_region="us-west1")
+
+        assert plan.region == "us-west1"
+        assert plan.estimate.egress_bytes == GB
+
+    def test_unknown_locations_keep_order(self):
+        planner = placement.Placement({}, FakeStorage({}))
+        plan = planner.place([node("missing", GB), {"id": "no-bucket"}], ["us-east1", "us-west1"], "out")
+
+        assert plan.region == "us-east1"
+        assert plan.out_bucket == "out"
+        assert plan.estimate.egress_cost == 0
@@ -0,0 +1,413 @@
+"""Measure cold starts of Trellis functions.
+
+Each function's main.py is imported in a new Python process, with the
+pipeline simulator's stand-ins for GCS, Pub/Sub, Neo4j and dsub, and
+its entry point is invoked twice with a minimal event. For each
+function this reports:
+
+    import      Seconds to import main.py, including module initialization.
+    init        Part of import not spent in import statements, e.g.
+                creating clients or modules loaded by importlib, like
+                database-triggers in check-triggers.
+    first       Seconds for the first invocation.
+    warm        Seconds for the second invocation.
+    rss         Resident memory added by importing main.py, in MB.
+    peak rss    Peak resident memory of the process, in MB.
+
+and the modules imported directly by main.py that took the longest to
+import, from "python -X importtime". When the google-cloud-storage or
+google-cloud-pubsub libraries are installed they are imported, so
+their import time is measured, but calls go to the stand-ins.
+
+Results can be saved and compared with a baseline to find regressions:
+
+    python cold_start_benchmark.py --output baseline.json
+    python cold_start_benchmark.py --baseline baseline.json
+
+Functions that fail to import (e.g. because a dependency is not
+installed) or raise on the minimal event are reported with the error.
+"""
+
+import io
+import os
+import re
+import ast
+import sys
+import json
+import time
+import base64
+import argparse
+import resource
+import tempfile
+import importlib
+import contextlib
+import statistics
+import subprocess
+
+from types import SimpleNamespace
+from datetime import datetime, timezone
+
+import stand_ins
+import delivery_generator
+import pipeline_simulator
+
+SIMULATOR_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(SIMULATOR_DIR, '..', 'functions')
+
+# Written to stderr around the import of main.py, to find its import times
+BEGIN_MARKER = '# cold-start-benchmark: begin'
+END_MARKER = '# cold-start-benchmark: end'
+
+METRICS = ['import_seconds', 'init_seconds', 'first_seconds', 'warm_seconds', 'rss_mb', 'peak_rss_mb']
+
+# Minimum changes reported as regressions, to ignore noise
+MIN_SECONDS_CHANGE = 0.02
+MIN_MEMORY_CHANGE = 5
+
+CLIENT_LIBRARIES = ['google.cloud.storage', 'google.cloud.pubsub']
+
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
+
+
+def discover_functions(functions_dir=FUNCTIONS_DIR):
+    """Get the entry point and trigger of each function from its cloudbuild.yaml.
+
+    Returns:
+        (dict): Entry point and trigger ('topic' or 'storage') of each
+                function. Both are None for functions that are not
+                deployed as Cloud Functions, e.g. check-dstat.
+    """
+    functions = {}
+    for name in sorted(os.listdir(functions_dir)):
+        main_path = os.path.join(functions_dir, name, 'main.py')
+        cloudbuild_path = os.path.join(functions_dir, name, 'cloudbuild.yaml')
+        if not os.path.isfile(main_path) or not os.path.isfile(cloudbuild_path):
+            continue
+
+        with open(cloudbuild_path) as fh:
+            cloudbuild = fh.read()
+        entry_point = re.search(r"--entry-point=(\w+)", cloudbuild)
+        trigger = None
+        if '--trigger-topic' in cloudbuild:
+            trigger = 'topic'
+        elif '--trigger-resource' in cloudbuild:
+            trigger = 'storage'
+        functions[name] = {
+                           'entry_point': entry_point.group(1) if entry_point else None,
+                           'trigger': trigger,
+        }
+    return functions
+
+
+def imported_packages(path):
+    """Get the top-level packages imported at module level by a file."""
+    with open(path) as fh:
+        tree = ast.parse(fh.read())
+    packages = set()
+    for statement in tree.body:
+        if isinstance(statement, ast.Import):
+            packages.update(alias.name.split('.')[0] for alias in statement.names)
+        elif isinstance(statement, ast.ImportFrom) and statement.module and not statement.level:
+            packages.add(statement.module.split('.')[0])
+    return packages
+
+
+def parse_import_times(stderr):
+    """Parse "-X importtime" lines written while main.py was imported.
+
+    Returns:
+        (list): Dicts with the 'module', 'self_us', 'cumulative_us' and
+                nesting 'depth' of each import.
+    """
+    imports = []
+    recording = False
+    for line in stderr.splitlines():
+        if line == BEGIN_MARKER:
+            recording = True
+        elif line == END_MARKER:
+            recording = False
+        elif recording:
+            match = IMPORT_TIME_PATTERN.match(line)
+            if match:
+                imports.append({
+                                'module': match.group(4),
+                                'self_us': int(match.group(1)),
+                                'cumulative_us': int(match.group(2)),
+                                'depth': (len(match.group(3)) - 1) // 2,
+                })
+    return imports
+
+
+def top_imports(imports, count=5, exclude=()):
+    """Get the slowest direct imports of main.py by cumulative time, or all if count is None."""
+    imports = [item for item in imports if item['module'] not in exclude]
+    if not imports:
+        return []
+    depth = min(item['depth'] for item in imports)
+    direct = [item for item in imports if item['depth'] == depth]
+    direct.sort(key=lambda item: item['cumulative_us'], reverse=True)
+    return [(item['module'], item['cumulative_us'] / 1e6) for item in direct[:count]]
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _peak_rss_mb():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _import_client_libraries(simulator, packages):
+    """Import installed google-cloud libraries, then restore the stand-ins.
+
+    Returns:
+        (list): Names of the libraries that are installed.
+    """
+    if 'google' not in packages:
+        return []
+    installed = []
+    for name in CLIENT_LIBRARIES:
+        sys.modules.pop(name, None)
+        try:
+            importlib.import_module(name)
+            installed.append(name)
+        except ImportError:
+            continue
+    stand_ins.install_cloud_modules(simulator.storage, simulator.publisher, simulator.subscriber)
+    return installed
+
+
+def _minimal_event(simulator, name, trigger):
+    if trigger == 'storage':
+        obj = next(delivery_generator.generate_delivery(plates=1, samples=1))
+        return delivery_generator.format_event(simulator.delivery_bucket, obj, datetime.now(timezone.utc))
+
+    # Only db-query receives queries; other functions receive their results
+    message = {
+               "header": {
+                          "resource": "query" if name == 'db-query' else "queryResult",
+                          "method": "POST",
+                          "labels": ["Benchmark"],
+                          "sentFrom": "cold-start-benchmark",
+                          "seedId": "1",
+                          "previousEventId": "1",
+               },
+               "body": {
+                        "cypher": "RETURN 1",
+                        "result-mode": "data",
+                        "results": {},
+               },
+    }
+    return {'data': base64.b64encode(json.dumps(message).encode('utf-8')), 'attributes': None}
+
+
+def _invoke(handler, event):
+    context = SimpleNamespace(
+                              event_id='1',
+                              timestamp=datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                              resource={})
+    start = time.perf_counter()
+    error = None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            handler(event, context)
+    except Exception as exception:
+        error = f"{type(exception).__name__}: {exception}"
+    return time.perf_counter() - start, error
+
+
+def measure(name, entry_point, trigger):
+    """Import and invoke one function in this process.
+
+    Run in a new process, by run_function(), so imports are cold.
+    """
+    root = tempfile.mkdtemp(prefix='trellis-cold-start-')
+    simulator = pipeline_simulator.PipelineSimulator(root, stand_ins.RecordedGraph(), load_functions=False)
+    main_path = os.path.join(FUNCTIONS_DIR, name, 'main.py')
+    packages = imported_packages(main_path)
+    # Standard library modules are not reported
+    stdlib = getattr(sys, 'stdlib_module_names', ())
+    preloaded = sorted(package for package in packages if package in sys.modules and package not in stdlib)
+
+    result = {
+              'function': name,
+              'preloaded': preloaded,
+              'error': None,
+    }
+    rss_before = _rss_mb()
+
+    sys.stderr.write(BEGIN_MARKER + '\n')
+    sys.stderr.flush()
+    start = time.perf_counter()
+    try:
+        result['client_libraries'] = _import_client_libraries(simulator, packages)
+        module = simulator.load_module(name)
+    except BaseException as exception:
+        module = None
+        result['error'] = f"import failed: {type(exception).__name__}: {exception}"
+    result['import_seconds'] = time.perf_counter() - start
+    sys.stderr.write(END_MARKER + '\n')
+    sys.stderr.flush()
+    result['rss_mb'] = _rss_mb() - rss_before
+
+    if module is not None and entry_point:
+        handler = getattr(module, entry_point)
+        event = _minimal_event(simulator, name, trigger)
+        result['first_seconds'], result['error'] = _invoke(handler, event)
+        result['warm_seconds'], _ = _invoke(handler, event)
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+
+def run_function(name, function, python=sys.executable):
+    """Measure a function in a new Python process.
+
+    Returns:
+        (dict): Metrics, errors and slowest imports of the function.
+    """
+    command = [
+               python, '-X', 'importtime', os.path.abspath(__file__),
+               '--child', name,
+               '--entry-point', function['entry_point'] or '',
+               '--trigger', function['trigger'] or '',
+    ]
+    process = subprocess.run(command, cwd=SIMULATOR_DIR, capture_output=True, text=True)
+    lines = process.stdout.strip().splitlines()
+    if process.returncode or not lines:
+        return {'function': name, 'error': f"benchmark process failed: {process.stderr.strip()[-500:]}"}
+
+    result = json.loads(lines[-1])
+    result['imports'] = parse_import_times(process.stderr)
+    direct = top_imports(result['imports'], count=None)
+    result['init_seconds'] = max(0, result['import_seconds'] - sum(seconds for _, seconds in direct))
+    return result
+
+
+def summarize(runs, top=5):
+    """Combine repeated runs of a function, using the median of each metric."""
+    result = dict(runs[-1])
+    for metric in METRICS:
+        values = [run[metric] for run in runs if run.get(metric) is not None]
+        result[metric] = statistics.median(values) if values else None
+    # Stand-ins replace the client libraries that are not installed
+    stand_in_libraries = set(CLIENT_LIBRARIES) - set(result.get('client_libraries') or [])
+    result['top_imports'] = top_imports(result.pop('imports', []), top, stand_in_libraries)
+    return result
+
+
+def benchmark(functions, repeat=3, top=5):
+    results = {}
+    for name, function in functions.items():
+        runs = [run_function(name, function) for _ in range(repeat)]
+        results[name] = summarize(runs, top)
+    return results
+
+
+def find_regressions(results, baseline, tolerance=0.2):
+    """Compare metrics with a baseline.
+
+    A metric regresses when it grows by more than "tolerance" of its
+    baseline value and by more than a minimum absolute change.
+
+    Returns:
+        (list): Function, metric, baseline value and new value of
+                each regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for metric in METRICS:
+            old, new = previous.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            minimum = MIN_MEMORY_CHANGE if metric.endswith('_mb') else MIN_SECONDS_CHANGE
+            if new - old > max(minimum, old * tolerance):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def _format_value(value, digits=3):
+    if value is None:
+        return '-'
+    return f"{value:.{digits}f}"
+
+
+def format_report(results, regressions=None):
+    width = max([20] + [len(name) for name in results])
+    lines = [
+             f"{'function':<{width}} {'import':>8} {'init':>8} {'first':>8} {'warm':>8} {'rss':>7} {'peak rss':>8}",
+    ]
+    for name, result in sorted(results.items(), key=lambda item: -(item[1].get('import_seconds') or 0)):
+        lines.append(
+                     f"{name:<{width}} {_format_value(result.get('import_seconds')):>8} " +
+                     f"{_format_value(result.get('init_seconds')):>8} " +
+                     f"{_format_value(result.get('first_seconds')):>8} {_format_value(result.get('warm_seconds')):>8} " +
+                     f"{_format_value(result.get('rss_mb'), 1):>7} {_format_value(result.get('peak_rss_mb'), 1):>8}")
+
+    lines.extend(["", "Slowest direct imports (cumulative seconds):"])
+    for name, result in sorted(results.items()):
+        offenders = ", ".join(f"{module} {seconds:.3f}" for module, seconds in result.get('top_imports', []))
+        lines.append(f"  {name}: {offenders or '-'}")
+        if result.get('preloaded'):
+            lines.append(f"    already imported by the benchmark: {', '.join(result['preloaded'])}")
+        if result.get('error'):
+            lines.append(f"    error: {result['error']}")
+
+    if regressions:
+        lines.extend(["", "Regressions:"])
+        for name, metric, old, new in regressions:
+            lines.append(f"  {name} {metric}: {old:.3f} -> {new:.3f}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('functions', nargs='*', help="Functions to measure. Defaults to all.")
+    parser.add_argument('--repeat', type=int, default=3, help="Processes per function; metrics are medians.")
+    parser.add_argument('--top', type=int, default=5, help="Slowest imports reported per function.")
+    parser.add_argument('--output', help="Save results as JSON, e.g. as a baseline.")
+    parser.add_argument('--baseline', help="Results to compare with; exits with 1 on regressions.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Relative growth counted as a regression.")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--entry-point', help=argparse.SUPPRESS)
+    parser.add_argument('--trigger', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        result = measure(args.child, args.entry_point or None, args.trigger or None)
+        print(json.dumps(result))
+        return 0
+
+    functions = discover_functions()
+    if args.functions:
+        unknown = set(args.functions) - set(functions)
+        if unknown:
+            parser.error(f"Unknown functions: {', '.join(sorted(unknown))}.")
+        functions = {name: functions[name] for name in args.functions}
+
+    results = benchmark(functions, args.repeat, args.top)
+
+    regressions = None
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = find_regressions(results, json.load(fh), args.tolerance)
+    print(format_report(results, regressions))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=4)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
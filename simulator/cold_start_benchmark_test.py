@@ -0,0 +1,77 @@
+import cold_start_benchmark
+
+IMPORT_TIMES = """\
+import time: self [us] | cumulative | imported package
+import time:       120 |        120 | yaml
+# cold-start-benchmark: begin
+import time:       300 |        300 |   neobolt.exceptions
+import time:      2000 |       9000 | py2neo
+import time:       500 |        500 | pdb
+import time:        50 |         50 |   pytz.lazy
+import time:       700 |        750 | pytz
+# cold-start-benchmark: end
+import time:       900 |        900 | json
+"""
+
+
+class TestDiscoverFunctions:
+
+    def test_entry_points_and_triggers(self):
+        functions = cold_start_benchmark.discover_functions()
+
+        assert functions['check-triggers'] == {'entry_point': 'check_triggers', 'trigger': 'topic'}
+        assert functions['create-blob-node'] == {'entry_point': 'create_node_query', 'trigger': 'storage'}
+        # Deployed to Cloud Run
+        assert functions['check-dstat'] == {'entry_point': None, 'trigger': None}
+        assert 'shared' not in functions
+
+
+class TestImportTimes:
+
+    def test_parse_between_markers(self):
+        imports = cold_start_benchmark.parse_import_times(IMPORT_TIMES)
+
+        assert [item['module'] for item in imports] == ['neobolt.exceptions', 'py2neo', 'pdb', 'pytz.lazy', 'pytz']
+        assert imports[0]['depth'] == 1
+        assert imports[1] == {'module': 'py2neo', 'self_us': 2000, 'cumulative_us': 9000, 'depth': 0}
+
+    def test_top_imports(self):
+        imports = cold_start_benchmark.parse_import_times(IMPORT_TIMES)
+
+        assert cold_start_benchmark.top_imports(imports, 2) == [('py2neo', 0.009), ('pytz', 0.00075)]
+        assert cold_start_benchmark.top_imports(imports, 1, exclude=['py2neo']) == [('pytz', 0.00075)]
+
+
+class TestRegressions:
+
+    def test_relative_and_absolute_change(self):
+        baseline = {
+                    'db-query': {'import_seconds': 0.5, 'first_seconds': 0.010, 'rss_mb': 40},
+                    'check-triggers': {'import_seconds': 0.2, 'rss_mb': 20},
+        }
+        results = {
+                   # Import grew by 40%; first invocation grew by 100%, but only 10 ms
+                   'db-query': {'import_seconds': 0.7, 'first_seconds': 0.020, 'rss_mb': 41},
+                   'check-triggers': {'import_seconds': 0.21, 'rss_mb': 30},
+                   'new-function': {'import_seconds': 1.0},
+        }
+
+        regressions = cold_start_benchmark.find_regressions(results, baseline, tolerance=0.2)
+
+        assert regressions == [('db-query', 'import_seconds', 0.5, 0.7), ('check-triggers', 'rss_mb', 20, 30)]
+        assert 'db-query import_seconds' in cold_start_benchmark.format_report(results, regressions)
+
+
+class TestRunFunction:
+
+    def test_cold_start(self):
+        functions = cold_start_benchmark.discover_functions()
+        runs = [cold_start_benchmark.run_function('delete-blob', functions['delete-blob'])]
+        result = cold_start_benchmark.summarize(runs)
+
+        assert result['error'] is None
+        assert result['import_seconds'] > 0
+        assert 0 <= result['init_seconds'] <= result['import_seconds']
+        assert result['first_seconds'] is not None
+        assert result['peak_rss_mb'] > 0
+        assert 'claim_check' in [module for module, _ in result['top_imports']]
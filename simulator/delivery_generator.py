@@ -0,0 +1,272 @@
+"""Generate GCS finalize events for synthetic Personalis deliveries.
+
+Objects follow the phase2 and phase3 naming conventions matched by
+config/phase3/from-personalis/create-node-config.py:
+
+    phase3  va_mvp_phase3/{plate}/{sample}/{flowcell}_{sample}_{index1}-{index2}_L00{lane}_R{mate}_001.fastq.gz
+    phase2  va_mvp_phase2/{plate}/{sample}/FASTQ/{sample}_{readGroup}_R{mate}.fastq.gz
+            va_mvp_phase2/{plate}/{sample}/Microarray/{sample}_microarray.gtc (and _Grn/_Red.idat)
+    both    va_mvp_phase{n}/{plate}/{sample}/{sample}.json
+            va_mvp_phase{n}/{plate}/{sample}/checksum.txt
+
+Sequencing data objects only exist as events, with sizes drawn around
+those of real deliveries. The sequencing JSON and checksum files, which
+create-blob-node reads, also have content.
+
+Events are scheduled by offset in seconds from the start of delivery:
+
+    steady  Objects arrive at a fixed rate.
+    burst   Groups of objects arrive at once, at a fixed interval.
+    replay  Offsets are taken from the timeCreated of recorded events.
+
+Usage:
+    python delivery_generator.py --plates 10 --samples 96 --mode burst > events.jsonl
+"""
+
+import sys
+import json
+import base64
+import random
+import hashlib
+import argparse
+
+from datetime import datetime, timedelta, timezone
+from collections import namedtuple
+
+# Mean and standard deviation of object sizes, in bytes
+PHASE3_FASTQ_SIZE = (5.4e9, 0.7e9)
+PHASE2_FASTQ_SIZE = (8.1e9, 1.1e9)
+MICROARRAY_SIZES = {
+                    'microarray.gtc': (8.7e6, 0.2e6),
+                    'microarray_Grn.idat': (8.1e6, 0.1e6),
+                    'microarray_Red.idat': (8.1e6, 0.1e6),
+}
+MIN_SIZE = 1024
+
+DeliveryObject = namedtuple('DeliveryObject', ['name', 'size', 'md5Hash', 'content'])
+ScheduledEvent = namedtuple('ScheduledEvent', ['offset', 'event', 'content'])
+
+
+def _random_md5(rng):
+    return base64.b64encode(rng.getrandbits(128).to_bytes(16, 'big')).decode()
+
+
+def _size(rng, distribution):
+    mean, deviation = distribution
+    return max(MIN_SIZE, int(rng.gauss(mean, deviation)))
+
+
+def _content_object(name, content):
+    digest = hashlib.md5(content.encode('utf-8')).digest()
+    return DeliveryObject(name, len(content.encode('utf-8')), base64.b64encode(digest).decode(), content)
+
+
+def _sequencing_json(plate, sample, rng, fastq_count):
+    metadata = {
+                'ShippingID': sample,
+                'PlateID': plate,
+                'SequencingCenter': 'Personalis',
+                'AlignmentCoverage': round(rng.uniform(30, 45), 2),
+                'ReadLength': 150,
+                'FastqCount': fastq_count,
+    }
+    return json.dumps(metadata, indent=4)
+
+
+def _checksum_file(rng, paths):
+    lines = [f"{rng.getrandbits(128):032x}\t./{path}" for path in paths]
+    return '\n'.join(lines) + '\n'
+
+
+def _phase3_sample(plate, sample, flowcell, rng, lanes):
+    prefix = f"va_mvp_phase3/{plate}/{sample}"
+    index = '-'.join(''.join(rng.choice('ACGT') for _ in range(8)) for _ in range(2))
+
+    objects = []
+    for lane in range(1, lanes + 1):
+        for mate in (1, 2):
+            basename = f"{flowcell}_{sample}_{index}_L00{lane}_R{mate}_001.fastq.gz"
+            objects.append(DeliveryObject(f"{prefix}/{basename}", _size(rng, PHASE3_FASTQ_SIZE), _random_md5(rng), None))
+
+    # Personalis lists phase3 fastqs under ./FASTQ/ in checksum files
+    basenames = [f"FASTQ/{obj.name.split('/')[-1]}" for obj in objects]
+    objects.append(_content_object(f"{prefix}/{sample}.json", _sequencing_json(plate, sample, rng, len(basenames))))
+    objects.append(_content_object(f"{prefix}/checksum.txt", _checksum_file(rng, basenames)))
+    return objects
+
+
+def _phase2_sample(plate, sample, rng, read_groups):
+    prefix = f"va_mvp_phase2/{plate}/{sample}"
+
+    objects = []
+    for read_group in range(read_groups):
+        for mate in (1, 2):
+            name = f"{prefix}/FASTQ/{sample}_{read_group}_R{mate}.fastq.gz"
+            objects.append(DeliveryObject(name, _size(rng, PHASE2_FASTQ_SIZE), _random_md5(rng), None))
+    for suffix, distribution in MICROARRAY_SIZES.items():
+        name = f"{prefix}/Microarray/{sample}_{suffix}"
+        objects.append(DeliveryObject(name, _size(rng, distribution), _random_md5(rng), None))
+
+    paths = [obj.name[len(prefix) + 1:] for obj in objects]
+    fastq_count = read_groups * 2
+    objects.append(_content_object(f"{prefix}/{sample}.json", _sequencing_json(plate, sample, rng, fastq_count)))
+    objects.append(_content_object(f"{prefix}/checksum.txt", _checksum_file(rng, paths)))
+    return objects
+
+
+def generate_delivery(plates, samples, phase=3, lanes=4, read_groups=3, first_plate=1, seed=0):
+    """Yield the objects of a delivery in upload order.
+
+    Each sample's sequencing data is uploaded before its JSON and
+    checksum files.
+
+    Args:
+        plates (int): Number of plates.
+        samples (int): Samples per plate.
+        phase (int): Delivery naming convention, 2 or 3.
+        lanes (int): Flowcell lanes per sample (phase3).
+        read_groups (int): Read groups per sample (phase2).
+        first_plate (int): Number of the first plate, so that
+                           deliveries can be generated in parts.
+        seed (int): Random seed; the same arguments give the same objects.
+    """
+    if phase not in (2, 3):
+        raise ValueError(f"Delivery phase {phase} is not valid. Supported phases: [2,3].")
+    if not 0 < read_groups <= 10:
+        raise ValueError("Phase2 read groups are numbered with a single digit.")
+
+    rng = random.Random(seed)
+    for plate_number in range(first_plate, first_plate + plates):
+        plate = f"DVALABP{plate_number:06d}"
+        flowcell = ''.join(rng.choice('ABCDEFGHJKLMNPRSTUVWXY0123456789') for _ in range(5)) + f"DSX{rng.randint(1, 9)}"
+        for sample_number in range(samples):
+            sample = f"SHIP{(plate_number * 1000 + sample_number) % 10**7:07d}"
+            if phase == 3:
+                yield from _phase3_sample(plate, sample, flowcell, rng, lanes)
+            else:
+                yield from _phase2_sample(plate, sample, rng, read_groups)
+
+
+def format_event(bucket, obj, time_created):
+    """Format object metadata like a GCS finalize event."""
+    timestamp = time_created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    return {
+            "bucket": bucket,
+            "name": obj.name,
+            "id": f"{bucket}/{obj.name}/1",
+            "size": str(obj.size),
+            "md5Hash": obj.md5Hash,
+            "contentType": 'application/json' if obj.name.endswith('.json') else 'application/octet-stream',
+            "storageClass": "STANDARD",
+            "generation": "1",
+            "metageneration": "1",
+            "timeCreated": timestamp,
+            "updated": timestamp,
+            "timeStorageClassUpdated": timestamp,
+            "kind": "storage#object",
+    }
+
+
+def _schedule(objects, offsets, bucket, start):
+    for offset, obj in zip(offsets, objects):
+        event = format_event(bucket, obj, start + timedelta(seconds=offset))
+        yield ScheduledEvent(offset, event, obj.content)
+
+
+def steady_schedule(objects, bucket, rate, start):
+    """Schedule objects to arrive at a fixed rate per second."""
+    offsets = (index / rate for index in range(sys.maxsize))
+    return _schedule(objects, offsets, bucket, start)
+
+
+def burst_schedule(objects, bucket, burst_size, interval, start):
+    """Schedule objects to arrive "burst_size" at a time every "interval" seconds."""
+    offsets = ((index // burst_size) * interval for index in range(sys.maxsize))
+    return _schedule(objects, offsets, bucket, start)
+
+
+def parse_time(timestamp):
+    """Parse a GCS metadata timestamp, with or without fractional seconds."""
+    for time_format in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return datetime.strptime(timestamp, time_format)
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognized timestamp: {timestamp}.")
+
+
+def replay_schedule(records, speedup=1):
+    """Schedule recorded events by the time they were created.
+
+    Args:
+        records (list): Generated records, with "event" and "content"
+                        keys, or GCS object metadata, e.g. from
+                        "gsutil ls -L" exports or Cloud Logging.
+        speedup (float): Factor by which to shorten the gaps
+                         between events.
+    """
+    scheduled = []
+    for record in records:
+        event = record.get('event', record)
+        scheduled.append((parse_time(event['timeCreated']), event, record.get('content')))
+    scheduled.sort(key=lambda item: item[0])
+    if not scheduled:
+        return
+
+    first = scheduled[0][0]
+    for time_created, event, content in scheduled:
+        yield ScheduledEvent((time_created - first).total_seconds() / speedup, event, content)
+
+
+def load_records(path):
+    with open(path) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def format_record(scheduled):
+    return json.dumps({'offset': scheduled.offset, 'event': scheduled.event, 'content': scheduled.content})
+
+
+def add_schedule_arguments(parser):
+    """Add delivery and schedule options shared with the pipeline simulator."""
+    parser.add_argument('--plates', type=int, default=1)
+    parser.add_argument('--samples', type=int, default=96, help="Samples per plate.")
+    parser.add_argument('--phase', type=int, default=3, choices=[2, 3], help="Delivery naming convention.")
+    parser.add_argument('--lanes', type=int, default=4, help="Flowcell lanes per sample (phase3).")
+    parser.add_argument('--read-groups', type=int, default=3, help="Read groups per sample (phase2).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mode', default='steady', choices=['steady', 'burst', 'replay'])
+    parser.add_argument('--rate', type=float, default=10, help="Objects per second (steady).")
+    parser.add_argument('--burst-size', type=int, default=500, help="Objects per burst (burst).")
+    parser.add_argument('--burst-interval', type=float, default=60, help="Seconds between bursts (burst).")
+    parser.add_argument('--replay', help="File of recorded events, one JSON object per line (replay).")
+    parser.add_argument('--speedup', type=float, default=1, help="Replay speedup factor (replay).")
+
+
+def schedule_from_arguments(args, bucket, start=None):
+    if args.mode == 'replay':
+        if not args.replay:
+            raise ValueError("Replay mode requires --replay.")
+        return replay_schedule(load_records(args.replay), args.speedup)
+
+    start = start or datetime.now(timezone.utc)
+    objects = generate_delivery(
+                                args.plates, args.samples, args.phase,
+                                lanes=args.lanes, read_groups=args.read_groups, seed=args.seed)
+    if args.mode == 'burst':
+        return burst_schedule(objects, bucket, args.burst_size, args.burst_interval, start)
+    return steady_schedule(objects, bucket, args.rate, start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_schedule_arguments(parser)
+    parser.add_argument('--bucket', default='trellis-simulator-from-personalis')
+    args = parser.parse_args(argv)
+
+    for scheduled in schedule_from_arguments(args, args.bucket):
+        print(format_record(scheduled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import os
+import re
+import ast
+import sys
+import json
+import pytest
+import importlib
+
+from datetime import datetime
+from collections import Counter
+
+import stand_ins
+import delivery_generator
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config')
+NODE_CONFIG_PATH = os.path.join(CONFIG_DIR, 'phase3', 'from-personalis', 'create-node-config.py')
+
+START = datetime(2021, 6, 1, 12, 0, 0)
+BUCKET = 'trellis-from-personalis'
+
+
+def load_match_patterns():
+    """Read NodeKinds.match_patterns without importing the config."""
+    with open(NODE_CONFIG_PATH) as fh:
+        tree = ast.parse(fh.read())
+    for item in ast.walk(tree):
+        if isinstance(item, ast.Assign) and isinstance(item.targets[0], ast.Attribute):
+            if item.targets[0].attr == 'match_patterns':
+                return ast.literal_eval(item.value)
+
+
+def count_labels(objects):
+    patterns = load_match_patterns()
+    labels = Counter()
+    for obj in objects:
+        for label, label_patterns in patterns.items():
+            match = None
+            for pattern in label_patterns:
+                match = re.fullmatch(pattern, obj.name)
+                if match:
+                    break
+            if match:
+                labels[label] += 1
+                if label == 'Blob':
+                    assert obj.name.split('/')[1:3] == [match['plate'], match['sample']]
+    return labels
+
+
+class TestGenerateDelivery:
+
+    def test_phase3_objects(self):
+        objects = list(delivery_generator.generate_delivery(plates=2, samples=3, lanes=4))
+        labels = count_labels(objects)
+
+        assert len(objects) == 2 * 3 * 10
+        assert labels['Blob'] == len(objects)
+        assert labels['Fastq'] == 2 * 3 * 8
+        assert labels['PersonalisSequencing'] == 6
+        assert labels['Checksum'] == 6
+        assert len({obj.name for obj in objects}) == len(objects)
+        assert objects[-1].name.endswith('checksum.txt')
+
+        fastq_sizes = [obj.size for obj in objects if obj.name.endswith('.fastq.gz')]
+        assert 3e9 < sum(fastq_sizes) / len(fastq_sizes) < 8e9
+
+    def test_phase2_objects(self):
+        objects = list(delivery_generator.generate_delivery(plates=1, samples=2, phase=2, read_groups=3))
+        labels = count_labels(objects)
+
+        assert labels['Fastq'] == 2 * 6
+        assert labels['Microarray'] == 2 * 3
+        assert labels['Checksum'] == 2
+
+        checksum = objects[-1].content.split('\n')
+        assert len([line for line in checksum if './FASTQ/' in line]) == 6
+        assert len([line for line in checksum if './Microarray/' in line]) == 3
+
+    def test_seed(self):
+        first = list(delivery_generator.generate_delivery(plates=1, samples=2, seed=1))
+        assert list(delivery_generator.generate_delivery(plates=1, samples=2, seed=1)) == first
+        assert list(delivery_generator.generate_delivery(plates=1, samples=2, seed=2)) != first
+
+    def test_invalid_phase(self):
+        with pytest.raises(ValueError):
+            list(delivery_generator.generate_delivery(plates=1, samples=1, phase=1))
+
+    def test_checksum_read_by_create_node_config(self, tmp_path):
+        pytest.importorskip('iso8601')
+        modules = {name: sys.modules.get(name) for name in ['google.cloud', 'google.cloud.storage', 'google.cloud.pubsub']}
+        client = stand_ins.LocalStorageClient(str(tmp_path))
+        stand_ins.install_cloud_modules(client, None)
+        sys.path.insert(0, CONFIG_DIR)
+        try:
+            config = importlib.import_module('phase3.from-personalis.create-node-config')
+            objects = list(delivery_generator.generate_delivery(plates=1, samples=1, lanes=2))
+            for obj in objects[-2:]:
+                client.store(f"gs://{BUCKET}/{obj.name}", obj.content)
+
+            checksum = {'bucket': BUCKET, 'path': objects[-1].name}
+            sequencing = {'bucket': BUCKET, 'path': objects[-2].name}
+            assert config.read_checksum(checksum, {})['fastqCount'] == 4
+            assert config.read_json(sequencing, {})['FastqCount'] == 4
+        finally:
+            sys.path.remove(CONFIG_DIR)
+            for name in [name for name in sys.modules if name.startswith('phase3')]:
+                del sys.modules[name]
+            for name, module in modules.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+
+
+class TestSchedules:
+
+    def test_steady(self):
+        objects = delivery_generator.generate_delivery(plates=1, samples=1, lanes=1)
+        schedule = list(delivery_generator.steady_schedule(objects, BUCKET, 2, START))
+
+        assert [scheduled.offset for scheduled in schedule] == [0, 0.5, 1, 1.5]
+        assert schedule[1].event['timeCreated'] == '2021-06-01T12:00:00.500Z'
+        assert schedule[1].event['bucket'] == BUCKET
+        assert schedule[1].content is None
+        assert json.loads(schedule[2].content)['ShippingID'] == 'SHIP0001000'
+        assert schedule[2].event['size'] == str(len(schedule[2].content))
+
+    def test_burst(self):
+        objects = delivery_generator.generate_delivery(plates=1, samples=1, lanes=2)
+        schedule = delivery_generator.burst_schedule(objects, BUCKET, 4, 30, START)
+
+        assert [scheduled.offset for scheduled in schedule] == [0, 0, 0, 0, 30, 30]
+
+    def test_replay(self, tmp_path):
+        objects = delivery_generator.generate_delivery(plates=1, samples=1, lanes=1)
+        schedule = list(delivery_generator.steady_schedule(objects, BUCKET, 0.1, START))
+        path = tmp_path / 'events.jsonl'
+        # Recorded events are not necessarily in order
+        path.write_text('\n'.join(delivery_generator.format_record(scheduled) for scheduled in reversed(schedule)))
+
+        replayed = list(delivery_generator.replay_schedule(delivery_generator.load_records(str(path)), speedup=10))
+
+        assert [scheduled.offset for scheduled in replayed] == [0, 1, 2, 3]
+        assert [scheduled.event for scheduled in replayed] == [scheduled.event for scheduled in schedule]
+        assert replayed[3].content == schedule[3].content
+
+    def test_replay_object_metadata(self):
+        records = [
+                   {'bucket': BUCKET, 'name': 'va_mvp_phase3/P/S/S.json', 'timeCreated': '2021-06-01T12:00:05Z'},
+                   {'bucket': BUCKET, 'name': 'va_mvp_phase3/P/S/checksum.txt', 'timeCreated': '2021-06-01T12:00:00.250Z'}]
+
+        replayed = list(delivery_generator.replay_schedule(records))
+
+        assert [scheduled.offset for scheduled in replayed] == [0, 4.75]
+        assert replayed[0].content is None
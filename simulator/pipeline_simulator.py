@@ -0,0 +1,450 @@
+"""Run Trellis functions end to end on one machine.
+
+Loads the Cloud Function entry points from functions/ and connects them
+with an in-process Pub/Sub bus, a local directory standing in for GCS
+and either a local Neo4j database or recorded query results. Objects
+written to a bucket with a create-node config trigger create-blob-node,
+as they would in GCP, so a synthetic plate delivery drives the same
+chain of functions and database triggers as a real one. Reports
+throughput, hops per event and queue depths per topic.
+
+Deliveries come from delivery_generator and arrive on a simulated clock
+that advances by the time functions take to process each message.
+Messages are processed one at a time, so queue depths are an upper
+bound for a deployment where functions scale out.
+
+Usage:
+    python pipeline_simulator.py --samples 4 --recording recorded.json
+    python pipeline_simulator.py --samples 4 --neo4j-url bolt://localhost:7687 --record recorded.json
+    python pipeline_simulator.py --mode replay --replay events.jsonl --speedup 10
+
+Functions that do not run as background functions (check-dstat, the
+Cloud Run dsub launchers) are not loaded; messages published to their
+topics are counted as undelivered.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import yaml
+import base64
+import logging
+import argparse
+import tempfile
+import contextlib
+import importlib.util
+
+from types import SimpleNamespace
+from collections import Counter, deque
+
+import stand_ins
+import delivery_generator
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FUNCTIONS_DIR = os.path.join(REPO_DIR, 'functions')
+SHARED_DIR = os.path.join(FUNCTIONS_DIR, 'shared')
+CONFIG_DIR = os.path.join(REPO_DIR, 'config')
+
+PROJECT = 'trellis-simulator'
+DATA_GROUP = 'phase3'
+
+# Function, entry point and the topic variable it is subscribed to
+PUBSUB_FUNCTIONS = [
+    ('db-query', 'query_db', 'DB_QUERY_TOPIC'),
+    ('check-triggers', 'check_triggers', 'TOPIC_TRIGGERS'),
+    ('create-job-node', 'write_job_node_query', 'NEW_JOBS_TOPIC'),
+    ('launch-fastq-to-ubam', 'launch_fastq_to_ubam', 'TOPIC_FASTQ_TO_UBAM'),
+    ('launch-gatk-5-dollar', 'launch_gatk_5_dollar', 'TOPIC_GATK_5_DOLLAR'),
+    ('launch-bam-fastqc', 'launch_fastqc', 'TOPIC_BAM_FASTQC'),
+    ('launch-flagstat', 'launch_flagstat', 'TOPIC_FLAGSTAT'),
+    ('launch-vcfstats', 'launch_vcfstats', 'TOPIC_VCFSTATS'),
+    ('launch-text-to-table', 'launch_text_to_table', 'TOPIC_TEXT_TO_TABLE'),
+]
+STORAGE_FUNCTION = ('create-blob-node', 'create_node_query')
+
+TRIGGER_TOPICS = [
+    'TOPIC_BAM_FASTQC',
+    'TOPIC_BIGQUERY_APPEND_TSV',
+    'TOPIC_BIGQUERY_IMPORT_CSV',
+    'TOPIC_BLOB_UPDATE_STORAGE',
+    'TOPIC_BLOB_UPDATE_USER_PERMISSIONS',
+    'TOPIC_CNVNATOR',
+    'TOPIC_DELETE_BLOB',
+    'TOPIC_DSTAT',
+    'TOPIC_FASTQ_TO_UBAM',
+    'TOPIC_FLAGSTAT',
+    'TOPIC_GATK_5_DOLLAR',
+    'TOPIC_KILL_JOB',
+    'TOPIC_POSTGRES_INSERT_DATA',
+    'TOPIC_TEXT_TO_TABLE',
+    'TOPIC_VCFSTATS',
+    'TOPIC_VIEW_GVCF_SNPS',
+]
+
+
+def make_vars(project=PROJECT, data_group=DATA_GROUP):
+    """Runtime variables normally stored in the Trellis credentials blob."""
+    env_vars = {
+                'GOOGLE_CLOUD_PROJECT': project,
+                'DATA_GROUP': data_group,
+                'DB_QUERY_TOPIC': 'db-query',
+                'TOPIC_TRIGGERS': 'check-triggers',
+                'NEW_JOBS_TOPIC': 'create-job-node',
+                'WGS_VARIANT_CALLING': True,
+                'TRELLIS_BUCKET': f"{project}-trellis",
+                'DSUB_REGIONS': ['us-west1'],
+                'DSUB_OUT_BUCKET': f"{project}-from-personalis-phase3-data",
+                'DSUB_LOG_BUCKET': f"{project}-from-personalis-phase3-logs",
+                'DSUB_USER': 'trellis',
+                'DSUB_NETWORK': 'trellis',
+                'DSUB_SUBNETWORK': 'trellis-us-west1',
+                'GATK_MVP_DIR': 'workflow-inputs/gatk-mvp',
+                'GATK_MVP_HASH': 'simulated',
+                'GATK_GERMLINE_DIR': 'gatk-mvp-pipeline',
+                'CROMWELL_IMAGE': 'broadinstitute/cromwell:latest',
+                'NEO4J_SCHEME': 'bolt',
+                'NEO4J_HOST': 'localhost',
+                'NEO4J_PORT': 7687,
+                'NEO4J_USER': 'neo4j',
+                'NEO4J_PASSPHRASE': '',
+                'NEO4J_MAX_CONN': 1,
+    }
+    for variable in TRIGGER_TOPICS:
+        env_vars[variable] = variable[len('TOPIC_'):].lower().replace('_', '-')
+    return env_vars
+
+
+@contextlib.contextmanager
+def patched(obj, name, value):
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+
+@contextlib.contextmanager
+def patched_environ(variables):
+    original = dict(os.environ)
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(original)
+
+
+class PipelineSimulator:
+    """Connects Trellis functions to local stand-ins and runs them.
+
+    Args:
+        root (str): Directory used as GCS; one folder per bucket.
+        graph: Object with a py2neo Graph run() method, used by db-query.
+        project (str): Project prefix of bucket names.
+        data_group (str): Config directory with create-node configs and
+                          database triggers.
+        quiet (bool): Hide function output.
+        load_functions (bool): Load and subscribe the pipeline functions;
+                               otherwise only set up the stand-ins.
+    """
+
+    def __init__(self, root, graph, project=PROJECT, data_group=DATA_GROUP, quiet=True, load_functions=True):
+        self.project = project
+        self.data_group = data_group
+        self.quiet = quiet
+        self.graph = graph
+
+        self.bus = stand_ins.TopicBus()
+        self.storage = stand_ins.LocalStorageClient(root, on_finalize=self._object_finalized)
+        self.publisher = stand_ins.BusPublisher(self.bus)
+        self.subscriber = stand_ins.BusSubscriber(self.bus)
+        self.dsub = stand_ins.SimulatedDsub(self.storage)
+        self.clock = stand_ins.NoSleep()
+        self.env_vars = make_vars(project, data_group)
+
+        self.invocations = Counter()
+        self.errors = Counter()
+        self.seconds = Counter()
+        self.elapsed = 0
+        self.clock_seconds = 0
+        self.offered = 0
+        self.pending = deque()
+
+        self._setup(load_functions)
+
+    def _setup(self, load_functions):
+        stand_ins.install_cloud_modules(self.storage, self.publisher, self.subscriber)
+
+        data_group_dir = os.path.join(CONFIG_DIR, self.data_group)
+        for path in (SHARED_DIR, CONFIG_DIR, data_group_dir):
+            if path not in sys.path:
+                sys.path.insert(0, path)
+
+        # Buckets with a create-node config trigger create-blob-node
+        for name in sorted(os.listdir(data_group_dir)):
+            if os.path.isfile(os.path.join(data_group_dir, name, 'create-node-config.py')):
+                self.storage.watched_buckets.add(f"{self.project}-{name}")
+
+        trellis_bucket = self.env_vars['TRELLIS_BUCKET']
+        self.storage.create_bucket(trellis_bucket)
+        self.storage.write(f"gs://{trellis_bucket}/credentials/vars.yaml", yaml.dump(self.env_vars))
+        gatk_dir = f"{self.env_vars['GATK_MVP_DIR']}/{self.env_vars['GATK_MVP_HASH']}"
+        self.storage.write(
+                           f"gs://{trellis_bucket}/{gatk_dir}/{self.env_vars['GATK_GERMLINE_DIR']}/generic.google-papi.options.json",
+                           json.dumps({}))
+        self.storage.write(f"gs://{trellis_bucket}/{gatk_dir}/mvp.hg38.inputs.json", json.dumps({}))
+
+        if load_functions:
+            function_name, entry_point = STORAGE_FUNCTION
+            handler = self.load_function(function_name, entry_point)
+            for bucket in self.storage.watched_buckets:
+                self.bus.subscribe(f"storage:{bucket}", function_name, self._storage_handler(function_name, handler))
+
+            for function_name, entry_point, variable in PUBSUB_FUNCTIONS:
+                handler = self.load_function(function_name, entry_point)
+                self.bus.subscribe(self.env_vars[variable], function_name, self._pubsub_handler(function_name, handler))
+
+        # Only count writes made by the pipeline
+        self.storage.unwatched_writes.clear()
+
+    def load_function(self, name, entry_point):
+        return getattr(self.load_module(name), entry_point)
+
+    def load_module(self, name):
+        """Import a function's main.py as it is initialized in GCP."""
+        variables = {
+                     'ENVIRONMENT': 'google-cloud',
+                     'FUNCTION_NAME': name,
+                     'TRIGGER_OPERATION': 'finalize',
+                     'GIT_COMMIT_HASH': 'simulated',
+                     'GIT_VERSION_TAG': 'simulated',
+                     'GCP_PROJECT': self.project,
+                     'CREDENTIALS_BUCKET': self.env_vars['TRELLIS_BUCKET'],
+                     'CREDENTIALS_BLOB': 'credentials/vars.yaml',
+        }
+        spec = importlib.util.spec_from_file_location(
+                                                      f"simulated_{name.replace('-', '_')}",
+                                                      os.path.join(FUNCTIONS_DIR, name, 'main.py'))
+        module = importlib.util.module_from_spec(spec)
+
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(patched_environ(variables))
+            if name == 'db-query':
+                import py2neo
+                stack.enter_context(patched(py2neo, 'Graph', lambda *args, **kwargs: self.graph))
+            self._output(stack)
+            spec.loader.exec_module(module)
+
+        if hasattr(module, 'DSUB'):
+            module.DSUB = self.dsub
+        if hasattr(module, 'time'):
+            module.time = self.clock
+        if hasattr(module, 'LAUNCHER'):
+            module.LAUNCHER.dsub = self.dsub
+            module.LAUNCHER.sleep = self.clock.sleep
+        return module
+
+    def _output(self, stack):
+        if self.quiet:
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+
+    def _make_context(self, message_id, resource):
+        return SimpleNamespace(
+                               event_id=message_id,
+                               timestamp=stand_ins._utc_timestamp(),
+                               resource=resource)
+
+    def _pubsub_handler(self, name, handler):
+        def deliver(message_id, data, attributes):
+            event = {'data': base64.b64encode(data), 'attributes': attributes or None}
+            context = self._make_context(message_id, {'service': 'pubsub.googleapis.com'})
+            self._invoke(name, handler, event, context)
+        return deliver
+
+    def _storage_handler(self, name, handler):
+        def deliver(message_id, data, attributes):
+            context = self._make_context(message_id, {'service': 'storage.googleapis.com'})
+            self._invoke(name, handler, data, context)
+        return deliver
+
+    def _invoke(self, name, handler, event, context):
+        self.invocations[name] += 1
+        start = time.time()
+        with contextlib.ExitStack() as stack:
+            self._output(stack)
+            try:
+                handler(event, context)
+            except Exception:
+                self.errors[name] += 1
+                logging.exception(f"{name} failed on event {context.event_id}.")
+        self.seconds[name] += time.time() - start
+
+    def _object_finalized(self, event):
+        self.bus.publish(f"storage:{event['bucket']}", event)
+
+    @property
+    def delivery_bucket(self):
+        return f"{self.project}-from-personalis"
+
+    def offer(self, schedule):
+        """Queue scheduled delivery events to arrive as the clock advances.
+
+        Args:
+            schedule (iterable): delivery_generator.ScheduledEvent tuples,
+                                 in order of offset.
+        """
+        for scheduled in schedule:
+            self.pending.append(scheduled)
+            self.offered += 1
+
+    def _upload(self, scheduled):
+        event = scheduled.event
+        content = scheduled.content
+        # Replayed events do not have content, but create-blob-node
+        # reads sequencing JSON and checksum objects
+        if content is None and event['name'].endswith('.json'):
+            content = '{}'
+        elif content is None and event['name'].endswith('checksum.txt'):
+            content = ''
+        # Sequencing data is never read, so only its event is sent
+        if content is not None:
+            self.storage.store(f"gs://{event['bucket']}/{event['name']}", content)
+        if event['bucket'] in self.storage.watched_buckets:
+            self._object_finalized(event)
+        else:
+            self.storage.unwatched_writes[event['bucket']] += 1
+
+    def run(self, max_messages=None):
+        """Deliver messages until the bus and pending deliveries are empty.
+
+        Delivery events are uploaded once the simulated clock reaches
+        their offset; the clock advances by the time taken to process
+        each message, or skips ahead when there is nothing to process.
+
+        Returns:
+            (int): Number of messages delivered.
+        """
+        delivered = 0
+        start = time.time()
+        while self.pending or self.bus.queue:
+            if max_messages is not None and delivered >= max_messages:
+                break
+            while self.pending and self.pending[0].offset <= self.clock_seconds:
+                self._upload(self.pending.popleft())
+            if not self.bus.queue:
+                self.clock_seconds = self.pending[0].offset
+                continue
+
+            message_start = time.time()
+            self.bus.deliver_next()
+            self.clock_seconds += time.time() - message_start
+            delivered += 1
+        self.elapsed += time.time() - start
+        return delivered
+
+    def report(self):
+        delivered = sum(self.bus.delivered.values())
+        topics = {}
+        for topic in sorted(set(self.bus.published) | set(self.bus.delivered)):
+            topics[topic] = {
+                             'published': self.bus.published[topic],
+                             'delivered': self.bus.delivered[topic],
+                             'undelivered': self.bus.undelivered[topic],
+                             'max_depth': self.bus.max_topic_depth[topic],
+            }
+        functions = {}
+        for name in sorted(self.invocations):
+            functions[name] = {
+                               'invocations': self.invocations[name],
+                               'errors': self.errors[name],
+                               'seconds': round(self.seconds[name], 3),
+            }
+        report = {
+                  'elapsed_seconds': round(self.elapsed, 3),
+                  'simulated_seconds': round(self.clock_seconds, 3),
+                  'objects_offered': self.offered,
+                  'delivered': delivered,
+                  'throughput': round(delivered / self.elapsed, 1) if self.elapsed else 0,
+                  'max_queue_depth': self.bus.max_depth,
+                  'max_hops': max(self.bus.hops, default=0),
+                  'hops': dict(sorted(self.bus.hops.items())),
+                  'topics': topics,
+                  'functions': functions,
+                  'dsub_jobs': len(self.dsub.submitted),
+                  'unwatched_writes': dict(self.storage.unwatched_writes),
+                  'skipped_sleep_seconds': round(self.clock.slept, 3),
+        }
+        unmatched = getattr(self.graph, 'unmatched', None)
+        if unmatched is not None:
+            report['unmatched_queries'] = sum(unmatched.values())
+        return report
+
+
+def format_report(report):
+    width = max([40] + [len(topic) for topic in report['topics']])
+    lines = [
+             f"Delivered {report['delivered']} messages in {report['elapsed_seconds']:.3f}s " +
+             f"({report['throughput']} messages/s).",
+             f"Uploaded {report['objects_offered']} objects over {report['simulated_seconds']:.3f} simulated seconds.",
+             f"Max queue depth: {report['max_queue_depth']}. Max hops: {report['max_hops']}. " +
+             f"Dsub jobs: {report['dsub_jobs']}.",
+             "",
+             f"{'topic':<{width}} {'published':>9} {'delivered':>9} {'undelivered':>11} {'max depth':>9}",
+    ]
+    for topic, stats in report['topics'].items():
+        lines.append(
+                     f"{topic:<{width}} {stats['published']:>9} {stats['delivered']:>9} " +
+                     f"{stats['undelivered']:>11} {stats['max_depth']:>9}")
+    lines.extend(["", f"{'function':<{width}} {'invocations':>11} {'errors':>6} {'seconds':>8}"])
+    for name, stats in report['functions'].items():
+        lines.append(f"{name:<{width}} {stats['invocations']:>11} {stats['errors']:>6} {stats['seconds']:>8.3f}")
+    lines.extend(["", "Hops: " + ", ".join(f"{hop}: {count}" for hop, count in report['hops'].items())])
+    if report.get('unmatched_queries'):
+        lines.append(f"Queries without a recorded result: {report['unmatched_queries']}.")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    delivery_generator.add_schedule_arguments(parser)
+    parser.add_argument('--storage-root', help="Directory used as GCS. Defaults to a temporary directory.")
+    parser.add_argument('--recording', help="Replay query results recorded with --record.")
+    parser.add_argument('--neo4j-url', help="Run queries on a local (test) Neo4j database.")
+    parser.add_argument('--neo4j-user', default='neo4j')
+    parser.add_argument('--neo4j-password', default='')
+    parser.add_argument('--record', help="Save query results from --neo4j-url to this file.")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON.")
+    parser.add_argument('--verbose', action='store_true', help="Show function output.")
+    args = parser.parse_args(argv)
+
+    if args.neo4j_url:
+        from py2neo import Graph
+        graph = Graph(args.neo4j_url, user=args.neo4j_user, password=args.neo4j_password)
+        if args.record:
+            graph = stand_ins.RecordingGraph(graph)
+    elif args.recording:
+        graph = stand_ins.RecordedGraph.load(args.recording)
+    else:
+        graph = stand_ins.RecordedGraph()
+
+    root = args.storage_root or tempfile.mkdtemp(prefix='trellis-simulator-')
+    simulator = PipelineSimulator(root, graph, quiet=not args.verbose)
+    simulator.offer(delivery_generator.schedule_from_arguments(args, simulator.delivery_bucket))
+    simulator.run()
+
+    report = simulator.report()
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print(format_report(report))
+
+    if args.neo4j_url and args.record:
+        graph.save(args.record)
+    return 1 if any(stats['errors'] for stats in report['functions'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
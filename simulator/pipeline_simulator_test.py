@@ -0,0 +1,121 @@
+import sys
+import pytest
+
+from datetime import datetime
+
+import stand_ins
+import pipeline_simulator
+import delivery_generator
+
+START = datetime(2021, 6, 1, 12, 0, 0)
+
+
+@pytest.fixture
+def cloud_modules():
+    """Restore google.cloud modules replaced by the stand-ins."""
+    names = ['google.cloud', 'google.cloud.storage', 'google.cloud.pubsub']
+    original = {name: sys.modules.get(name) for name in names}
+    yield
+    # Config modules imported with the stand-ins
+    for name in list(sys.modules):
+        if name.startswith('phase3') or name == 'database-triggers':
+            del sys.modules[name]
+    for name, module in original.items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+
+
+class TestTopicBus:
+
+    def test_hops_and_depth(self):
+        bus = stand_ins.TopicBus()
+        received = []
+
+        def forward(message_id, data, attributes):
+            received.append(data)
+            bus.publish('second', data + b'-forwarded')
+
+        bus.subscribe('first', 'forward', forward)
+        bus.subscribe('second', 'sink', lambda message_id, data, attributes: received.append(data))
+
+        bus.publish('first', b'a')
+        bus.publish('first', b'b')
+        bus.publish('unsubscribed', b'c')
+        while bus.queue:
+            bus.deliver_next()
+
+        assert received == [b'a', b'b', b'a-forwarded', b'b-forwarded']
+        assert bus.hops == {0: 2, 1: 2}
+        assert bus.max_depth == 2
+        assert bus.max_topic_depth['first'] == 2
+        assert bus.undelivered == {'unsubscribed': 1}
+
+
+class TestLocalStorage:
+
+    def test_finalize_events(self, tmp_path):
+        events = []
+        client = stand_ins.LocalStorageClient(str(tmp_path), on_finalize=events.append)
+        client.watched_buckets.add('watched')
+
+        client.write('gs://watched/plate/sample/sample.json', '{"sample": "SAMPLE1"}')
+        client.write('gs://other/log.txt', 'log')
+
+        assert [event['name'] for event in events] == ['plate/sample/sample.json']
+        assert events[0]['bucket'] == 'watched'
+        assert events[0]['size'] == '21'
+        assert client.unwatched_writes == {'other': 1}
+
+        blob = client.get_bucket('watched').get_blob('plate/sample/sample.json')
+        assert blob.download_as_string(start=2, end=7) == b'sample'
+        assert client.bucket('watched').get_blob('missing.json') is None
+
+
+class TestRecordedGraph:
+
+    def test_replay_by_query_shape(self):
+        recorded = 'MATCH (node:Blob {id: "blob-1"}) WHERE node.size > 10 RETURN node'
+        shape = stand_ins.normalize_query(recorded)
+        graph = stand_ins.RecordedGraph({shape: [{"data": [{"node": {"id": "blob-1"}}]}]})
+
+        query = 'MATCH (node:Blob {id: "blob-2"})\n WHERE node.size > 500 RETURN node'
+        assert graph.run(query).data() == [{"node": {"id": "blob-1"}}]
+        assert graph.run('MATCH (node:Job) RETURN node').data() == []
+        assert sum(graph.unmatched.values()) == 1
+
+
+class TestSimulatedDsub:
+
+    def test_outputs_written(self, tmp_path):
+        client = stand_ins.LocalStorageClient(str(tmp_path))
+        dsub = stand_ins.SimulatedDsub(client)
+        job_dict = {'user': 'trellis', 'outputs': {'BAM': 'gs://out/plate/sample/sample.bam'}}
+
+        result = dsub.submit(job_dict, 'fastq-to-ubam', {})
+
+        assert result['user-id'] == 'trellis'
+        assert client.bucket('out').get_blob('plate/sample/sample.bam').exists()
+
+
+class TestPipeline:
+
+    def test_plate_delivery(self, tmp_path, cloud_modules):
+        pytest.importorskip('py2neo')
+        pytest.importorskip('iso8601')
+
+        simulator = pipeline_simulator.PipelineSimulator(str(tmp_path), stand_ins.RecordedGraph())
+        objects = delivery_generator.generate_delivery(plates=1, samples=2, lanes=2)
+        simulator.offer(delivery_generator.burst_schedule(objects, simulator.delivery_bucket, 4, 60, START))
+        simulator.run()
+        report = simulator.report()
+
+        assert report['objects_offered'] == 12
+        assert report['functions']['create-blob-node']['invocations'] == 12
+        assert report['functions']['db-query']['invocations'] == 12
+        assert not any(stats['errors'] for stats in report['functions'].values())
+        assert report['hops'][0] == 12
+        assert report['simulated_seconds'] >= 120
+        assert report['max_hops'] >= 1
+        assert 'db-query' in pipeline_simulator.format_report(report)
@@ -0,0 +1,439 @@
+"""In-process stand-ins for the cloud services used by Trellis functions.
+
+The pipeline simulator installs these in place of the google.cloud.storage
+and google.cloud.pubsub modules, so each function's own initialization
+code runs unchanged, and replaces the Neo4j graph used by db-query and
+the dsub client used by launchers.
+
+    LocalStorageClient  GCS buckets stored as directories on local disk.
+    TopicBus            Pub/Sub topics delivered to functions in order.
+    BusSubscriber       Pull subscriptions to TopicBus topics.
+    RecordedGraph       Replays Neo4j results recorded by RecordingGraph.
+    SimulatedDsub       Accepts dsub jobs and writes their outputs.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import types
+import base64
+import hashlib
+import itertools
+
+from collections import deque, Counter, defaultdict
+from datetime import datetime, timezone
+
+from google.api_core import exceptions
+
+
+def _utc_timestamp():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class LocalBlob:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.storage_class = 'STANDARD'
+        self.content_type = None
+
+    @property
+    def _path(self):
+        return os.path.join(self.bucket._path, self.name)
+
+    @property
+    def size(self):
+        return os.path.getsize(self._path)
+
+    @property
+    def md5_hash(self):
+        with open(self._path, 'rb') as fh:
+            return base64.b64encode(hashlib.md5(fh.read()).digest()).decode()
+
+    def exists(self, client=None):
+        return os.path.isfile(self._path)
+
+    def _write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open(self._path, 'wb') as fh:
+            fh.write(data)
+
+    def upload_from_string(self, data, content_type=None, client=None):
+        self._write(data)
+        self.content_type = content_type or 'application/octet-stream'
+        self.bucket.client._object_finalized(self)
+
+    def download_as_string(self, client=None, start=None, end=None):
+        if not self.exists():
+            raise exceptions.NotFound(f"gs://{self.bucket.name}/{self.name}")
+        with open(self._path, 'rb') as fh:
+            if start is None:
+                return fh.read()
+            fh.seek(start)
+            if end is None:
+                return fh.read()
+            return fh.read(end - start + 1)
+
+    download_as_bytes = download_as_string
+
+    def delete(self, client=None):
+        if not self.exists():
+            raise exceptions.NotFound(f"gs://{self.bucket.name}/{self.name}")
+        os.remove(self._path)
+
+    def to_event(self):
+        """Format object metadata like a GCS finalize event."""
+        timestamp = _utc_timestamp()
+        return {
+                "bucket": self.bucket.name,
+                "name": self.name,
+                "id": f"{self.bucket.name}/{self.name}/1",
+                "size": str(self.size),
+                "md5Hash": self.md5_hash,
+                "contentType": self.content_type or 'application/octet-stream',
+                "storageClass": self.storage_class,
+                "generation": "1",
+                "metageneration": "1",
+                "timeCreated": timestamp,
+                "updated": timestamp,
+                "timeStorageClassUpdated": timestamp,
+                "kind": "storage#object",
+        }
+
+
+class LocalBucket:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    @property
+    def _path(self):
+        return os.path.join(self.client.root, self.name)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name, client=None):
+        blob = LocalBlob(self, name)
+        if blob.exists():
+            return blob
+        return None
+
+    def list_blobs(self, prefix=''):
+        blobs = []
+        for directory, _, filenames in os.walk(self._path):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(directory, filename), self._path)
+                if name.startswith(prefix):
+                    blobs.append(LocalBlob(self, name))
+        return sorted(blobs, key=lambda blob: blob.name)
+
+
+class LocalStorageClient:
+    """GCS client backed by a local directory with one folder per bucket.
+
+    Uploads to watched buckets call on_finalize with the object's
+    finalize event, like a storage-triggered Cloud Function.
+    """
+
+    def __init__(self, root, on_finalize=None):
+        self.root = root
+        self.on_finalize = on_finalize
+        self.watched_buckets = set()
+        self.unwatched_writes = Counter()
+
+    def bucket(self, name, user_project=None):
+        return LocalBucket(self, name)
+
+    def get_bucket(self, name):
+        bucket = LocalBucket(self, name)
+        if not os.path.isdir(bucket._path):
+            raise exceptions.NotFound(f"gs://{name}")
+        return bucket
+
+    def lookup_bucket(self, name):
+        try:
+            return self.get_bucket(name)
+        except exceptions.NotFound:
+            return None
+
+    def create_bucket(self, name):
+        os.makedirs(os.path.join(self.root, name), exist_ok=True)
+        return LocalBucket(self, name)
+
+    def write(self, uri, data):
+        """Write an object to a "gs://bucket/path" URI."""
+        bucket, path = uri[len('gs://'):].split('/', 1)
+        self.bucket(bucket).blob(path).upload_from_string(data)
+
+    def store(self, uri, data):
+        """Write an object without sending a finalize event."""
+        bucket, path = uri[len('gs://'):].split('/', 1)
+        self.bucket(bucket).blob(path)._write(data)
+
+    def _object_finalized(self, blob):
+        if self.on_finalize and blob.bucket.name in self.watched_buckets:
+            self.on_finalize(blob.to_event())
+        else:
+            self.unwatched_writes[blob.bucket.name] += 1
+
+
+class PublishResult:
+
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+    def result(self, timeout=None):
+        return self.message_id
+
+
+class BusPublisher:
+    """PublisherClient that publishes to a TopicBus."""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def topic_path(self, project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic_path, data, **attributes):
+        topic = topic_path.split('/')[-1]
+        return PublishResult(self.bus.publish(topic, data, attributes))
+
+
+class BusSubscriber:
+    """SubscriberClient for pull subscriptions attached to TopicBus topics."""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.subscriptions = defaultdict(deque)
+
+    def subscription_path(self, project, subscription):
+        return f"projects/{project}/subscriptions/{subscription}"
+
+    def attach(self, subscription, topic):
+        """Collect messages published to a topic for pulling."""
+        def collect(message_id, data, attributes):
+            message = types.SimpleNamespace(message_id=message_id, data=data, attributes=attributes)
+            self.subscriptions[subscription].append(types.SimpleNamespace(ack_id=message_id, message=message))
+        self.bus.subscribe(topic, f"subscription:{subscription}", collect)
+
+    def pull(self, subscription_path, max_messages, return_immediately=False):
+        messages = self.subscriptions[subscription_path.split('/')[-1]]
+        received = [messages.popleft() for _ in range(min(max_messages, len(messages)))]
+        return types.SimpleNamespace(received_messages=received)
+
+    def acknowledge(self, subscription_path, ack_ids):
+        pass
+
+
+class TopicBus:
+    """In-process Pub/Sub that delivers messages in publication order.
+
+    Storage events share the queue, as "storage:<bucket>" topics, so all
+    work is measured the same way. Each message records its hop count:
+    the number of function invocations between it and the input that
+    started it. Messages published outside of a delivery are hop 0.
+    """
+
+    def __init__(self):
+        self.subscribers = defaultdict(list)
+        self.queue = deque()
+        self._ids = itertools.count(1)
+        self._current_hop = None
+
+        self.published = Counter()
+        self.delivered = Counter()
+        self.undelivered = Counter()
+        self.max_depth = 0
+        self.max_topic_depth = Counter()
+        self._topic_depth = Counter()
+        self.hops = Counter()
+
+    def subscribe(self, topic, name, handler):
+        self.subscribers[topic].append((name, handler))
+
+    def publish(self, topic, data, attributes=None):
+        message_id = str(next(self._ids))
+        self.published[topic] += 1
+        if not self.subscribers.get(topic):
+            self.undelivered[topic] += 1
+            return message_id
+
+        hop = 0 if self._current_hop is None else self._current_hop + 1
+        for name, handler in self.subscribers[topic]:
+            self.queue.append((topic, name, handler, message_id, data, attributes or {}, hop))
+            self._topic_depth[topic] += 1
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self.max_topic_depth[topic] = max(self.max_topic_depth[topic], self._topic_depth[topic])
+        return message_id
+
+    def deliver_next(self):
+        """Deliver the oldest queued message.
+
+        Returns:
+            (tuple): Topic, subscriber name, message ID and hop count
+                     of the delivered message.
+        """
+        topic, name, handler, message_id, data, attributes, hop = self.queue.popleft()
+        self._topic_depth[topic] -= 1
+        self.delivered[topic] += 1
+        self.hops[hop] += 1
+
+        self._current_hop = hop
+        try:
+            handler(message_id, data, attributes)
+        finally:
+            self._current_hop = None
+        return topic, name, message_id, hop
+
+
+def normalize_query(query):
+    """Replace literal values so that queries with the same shape match."""
+    query = re.sub(r'"(?:[^"\\]|\\.)*"', '?', query)
+    query = re.sub(r"'(?:[^'\\]|\\.)*'", '?', query)
+    query = re.sub(r'\b\d+(?:\.\d+)?\b', '?', query)
+    return ' '.join(query.split())
+
+
+class RecordedCursor:
+
+    def __init__(self, data, stats):
+        self._data = data
+        self._stats = stats
+
+    def data(self):
+        return self._data
+
+    def stats(self):
+        return self._stats
+
+
+class RecordingGraph:
+    """Run queries on a Neo4j graph and record their results by query shape."""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.recordings = defaultdict(list)
+
+    def run(self, query, parameters=None):
+        cursor = self.graph.run(query, parameters)
+        data = cursor.data()
+        stats = dict(cursor.stats())
+        self.recordings[normalize_query(query)].append({"data": data, "stats": stats})
+        return RecordedCursor(data, stats)
+
+    def save(self, path):
+        with open(path, 'w') as fh:
+            json.dump(self.recordings, fh, indent=2, default=str)
+
+
+class RecordedGraph:
+    """Replay recorded Neo4j results for queries with a recorded shape.
+
+    Results are replayed in the order they were recorded, repeating the
+    last result once they run out. Queries that were never recorded
+    return no rows, which Trellis treats as "no matching nodes".
+    """
+
+    def __init__(self, recordings=None):
+        self.recordings = {shape: deque(results) for shape, results in (recordings or {}).items()}
+        self.queries = Counter()
+        self.unmatched = Counter()
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fh:
+            return cls(json.load(fh))
+
+    def run(self, query, parameters=None):
+        shape = normalize_query(query)
+        self.queries[shape] += 1
+
+        results = self.recordings.get(shape)
+        if not results:
+            self.unmatched[shape] += 1
+            return RecordedCursor([], {})
+        result = results.popleft() if len(results) > 1 else results[0]
+        return RecordedCursor(result['data'], result.get('stats', {}))
+
+
+class SimulatedDsub:
+    """Accept dsub submissions and write each job's outputs to storage.
+
+    Output objects are written when the job is submitted, so storage
+    triggers respond as if the job had completed immediately.
+    """
+
+    def __init__(self, storage_client, write_outputs=True):
+        self.storage_client = storage_client
+        self.write_outputs = write_outputs
+        self.submitted = []
+        self._ids = itertools.count(1)
+
+    def submit(self, job_dict, name, labels):
+        job_id = f"{name}--simulated--{next(self._ids)}"
+        self.submitted.append((job_dict, name, labels))
+        if self.write_outputs:
+            for uri in job_dict.get('outputs', {}).values():
+                self.storage_client.write(uri, f"Output of {job_id}.\n")
+        return {
+                'job-id': job_id,
+                'user-id': job_dict.get('user'),
+                'task-id': [],
+                'latency': 0.0,
+        }
+
+    def submit_all(self, submissions, max_workers=1):
+        return [self.submit(*submission) for submission in submissions]
+
+    def submit_as_completed(self, submissions, max_workers=1):
+        for index, submission in enumerate(submissions):
+            yield index, self.submit(*submission)
+
+
+class NoSleep:
+    """Proxy for the time module that records sleeps instead of waiting."""
+
+    def __init__(self):
+        self.slept = 0
+
+    def sleep(self, seconds):
+        self.slept += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def install_cloud_modules(storage_client, publisher, subscriber=None):
+    """Replace google.cloud.storage and google.cloud.pubsub with stand-ins.
+
+    Functions create their clients with storage.Client(),
+    pubsub.PublisherClient() and pubsub.SubscriberClient(), so each
+    returns the shared stand-in.
+    """
+    storage_module = types.ModuleType('google.cloud.storage')
+    storage_module.Client = lambda *args, **kwargs: storage_client
+
+    pubsub_module = types.ModuleType('google.cloud.pubsub')
+    pubsub_module.PublisherClient = lambda *args, **kwargs: publisher
+    pubsub_module.SubscriberClient = lambda *args, **kwargs: subscriber
+
+    import google
+    cloud = sys.modules.get('google.cloud')
+    if cloud is None:
+        cloud = types.ModuleType('google.cloud')
+        cloud.__path__ = []
+        sys.modules['google.cloud'] = cloud
+        google.cloud = cloud
+
+    cloud.storage = storage_module
+    cloud.pubsub = pubsub_module
+    sys.modules['google.cloud.storage'] = storage_module
+    sys.modules['google.cloud.pubsub'] = pubsub_module